@@ -0,0 +1,180 @@
+"""
+Benchmark of the numpy reader for multilayer EXR files (exr_reader)
+
+For each .exr file in a folder, it times:
+- reading the header
+- reading all the channels, with 1 thread and with n_threads threads
+- reading only the depth channel (Depth.Z)
+and reports the median time per file and the files read per second.
+
+If no folder is given, n_files synthetic multilayer EXR files (ZIP compression, 32-bit channels, with the Combined,
+Depth, IndexOB and Vector passes as saved by Blender) are written to a temporary dir with write_exr_file, and the
+channels read are compared to those written.
+
+Run from the terminal (no Blender required):
+    python benchmark_exr_reader.py --exr_dir <dir with renders>
+    python benchmark_exr_reader.py --n_files 10 --resolution 1800 900
+"""
+import argparse
+import glob
+import os
+import struct
+import tempfile
+import time
+import zlib
+import numpy as np
+
+import exr_reader
+
+
+def write_exr_file(filename,
+                   channels_dict,
+                   compression='ZIP'):
+    """
+    Write a single-part scanline EXR file (as the ones Blender saves), with NONE, ZIPS or ZIP compression
+
+    :param filename: path to the .exr file
+    :param channels_dict: dict with an array of shape (n_rows, n_cols) per channel name (float32, float16 or uint32)
+    :param compression: 'NONE', 'ZIPS' or 'ZIP'
+    """
+    list_names = sorted(channels_dict.keys())
+    n_rows, n_cols = channels_dict[list_names[0]].shape
+    pixel_type_per_dtype = {np.dtype('uint32'): 0, np.dtype('float16'): 1, np.dtype('float32'): 2}
+    compression_id = exr_reader.EXR_COMPRESSION_NAMES.index(compression)
+    n_lines_per_block = exr_reader.EXR_COMPRESSION_PER_ID[compression_id][1]
+
+    def attribute(name, type_str, value_bytes):
+        return name.encode() + b'\x00' + type_str.encode() + b'\x00' + struct.pack('<i', len(value_bytes)) + value_bytes
+
+    channels_bytes = b''.join(n.encode() + b'\x00' + struct.pack('<iB3x2i', pixel_type_per_dtype[channels_dict[n].dtype], 0, 1, 1)
+                              for n in list_names) + b'\x00'
+    header_bytes = struct.pack('<iI', exr_reader.EXR_MAGIC_NUMBER, 2) + \
+        attribute('channels', 'chlist', channels_bytes) + \
+        attribute('compression', 'compression', bytes([compression_id])) + \
+        attribute('dataWindow', 'box2i', struct.pack('<4i', 0, 0, n_cols - 1, n_rows - 1)) + \
+        attribute('displayWindow', 'box2i', struct.pack('<4i', 0, 0, n_cols - 1, n_rows - 1)) + \
+        attribute('lineOrder', 'lineOrder', bytes([0])) + \
+        attribute('pixelAspectRatio', 'float', struct.pack('<f', 1)) + \
+        attribute('screenWindowCenter', 'v2f', struct.pack('<2f', 0, 0)) + \
+        attribute('screenWindowWidth', 'float', struct.pack('<f', 1)) + b'\x00'
+
+    list_blocks = []
+    for y in range(0, n_rows, n_lines_per_block):
+        # per scanline, the pixels of each channel in turn
+        block_bytes = b''.join(channels_dict[n][row].astype(channels_dict[n].dtype.newbyteorder('<')).tobytes()
+                               for row in range(y, min(y + n_lines_per_block, n_rows)) for n in list_names)
+        if compression != 'NONE':
+            raw = np.frombuffer(block_bytes, dtype=np.uint8)
+            reordered = np.concatenate((raw[0::2], raw[1::2]))
+            deltas = reordered.copy()
+            deltas[1:] = reordered[1:] - reordered[:-1] + 128
+            compressed_bytes = zlib.compress(deltas.tobytes())
+            if len(compressed_bytes) < len(block_bytes):
+                block_bytes = compressed_bytes
+        list_blocks.append(struct.pack('<2i', y, len(block_bytes)) + block_bytes)
+
+    offset = len(header_bytes) + 8 * len(list_blocks)
+    block_offsets = []
+    for block in list_blocks:
+        block_offsets.append(offset)
+        offset += len(block)
+    with open(filename, 'wb') as f:
+        f.write(header_bytes)
+        f.write(np.array(block_offsets, dtype='<u8').tobytes())
+        for block in list_blocks:
+            f.write(block)
+
+
+def get_synthetic_render_channels(n_rows,
+                                  n_cols,
+                                  seed=0):
+    """
+    Get channels like those in Blender's multilayer renders: smooth depth with a few objects, their index,
+    a smooth flow and a noisy image
+    """
+    rng = np.random.default_rng(seed)
+    row_grid, col_grid = np.meshgrid(np.linspace(-1, 1, n_rows), np.linspace(-1, 1, n_cols), indexing='ij')
+    depth = 3 + np.cos(3 * col_grid) + row_grid
+    index = np.zeros((n_rows, n_cols), dtype=np.float32)
+    for k in range(1, 7):
+        centre = rng.uniform(-1, 1, 2)
+        flag_object = np.hypot(row_grid - centre[0], 4 * (col_grid - centre[1])) < 0.3
+        depth[flag_object] = np.minimum(depth[flag_object], 1 + k * 0.2)
+        index[flag_object] = k
+    channels_dict = {'ViewLayer.Depth.Z': depth.astype(np.float32),
+                     'ViewLayer.IndexOB.X': index}
+    for c, flow in zip('XYZW', [np.sin(col_grid), np.cos(row_grid), -np.sin(col_grid), -np.cos(row_grid)]):
+        channels_dict['ViewLayer.Vector.' + c] = flow.astype(np.float32)
+    for c in 'RGB':
+        channels_dict['ViewLayer.Combined.' + c] = (index / 6 + 0.05 * rng.random((n_rows, n_cols))).astype(np.float32)
+    channels_dict['ViewLayer.Combined.A'] = np.ones((n_rows, n_cols), dtype=np.float32)
+    return channels_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the numpy reader for multilayer EXR files')
+    parser.add_argument('--exr_dir', default=None,
+                        help='Dir with .exr files; if not given, synthetic files are written to a temporary dir')
+    parser.add_argument('--n_files', type=int, default=10,
+                        help='Number of synthetic files')
+    parser.add_argument('--resolution', type=int, nargs=2, default=[1800, 900],
+                        help='Resolution (x, y) of the synthetic files')
+    parser.add_argument('--n_threads', type=int, default=os.cpu_count() or 1,
+                        help='Number of threads decoding the blocks of each file')
+    args = parser.parse_args()
+
+    ### Files
+    list_written_channels_dicts = []
+    if args.exr_dir:
+        list_exr_paths = sorted(glob.glob(os.path.join(args.exr_dir, '*.exr')))
+    else:
+        exr_dir = tempfile.mkdtemp(prefix='benchmark_exr_reader_')
+        list_exr_paths = []
+        for i in range(args.n_files):
+            channels_dict = get_synthetic_render_channels(args.resolution[1], args.resolution[0], seed=i)
+            list_exr_paths.append(os.path.join(exr_dir, '{:04d}.exr'.format(i)))
+            write_exr_file(list_exr_paths[-1], channels_dict)
+            list_written_channels_dicts.append(channels_dict)
+    if not list_exr_paths:
+        print('No .exr files found')
+        return
+    header_dict = exr_reader.read_exr_header(list_exr_paths[0])
+    print('{} files of {}x{} pixels, {} compression, {:.1f} MB per file on average, channels: {}'
+          .format(len(list_exr_paths),
+                  header_dict['image_shape'][1],
+                  header_dict['image_shape'][0],
+                  header_dict['compression'],
+                  np.mean([os.path.getsize(p) for p in list_exr_paths]) / 1e6,
+                  [c['name'] for c in header_dict['channels']]))
+
+    ### Read
+    dict_times_in_s = {'header': [], 'all channels (1 thread)': [],
+                       'all channels ({} threads)'.format(args.n_threads): [], 'Depth.Z only': []}
+    flag_match = True
+    for i, exr_path in enumerate(list_exr_paths):
+        t0 = time.perf_counter()
+        exr_reader.read_exr_header(exr_path)
+        dict_times_in_s['header'].append(time.perf_counter() - t0)
+        for key, n_threads in [('all channels (1 thread)', 1),
+                               ('all channels ({} threads)'.format(args.n_threads), args.n_threads)]:
+            t0 = time.perf_counter()
+            channels_dict = exr_reader.read_exr_channels(exr_path, n_threads=n_threads)
+            dict_times_in_s[key].append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        depth_dict = exr_reader.read_exr_channels(exr_path, ['Depth.Z'], n_threads=args.n_threads)
+        dict_times_in_s['Depth.Z only'].append(time.perf_counter() - t0)
+
+        if list_written_channels_dicts:
+            flag_match &= all(np.array_equal(v, channels_dict[k]) for k, v in list_written_channels_dicts[i].items())
+            flag_match &= np.array_equal(list(depth_dict.values())[0], list_written_channels_dicts[i]['ViewLayer.Depth.Z'])
+
+    for key, list_times_in_s in dict_times_in_s.items():
+        print('{}: {:.4f} s per file, {:.1f} files per second'.format(key,
+                                                                      np.median(list_times_in_s),
+                                                                      1 / np.median(list_times_in_s)))
+    if list_written_channels_dicts:
+        print('Channels read match those written: {}'.format(flag_match))
+
+
+if __name__ == '__main__':
+    main()
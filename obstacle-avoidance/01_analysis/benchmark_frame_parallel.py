@@ -0,0 +1,92 @@
+"""
+Benchmark of the frame-parallel computation of the software passes (frame_parallel)
+
+It renders the depth and object index maps (and optionally the optic flow) of the first n_frames frames of the trial
+in the input json file, with each number of worker processes in --n_workers, and reports the frames per second and
+the speedup relative to the first number of workers. The outputs of every run are checked against those of the
+first one.
+
+Run from the terminal (no Blender required):
+    python benchmark_frame_parallel.py ../00_data/config_input_files/201124_Drogon16_eyesRF.json --n_workers 1 2 4 8
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+
+import config
+import load_data
+import camera_poses
+import frame_parallel
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the frame-parallel computation of the software passes')
+    parser.add_argument('input_json_path',
+                        help='Path to input json file (as for main.py)')
+    parser.add_argument('--n_frames', type=int, default=64,
+                        help='Number of frames to render (from the start of the animation)')
+    parser.add_argument('--n_workers', type=int, nargs='+', default=[1, os.cpu_count() or 1],
+                        help='Numbers of worker processes to compare')
+    parser.add_argument('--n_frames_per_chunk', type=int, default=8,
+                        help='Number of consecutive frames per chunk')
+    parser.add_argument('--optic_flow', action='store_true',
+                        help='If present, the optic flow is computed too')
+    parser.add_argument('--output_dir', default=None,
+                        help='Dir for the output .npy files (default: a temporary dir)')
+    args = parser.parse_args()
+
+    ### Load data and compute camera poses
+    input_config = config.config(args.input_json_path)
+    data_cache_folder_path = input_config.data_cache_folder_path if input_config.flag_use_data_cache else None
+    geometry_dict = load_data.load_csv_with_cache(load_data.csv_to_dict_keys_per_row,
+                                                  input_config.geometry_csv_path_to_file,
+                                                  [input_config.geometry_csv_n_header_rows_to_skip,
+                                                   input_config.geometry_csv_idx_col_start_data],
+                                                  data_cache_folder_path)
+    transforms_dict = load_data.csv_transforms_concatenated_to_dict(input_config)
+    camera_poses_dict = camera_poses.compute_camera_poses(transforms_dict,
+                                                          input_config)
+    camera_poses_dict = {k: v[:args.n_frames] for k, v in camera_poses_dict.items()}
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='benchmark_frame_parallel_')
+
+    ### Render with each number of workers
+    print('Rendering {} frames of {}x{} pixels ({} cores)'.format(len(camera_poses_dict['frame']),
+                                                                  *input_config.render_resolution_x_y_in_pixels,
+                                                                  os.cpu_count()))
+    list_frames_per_s = []
+    reference_outputs_dict = None
+    for n_workers in args.n_workers:
+        t0 = time.perf_counter()
+        output_arrays_dict = frame_parallel.render_frames_in_parallel(
+            geometry_dict,
+            camera_poses_dict,
+            input_config,
+            os.path.join(output_dir, '{}_workers'.format(n_workers)),
+            n_workers=n_workers,
+            n_frames_per_chunk=args.n_frames_per_chunk,
+            flag_optic_flow=args.optic_flow,
+            ray_table_cache_folder_path=input_config.ray_table_cache_folder_path if input_config.flag_use_data_cache else None,
+            data_cache_folder_path=data_cache_folder_path,
+            flag_verbose=False)
+        time_in_s = time.perf_counter() - t0
+        list_frames_per_s.append(len(camera_poses_dict['frame']) / time_in_s)
+
+        # check the outputs are the same as with the first number of workers
+        if reference_outputs_dict is None:
+            reference_outputs_dict = output_arrays_dict
+            flag_same_outputs = True
+        else:
+            flag_same_outputs = all(np.array_equal(output_arrays_dict[k], reference_outputs_dict[k], equal_nan=True)
+                                    for k in frame_parallel.OUTPUT_FILE_STR_PER_PASS if k in output_arrays_dict)
+        print('{} worker(s): {:.2f} s, {:.2f} frames per second, speedup {:.2f}x (outputs {})'
+              .format(n_workers,
+                      time_in_s,
+                      list_frames_per_s[-1],
+                      list_frames_per_s[-1] / list_frames_per_s[0],
+                      'match' if flag_same_outputs else 'DO NOT MATCH'))
+
+
+if __name__ == '__main__':
+    main()
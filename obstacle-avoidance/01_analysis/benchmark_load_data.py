@@ -0,0 +1,118 @@
+"""
+Benchmark of the csv loaders for the transforms data in load_data
+
+It writes a synthetic transforms csv (same header as the transforms exports, with NaN dropouts) and
+compares the time to parse it with:
+- load_data.csv_to_dict_keys_per_col (per-cell parsing with csv.reader)
+- load_data.csv_to_dict_keys_per_col_bulk (bulk parsing with numpy)
+
+It also checks that both loaders return the same dict.
+
+Run from the terminal (no Blender required):
+    python benchmark_load_data.py --n_rows 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+import load_data
+
+
+def write_synthetic_transforms_csv(filename,
+                                   n_rows,
+                                   frame_start=427,
+                                   seed=0):
+    """
+    Write a csv with the same layout as the transforms export (one metadata row, one row of keys and one row per frame)
+
+    - translations in mm and unit quaternions, as float with 15 decimals
+    - ~5% of the rows have 'NaN' in the non-interpolated fields (as in marker dropouts)
+    (no empty cells, since csv_to_dict_keys_per_col cannot parse them)
+
+    :param filename: path to output csv file
+    :param n_rows: number of data rows (frames)
+    :param frame_start: first frame
+    :param seed: seed for the random generator
+    :return:
+    """
+    rng = np.random.default_rng(seed)
+    list_of_keys = ['frame', 'frames_from_the_start',
+                    'transform_t_X', 'transform_t_Y', 'transform_t_Z',
+                    'transform_t_interp_X', 'transform_t_interp_Y', 'transform_t_interp_Z',
+                    'transform_q_W', 'transform_q_X', 'transform_q_Y', 'transform_q_Z',
+                    'transform_q_interp_W', 'transform_q_interp_X', 'transform_q_interp_Y', 'transform_q_interp_Z']
+
+    n_rows_per_chunk = 100000
+    with open(filename, 'w') as f:
+        f.write('Birds_flights_indiv_labels_synthetic.mat\n')
+        f.write(','.join(list_of_keys) + '\n')
+        for chunk_start in range(0, n_rows, n_rows_per_chunk):
+            n = min(n_rows_per_chunk, n_rows - chunk_start)
+            frames = np.arange(chunk_start, chunk_start + n)
+            t = rng.normal(0, 1000, size=(n, 3))
+            q = rng.normal(size=(n, 4))
+            q /= np.linalg.norm(q, axis=1, keepdims=True)
+            values_str = np.char.mod('%.15g', np.concatenate((t, t, q, q), axis=1)).astype(object)
+
+            # dropouts in non-interp fields
+            mask_nan = rng.random(n) < 0.05
+            values_str[mask_nan, 0:3] = 'NaN'
+            values_str[mask_nan, 6:10] = 'NaN'
+
+            for i in range(n):
+                f.write('{},{},'.format(frames[i] + frame_start, frames[i]) + ','.join(values_str[i]) + '\n')
+
+
+def check_dicts_are_equal(dict_a,
+                          dict_b):
+    """
+    Check two transforms dicts have the same keys, dtypes kinds and values (nan compared as equal)
+    """
+    if list(dict_a.keys()) != list(dict_b.keys()):
+        return False
+    for k in dict_a.keys():
+        if dict_a[k].dtype.kind != dict_b[k].dtype.kind:
+            return False
+        if not np.array_equal(dict_a[k], dict_b[k], equal_nan=(dict_a[k].dtype.kind == 'f')):
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the csv loaders for the transforms data')
+    parser.add_argument('--n_rows', type=int, default=1000000,
+                        help='Number of rows in the synthetic transforms csv')
+    parser.add_argument('--n_repeats', type=int, default=1,
+                        help='Number of repetitions per loader (the minimum time is reported)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'synthetic_transforms_export.csv')
+        print('Writing synthetic csv with {} rows...'.format(args.n_rows))
+        write_synthetic_transforms_csv(csv_path, args.n_rows)
+        print('File size: {:.1f} MB'.format(os.path.getsize(csv_path) / 1e6))
+
+        dict_results = dict()
+        for loader in [load_data.csv_to_dict_keys_per_col,
+                       load_data.csv_to_dict_keys_per_col_bulk]:
+            list_times = []
+            for _ in range(args.n_repeats):
+                t0 = time.perf_counter()
+                dict_results[loader.__name__] = loader(csv_path, 1)
+                list_times.append(time.perf_counter() - t0)
+            print('{}: {:.2f} s'.format(loader.__name__, min(list_times)))
+            dict_results[loader.__name__ + '_time'] = min(list_times)
+
+    print('Speedup: {:.1f}x'.format(dict_results['csv_to_dict_keys_per_col_time']
+                                    / dict_results['csv_to_dict_keys_per_col_bulk_time']))
+    if not check_dicts_are_equal(dict_results['csv_to_dict_keys_per_col'],
+                                 dict_results['csv_to_dict_keys_per_col_bulk']):
+        sys.exit('ERROR: the output of the two loaders is different')
+    print('Output of both loaders is identical')
+
+
+if __name__ == '__main__':
+    main()
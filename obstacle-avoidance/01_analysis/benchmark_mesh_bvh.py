@@ -0,0 +1,205 @@
+"""
+Benchmark of the BVH for meshes in the numpy ray caster (mesh_bvh)
+
+It renders the depth and object index maps of a triangle mesh from camera poses inside it, with the camera in the
+input json file (projection and resolution), and reports:
+- the time to read the mesh and build its BVH, and to load it from the cache
+- the time per frame and frames per second
+- (with --check) the max depth error over a sample of rays, compared to intersecting them with all the triangles
+
+If no mesh file is given, a synthetic SLAM-like mesh is generated (a noisy room with pillars, with about n_triangles
+triangles) and saved as a binary .ply file in the output dir.
+
+Run from the terminal (no Blender required):
+    python benchmark_mesh_bvh.py ../00_data/config_input_files/201124_Drogon16_eyesRF.json --n_triangles 500000 --check
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+
+import config
+import load_data
+import mesh_bvh
+import ray_tables
+import raycast_renderer
+
+
+def get_synthetic_room_mesh(n_triangles,
+                            room_size_in_m=(4.0, 3.0, 2.5),
+                            noise_in_m=0.005,
+                            seed=0):
+    """
+    Get a noisy room-like mesh (as captured with SLAM): the 6 sides of a box, and 4 pillars inside it,
+    as regular grids of triangles with noise added to the vertices
+
+    :param n_triangles: approximate number of triangles
+    :param room_size_in_m: room size in x, y, z (the room goes from (0, 0, 0) to room_size_in_m)
+    :param noise_in_m: std of the noise added to the vertices
+    :param seed: seed for the noise
+    :return: vertices_array (n_vertices, 3), faces_array (n_triangles, 3)
+    """
+    room_size = np.array(room_size_in_m)
+    list_boxes = [(np.zeros(3), room_size)]
+    for x, y in [(0.25, 0.25), (0.25, 0.75), (0.75, 0.25), (0.75, 0.75)]:
+        pillar_centre = np.array([x, y, 0]) * room_size
+        list_boxes.append((pillar_centre - [0.15, 0.15, 0], pillar_centre + [0.15, 0.15, room_size[2]]))
+    total_area = sum(2 * ((b[1] - b[0])[0] * (b[1] - b[0])[1] + (b[1] - b[0])[1] * (b[1] - b[0])[2]
+                          + (b[1] - b[0])[0] * (b[1] - b[0])[2]) for b in list_boxes)
+    quad_size = np.sqrt(2 * total_area / n_triangles)
+
+    rng = np.random.default_rng(seed)
+    list_vertices = []
+    list_faces = []
+    n_vertices = 0
+    for box_min, box_max in list_boxes:
+        for axis in range(3):
+            for side in [box_min, box_max]:
+                # grid on the side of the box perpendicular to axis
+                axis_u, axis_v = [a for a in range(3) if a != axis]
+                n_u = max(int(np.ceil((box_max[axis_u] - box_min[axis_u]) / quad_size)), 1)
+                n_v = max(int(np.ceil((box_max[axis_v] - box_min[axis_v]) / quad_size)), 1)
+                grid_u, grid_v = np.meshgrid(np.linspace(box_min[axis_u], box_max[axis_u], n_u + 1),
+                                             np.linspace(box_min[axis_v], box_max[axis_v], n_v + 1), indexing='ij')
+                vertices = np.zeros((n_u + 1, n_v + 1, 3))
+                vertices[..., axis] = side[axis]
+                vertices[..., axis_u] = grid_u
+                vertices[..., axis_v] = grid_v
+                list_vertices.append(vertices.reshape(-1, 3) + rng.normal(0, noise_in_m, ((n_u + 1) * (n_v + 1), 3)))
+                idx = np.arange((n_u + 1) * (n_v + 1)).reshape(n_u + 1, n_v + 1) + n_vertices
+                quads = np.stack((idx[:-1, :-1], idx[1:, :-1], idx[1:, 1:], idx[:-1, 1:]), axis=-1).reshape(-1, 4)
+                list_faces += [quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]]
+                n_vertices += (n_u + 1) * (n_v + 1)
+    return np.concatenate(list_vertices), np.concatenate(list_faces)
+
+
+def save_ply_file(filename,
+                  vertices_array,
+                  faces_array):
+    """
+    Save a triangle mesh as a binary (little endian) .ply file
+    """
+    header_str = '\n'.join(['ply',
+                            'format binary_little_endian 1.0',
+                            'element vertex {}'.format(len(vertices_array)),
+                            'property float x', 'property float y', 'property float z',
+                            'element face {}'.format(len(faces_array)),
+                            'property list uchar int vertex_indices',
+                            'end_header']) + '\n'
+    faces_data = np.zeros(len(faces_array), dtype=[('n', 'u1'), ('idx', '<i4', (3,))])
+    faces_data['n'] = 3
+    faces_data['idx'] = faces_array
+    with open(filename, 'wb') as f:
+        f.write(header_str.encode('ascii'))
+        f.write(vertices_array.astype('<f4').tobytes())
+        f.write(faces_data.tobytes())
+
+
+def get_depth_of_rays_brute_force(bvh_dict,
+                                  camera_location,
+                                  ray_directions,
+                                  n_leaves_per_chunk=4096):
+    """
+    Get the distance to the closest hit of each ray, intersecting it with all the triangles of the BVH leaves
+
+    :param ray_directions: array of shape (3, n_rays) (world RF)
+    :return: depth array of shape (n_rays,) (inf for no hit)
+    """
+    n_leaves = len(bvh_dict['V0'])
+    ray_directions_packets = ray_directions[:, None, :].astype(np.float32)
+    depth_array = np.full(ray_directions.shape[1], np.inf, dtype=np.float32)
+    for i0 in range(0, n_leaves, n_leaves_per_chunk):
+        leaf_idcs = np.arange(i0, min(i0 + n_leaves_per_chunk, n_leaves))
+        t_array = mesh_bvh.intersect_ray_packets_with_leaves(bvh_dict,
+                                                             camera_location,
+                                                             ray_directions_packets,
+                                                             np.zeros(len(leaf_idcs), dtype=np.int64),
+                                                             leaf_idcs)
+        depth_array = np.minimum(depth_array, t_array.min(axis=0))
+    return depth_array
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the BVH for meshes in the numpy ray caster')
+    parser.add_argument('input_json_path',
+                        help='Path to input json file (for the camera params)')
+    parser.add_argument('--mesh_path', default=None,
+                        help='Path to mesh file (.obj or .ply); if not given, a synthetic room mesh is generated')
+    parser.add_argument('--n_triangles', type=int, default=500000,
+                        help='Approximate number of triangles of the synthetic mesh')
+    parser.add_argument('--n_frames', type=int, default=10,
+                        help='Number of frames to render')
+    parser.add_argument('--check', action='store_true',
+                        help='Compare the depth of a sample of rays per frame to intersecting them with all triangles')
+    parser.add_argument('--render_resolution_percentage', type=float, default=None,
+                        help='If given, overrides the resolution percentage in the input json (e.g. 25 for previews)')
+    parser.add_argument('--output_dir', default=None,
+                        help='Dir for the synthetic mesh and the BVH cache (default: a temporary dir)')
+    args = parser.parse_args()
+
+    input_config = config.config(args.input_json_path)
+    if args.render_resolution_percentage is not None:
+        input_config.render_resolution_percentage = args.render_resolution_percentage
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='benchmark_mesh_bvh_')
+    os.makedirs(output_dir, exist_ok=True)
+    cache_folder_path = os.path.join(output_dir, '_cache')
+
+    ### Mesh
+    if args.mesh_path:
+        mesh_path = args.mesh_path
+    else:
+        vertices_array, faces_array = get_synthetic_room_mesh(args.n_triangles)
+        mesh_path = os.path.join(output_dir, 'synthetic_room_{}.ply'.format(len(faces_array)))
+        save_ply_file(mesh_path, vertices_array, faces_array)
+    loader_args = [input_config.mesh_bvh_n_triangles_per_leaf, input_config.mesh_vertices_to_m]
+
+    t0 = time.perf_counter()
+    bvh_dict = load_data.load_csv_with_cache(mesh_bvh.mesh_file_to_bvh_dict, mesh_path, loader_args, cache_folder_path)
+    time_build_in_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    bvh_dict = load_data.load_csv_with_cache(mesh_bvh.mesh_file_to_bvh_dict, mesh_path, loader_args, cache_folder_path)
+    time_cached_in_s = time.perf_counter() - t0
+    n_triangles = int(np.sum(np.asarray(bvh_dict['triangle_index']) >= 0))
+    print('Mesh: {} ({} triangles, {} leaves)'.format(mesh_path, n_triangles, len(bvh_dict['V0'])))
+    print('Read mesh and build BVH: {:.2f} s; load BVH from cache: {:.3f} s'.format(time_build_in_s, time_cached_in_s))
+
+    ### Camera poses: random locations inside the bounding box of the mesh (away from its sides), random orientations
+    rng = np.random.default_rng(1)
+    box_min, box_max = np.asarray(bvh_dict['node_min'][0]), np.asarray(bvh_dict['node_max'][0])
+    list_locations = box_min + (box_max - box_min) * rng.uniform(0.1, 0.9, (args.n_frames, 3))
+    list_quats = rng.normal(size=(args.n_frames, 4))
+    list_quats /= np.linalg.norm(list_quats, axis=1, keepdims=True)
+    list_meshes = [{'name': 'mesh', 'pass_index': 1, 'bvh': bvh_dict}]
+
+    ray_table = ray_tables.get_ray_table(input_config)
+    list_ray_packets_dicts = raycast_renderer.get_ray_tiles_hierarchy(ray_table,
+                                                                      input_config.mesh_ray_packet_size_in_pixels,
+                                                                      input_config.mesh_ray_packet_n_levels)
+    print('Rendering {} frames of {}x{} pixels...'.format(args.n_frames, ray_table.shape[1], ray_table.shape[0]))
+    list_times_in_s = []
+    list_max_errors = []
+    for location, quat in zip(list_locations, list_quats):
+        t0 = time.perf_counter()
+        depth_array, object_index_array = raycast_renderer.render_depth_and_object_index_of_meshes(location,
+                                                                                                   quat,
+                                                                                                   list_ray_packets_dicts,
+                                                                                                   list_meshes,
+                                                                                                   input_config.camera_clip_start_end_in_m)
+        list_times_in_s.append(time.perf_counter() - t0)
+
+        if args.check:
+            idx_pixels = rng.choice(ray_table.shape[0] * ray_table.shape[1], 2000, replace=False)
+            ray_directions = ray_tables.get_ray_directions_in_worldRF(ray_table, quat).reshape(-1, 3)[idx_pixels].T
+            depth_brute_force = get_depth_of_rays_brute_force(bvh_dict, location, ray_directions)
+            depth_brute_force[np.isinf(depth_brute_force)] = raycast_renderer.BACKGROUND_DEPTH
+            list_max_errors.append(np.max(np.abs(depth_array.ravel()[idx_pixels] - depth_brute_force)))
+
+    print('mesh_bvh: {:.3f} s per frame (first frame: {:.3f} s), {:.2f} frames per second'
+          .format(np.median(list_times_in_s), list_times_in_s[0], 1 / np.median(list_times_in_s)))
+    if args.check:
+        print('Max depth error vs all triangles (2000 rays per frame): {:.2e} m'.format(max(list_max_errors)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Benchmark of the numpy ray caster for the depth and object index passes (raycast_renderer)
+
+It loads the geometry and transforms data for an input json file (as main.py), computes the camera poses and renders
+the depth and object index maps for the first N frames of the animation with raycast_renderer.
+
+The frames per second are compared to those of Cycles, if one or more logs of Blender rendering the same
+trial are given (e.g. the logs saved by run_rendering.py). The render time per frame in Cycles is read from the
+'Time: mm:ss.ss (Saving: mm:ss.ss)' line that Blender prints after saving each frame.
+
+Run from the terminal (no Blender required):
+    python benchmark_raycast_renderer.py ../00_data/config_input_files/201124_Drogon16_eyesRF.json --n_frames 20
+    --blender_logs ../02_output/LOG_batch_rendering_<timestamp>/LOG_201124_Drogon16_eyesRF.txt
+"""
+import argparse
+import os
+import re
+import time
+import numpy as np
+
+import config
+import load_data
+import camera_poses
+import raycast_renderer
+
+# Blender prints this line after saving each frame, e.g.: ' Time: 00:01.58 (Saving: 00:00.05)' (or hh:mm:ss.ss)
+BLENDER_TIME_LINE_REGEXP = re.compile(r'^\s*Time: (?:(?P<h>\d+):)?(?P<m>\d+):(?P<s>\d+(?:\.\d+)?) \(Saving')
+
+
+def get_render_times_from_blender_logs(list_log_paths):
+    """
+    Get the render time of every frame in a list of Blender logs
+
+    :param list_log_paths: list of paths to Blender logs
+    :return: list of render times in s
+    """
+    list_times_in_s = []
+    for log_path in list_log_paths:
+        with open(log_path) as f:
+            for line in f:
+                match = BLENDER_TIME_LINE_REGEXP.match(line)
+                if match:
+                    list_times_in_s.append(3600 * int(match.group('h') or 0)
+                                           + 60 * int(match.group('m'))
+                                           + float(match.group('s')))
+    return list_times_in_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the numpy ray caster for the depth and object index passes')
+    parser.add_argument('input_json_path',
+                        help='Path to input json file (as for main.py)')
+    parser.add_argument('--n_frames', type=int, default=20,
+                        help='Number of frames to render (from the start of the animation)')
+    parser.add_argument('--tile_size_in_pixels', type=int, default=32,
+                        help='Number of pixels per side of the tiles of rays')
+    parser.add_argument('--blender_logs', nargs='*', default=[],
+                        help='Logs of Blender rendering the same trial, to compare to Cycles')
+    parser.add_argument('--output_dir', default=None,
+                        help='If given, the depth and object index maps are saved as one npz file per frame in this dir')
+    args = parser.parse_args()
+
+    ### Load data and compute camera poses
+    input_config = config.config(args.input_json_path)
+    geometry_dict = load_data.load_csv_with_cache(load_data.csv_to_dict_keys_per_row,
+                                                  input_config.geometry_csv_path_to_file,
+                                                  [input_config.geometry_csv_n_header_rows_to_skip,
+                                                   input_config.geometry_csv_idx_col_start_data],
+                                                  input_config.data_cache_folder_path if input_config.flag_use_data_cache else None)
+    transforms_dict = load_data.csv_transforms_concatenated_to_dict(input_config)
+    camera_poses_dict = camera_poses.compute_camera_poses(transforms_dict,
+                                                          input_config)
+    camera_poses_dict = {k: v[:args.n_frames] for k, v in camera_poses_dict.items()}
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    ### Render
+    print('Rendering {} frames of {}x{} pixels...'.format(len(camera_poses_dict['frame']),
+                                                         *input_config.render_resolution_x_y_in_pixels))
+    t0 = time.perf_counter()
+    list_times_in_s = []
+    for frame, depth_array, object_index_array in raycast_renderer.render_frames(geometry_dict,
+                                                                                 camera_poses_dict,
+                                                                                 input_config,
+                                                                                 args.tile_size_in_pixels,
+                                                                                 input_config.ray_table_cache_folder_path
+                                                                                 if input_config.flag_use_data_cache else None):
+        list_times_in_s.append(time.perf_counter() - t0)
+        if args.output_dir:
+            np.savez_compressed(os.path.join(args.output_dir, '{:04d}.npz'.format(frame)),
+                                depth=depth_array,
+                                object_index=object_index_array)
+        t0 = time.perf_counter()
+
+    # (the first frame includes getting the ray table and computing the tiles)
+    print('raycast_renderer: {:.3f} s per frame (first frame: {:.3f} s), {:.2f} frames per second'
+          .format(np.median(list_times_in_s), list_times_in_s[0], 1 / np.median(list_times_in_s)))
+
+    ### Compare to Cycles
+    if args.blender_logs:
+        list_cycles_times_in_s = get_render_times_from_blender_logs(args.blender_logs)
+        if not list_cycles_times_in_s:
+            print('No render times found in the Blender logs')
+            return
+        print('Cycles: {:.3f} s per frame ({} frames), {:.2f} frames per second'
+              .format(np.median(list_cycles_times_in_s),
+                      len(list_cycles_times_in_s),
+                      1 / np.median(list_cycles_times_in_s)))
+        print('Speedup: {:.1f}x'.format(np.median(list_cycles_times_in_s) / np.median(list_times_in_s)))
+
+
+if __name__ == '__main__':
+    main()
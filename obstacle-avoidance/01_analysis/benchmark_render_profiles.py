@@ -0,0 +1,108 @@
+"""
+Benchmark of the render profiles (see config.DICT_RENDER_PROFILES)
+
+Renders the same frames of a trial with each render profile (one Blender process per profile with main.py, see
+render_autotune.render_frames_with_settings), and reports from the render times recorded in each output dir (see
+render_timing):
+- the mean render time per frame, and the speedup with respect to the slowest profile
+- the render time per animation frame, accounting for the frame step (e.g. RGB renders at a lower frame rate)
+
+The render output dirs of previous renders can be compared instead (--render_output_dirs, no Blender required).
+
+Run from the terminal:
+    python benchmark_render_profiles.py ../00_data/config_input_files/201124_Drogon16_eyesRF.json --frames 714..721
+        --profiles BLENDER_DEFAULT DATA_PASSES RGB_QUALITY --blender blender
+    python benchmark_render_profiles.py --render_output_dirs <render output dir 1> <render output dir 2>
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import config
+import render_autotune
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the render profiles')
+    parser.add_argument('input_json_path', nargs='?', default=None,
+                        help='Path to input json file of the trial to render with each profile')
+    parser.add_argument('--profiles', nargs='+', default=list(config.DICT_RENDER_PROFILES.keys()),
+                        help='Render profiles to compare')
+    parser.add_argument('--frames', default=None,
+                        help="Frames to render, as in Blender's --render-frame (e.g. 714..721); default: the first 8 "
+                             "frames of the suggested range of leg 1")
+    parser.add_argument('--output_dir', default=None,
+                        help='Dir for the render output dirs (one per profile); default: a temporary dir')
+    parser.add_argument('--blender', dest='blender_path', default='blender',
+                        help='Path to Blender executable')
+    parser.add_argument('--render_output_dirs', nargs='+', default=None,
+                        help='If present, compare the render times of these render output dirs (no rendering)')
+    args = parser.parse_args()
+
+    ### Render each profile (or use previous renders)
+    if args.render_output_dirs is not None:
+        list_render_output_dirs = args.render_output_dirs
+    elif args.input_json_path is not None:
+        for render_profile in args.profiles:
+            if render_profile not in config.DICT_RENDER_PROFILES:
+                sys.exit('ERROR in benchmark_render_profiles: render profile {} not in {}'
+                         .format(render_profile, list(config.DICT_RENDER_PROFILES.keys())))
+        frames_cli_str = args.frames
+        if frames_cli_str is None:
+            with open(args.input_json_path) as f:
+                first_frame = int(json.load(f)['suggested_frame_range_for_cli_rendering_leg_1'][0])
+            frames_cli_str = '{}..{}'.format(first_frame, first_frame + 7)
+        output_dir_path = args.output_dir or tempfile.mkdtemp(prefix='benchmark_render_profiles_')
+        os.makedirs(output_dir_path, exist_ok=True)
+        print('Rendering frames {} with profiles {} in {}'.format(frames_cli_str, args.profiles, output_dir_path))
+        list_render_output_dirs = [render_autotune.render_frames_with_settings(args.input_json_path,
+                                                                               render_profile,
+                                                                               {'render_profile': render_profile},
+                                                                               frames_cli_str,
+                                                                               output_dir_path,
+                                                                               args.blender_path)
+                                   for render_profile in args.profiles]
+    else:
+        sys.exit('ERROR in benchmark_render_profiles: an input json file or --render_output_dirs is required')
+
+    ### Render times per profile
+    list_rows = []
+    for render_output_dir_path in list_render_output_dirs:
+        render_times_dict = render_autotune.read_render_times(render_output_dir_path)
+        if render_times_dict is None or not render_times_dict['frames']:
+            print('WARNING: no render times in {}'.format(render_output_dir_path))
+            continue
+        list_render_times = [d['render_time_in_s'] for d in render_times_dict['frames'] if d['render_time_in_s'] is not None]
+        list_render_and_save_times = [d['render_and_save_time_in_s'] for d in render_times_dict['frames']]
+        render_params_dict = render_times_dict['render_params']
+        mean_render_and_save_time_in_s = sum(list_render_and_save_times) / len(list_render_and_save_times)
+        list_rows.append({'render_output_dir': render_output_dir_path,
+                          'render_profile': render_params_dict['render_profile'],
+                          'samples': render_params_dict['render_samples'],
+                          'frame_step': render_params_dict['render_frame_step'],
+                          'n_frames': len(list_render_and_save_times),
+                          'mean_render_time_in_s': sum(list_render_times) / max(len(list_render_times), 1),
+                          'mean_render_and_save_time_in_s': mean_render_and_save_time_in_s,
+                          'time_per_animation_frame_in_s': mean_render_and_save_time_in_s / render_params_dict['render_frame_step']})
+    if not list_rows:
+        return
+
+    slowest_time_in_s = max(row['mean_render_and_save_time_in_s'] for row in list_rows)
+    print('{:>16} {:>8} {:>6} {:>8} {:>16} {:>16} {:>8} {:>16}'.format('profile', 'samples', 'step', 'frames',
+                                                                       'render (s)', 'render+save (s)', 'speedup',
+                                                                       's/anim. frame'))
+    for row in list_rows:
+        print('{:>16} {:>8} {:>6} {:>8} {:>16.3f} {:>16.3f} {:>7.1f}x {:>16.3f}'.format(row['render_profile'],
+                                                                                        row['samples'],
+                                                                                        row['frame_step'],
+                                                                                        row['n_frames'],
+                                                                                        row['mean_render_time_in_s'],
+                                                                                        row['mean_render_and_save_time_in_s'],
+                                                                                        slowest_time_in_s / row['mean_render_and_save_time_in_s'],
+                                                                                        row['time_per_animation_frame_in_s']))
+
+
+if __name__ == '__main__':
+    main()
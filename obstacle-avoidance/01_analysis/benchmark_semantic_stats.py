@@ -0,0 +1,113 @@
+"""
+Benchmark of the solid-angle-weighted statistics per frame and object (semantic_stats)
+
+For a stack of synthetic frames (object index and depth as in benchmark_exr_reader.get_synthetic_render_channels),
+with the camera of the input json, it reports:
+- the time per frame of semantic_stats.compute_semantic_stats, in blocks of semantic_stats_frames_per_block frames
+- the time per frame of the depth percentiles computed with an argsort per frame and object (reference)
+- the max difference between the two, and between the total solid angle per frame and that of the image
+- the fraction of the visual field of each object in the first frame, from pixel counts and from solid angles
+
+Run from the terminal (no Blender required):
+    python benchmark_semantic_stats.py ../00_data/config_input_files/201124_Drogon16_eyesRF.json --n_frames 32
+"""
+import argparse
+import time
+import numpy as np
+
+import config
+import ray_tables
+import semantic_stats
+import benchmark_exr_reader
+
+
+def compute_depth_percentiles_reference(object_index_stack,
+                                        depth_stack,
+                                        pixel_solid_angles,
+                                        n_object_indices,
+                                        list_percentiles):
+    """
+    Solid-angle-weighted depth percentiles with an argsort per frame and object (see semantic_stats header)
+    """
+    depth_percentiles = np.full((depth_stack.shape[0], n_object_indices, len(list_percentiles)), np.nan)
+    for i in range(depth_stack.shape[0]):
+        for k in range(n_object_indices):
+            flag_object = (object_index_stack[i] == k) & np.isfinite(depth_stack[i]) & (pixel_solid_angles > 0)
+            if not np.any(flag_object):
+                continue
+            idcs_sorted = np.argsort(depth_stack[i][flag_object], kind='stable')
+            cumulative_weights = np.cumsum(pixel_solid_angles[flag_object][idcs_sorted])
+            idcs = np.searchsorted(cumulative_weights, cumulative_weights[-1] * np.array(list_percentiles) / 100)
+            depth_percentiles[i, k] = depth_stack[i][flag_object][idcs_sorted][np.minimum(idcs, len(idcs_sorted) - 1)]
+    return depth_percentiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the solid-angle-weighted statistics per frame and object')
+    parser.add_argument('input_json_path',
+                        help='Path to input json file (camera, object indices and stats params)')
+    parser.add_argument('--n_frames', type=int, default=32,
+                        help='Number of synthetic frames')
+    args = parser.parse_args()
+
+    input_config = config.config(args.input_json_path)
+    camera_projection_params_dict = ray_tables.get_camera_projection_params(input_config)
+    n_rows, n_cols = camera_projection_params_dict['n_rows'], camera_projection_params_dict['n_cols']
+    n_object_indices = max(input_config.list_indices_for_object_ID) + 1
+    list_percentiles = input_config.semantic_stats_depth_percentiles
+    n_frames_per_block = input_config.semantic_stats_frames_per_block
+
+    ### Synthetic frames
+    list_channels_dicts = [benchmark_exr_reader.get_synthetic_render_channels(n_rows, n_cols, seed=i)
+                           for i in range(args.n_frames)]
+    object_index_stack = np.stack([d['ViewLayer.IndexOB.X'] for d in list_channels_dicts]).astype(np.uint8)
+    depth_stack = np.stack([d['ViewLayer.Depth.Z'] for d in list_channels_dicts]).astype(np.float16)
+    del list_channels_dicts
+    print('{} frames of {}x{} pixels, {} object indices, depth percentiles {}, blocks of {} frames'
+          .format(args.n_frames, n_cols, n_rows, n_object_indices, list_percentiles, n_frames_per_block))
+
+    ### Stats, in blocks of frames
+    pixel_solid_angles = semantic_stats.get_pixel_solid_angles(camera_projection_params_dict)
+    ray_table = ray_tables.compute_ray_table(camera_projection_params_dict)
+    t0 = time.perf_counter()
+    list_block_stats_dicts = [semantic_stats.compute_semantic_stats(object_index_stack[i:i + n_frames_per_block],
+                                                                    depth_stack[i:i + n_frames_per_block],
+                                                                    pixel_solid_angles,
+                                                                    ray_table,
+                                                                    n_object_indices,
+                                                                    list_percentiles)
+                              for i in range(0, args.n_frames, n_frames_per_block)]
+    time_in_s = time.perf_counter() - t0
+    stats_dict = {k: np.concatenate([d[k] for d in list_block_stats_dicts]) for k in semantic_stats.LIST_STATS_STR}
+    print('Semantic stats: {:.1f} ms per frame'.format(1e3 * time_in_s / args.n_frames))
+
+    ### Reference percentiles (only the first block of frames)
+    n_frames_reference = min(n_frames_per_block, args.n_frames)
+    t0 = time.perf_counter()
+    depth_percentiles_reference = compute_depth_percentiles_reference(object_index_stack[:n_frames_reference],
+                                                                      depth_stack[:n_frames_reference].astype(np.float32),
+                                                                      pixel_solid_angles,
+                                                                      n_object_indices,
+                                                                      list_percentiles)
+    print('Depth percentiles with an argsort per frame and object: {:.1f} ms per frame'
+          .format(1e3 * (time.perf_counter() - t0) / n_frames_reference))
+
+    ### Checks
+    print('Depth percentiles match the reference: {}'.format(np.array_equal(stats_dict['depth_percentiles'][:n_frames_reference],
+                                                                            depth_percentiles_reference,
+                                                                            equal_nan=True)))
+    print('Max error of the total solid angle per frame: {:.1e} sr (image: {:.4f} sr)'
+          .format(np.max(np.abs(np.nansum(stats_dict['solid_angle_in_sr'], axis=1) - pixel_solid_angles.sum())),
+                  pixel_solid_angles.sum()))
+    print('Fraction of the visual field per object in the first frame (pixel count, solid angle):')
+    for k in np.flatnonzero(stats_dict['pixel_count'][0]):
+        print('    {:2d}: {:.4f}, {:.4f} (centroid at longitude {:6.1f} deg, latitude {:5.1f} deg)'
+              .format(k,
+                      stats_dict['pixel_count'][0, k] / np.sum(stats_dict['pixel_count'][0]),
+                      stats_dict['solid_angle_in_sr'][0, k] / pixel_solid_angles.sum(),
+                      np.rad2deg(stats_dict['centroid_longitude_in_rad'][0, k]),
+                      np.rad2deg(stats_dict['centroid_latitude_in_rad'][0, k])))
+
+
+if __name__ == '__main__':
+    main()
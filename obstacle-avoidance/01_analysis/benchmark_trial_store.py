@@ -0,0 +1,125 @@
+"""
+Benchmark of the per-trial array store of the rendered passes (trial_store)
+
+It consolidates the EXR files of a render output dir into a store, and reports:
+- the time to consolidate per frame, and the size of the store relative to the EXR files
+- the time to read a range of frames of the depth, in full and in a window of longitude and latitude, from the store
+  and from the EXR files
+- (for synthetic renders) the max error of the values in the store, relative to those in the EXR files
+
+If no render dir is given, n_frames synthetic multilayer EXR files are written to a temporary dir (see
+benchmark_exr_reader.get_synthetic_render_channels), and consolidated in two steps (half of the frames, and then
+the rest), as when consolidating while rendering.
+
+Run from the terminal (no Blender required):
+    python benchmark_trial_store.py ../00_data/config_input_files/201124_Drogon16_eyesRF.json --n_frames 64
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+
+import config
+import exr_reader
+import trial_store
+import benchmark_exr_reader
+
+
+def get_folder_size_in_bytes(folder_path):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, list_files in os.walk(folder_path) for f in list_files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the per-trial array store of the rendered passes')
+    parser.add_argument('input_json_path',
+                        help='Path to input json file of the trial (frame range, store params and camera)')
+    parser.add_argument('--render_dir', default=None,
+                        help='Render output dir with the EXR files; if not given, synthetic files are written')
+    parser.add_argument('--n_frames', type=int, default=64,
+                        help='Number of synthetic frames')
+    parser.add_argument('--n_frames_to_read', type=int, default=32,
+                        help='Number of frames in the range read')
+    args = parser.parse_args()
+
+    input_config = config.config(args.input_json_path)
+    frame_start = int(input_config.animation_frame_start_end[0])
+    output_dir = tempfile.mkdtemp(prefix='benchmark_trial_store_')
+    store_path = os.path.join(output_dir, 'store')
+
+    ### Render dir
+    if args.render_dir:
+        render_dir = args.render_dir
+    else:
+        render_dir = os.path.join(output_dir, 'renders')
+        os.makedirs(render_dir)
+        n_cols, n_rows = [int(round(x * input_config.render_resolution_percentage / 100))
+                          for x in input_config.render_resolution_x_y_in_pixels]
+        for i in range(args.n_frames):
+            benchmark_exr_reader.write_exr_file(os.path.join(render_dir, '{:04d}.exr'.format(frame_start + i)),
+                                                benchmark_exr_reader.get_synthetic_render_channels(n_rows, n_cols, seed=i))
+    dict_frame_to_path = trial_store.get_rendered_frames(render_dir)
+    print('{} EXR files in {} ({:.1f} MB)'.format(len(dict_frame_to_path), render_dir, get_folder_size_in_bytes(render_dir) / 1e6))
+
+    ### Consolidate (for synthetic renders, in two steps)
+    t0 = time.perf_counter()
+    if not args.render_dir:
+        list_frames = sorted(dict_frame_to_path)
+        for frame in list_frames[len(list_frames) // 2:]:
+            os.rename(dict_frame_to_path[frame], dict_frame_to_path[frame] + '.tmp')
+        trial_store.consolidate_trial_renders(render_dir, store_path, input_config, flag_verbose=False)
+        for frame in list_frames[len(list_frames) // 2:]:
+            os.rename(dict_frame_to_path[frame] + '.tmp', dict_frame_to_path[frame])
+    store_dict, _ = trial_store.consolidate_trial_renders(render_dir, store_path, input_config, flag_verbose=False)
+    time_in_s = time.perf_counter() - t0
+    print('Consolidate: {:.3f} s per frame; store: {:.1f} MB, arrays {}'.format(time_in_s / len(dict_frame_to_path),
+                                                                              get_folder_size_in_bytes(store_path) / 1e6,
+                                                                              {k: v['dtype'] for k, v in store_dict['arrays'].items()}))
+
+    ### Read a range of frames of the depth: from the store, and from the EXR files
+    list_frames = sorted(dict_frame_to_path)[:args.n_frames_to_read]
+    frame_start_end = (list_frames[0], list_frames[-1])
+    t0 = time.perf_counter()
+    depth_store = trial_store.read_array(store_dict, 'depth', frame_start_end)
+    time_store_in_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    depth_exr = np.stack([exr_reader.read_exr_channels(dict_frame_to_path[f], ['Depth.Z'])['ViewLayer.Depth.Z']
+                          if f in dict_frame_to_path else np.full(store_dict['image_shape'], np.nan, dtype=np.float32)
+                          for f in range(frame_start_end[0], frame_start_end[1] + 1)])
+    time_exr_in_s = time.perf_counter() - t0
+    print('Read depth of frames {}-{}: {:.3f} s from the store, {:.3f} s from the EXR files'.format(*frame_start_end,
+                                                                                                  time_store_in_s,
+                                                                                                  time_exr_in_s))
+
+    ### Read a window of +-30 deg around the forward direction
+    t0 = time.perf_counter()
+    depth_window, row_start_end, col_start_end = trial_store.read_array_in_lon_lat_window(store_dict,
+                                                                                          'depth',
+                                                                                          np.deg2rad([-30, 30]),
+                                                                                          np.deg2rad([-30, 30]),
+                                                                                          frame_start_end)
+    print('Read depth of frames {}-{} in a 60x60 deg window ({}x{} pixels): {:.3f} s from the store'
+          .format(*frame_start_end,
+                  depth_window.shape[2],
+                  depth_window.shape[1],
+                  time.perf_counter() - t0))
+
+    ### Errors of the stored values
+    flag_finite = np.isfinite(depth_exr) & (depth_exr < 65504)
+    print('Depth: max relative error {:.1e}'.format(np.max(np.abs(depth_store[flag_finite] - depth_exr[flag_finite])
+                                                           / depth_exr[flag_finite])))
+    window_exr = depth_exr[:, row_start_end[0]:row_start_end[1], col_start_end[0]:col_start_end[1]]
+    flag_window = ~np.isnan(depth_window)
+    print('Depth in window matches full read: {}'.format(np.array_equal(depth_window[flag_window],
+                                                                        depth_store[:, row_start_end[0]:row_start_end[1],
+                                                                                    col_start_end[0]:col_start_end[1]][flag_window])
+                                                         and np.allclose(depth_window[flag_window], window_exr[flag_window], rtol=1e-3)))
+    index_store = trial_store.read_array(store_dict, 'object_index', frame_start_end)
+    index_exr = np.stack([exr_reader.read_exr_channels(dict_frame_to_path[f], ['IndexOB.X'])['ViewLayer.IndexOB.X']
+                          for f in list_frames])
+    print('Object index matches: {}'.format(np.array_equal(index_store[np.array(list_frames) - frame_start_end[0]],
+                                                           index_exr.astype(index_store.dtype))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import sys
+import numpy as np
+
+# Camera poses for all animation frames, computed at once as numpy arrays
+# (no bpy/mathutils required, so this can also be used outside Blender)
+# Quaternions are (w,x,y,z) and products follow the Hamilton convention (as mathutils' '@')
+
+
+def quaternion_multiply(q1,
+                        q2):
+    """
+    Hamilton product of quaternions q1 @ q2 (as mathutils.Quaternion '@'), vectorised
+
+    :param q1: array of shape (..., 4), quaternions as (w,x,y,z)
+    :param q2: array of shape (..., 4), quaternions as (w,x,y,z) (broadcast against q1)
+    :return: array of shape (..., 4) with the product q1 @ q2
+    """
+    q1 = np.asarray(q1, dtype=np.float64)
+    q2 = np.asarray(q2, dtype=np.float64)
+    w1, x1, y1, z1 = np.moveaxis(q1, -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(q2, -1, 0)
+    return np.stack((w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                     w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                     w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                     w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2),
+                    axis=-1)
+
+
+def euler_to_quaternion(eul_angles_in_rad,
+                        eul_order_str='XYZ'):
+    """
+    Quaternion for a rotation defined by Euler angles, as mathutils.Euler(angles, order).to_quaternion()
+
+    In Blender, Euler angles are rotations around the GLOBAL axes, applied in the order given by the string
+    (e.g. for 'XYZ': first around Xglobal, then Yglobal, then Zglobal), so the quaternion is q_Z @ q_Y @ q_X
+
+    :param eul_angles_in_rad: angles around X, Y and Z axes (in rad!)
+    :param eul_order_str: order of the rotations (e.g. 'XYZ')
+    :return: quaternion (w,x,y,z) as numpy array of shape (4,)
+    """
+    quat = np.array([1.0, 0.0, 0.0, 0.0])
+    for axis_str in eul_order_str:
+        idx_axis = 'XYZ'.index(axis_str)
+        half_angle = 0.5 * eul_angles_in_rad[idx_axis]
+        quat_axis = np.zeros(4)
+        quat_axis[0] = np.cos(half_angle)
+        quat_axis[idx_axis + 1] = np.sin(half_angle)
+        quat = quaternion_multiply(quat_axis, quat)  # each rotation is applied after the previous ones
+    return quat
+
+
+def quaternion_to_rotation_matrix(quat):
+    """
+    Rotation matrix for a quaternion (as mathutils.Quaternion.to_matrix()), vectorised
+
+    :param quat: array of shape (..., 4), quaternions as (w,x,y,z) (normalised here)
+    :return: array of shape (..., 3, 3), such that v_rotated = R @ v
+    """
+    quat = np.asarray(quat, dtype=np.float64)
+    quat = quat / np.linalg.norm(quat, axis=-1, keepdims=True)
+    w, x, y, z = np.moveaxis(quat, -1, 0)
+    return np.stack((np.stack((1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)), axis=-1),
+                     np.stack((2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)), axis=-1),
+                     np.stack((2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)), axis=-1)),
+                    axis=-2)
+
+
+def get_dense_frame_to_row_index(frames_array,
+                                 frame_start_end):
+    """
+    Get an array that maps every frame in frame_start_end (both inclusive) to its row in frames_array
+    (i.e., idx_row = frame_to_row[frame - frame_start]), with -1 for frames not in frames_array
+
+    This replaces searching for each frame (np.where(frames_array == frame)) in a loop over frames
+
+    :param frames_array: 1-dim int array of frames (e.g. transforms_dict['frame'])
+    :param frame_start_end: first and last frame
+    :return: frame_to_row (int array with one element per frame in range)
+    """
+    frame_start, frame_end = int(frame_start_end[0]), int(frame_start_end[1])
+    frames_array = np.asarray(frames_array, dtype=np.int64)
+    frame_to_row = np.full(frame_end - frame_start + 1, -1, dtype=np.int64)
+
+    mask_in_range = (frames_array >= frame_start) & (frames_array <= frame_end)
+    idx_rows_in_range = np.flatnonzero(mask_in_range)
+    # reversed so that, if a frame is repeated, its first row is kept (as with np.where(...)[0][0])
+    frame_to_row[frames_array[idx_rows_in_range[::-1]] - frame_start] = idx_rows_in_range[::-1]
+
+    return frame_to_row
+
+
+def compute_camera_poses(transforms_dict,
+                         input_config):
+    """
+    Compute the camera location and rotation quaternion for every animation frame, for the reference frame the
+    camera tracks (see define_camera.insert_camera_keyframes)
+
+    - location: translation from csv data (interp or not) in m
+    - rotation quaternion (the rotation to the desired camera pose, quat_worldRF_to_cameraRF, is applied first):
+        - Opt 1, camera tracks trajectoryRF: quat_from_transforms_csv @ quat_worldRF_to_cameraRF
+        - Opt 2, camera tracks headRF: quat_from_transforms_csv @ quat_worldRF_to_cameraRF
+        - Opt 3, camera always parallel to worldRF: quat_worldRF_to_cameraRF
+        - Opt 4 (default), camera tracks eyesRF: quat_from_transforms_csv @ quat_from_headRF_t0_to_eyesRF @ quat_worldRF_to_cameraRF
+
+    :param transforms_dict: dict with concatenated transforms data (see load_data.csv_transforms_concatenated_to_dict)
+    :param input_config: config
+    :return: camera_poses_dict, with keys
+        - 'frame': int array of shape (n_frames,)
+        - 'location': array of shape (n_frames, 3)
+        - 'rotation_quaternion': array of shape (n_frames, 4) (w,x,y,z)
+    """
+    ### Check consistency of trajectoryRF flag with csv path
+    if input_config.flag_camera_tracks_trajectoryRF and \
+            'trajectoryRF' not in input_config.transforms_csv_path_to_file:
+        sys.exit("ERROR in config: the transforms csv data path does not contain 'trajectoryRF', but flag_camera_tracks_trajectoryRF is set to True")
+
+    ### Compute quaternion to rotate Blender camera (applied first, same for all frames)
+    quat_worldRF_to_cameraRF = euler_to_quaternion(input_config.eul_worldRF_to_cameraRF_rad[0],
+                                                   input_config.eul_worldRF_to_cameraRF_rad[1])
+
+    ### Compute quaternion to rotate headRF ref pose to eyesRF (same for all frames)
+    quat_from_headRF_t0_to_eyesRF = \
+        np.asarray(input_config.eyesRF_quat_dict[input_config.date_bird_HP_pair_str], dtype=np.float64)
+
+    ### Get row of transforms data for each animation frame
+    frames_array = np.arange(input_config.animation_frame_start_end[0],
+                             input_config.animation_frame_start_end[1] + 1)
+    frame_to_row = get_dense_frame_to_row_index(transforms_dict['frame'],
+                                                input_config.animation_frame_start_end)
+    if np.any(frame_to_row < 0):
+        sys.exit('ERROR in transforms data: no data for frames {} of the animation'.format(frames_array[frame_to_row < 0]))
+
+    ### Translation (interp or not)
+    if input_config.flag_use_transform_interp:
+        location_array = np.asarray(transforms_dict['transform_t_interp_XYZ'])[frame_to_row] * input_config.mm_to_m
+        quat_from_transforms_csv = np.asarray(transforms_dict['transform_q_interp_WXYZ'])[frame_to_row]
+    else:
+        location_array = np.asarray(transforms_dict['transform_t_XYZ'])[frame_to_row] * input_config.mm_to_m
+        quat_from_transforms_csv = np.asarray(transforms_dict['transform_q_WXYZ'])[frame_to_row]
+
+    ### Rotation
+    # Opt 1: camera tracks trajectoryRF / Opt 2: camera tracks headRF
+    if input_config.flag_camera_tracks_trajectoryRF or input_config.flag_camera_tracks_headRF:
+        rotation_quaternion_array = quaternion_multiply(quat_from_transforms_csv,
+                                                        quat_worldRF_to_cameraRF)
+    # Opt 3: camera always parallel to worldRF
+    elif input_config.flag_camera_tracks_worldRF:
+        rotation_quaternion_array = np.tile(quat_worldRF_to_cameraRF, (frames_array.shape[0], 1))
+    # Opt 4: camera tracks eyesRF (requires an additional rotation to eyesRF)
+    else:
+        rotation_quaternion_array = quaternion_multiply(quaternion_multiply(quat_from_transforms_csv,
+                                                                            quat_from_headRF_t0_to_eyesRF),
+                                                        quat_worldRF_to_cameraRF)
+
+    return {'frame': frames_array,
+            'location': location_array,
+            'rotation_quaternion': rotation_quaternion_array}
+
+
+def decimate_camera_poses(camera_poses_dict,
+                          max_translation_error_in_m,
+                          max_rotation_error_in_deg):
+    """
+    Remove redundant keyframes, for CONSTANT interpolation between keyframes
+
+    With CONSTANT interpolation, the camera pose at a frame without keyframe is the pose of the previous keyframe.
+    A frame is removed if its location and rotation differ from those of the last kept keyframe by less than
+    the thresholds, so the pose error at any frame is at most max_translation_error_in_m and max_rotation_error_in_deg.
+    (comparing to the last kept keyframe, rather than to the previous frame, avoids the error accumulating
+    along slow drifts)
+
+    The first and last frames are always kept (and frames with nan poses are never removed).
+
+    :param camera_poses_dict: dict with 'frame', 'location' and 'rotation_quaternion' arrays (see compute_camera_poses)
+    :param max_translation_error_in_m: maximum distance between the location of a removed frame and the keyframe before it
+    :param max_rotation_error_in_deg: maximum rotation angle between a removed frame and the keyframe before it
+    :return: camera_poses_decimated_dict, n_keyframes_removed
+    """
+    location_array = np.asarray(camera_poses_dict['location'], dtype=np.float64)
+    quat_array = np.asarray(camera_poses_dict['rotation_quaternion'], dtype=np.float64)
+    quat_array = quat_array / np.linalg.norm(quat_array, axis=1, keepdims=True)
+    n_frames = location_array.shape[0]
+
+    # cos of half the max rotation angle (angle between unit quaternions q1, q2 is 2*arccos(|q1.q2|))
+    min_abs_dot_product = np.cos(0.5 * np.deg2rad(max_rotation_error_in_deg))
+
+    mask_keep = np.zeros(n_frames, dtype=bool)
+    idx_last_kept = 0
+    for i in range(n_frames):
+        if i == 0 or i == n_frames - 1:
+            mask_keep[i] = True
+        else:
+            translation_error = np.linalg.norm(location_array[i] - location_array[idx_last_kept])
+            abs_dot_product = abs(np.dot(quat_array[i], quat_array[idx_last_kept]))
+            # (written as 'not <=' so that nan poses are kept)
+            mask_keep[i] = not (translation_error <= max_translation_error_in_m and
+                                abs_dot_product >= min_abs_dot_product)
+        if mask_keep[i]:
+            idx_last_kept = i
+
+    camera_poses_decimated_dict = {k: np.asarray(v)[mask_keep] for k, v in camera_poses_dict.items()}
+    return camera_poses_decimated_dict, int(n_frames - np.count_nonzero(mask_keep))
@@ -0,0 +1,246 @@
+import os
+import numpy as np
+import raycast_renderer
+
+# Clearance and time-to-contact of the head to every perch and obstacle, per frame, for all the trials of a session
+#
+# The head trajectory is the translation in the transforms csv (transform_t_interp_XYZ), and the perches and
+# obstacles are the cylinders built from the geometry dict (with perch_radius and obs_radius, see
+# raycast_renderer.get_primitives_from_geometry_dict). The trials are padded with nan to the same number of frames
+# and cylinders, so that all the metrics are computed for the whole session at once, as arrays of shape
+# (n_trials, n_frames, n_cylinders).
+#
+# Metrics per frame and cylinder:
+# - clearance_in_m: signed distance from the head to the surface of the solid cylinder (negative inside)
+# - closing_speed_in_m_per_s: rate at which the clearance decreases (head velocity along the direction from the head
+#   to the closest point of the cylinder). Positive when approaching; nan inside the cylinder
+# - tau_in_s: time-to-contact at the current closing speed (clearance / closing speed), inf if not approaching
+# - angular_size_in_rad: angle subtended by the cylinder across its axis, 2 * arcsin(radius / distance to the axis
+#   segment); nan if the head is within the radius of the axis segment
+# - angular_expansion_rate_in_rad_per_s: time derivative of the angular size
+# - tau_from_expansion_in_s: optical tau (angular size / angular expansion rate), inf if not expanding
+# The head velocity is computed with central differences (one-sided next to the trial's ends and to frames without data),
+# with the time between frames from the frame numbers and mocap_sampling_rate_in_Hz. The closing speed and expansion
+# rate are then derived analytically from it.
+
+# metrics per frame and cylinder (arrays of shape (n_frames, n_cylinders) per trial)
+LIST_METRICS_STR = ['clearance_in_m',
+                    'closing_speed_in_m_per_s',
+                    'tau_in_s',
+                    'angular_size_in_rad',
+                    'angular_expansion_rate_in_rad_per_s',
+                    'tau_from_expansion_in_s']
+
+
+def get_trial_dict(geometry_dict,
+                   transforms_dict,
+                   input_config):
+    """
+    Get the head trajectory and the cylinders of a trial
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param transforms_dict: dict with concatenated transforms data (see load_data.csv_transforms_concatenated_to_dict)
+    :param input_config: config
+    :return: trial_dict, with keys
+        - 'frame': array of shape (n_frames,), 'head_location': array of shape (n_frames, 3), in m
+        - 'time_per_frame_in_s': 1 / mocap_sampling_rate_in_Hz
+        - 'name' (list), 'pass_index', 'P1', 'P2', 'radius': of the cylinders (see get_primitives_from_geometry_dict)
+    """
+    cylinders_dict = raycast_renderer.get_primitives_from_geometry_dict(geometry_dict,
+                                                                        input_config)['cylinders']
+    return dict(cylinders_dict,
+                frame=np.asarray(transforms_dict['frame']),
+                head_location=np.asarray(transforms_dict['transform_t_interp_XYZ'], dtype=np.float64) * input_config.mm_to_m,
+                time_per_frame_in_s=1 / input_config.mocap_sampling_rate_in_Hz)
+
+
+def pad_trials(list_trial_dicts):
+    """
+    Stack the trials' arrays, padded with nan to the max number of frames and of cylinders
+
+    :param list_trial_dicts: list of trial dicts (see get_trial_dict)
+    :return: dict with 'time_in_s' (n_trials, n_frames), 'head_location' (n_trials, n_frames, 3), 'P1', 'P2'
+        (n_trials, n_cylinders, 3) and 'radius' (n_trials, n_cylinders)
+    """
+    n_trials = len(list_trial_dicts)
+    n_frames = max(len(t['frame']) for t in list_trial_dicts)
+    n_cylinders = max(len(t['radius']) for t in list_trial_dicts)
+    padded_dict = {'time_in_s': np.full((n_trials, n_frames), np.nan),
+                   'head_location': np.full((n_trials, n_frames, 3), np.nan),
+                   'P1': np.full((n_trials, n_cylinders, 3), np.nan),
+                   'P2': np.full((n_trials, n_cylinders, 3), np.nan),
+                   'radius': np.full((n_trials, n_cylinders), np.nan)}
+    for i, trial_dict in enumerate(list_trial_dicts):
+        padded_dict['time_in_s'][i, :len(trial_dict['frame'])] = trial_dict['frame'] * trial_dict['time_per_frame_in_s']
+        padded_dict['head_location'][i, :len(trial_dict['frame'])] = trial_dict['head_location']
+        for k in ['P1', 'P2', 'radius']:
+            padded_dict[k][i, :len(trial_dict['radius'])] = trial_dict[k]
+    return padded_dict
+
+
+def get_velocity(location,
+                 time_in_s):
+    """
+    Velocity along the frames axis, with central differences where both neighbours have data, and one-sided
+    differences otherwise (nan if neither neighbour has data)
+
+    :param location: array of shape (..., n_frames, 3)
+    :param time_in_s: array of shape (..., n_frames)
+    :return: velocity array of shape (..., n_frames, 3)
+    """
+    pad_location = np.full(location.shape[:-2] + (1, 3), np.nan)
+    pad_time = np.full(time_in_s.shape[:-1] + (1,), np.nan)
+    location_prev = np.concatenate((pad_location, location[..., :-1, :]), axis=-2)
+    location_next = np.concatenate((location[..., 1:, :], pad_location), axis=-2)
+    time_prev = np.concatenate((pad_time, time_in_s[..., :-1]), axis=-1)[..., None]
+    time_next = np.concatenate((time_in_s[..., 1:], pad_time), axis=-1)[..., None]
+    time_in_s = time_in_s[..., None]
+
+    velocity = (location_next - location_prev) / (time_next - time_prev)
+    for velocity_one_sided in [(location_next - location) / (time_next - time_in_s),
+                               (location - location_prev) / (time_in_s - time_prev)]:
+        velocity = np.where(np.isnan(velocity), velocity_one_sided, velocity)
+    return velocity
+
+
+def compute_clearance_metrics(head_location,
+                              head_velocity,
+                              P1,
+                              P2,
+                              radius):
+    """
+    Compute the metrics in LIST_METRICS_STR (see header), broadcasting the head's locations and velocities
+    against the cylinders
+
+    :param head_location, head_velocity: arrays of shape (..., 3), in m and m/s
+    :param P1, P2: centres of the cylinders' bases, arrays of shape (..., 3) (broadcastable to head_location's), in m
+    :param radius: array of shape (...) (broadcastable to head_location's without the last axis), in m
+    :return: metrics_dict, with one array per metric in LIST_METRICS_STR
+    """
+    axis_length = np.linalg.norm(P2 - P1, axis=-1)
+    axis = (P2 - P1) / axis_length[..., None]
+
+    ### Head location relative to the cylinder: along the axis and radial
+    P1_to_head = head_location - P1
+    axial = np.sum(P1_to_head * axis, axis=-1)
+    axial_clipped = np.clip(axial, 0, axis_length)
+    # vector from the closest point of the axis segment to the head, and its length
+    axis_to_head = P1_to_head - axial_clipped[..., None] * axis
+    distance_to_axis = np.linalg.norm(axis_to_head, axis=-1)
+    radial_distance = np.linalg.norm(P1_to_head - axial[..., None] * axis, axis=-1)
+
+    ### Clearance (signed distance to the solid cylinder), and unit vector from the cylinder to the head (outside)
+    axial_excess = np.maximum(np.maximum(-axial, axial - axis_length), 0)
+    radial_excess = np.maximum(radial_distance - radius, 0)
+    flag_inside = (axial_excess == 0) & (radial_excess == 0)
+    clearance = np.where(flag_inside,
+                         -np.minimum(radius - radial_distance, np.minimum(axial, axis_length - axial)),
+                         np.hypot(axial_excess, radial_excess))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # head minus closest point of the cylinder = radial part beyond the radius + axial part beyond the caps
+        axial_part = (axial - axial_clipped)[..., None] * axis
+        radial_scale = np.where(radial_distance > 0, radial_excess / radial_distance, 0)
+        closest_to_head = (axis_to_head - axial_part) * radial_scale[..., None] + axial_part
+        unit_cylinder_to_head = closest_to_head / clearance[..., None]
+        closing_speed = np.where(flag_inside, np.nan, -np.sum(unit_cylinder_to_head * head_velocity, axis=-1))
+        tau = np.where(closing_speed > 0, clearance / closing_speed, np.inf)
+
+        ### Angular size across the axis, and its rate of change
+        flag_outside_radius = distance_to_axis > radius
+        angular_size = np.where(flag_outside_radius,
+                                2 * np.arcsin(np.minimum(radius / distance_to_axis, 1)),
+                                np.nan)
+        distance_to_axis_rate = np.sum(axis_to_head * head_velocity, axis=-1) / distance_to_axis
+        angular_expansion_rate = np.where(flag_outside_radius,
+                                          -2 * radius * distance_to_axis_rate
+                                          / (distance_to_axis * np.sqrt(distance_to_axis ** 2 - radius ** 2)),
+                                          np.nan)
+        tau_from_expansion = np.where(angular_expansion_rate > 0, angular_size / angular_expansion_rate, np.inf)
+
+    # tau is nan (rather than inf) where the rates are not defined (no velocity, inside the cylinder, padding)
+    return {'clearance_in_m': clearance,
+            'closing_speed_in_m_per_s': closing_speed,
+            'tau_in_s': np.where(np.isnan(closing_speed), np.nan, tau),
+            'angular_size_in_rad': angular_size,
+            'angular_expansion_rate_in_rad_per_s': angular_expansion_rate,
+            'tau_from_expansion_in_s': np.where(np.isnan(angular_expansion_rate), np.nan, tau_from_expansion)}
+
+
+def compute_clearance_metrics_for_trials(list_trial_dicts):
+    """
+    Compute the metrics in LIST_METRICS_STR for every frame and cylinder of every trial, all trials at once
+
+    :param list_trial_dicts: list of trial dicts (see get_trial_dict)
+    :return: list of metrics dicts, one per trial, with 'frame', 'name' and 'pass_index' (of the cylinders),
+        and one array of shape (n_frames, n_cylinders) per metric
+    """
+    padded_dict = pad_trials(list_trial_dicts)
+    head_velocity = get_velocity(padded_dict['head_location'],
+                                 padded_dict['time_in_s'])
+    # (n_trials, n_frames, 1, ...) against (n_trials, 1, n_cylinders, ...)
+    metrics_dict = compute_clearance_metrics(padded_dict['head_location'][:, :, None],
+                                             head_velocity[:, :, None],
+                                             padded_dict['P1'][:, None],
+                                             padded_dict['P2'][:, None],
+                                             padded_dict['radius'][:, None])
+
+    list_metrics_dicts = []
+    for i, trial_dict in enumerate(list_trial_dicts):
+        n_frames, n_cylinders = len(trial_dict['frame']), len(trial_dict['radius'])
+        trial_metrics_dict = {'frame': np.asarray(trial_dict['frame']),
+                              'name': list(trial_dict['name']),
+                              'pass_index': np.asarray(trial_dict['pass_index'])}
+        for k in LIST_METRICS_STR:
+            trial_metrics_dict[k] = metrics_dict[k][i, :n_frames, :n_cylinders].astype(np.float32)
+        list_metrics_dicts.append(trial_metrics_dict)
+    return list_metrics_dicts
+
+
+def save_clearance_metrics(metrics_dict,
+                           output_path):
+    """
+    Save the metrics of a trial as a compressed .npz file
+
+    :param metrics_dict: see compute_clearance_metrics_for_trials
+    :param output_path: path to the .npz file
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    np.savez_compressed(output_path,
+                        **{k: np.asarray(v) for k, v in metrics_dict.items()})
+
+
+if __name__ == '__main__':
+    # compute the metrics for all the trials in a session, without Blender:
+    #     python clearance_metrics.py <input json 1> [<input json 2> ...]
+    # (one file per trial: <render_output_parent_dir_path>/<render_output_parent_dir_str>_clearance.npz)
+    import sys
+    import time
+    import config
+    import load_data
+
+    list_input_configs = []
+    list_trial_dicts = []
+    for json_path in sys.argv[1:]:
+        input_config = config.config(json_path)
+        geometry_dict = load_data.load_csv_with_cache(load_data.csv_to_dict_keys_per_row,
+                                                      input_config.geometry_csv_path_to_file,
+                                                      [input_config.geometry_csv_n_header_rows_to_skip,
+                                                       input_config.geometry_csv_idx_col_start_data],
+                                                      input_config.data_cache_folder_path if input_config.flag_use_data_cache else None)
+        transforms_dict = load_data.csv_transforms_concatenated_to_dict(input_config)
+        list_input_configs.append(input_config)
+        list_trial_dicts.append(get_trial_dict(geometry_dict,
+                                               transforms_dict,
+                                               input_config))
+
+    t0 = time.perf_counter()
+    list_metrics_dicts = compute_clearance_metrics_for_trials(list_trial_dicts)
+    print('Clearance metrics for {} trials ({} frames) in {:.3f} s'.format(len(list_trial_dicts),
+                                                                        sum(len(t['frame']) for t in list_trial_dicts),
+                                                                        time.perf_counter() - t0))
+    for input_config, metrics_dict in zip(list_input_configs, list_metrics_dicts):
+        output_path = os.path.join(input_config.render_output_parent_dir_path,
+                                   input_config.render_output_parent_dir_str + '_clearance.npz')
+        save_clearance_metrics(metrics_dict,
+                               output_path)
+        print('    saved to {}'.format(output_path))
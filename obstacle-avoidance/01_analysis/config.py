@@ -9,6 +9,7 @@ import math
 import numpy as np
 import os
 import load_data
+import render_autotune
 from datetime import datetime
 import string
 import sys
@@ -16,6 +17,62 @@ import json
 import pdb
 import re
 
+# Cycles sampling, light paths, pixel filter and passes per render profile (defaults of the render params in config,
+# each can still be set in the input json)
+# - 'BLENDER_DEFAULT': Blender 2.93 defaults (sampling and light paths were not set before render profiles were added)
+# - 'DATA_PASSES': ground-truth passes only (depth, object index and vector). One sample per pixel with the Box filter
+#   (each pixel is a single camera ray), no bounces, no adaptive sampling and no denoising
+# - 'RGB_QUALITY': combined (RGB) pass only, adaptive sampling and denoising. For separate RGB renders, e.g. at a lower
+#   frame rate than the data passes (with render_frame_step, see run_rendering.py)
+DICT_RENDER_PROFILES = {'BLENDER_DEFAULT': {'samples': 128,
+                                            'use_adaptive_sampling': False,
+                                            'adaptive_threshold': 0.01,
+                                            'use_denoising': False,
+                                            'max_bounces': 12,
+                                            'diffuse_bounces': 4,
+                                            'glossy_bounces': 4,
+                                            'transmission_bounces': 12,
+                                            'volume_bounces': 0,
+                                            'transparent_max_bounces': 8,
+                                            'caustics_reflective': True,
+                                            'caustics_refractive': True,
+                                            'pixel_filter_type': 'BOX',
+                                            'use_pass_z': True,
+                                            'use_pass_object_index': True,
+                                            'use_pass_vector': True},
+                        'DATA_PASSES': {'samples': 1,
+                                        'use_adaptive_sampling': False,
+                                        'adaptive_threshold': 0.01,
+                                        'use_denoising': False,
+                                        'max_bounces': 0,
+                                        'diffuse_bounces': 0,
+                                        'glossy_bounces': 0,
+                                        'transmission_bounces': 0,
+                                        'volume_bounces': 0,
+                                        'transparent_max_bounces': 0,
+                                        'caustics_reflective': False,
+                                        'caustics_refractive': False,
+                                        'pixel_filter_type': 'BOX',
+                                        'use_pass_z': True,
+                                        'use_pass_object_index': True,
+                                        'use_pass_vector': True},
+                        'RGB_QUALITY': {'samples': 64,
+                                        'use_adaptive_sampling': True,
+                                        'adaptive_threshold': 0.01,
+                                        'use_denoising': True,
+                                        'max_bounces': 4,
+                                        'diffuse_bounces': 2,
+                                        'glossy_bounces': 2,
+                                        'transmission_bounces': 4,
+                                        'volume_bounces': 0,
+                                        'transparent_max_bounces': 8,
+                                        'caustics_reflective': False,
+                                        'caustics_refractive': False,
+                                        'pixel_filter_type': 'BLACKMAN_HARRIS',
+                                        'use_pass_z': False,
+                                        'use_pass_object_index': False,
+                                        'use_pass_vector': False}}
+
 class config():
 
     def __init__(self,
@@ -149,6 +206,12 @@ class config():
         self.keys_to_exclude_from_config_dict = input_json_dict.get('keys_to_exclude_from_config_dict',
                                                                     ['frames_TO_L_frames_from_video_review_dict',
                                                                      'eyesRF_quat_dict']) # bc numpy arrays are not serializable...
+        # saves a json file with the wall time, CPU time and peak memory of each stage of main.main, next to the config json
+        # (off by default; always saved, with cProfile stats per stage, if main.py is run with --cprofile)
+        self.flag_save_profiling_as_json = input_json_dict.get('flag_save_profiling_as_json', False)
+        # saves a json file with the hash of the inputs of each frame (scene, render settings and camera pose), used to
+        # re-render only the frames that changed (see render_dependencies and run_rendering.py --incremental)
+        self.flag_save_render_hashes = input_json_dict.get('flag_save_render_hashes', True)
 
         ##########################################################################################################################3
         ### Parameters for reading/loading csv data
@@ -165,6 +228,21 @@ class config():
                                                                       1)
         self.geometry_csv_idx_col_start_data = input_json_dict.get('geometry_csv_idx_col_start_data',
                                                                    1)  # number of col (starting with 0) where numpy array assigned to the key=first csv elem starts
+        ## Meshes (e.g. from SLAM) added to the geometry in the numpy ray caster (see mesh_bvh and raycast_renderer)
+        # (offline rendering: a few s per full-resolution frame for a SLAM-size mesh, see mesh_bvh)
+        # .obj or .ply files; relative paths are relative to the folder of the geometry csv file
+        self.mesh_file_paths_list = input_json_dict.get('mesh_file_paths_list',
+                                                        [])
+        self.mesh_vertices_to_m = input_json_dict.get('mesh_vertices_to_m',
+                                                      1.0)  # factor to convert mesh vertices coords to m
+        self.mesh_bvh_n_triangles_per_leaf = input_json_dict.get('mesh_bvh_n_triangles_per_leaf',
+                                                                 4)
+        # rays are traversed through the BVH in square packets of pixels of this size, grouped in n_levels levels of
+        # packets of twice the size (see raycast_renderer.get_ray_tiles_hierarchy)
+        self.mesh_ray_packet_size_in_pixels = input_json_dict.get('mesh_ray_packet_size_in_pixels',
+                                                                  4)
+        self.mesh_ray_packet_n_levels = input_json_dict.get('mesh_ray_packet_n_levels',
+                                                            4)
 
         ## Transforms csv to dict------------------------------------------------------------------------------------------------------------
         # load transform data
@@ -187,6 +265,12 @@ class config():
                                                                                 self.transforms_csv_file_str))
         self.transforms_csv_n_header_rows_to_skip = input_json_dict.get('transforms_csv_n_header_rows_to_skip',
                                                                         1)
+        # if True, only the transforms for the animation frames (animation_frame_start_end) are loaded
+        # (without the data cache, the csv is only read up to the last animation frame; with the data cache, the
+        # cached table is sliced, but the whole csv is read once to build the cache entry, see
+        # load_data.csv_transforms_concatenated_to_dict)
+        self.flag_load_only_animation_frames = input_json_dict.get('flag_load_only_animation_frames',
+                                                                   True)
 
         # concatenate selected columns of transform CSV
         # (I don't think a user would need to change these... so no kwargs.get for now)
@@ -214,17 +298,44 @@ class config():
         self.frames_csv_idx_col_start_data = input_json_dict.get('frames_csv_idx_col_start_data',
                                                                  8)
 
+        ## Cache of parsed csv tables
+        # if True, parsed csv tables (geometry, transforms, eyesRF, TO/L frames) are saved as .npy files in the cache folder,
+        # and reloaded from there if the csv has not changed (see load_data.load_csv_with_cache). Off by default: the
+        # csv files are parsed in every run unless the cache is requested in the input json
+        self.flag_use_data_cache = input_json_dict.get('flag_use_data_cache',
+                                                       False)
+        self.data_cache_folder_path = input_json_dict.get('data_cache_folder_path',
+                                                          os.path.join(self.data_folder_path, '_cache'))
+        # ray direction per pixel for each camera configuration (see ray_tables.get_ray_table), saved as float32 .npy
+        # files if flag_use_data_cache is True
+        self.ray_table_cache_folder_path = input_json_dict.get('ray_table_cache_folder_path',
+                                                               os.path.join(self.data_cache_folder_path, 'ray_tables'))
+        # environment built by define_geometry.create_environment, saved as a .blend library per geometry and
+        # geometry-related config params, and appended (or linked) by later trials instead of rebuilt
+        # (see scene_cache.create_environment_with_cache). Off by default: the environment is built from the geometry
+        # csv unless the cache is requested in the input json
+        self.flag_use_scene_cache = input_json_dict.get('flag_use_scene_cache',
+                                                        False)
+        self.scene_cache_folder_path = input_json_dict.get('scene_cache_folder_path',
+                                                           os.path.join(self.data_cache_folder_path, 'scenes'))
+        self.scene_cache_import_mode = input_json_dict.get('scene_cache_import_mode',
+                                                           'APPEND')  # 'APPEND' (local copy) or 'LINK' (read-only, from the .blend file)
+
         ##############################################################################################################
         ### Add selected data directly to config: frames TO-L and eyesRF rot quat
         ## Add frames TO-L dict to config
-        self.frames_TO_L_frames_from_video_review_dict = load_data.csv_to_dict_TO_L_frames(self.frames_TO_L_csv_path_to_file,
-                                                                                           self.frames_csv_n_header_rows_to_skip,
-                                                                                           self.frames_csv_idx_col_start_data)
+        self.frames_TO_L_frames_from_video_review_dict = load_data.load_csv_with_cache(load_data.csv_to_dict_TO_L_frames,
+                                                                                       self.frames_TO_L_csv_path_to_file,
+                                                                                       [self.frames_csv_n_header_rows_to_skip,
+                                                                                        self.frames_csv_idx_col_start_data],
+                                                                                       self.data_cache_folder_path if self.flag_use_data_cache else None)
 
         ## Add eyesRF quaternions (to rotate from headRF ref pose to eyesRF) to config
-        self.eyesRF_quat_dict = load_data.csv_to_dict_keys_per_row(self.eyesRF_csv_path_to_file,
-                                                                   self.eyesRF_csv_n_header_rows_to_skip,
-                                                                   self.eyesRF_csv_idx_col_start_data)
+        self.eyesRF_quat_dict = load_data.load_csv_with_cache(load_data.csv_to_dict_keys_per_row,
+                                                              self.eyesRF_csv_path_to_file,
+                                                              [self.eyesRF_csv_n_header_rows_to_skip,
+                                                               self.eyesRF_csv_idx_col_start_data],
+                                                              self.data_cache_folder_path if self.flag_use_data_cache else None)
 
         ######################################################################################################################
         ### Scene parameters
@@ -324,11 +435,48 @@ class config():
         self.render_device = input_json_dict.get('render_device',
                                                  'GPU')  # engine: always Cycles
 
+        ## Render profile
+        # defaults for sampling, light paths, pixel filter and passes (see DICT_RENDER_PROFILES)
+        self.render_profile = input_json_dict.get('render_profile',
+                                                  'BLENDER_DEFAULT')  # options: 'BLENDER_DEFAULT', 'DATA_PASSES' (ground-truth passes only) or 'RGB_QUALITY'
+        if self.render_profile not in DICT_RENDER_PROFILES:
+            sys.exit("ERROR in config: render profile {} not in {}".format(self.render_profile,
+                                                                           list(DICT_RENDER_PROFILES.keys())))
+        render_profile_dict = DICT_RENDER_PROFILES[self.render_profile]
+
         ## Pixel filtering
         # Z, Material and Object passes are not anti-aliased; but Vector is. I disable it using the Box filter
         # with Box: pixel samples stay withi pixel (https://blender.stackexchange.com/questions/129636/how-does-anti-aliasing-work-in-cycles)
         self.pixel_filter_type = input_json_dict.get('pixel_filter_type',
-                                                     'BOX')  # preferred: BOX; options: BOX=no pixel filtering, BLACKMAN_HARRIS = Blackman Harris filter (this is the default in Blender, with pixel width 1.5)
+                                                     render_profile_dict['pixel_filter_type'])  # preferred: BOX; options: BOX=no pixel filtering, BLACKMAN_HARRIS = Blackman Harris filter (this is the default in Blender, with pixel width 1.5)
+
+        ## Sampling
+        self.render_samples = input_json_dict.get('render_samples',
+                                                  render_profile_dict['samples'])  # samples per pixel
+        self.render_use_adaptive_sampling = input_json_dict.get('render_use_adaptive_sampling',
+                                                                render_profile_dict['use_adaptive_sampling'])
+        self.render_adaptive_threshold = input_json_dict.get('render_adaptive_threshold',
+                                                             render_profile_dict['adaptive_threshold'])  # noise threshold for adaptive sampling
+        self.render_use_denoising = input_json_dict.get('render_use_denoising',
+                                                        render_profile_dict['use_denoising'])
+
+        ## Light paths
+        self.render_max_bounces = input_json_dict.get('render_max_bounces',
+                                                      render_profile_dict['max_bounces'])
+        self.render_diffuse_bounces = input_json_dict.get('render_diffuse_bounces',
+                                                          render_profile_dict['diffuse_bounces'])
+        self.render_glossy_bounces = input_json_dict.get('render_glossy_bounces',
+                                                         render_profile_dict['glossy_bounces'])
+        self.render_transmission_bounces = input_json_dict.get('render_transmission_bounces',
+                                                               render_profile_dict['transmission_bounces'])
+        self.render_volume_bounces = input_json_dict.get('render_volume_bounces',
+                                                         render_profile_dict['volume_bounces'])
+        self.render_transparent_max_bounces = input_json_dict.get('render_transparent_max_bounces',
+                                                                  render_profile_dict['transparent_max_bounces'])
+        self.render_caustics_reflective = input_json_dict.get('render_caustics_reflective',
+                                                              render_profile_dict['caustics_reflective'])
+        self.render_caustics_refractive = input_json_dict.get('render_caustics_refractive',
+                                                              render_profile_dict['caustics_refractive'])
 
         #################################################################################################################
         ## Image pixel resolution
@@ -397,6 +545,34 @@ class config():
         self.render_pixel_aspect_x_y = input_json_dict.get('render_pixel_aspect_x_y',
                                                            [1, 1])
 
+        ################################################################################################################
+        ## CPU threads and tile size (used if rendering on CPU, or if Cycles falls back to CPU because no GPU is available)
+        self.render_cpu_threads = input_json_dict.get('render_cpu_threads',
+                                                      0)  # 0: one thread per CPU (Blender's AUTO threads mode)
+        self.render_cpu_tile_x_y_in_pixels = input_json_dict.get('render_cpu_tile_x_y_in_pixels',
+                                                                 [64, 64])  # Blender's default
+        # if they are not set in the input json, use the fastest ones found by render_autotune for this machine,
+        # resolution and samples per pixel (if any). Off by default: the settings found on one machine are only used
+        # if requested in the input json
+        self.flag_use_render_autotune = input_json_dict.get('flag_use_render_autotune',
+                                                            False)
+        self.render_autotune_file_path = input_json_dict.get('render_autotune_file_path',
+                                                             os.path.join(self.data_cache_folder_path,
+                                                                          render_autotune.RENDER_AUTOTUNE_FILENAME))
+        # where the CPU threads and tile size come from ('input json', 'render_autotune' or 'default'), saved with the
+        # config (the device they are applied to is recorded by define_camera.set_rendering_parameters)
+        self.render_cpu_settings_source = 'input json' \
+            if any(param_str in input_json_dict for param_str in render_autotune.LIST_AUTOTUNED_PARAMS_STR) else 'default'
+        if self.flag_use_render_autotune and self.render_cpu_settings_source == 'default':
+            autotuned_settings_dict = render_autotune.load_autotuned_settings(self.render_autotune_file_path,
+                                                                              render_autotune.get_render_autotune_key(self))
+            if autotuned_settings_dict is not None:
+                self.render_cpu_threads = autotuned_settings_dict['render_cpu_threads']
+                self.render_cpu_tile_x_y_in_pixels = autotuned_settings_dict['render_cpu_tile_x_y_in_pixels']
+                self.render_cpu_settings_source = 'render_autotune'
+                print('Autotuned CPU render settings: {} threads, {} tiles'.format(self.render_cpu_threads,
+                                                                                  self.render_cpu_tile_x_y_in_pixels))
+
         ################################################################################################################
         ## Start/end frames for animation (and rendering if --render-anim flag is used)
         # Get TO-L frames for first and second leg
@@ -451,12 +627,15 @@ class config():
                                                      1)
         self.render_fps = input_json_dict.get('render_fps',
                                               30)  # (I think this is only atually used by Blender if I render a video)
+        # sampling rate of the motion capture system (animation frames match Vicon frames); used to express optic flow per second
+        self.mocap_sampling_rate_in_Hz = input_json_dict.get('mocap_sampling_rate_in_Hz',
+                                                             200)
 
         ## Passes
         self.render_use_pass_combined = input_json_dict.get('render_use_pass_combined', True)  # default: True; even if set to False it will produce it; combined=RGBA
-        self.render_use_pass_z = input_json_dict.get('render_use_pass_z', True)
-        self.render_use_pass_object_index = input_json_dict.get('render_use_pass_object_index', True)
-        self.render_use_pass_vector = input_json_dict.get('render_use_pass_vector', True)
+        self.render_use_pass_z = input_json_dict.get('render_use_pass_z', render_profile_dict['use_pass_z'])
+        self.render_use_pass_object_index = input_json_dict.get('render_use_pass_object_index', render_profile_dict['use_pass_object_index'])
+        self.render_use_pass_vector = input_json_dict.get('render_use_pass_vector', render_profile_dict['use_pass_vector'])  # can be set to False and the optic flow computed from the depth pass and camera poses instead (see optic_flow.py)
 
         ## Metadata stamps
         self.render_use_stamp = input_json_dict.get('render_use_stamp', True)
@@ -472,18 +651,59 @@ class config():
         self.render_use_overwrite = input_json_dict.get('render_use_overwrite', True)
         self.render_use_file_extension = input_json_dict.get('render_use_file_extension', True)
         self.render_use_render_cache = input_json_dict.get('render_use_render_cache', False)
+        # in worker mode (main.py --queue_dir), keep the render data (e.g. BVH) between frames and jobs (see render_worker)
+        self.render_server_use_persistent_data = input_json_dict.get('render_server_use_persistent_data', True)
+        # saves a json file with the render time of each frame, with the render profile and its params (see render_timing)
+        # (off by default; set by render_autotune and benchmark_render_profiles in the input jsons they render)
+        self.flag_save_render_times_as_json = input_json_dict.get('flag_save_render_times_as_json', False)
         self.render_output_file_format = input_json_dict.get('render_output_file_format', 'OPEN_EXR_MULTILAYER')  # Options: 'OPEN_EXR_MULTILAYER' or 'PNG'. For PNG I use default compression 15%
         self.render_image_color_mode = input_json_dict.get('render_image_color_mode', 'RGBA')
         self.render_image_color_depth = input_json_dict.get('render_image_color_depth', '32')  # Options: 16 or 32 for 'OPEN_EXR_MULTILAYER'; 8 por 16 for 'PNG'
         self.render_image_exr_codec = input_json_dict.get('render_image_exr_codec', 'ZIP')  # default
         self.render_image_use_preview = input_json_dict.get('render_image_use_preview', False)   # if true, saves as JPEG as well
 
+        ## Per-trial array store (rendered passes consolidated in chunked, compressed arrays, see trial_store)
+        # chunks span trial_store_frames_per_chunk frames and tiles of trial_store_tile_size_in_pixels x trial_store_tile_size_in_pixels pixels
+        self.trial_store_frames_per_chunk = input_json_dict.get('trial_store_frames_per_chunk',
+                                                                16)
+        self.trial_store_tile_size_in_pixels = input_json_dict.get('trial_store_tile_size_in_pixels',
+                                                                   128)
+        # dtype per pass: float16 keeps ~3 significant digits (depth to ~5 mm at 10 m; background depth becomes inf),
+        # uint8 is enough for object indices up to 255. Use 'float32' for the exact rendered values
+        self.trial_store_dtypes_dict = input_json_dict.get('trial_store_dtypes_dict',
+                                                           {'depth': 'float16',
+                                                            'object_index': 'uint8',
+                                                            'flow': 'float16'})
+
+        ## Semantic statistics (solid angle, centroid direction and depth percentiles per frame and object, see semantic_stats)
+        self.semantic_stats_depth_percentiles = input_json_dict.get('semantic_stats_depth_percentiles',
+                                                                    [5, 50, 95])
+        # frames read and processed at once (~50 bytes per pixel and frame in memory)
+        self.semantic_stats_frames_per_block = input_json_dict.get('semantic_stats_frames_per_block',
+                                                                   16)
+
         ###########################################################################################################################
         ### Camera keyframes definition
         ## Interpolation between keyframes
         self.interpolation_between_keyframes = input_json_dict.get('interpolation_between_keyframes',
                                                                    'CONSTANT') # CONSTANT= value between frames is equal to the previous frame value (no interpolation) Other: LINEAR (it shuldn't really matter but just to be sure)
 
+        ## Keyframe insertion
+        # if True, the action and F-curves of the camera are created directly and all keyframes are written at once;
+        # if False, keyframe_insert is called per frame (slower, same animation)
+        self.flag_insert_keyframes_in_bulk = input_json_dict.get('flag_insert_keyframes_in_bulk',
+                                                                 True)
+
+        ## Keyframe decimation (only applied if interpolation between keyframes is CONSTANT)
+        # if True, keyframes whose translation and rotation differ from the previous keyframe by less than the thresholds
+        # are removed (so the pose error at any frame is below the thresholds)
+        self.flag_decimate_keyframes = input_json_dict.get('flag_decimate_keyframes',
+                                                           False)
+        self.keyframe_decimation_max_translation_in_mm = input_json_dict.get('keyframe_decimation_max_translation_in_mm',
+                                                                             0.1)  # mm
+        self.keyframe_decimation_max_rotation_in_deg = input_json_dict.get('keyframe_decimation_max_rotation_in_deg',
+                                                                           0.05)  # deg
+
         ## Camera orientation wrt worldRF
         # OJO! In Blender Euler angles are rotations with respect to GLOBAL AXES. So if it is 'XYZ': first rotation is
         # around Xglobal, and second is around Yglobal (!!!), not the new Y-axis!, and third around Zglobal (not the new Zaxis!!)
@@ -550,9 +770,20 @@ class config():
                                                                     'wall_xmin': 10,
                                                                     'floor': 11,
                                                                     'ceiling': 12})
+        # meshes (keys as in mesh_file_paths_list): meshes not in the dict get consecutive indices after the max index above
+        self.dict_mesh_file_str_to_object_index = dict(input_json_dict.get('dict_mesh_file_str_to_object_index',
+                                                                           dict()))
+        for mesh_file_str in self.mesh_file_paths_list:
+            if mesh_file_str not in self.dict_mesh_file_str_to_object_index:
+                self.dict_mesh_file_str_to_object_index[mesh_file_str] = \
+                    max(list(self.dict_perch_str_to_object_index.values())
+                        + list(self.dict_obs_ID_to_object_index.values())
+                        + list(self.dict_planes_str_to_object_index.values())
+                        + list(self.dict_mesh_file_str_to_object_index.values())) + 1
         # check indices for object ID are unique
         self.list_indices_for_object_ID = list(self.dict_perch_str_to_object_index.values()) \
                                            + list(self.dict_obs_ID_to_object_index.values())   \
-                                           + list(self.dict_planes_str_to_object_index.values())
+                                           + list(self.dict_planes_str_to_object_index.values()) \
+                                           + list(self.dict_mesh_file_str_to_object_index.values())
         if len(set(self.list_indices_for_object_ID)) != len(self.list_indices_for_object_ID):
             sys.exit("ERROR in config: the indices for Blender's object ID are not unique")
@@ -10,6 +10,7 @@ import mathutils
 import numpy as np
 import sys
 import pdb
+import camera_poses
 
 
 def create_camera(scene,
@@ -29,6 +30,15 @@ def create_camera(scene,
                                           config)
     return camera_object
 
+def remove_camera_and_animation():
+    """
+    Remove the camera objects, cameras and actions (keyframes) of a previous trial, keeping the rest of the scene
+    (used by the render worker between trials with the same environment, see render_worker)
+    """
+    [bpy.data.objects.remove(obj) for obj in list(bpy.data.objects) if obj.type == 'CAMERA']
+    [bpy.data.cameras.remove(e) for e in bpy.data.cameras]
+    [bpy.data.actions.remove(e) for e in bpy.data.actions]
+
 def initialise_camera(scene,
                       config):
     """
@@ -111,7 +121,8 @@ def set_rendering_parameters(scene,
     Set rendering parameters
 
     Parameters:
-    - device
+    - device (and threads and tile size if rendering on CPU)
+    - pixel filter, sampling and light paths (see render profiles in config)
     - pixel resolution
     - rendering start/end frames and frame rate
     - passes
@@ -123,11 +134,40 @@ def set_rendering_parameters(scene,
     :return:
     """
     # Select device (GPU)
-    scene.cycles.device = config.render_device
+    # (if no GPU is enabled for Cycles, it renders on CPU: warn, and use the CPU threads and tile size of the config)
+    render_device = config.render_device
+    if render_device == 'GPU' and not bpy.context.preferences.addons['cycles'].preferences.has_active_device():
+        print('WARNING: no GPU device enabled for Cycles, rendering on CPU ({} threads, {} tiles)'
+              .format(config.render_cpu_threads or 'AUTO', config.render_cpu_tile_x_y_in_pixels))
+        render_device = 'CPU'
+    scene.cycles.device = render_device
+    config.render_device_applied = render_device  # (saved with the config, see main)
+
+    # CPU threads and tile size (see render_autotune)
+    if render_device == 'CPU':
+        scene.render.threads_mode = 'FIXED' if config.render_cpu_threads > 0 else 'AUTO'
+        if config.render_cpu_threads > 0:
+            scene.render.threads = config.render_cpu_threads
+        scene.render.tile_x = config.render_cpu_tile_x_y_in_pixels[0]
+        scene.render.tile_y = config.render_cpu_tile_x_y_in_pixels[1]
 
     # Set pixel filter: if BOX (preferred), pixel filtering is disabled
     scene.cycles.pixel_filter_type = config.pixel_filter_type
 
+    # Sampling and light paths (defaults from the render profile, see config.DICT_RENDER_PROFILES)
+    scene.cycles.samples = config.render_samples
+    scene.cycles.use_adaptive_sampling = config.render_use_adaptive_sampling
+    scene.cycles.adaptive_threshold = config.render_adaptive_threshold
+    scene.cycles.use_denoising = config.render_use_denoising
+    scene.cycles.max_bounces = config.render_max_bounces
+    scene.cycles.diffuse_bounces = config.render_diffuse_bounces
+    scene.cycles.glossy_bounces = config.render_glossy_bounces
+    scene.cycles.transmission_bounces = config.render_transmission_bounces
+    scene.cycles.volume_bounces = config.render_volume_bounces
+    scene.cycles.transparent_max_bounces = config.render_transparent_max_bounces
+    scene.cycles.caustics_reflective = config.render_caustics_reflective
+    scene.cycles.caustics_refractive = config.render_caustics_refractive
+
     # Pixel resolution
     scene.render.resolution_x = config.render_resolution_x_y_in_pixels[0]
     scene.render.resolution_y = config.render_resolution_x_y_in_pixels[1]
@@ -280,14 +320,13 @@ def insert_camera_keyframes(camera_object,
     """
     Insert camera keyframes for translation and rotation
 
-    - Gets quaternions to rotate Blender camera to desired initial pose, and to rotate headRF to eyesRF
-    - Looping thru rendering frames:
-        - insert translation keyframes as 'location' (use interp data if required)
-        - insert rotation keyframe
-            - get quaternions from csv data
-            - add appropriate rotation quaternion to camera object.
-                - Unless one of the flags for the special cases of the reference frame to track is True, the camera tracks the eyesRF (coord syst linked to the visual system)
-            - insert keyframe
+    - Computes the camera poses for all rendering frames at once (see camera_poses.compute_camera_poses):
+        - translation as 'location' (use interp data if required)
+        - rotation quaternion from csv data, combined with the quaternions to rotate Blender camera to desired initial pose,
+        and to rotate headRF to eyesRF
+            - Unless one of the flags for the special cases of the reference frame to track is True, the camera tracks the eyesRF (coord syst linked to the visual system)
+    - If required, removes keyframes whose pose is within tolerance of the previous keyframe (CONSTANT interpolation only)
+    - Looping thru rendering frames: insert translation and rotation keyframes
     - Set interpolation between all keyframes (Constant)
     - Set the scene camera to the camera object (otherwise Cycles won't find it)
 
@@ -298,81 +337,113 @@ def insert_camera_keyframes(camera_object,
     """
 
     ######################################################################################################################################
-    ### Compute quaternion to rotate Blender camera (applied first, same for all frames)
-    eul_worldRF_to_cameraRF_rad = mathutils.Euler(input_config.eul_worldRF_to_cameraRF_rad[0],
-                                                  input_config.eul_worldRF_to_cameraRF_rad[1])  # in rad!
-    quat_worldRF_to_cameraRF = eul_worldRF_to_cameraRF_rad.to_quaternion()
-
-    ### Compute quaternion to rotate headRF ref pose to eyesRF (same for all frames)
-    quat_from_headRF_t0_to_eyesRF = \
-        mathutils.Quaternion(input_config.eyesRF_quat_dict[input_config.date_bird_HP_pair_str])
-
-    ####################################################################################################################################################3
-    ### Insert keyframes at each frame
-    for frame in range(input_config.animation_frame_start_end[0],
-                       input_config.animation_frame_start_end[1] + 1):
-        ### get idx for this frame
-        idx_frame = np.where(transforms_dict['frame'] == frame)
-
-        ####################################################################################################################################################3
-        ### Insert translation keyframe (interp or not)
-        if input_config.flag_use_transform_interp:
-            camera_object.location = mathutils.Vector(
-                transforms_dict['transform_t_interp_XYZ'][idx_frame].squeeze() * input_config.mm_to_m)
-        else:
-            camera_object.location = mathutils.Vector(
-                transforms_dict['transform_t_XYZ'][idx_frame].squeeze() * input_config.mm_to_m)
-        camera_object.keyframe_insert(data_path='location',
-                                      frame=frame)
-
-        ####################################################################################################################################################
-        ### Insert rotation keyframe
-        # Rotate camera to desired pose --apply rotation to camera first! (quat_worldRF_to_cameraRF)
-
-        ### Get rotation quaternions from csv data
-        # (rotation from ref pose to pose at t; ref pose is headpack axes aligned with world axes; interp or not)
-        if input_config.flag_use_transform_interp:
-            quat_from_transforms_csv = mathutils.Quaternion(
-                transforms_dict['transform_q_interp_WXYZ'][idx_frame].squeeze())
+    ### Compute camera location and rotation for all frames
+    camera_poses_dict = camera_poses.compute_camera_poses(transforms_dict,
+                                                          input_config)
+
+    ### Remove redundant keyframes if required (only valid for CONSTANT interpolation)
+    if input_config.flag_decimate_keyframes:
+        if input_config.interpolation_between_keyframes != 'CONSTANT':
+            print('WARNING: keyframe decimation is only applied with CONSTANT interpolation between keyframes, '
+                  'but interpolation is {}. No keyframes removed'.format(input_config.interpolation_between_keyframes))
         else:
-            quat_from_transforms_csv = mathutils.Quaternion(
-                transforms_dict['transform_q_WXYZ'][idx_frame].squeeze())
-
-        ### Add the required rotation quaternion to camera object
-        ### Opt 1: camera tracks trajectoryRF
-        if input_config.flag_camera_tracks_trajectoryRF:
-            # check if csv path for transforms contains 'trajectoryRF'! if not, exit
-            if 'trajectoryRF' not in input_config.transforms_csv_path_to_file:
-                sys.exit("ERROR in config: the transforms csv data path does not contain 'trajectoryRF', but flag_camera_tracks_trajectoryRF is set to True")
-            camera_object.rotation_quaternion = quat_from_transforms_csv @ quat_worldRF_to_cameraRF
-
-        ### Opt 2: camera tracks headRF (coordinate system linked to headpack)
-        elif input_config.flag_camera_tracks_headRF:
-            camera_object.rotation_quaternion = quat_from_transforms_csv @ quat_worldRF_to_cameraRF
-
-        ### Opt 3: camera always parallel to worldRF
-        elif input_config.flag_camera_tracks_worldRF:
-            camera_object.rotation_quaternion = quat_worldRF_to_cameraRF
-
-        ### Opt 4: camera tracks eyesRF (visual system linked coord system)
-        # requires an additional rotation to eyesRF
-        else:
-            camera_object.rotation_quaternion = \
-                    quat_from_transforms_csv @ quat_from_headRF_t0_to_eyesRF @ quat_worldRF_to_cameraRF # I think this is correct: quat_from_worldRF_to_headRF*quat_from_headRF_to_eyesRF * quat_worldRF_to_cameraRF
-
-        # insert rotation keyframe
-        camera_object.keyframe_insert("rotation_quaternion",
-                                      frame=frame)
+            n_frames = camera_poses_dict['frame'].shape[0]
+            camera_poses_dict, n_keyframes_removed = \
+                camera_poses.decimate_camera_poses(camera_poses_dict,
+                                                   input_config.keyframe_decimation_max_translation_in_mm * input_config.mm_to_m,
+                                                   input_config.keyframe_decimation_max_rotation_in_deg)
+            print('Keyframe decimation: {} of {} keyframes removed '
+                  '(max translation error {} mm, max rotation error {} deg)'.format(n_keyframes_removed,
+                                                                                    n_frames,
+                                                                                    input_config.keyframe_decimation_max_translation_in_mm,
+                                                                                    input_config.keyframe_decimation_max_rotation_in_deg))
 
-    #############################################################################################################################################################
-    ## Set interpolation between keyframes
-    # https://blender.stackexchange.com/questions/27157/how-to-change-to-constant-interpolation-mode-from-a-python-script
-    list_of_fcurves = camera_object.animation_data.action.fcurves
-    for fcurve in list_of_fcurves:
-        for kf in fcurve.keyframe_points:
-            kf.interpolation = input_config.interpolation_between_keyframes
+    ####################################################################################################################################################3
+    ### Insert keyframes
+    if input_config.flag_insert_keyframes_in_bulk:
+        # create action and F-curves directly, and fill all keyframes at once
+        insert_keyframes_in_bulk(camera_object,
+                                 camera_poses_dict,
+                                 input_config.interpolation_between_keyframes)
+    else:
+        # insert keyframes frame by frame
+        for frame, location, rotation_quaternion in zip(camera_poses_dict['frame'],
+                                                        camera_poses_dict['location'],
+                                                        camera_poses_dict['rotation_quaternion']):
+            # insert translation keyframe
+            camera_object.location = mathutils.Vector(location)
+            camera_object.keyframe_insert(data_path='location',
+                                          frame=int(frame))
+
+            # insert rotation keyframe
+            camera_object.rotation_quaternion = mathutils.Quaternion(rotation_quaternion)
+            camera_object.keyframe_insert("rotation_quaternion",
+                                          frame=int(frame))
+
+        #############################################################################################################################################################
+        ## Set interpolation between keyframes
+        # https://blender.stackexchange.com/questions/27157/how-to-change-to-constant-interpolation-mode-from-a-python-script
+        list_of_fcurves = camera_object.animation_data.action.fcurves
+        for fcurve in list_of_fcurves:
+            for kf in fcurve.keyframe_points:
+                kf.interpolation = input_config.interpolation_between_keyframes
 
     #############################################################################################################################################################
     ## Set the scene camera to the camera object
     # https://blender.stackexchange.com/questions/67805/bpy-ops-render-render-does-not-find-camera
     bpy.context.scene.camera = camera_object
+
+
+def insert_keyframes_in_bulk(camera_object,
+                             camera_poses_dict,
+                             interpolation_str):
+    """
+    Insert location and rotation quaternion keyframes for all frames at once, writing the F-curves directly
+
+    It produces the same animation as calling keyframe_insert per frame for 'location' and 'rotation_quaternion'
+    and then setting the interpolation of every keyframe point, but with a constant number of API calls per F-curve:
+    - create the action (named as in keyframe_insert: <object name>Action) and assign it to the object
+    - create 7 F-curves (location XYZ, rotation_quaternion WXYZ) in the 'Object Transforms' group
+    - per F-curve: allocate all keyframe points in one call, and fill coordinates and interpolation from flat arrays
+    - update the F-curves (to recompute the handles, as keyframe_insert does)
+
+    :param camera_object:
+    :param camera_poses_dict: dict with 'frame', 'location' and 'rotation_quaternion' arrays (see camera_poses.compute_camera_poses)
+    :param interpolation_str: interpolation between keyframes (e.g. 'CONSTANT')
+    :return: action
+    """
+    frames_array = np.asarray(camera_poses_dict['frame'], dtype=np.float32)
+    n_keyframes = frames_array.shape[0]
+
+    # integer value of the interpolation enum (foreach_set requires ints for enum properties)
+    interpolation_enum_value = \
+        bpy.types.Keyframe.bl_rna.properties['interpolation'].enum_items[interpolation_str].value
+    interpolation_array = np.full(n_keyframes, interpolation_enum_value, dtype=np.int32)
+
+    # Create action and assign it to camera object
+    if camera_object.animation_data is None:
+        camera_object.animation_data_create()
+    action = bpy.data.actions.new(name=camera_object.name + 'Action')
+    camera_object.animation_data.action = action
+
+    # Create F-curves and fill keyframes
+    co_array = np.empty(2 * n_keyframes, dtype=np.float32)
+    co_array[0::2] = frames_array
+    for data_path, values_array in [('location', camera_poses_dict['location']),
+                                    ('rotation_quaternion', camera_poses_dict['rotation_quaternion'])]:
+        for idx in range(values_array.shape[1]):
+            fcurve = action.fcurves.new(data_path=data_path,
+                                        index=idx,
+                                        action_group='Object Transforms')
+            fcurve.keyframe_points.add(count=n_keyframes)
+            co_array[1::2] = values_array[:, idx]
+            fcurve.keyframe_points.foreach_set('co', co_array)
+            fcurve.keyframe_points.foreach_set('interpolation', interpolation_array)
+            fcurve.update()
+
+    # Set object's current location and rotation to the last keyframe (as after inserting keyframes frame by frame)
+    if n_keyframes > 0:
+        camera_object.location = mathutils.Vector(camera_poses_dict['location'][-1])
+        camera_object.rotation_quaternion = mathutils.Quaternion(camera_poses_dict['rotation_quaternion'][-1])
+
+    return action
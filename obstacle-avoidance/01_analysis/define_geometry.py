@@ -25,21 +25,8 @@ def create_environment(geometry_dict,
     :return:
     """
     ##########################################################################################3
-    ### Remove pre-existing objects
-    # (in default startup blend file: camera, light and cube)
-    # https://docs.blender.org/api/current/bpy.ops.html#overriding-context
-    context_copy = bpy.context.copy()
-    context_copy['selected_objects'] = list(bpy.context.scene.objects)
-    bpy.ops.object.delete(context_copy)
-
-    ### Delete pre-existing data blocks
-    # (if running the code several times in Blender, some data accumulate)
-    # remove cameras, materials, meshes, lights and actions from several runs (not sure this is the best way)
-    [bpy.data.cameras.remove(e) for e in bpy.data.cameras]
-    [bpy.data.materials.remove(e) for e in bpy.data.materials]
-    [bpy.data.meshes.remove(e) for e in bpy.data.meshes]
-    [bpy.data.lights.remove(e) for e in bpy.data.lights]
-    [bpy.data.actions.remove(e) for e in bpy.data.actions]
+    ### Remove pre-existing objects and data blocks
+    remove_pre_existing_objects()
 
     ##########################################################################################3
     ### Build perches (cylinders)
@@ -139,6 +126,27 @@ def create_environment(geometry_dict,
             obj.select_set(False)
 
 
+def remove_pre_existing_objects():
+    """
+    Remove the objects in the scene (in default startup blend file: camera, light and cube), and the cameras,
+    materials, meshes, lights and actions in the blend data
+    """
+    ### Remove pre-existing objects
+    # https://docs.blender.org/api/current/bpy.ops.html#overriding-context
+    context_copy = bpy.context.copy()
+    context_copy['selected_objects'] = list(bpy.context.scene.objects)
+    bpy.ops.object.delete(context_copy)
+
+    ### Delete pre-existing data blocks
+    # (if running the code several times in Blender, some data accumulate)
+    # remove cameras, materials, meshes, lights and actions from several runs (not sure this is the best way)
+    [bpy.data.cameras.remove(e) for e in bpy.data.cameras]
+    [bpy.data.materials.remove(e) for e in bpy.data.materials]
+    [bpy.data.meshes.remove(e) for e in bpy.data.meshes]
+    [bpy.data.lights.remove(e) for e in bpy.data.lights]
+    [bpy.data.actions.remove(e) for e in bpy.data.actions]
+
+
 def create_cylinder_between_points(P1, P2, R):
     """
     Create cylinder from coordinates of bases' centres and radius
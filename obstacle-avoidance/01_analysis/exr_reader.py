@@ -0,0 +1,314 @@
+import concurrent.futures
+import fnmatch
+import mmap
+import os
+import struct
+import sys
+import zlib
+import numpy as np
+
+# Reader for the OpenEXR files saved by Blender (render_output_file_format 'OPEN_EXR_MULTILAYER'), using only
+# zlib and numpy (no OpenEXR library required)
+#
+# Supported files: single-part scanline images, with NONE, ZIPS or ZIP compression (render_image_exr_codec) and
+# HALF, FLOAT or UINT channels (render_image_color_depth 16 or 32) without subsampling.
+#
+# File layout (see the OpenEXR file layout docs):
+# - magic number and version, then the header: a list of attributes (name, type, size, value), ending with a null byte
+# - offset table: the position in the file of each block of scanlines (16 scanlines per block for ZIP, 1 otherwise)
+# - blocks: y coord of the first scanline (int32), data size (int32) and data. For each scanline of the block, the data
+#   has the pixels of each channel in turn (channels in alphabetical order, as in the header)
+# ZIP/ZIPS blocks are zlib-compressed, after splitting the bytes in two halves (even and odd bytes) and
+# storing the difference between consecutive bytes (+128); blocks where compression does not reduce the size
+# are stored uncompressed.
+#
+# The header is read when the file is opened, and the blocks are decoded only when their channels are requested
+# (only the blocks covering the requested rows), with a pool of threads (zlib and numpy release the GIL). Each block
+# is decompressed once for all the requested channels. As each ZIP block compresses all the channels together,
+# reading one channel still decompresses the blocks it is in, but only that channel is converted and copied to the
+# output array.
+#
+# Channel names in Blender's multilayer files are <view layer>.<pass>.<channel>, e.g. 'ViewLayer.Depth.Z',
+# 'ViewLayer.IndexOB.X', 'ViewLayer.Vector.X' or 'ViewLayer.Combined.R'. Channels can be requested by their full
+# name, or by a pattern (fnmatch) of their full name or of the name without the view layer (e.g. 'IndexOB.X' or
+# 'Vector.*'). The output arrays have row 0 at the top of the image (as in the rendered images).
+
+EXR_MAGIC_NUMBER = 20000630
+
+# version flags
+EXR_FLAG_TILED = 0x200
+EXR_FLAG_DEEP = 0x800
+EXR_FLAG_MULTIPART = 0x1000
+
+# compression types: (name, number of scanlines per block), for the supported ones
+EXR_COMPRESSION_PER_ID = {0: ('NONE', 1),
+                          2: ('ZIPS', 1),
+                          3: ('ZIP', 16)}
+EXR_COMPRESSION_NAMES = ['NONE', 'RLE', 'ZIPS', 'ZIP', 'PIZ', 'PXR24', 'B44', 'B44A', 'DWAA', 'DWAB']
+
+# pixel types
+EXR_DTYPE_PER_PIXEL_TYPE = {0: np.dtype('<u4'),  # UINT
+                            1: np.dtype('<f2'),  # HALF
+                            2: np.dtype('<f4')}  # FLOAT
+
+
+def read_null_terminated_str(buffer,
+                             pos):
+    """
+    Read a null-terminated string from buffer at pos
+
+    :return: string, position after the null byte
+    """
+    end = buffer.index(b'\x00', pos)
+    return buffer[pos:end].decode('utf-8'), end + 1
+
+
+def parse_channel_list(value_bytes):
+    """
+    Parse the value of a 'chlist' attribute
+
+    :param value_bytes: attribute value
+    :return: list of channel dicts, with 'name', 'dtype', 'x_sampling' and 'y_sampling' (in the file's order)
+    """
+    list_channels = []
+    pos = 0
+    while value_bytes[pos] != 0:
+        name, pos = read_null_terminated_str(value_bytes, pos)
+        pixel_type, _, x_sampling, y_sampling = struct.unpack_from('<iI2i', value_bytes, pos)
+        pos += 16
+        if pixel_type not in EXR_DTYPE_PER_PIXEL_TYPE:
+            sys.exit('ERROR in exr_reader: unknown pixel type {} for channel {}'.format(pixel_type, name))
+        list_channels.append({'name': name,
+                              'dtype': EXR_DTYPE_PER_PIXEL_TYPE[pixel_type],
+                              'x_sampling': x_sampling,
+                              'y_sampling': y_sampling})
+    return list_channels
+
+
+def read_exr_header(filename):
+    """
+    Read the header and the offset table of an EXR file
+
+    :param filename: path to the .exr file
+    :return: header_dict, with keys
+        - 'filename', 'compression' (name), 'n_lines_per_block'
+        - 'channels': list of channel dicts (see parse_channel_list), with the byte offset of each channel
+          in a scanline ('offset_in_line')
+        - 'data_window': (x_min, y_min, x_max, y_max), 'image_shape': (n_rows, n_cols)
+        - 'n_bytes_per_line': number of bytes of all the channels in one (uncompressed) scanline
+        - 'block_offsets': array with the position in the file of each block
+        - 'attributes': dict with the raw bytes of every header attribute
+    """
+    with open(filename, 'rb') as f:
+        # the header is usually a few KB (read more if needed)
+        buffer = f.read(1 << 16)
+        magic, version = struct.unpack_from('<iI', buffer, 0)
+        if magic != EXR_MAGIC_NUMBER:
+            sys.exit('ERROR in exr_reader: {} is not an OpenEXR file'.format(filename))
+        if version & (EXR_FLAG_TILED | EXR_FLAG_DEEP | EXR_FLAG_MULTIPART):
+            sys.exit('ERROR in exr_reader: tiled, deep or multi-part files are not supported ({})'.format(filename))
+
+        ### Attributes
+        attributes_dict = {}
+        pos = 8
+        while True:
+            if pos + 1024 > len(buffer):
+                buffer += f.read(max(len(buffer), 1 << 16))
+            if pos >= len(buffer):
+                sys.exit('ERROR in exr_reader: truncated header in {}'.format(filename))
+            if buffer[pos] == 0:
+                pos += 1
+                break
+            name, pos = read_null_terminated_str(buffer, pos)
+            _, pos = read_null_terminated_str(buffer, pos)
+            (size,) = struct.unpack_from('<i', buffer, pos)
+            pos += 4
+            buffer += f.read(max(pos + size - len(buffer), 0))
+            if pos + size > len(buffer):
+                sys.exit('ERROR in exr_reader: truncated header in {}'.format(filename))
+            attributes_dict[name] = bytes(buffer[pos:pos + size])
+            pos += size
+
+        ### Required attributes
+        compression_id = attributes_dict['compression'][0]
+        if compression_id not in EXR_COMPRESSION_PER_ID:
+            sys.exit('ERROR in exr_reader: compression {} not supported (only NONE, ZIPS or ZIP) ({})'
+                     .format(EXR_COMPRESSION_NAMES[compression_id] if compression_id < len(EXR_COMPRESSION_NAMES)
+                             else compression_id, filename))
+        compression, n_lines_per_block = EXR_COMPRESSION_PER_ID[compression_id]
+        data_window = struct.unpack('<4i', attributes_dict['dataWindow'])
+        n_rows = data_window[3] - data_window[1] + 1
+        n_cols = data_window[2] - data_window[0] + 1
+        list_channels = parse_channel_list(attributes_dict['channels'])
+        offset_in_line = 0
+        for channel_dict in list_channels:
+            if channel_dict['x_sampling'] != 1 or channel_dict['y_sampling'] != 1:
+                sys.exit('ERROR in exr_reader: subsampled channels are not supported ({} in {})'
+                         .format(channel_dict['name'], filename))
+            channel_dict['offset_in_line'] = offset_in_line
+            offset_in_line += n_cols * channel_dict['dtype'].itemsize
+
+        ### Offset table
+        n_blocks = -(-n_rows // n_lines_per_block)
+        buffer += f.read(max(pos + 8 * n_blocks - len(buffer), 0))
+        if pos + 8 * n_blocks > len(buffer):
+            sys.exit('ERROR in exr_reader: truncated offset table in {}'.format(filename))
+        block_offsets = np.frombuffer(buffer, dtype='<u8', count=n_blocks, offset=pos).astype(np.int64)
+
+    return {'filename': filename,
+            'compression': compression,
+            'n_lines_per_block': n_lines_per_block,
+            'channels': list_channels,
+            'data_window': data_window,
+            'image_shape': (n_rows, n_cols),
+            'n_bytes_per_line': offset_in_line,
+            'block_offsets': block_offsets,
+            'attributes': attributes_dict}
+
+
+def get_channel_names(header_dict,
+                      list_channel_patterns=None):
+    """
+    Get the names of the channels in the file that match any of the patterns, matching either the full name or
+    the name without the view layer (e.g. 'Depth.Z', 'Vector.*')
+
+    :param header_dict: see read_exr_header
+    :param list_channel_patterns: list of names or fnmatch patterns; if None, all the channels
+    :return: list of channel names (in the file's order)
+    """
+    list_names = [c['name'] for c in header_dict['channels']]
+    if list_channel_patterns is None:
+        return list_names
+    list_matched_names = []
+    for pattern in list_channel_patterns:
+        list_matches = [n for n in list_names if fnmatch.fnmatchcase(n, pattern) or fnmatch.fnmatchcase(n, '*.' + pattern)]
+        if not list_matches:
+            sys.exit('ERROR in exr_reader: no channel matches {} in {} (channels: {})'
+                     .format(pattern, header_dict['filename'], list_names))
+        list_matched_names += [n for n in list_matches if n not in list_matched_names]
+    return [n for n in list_names if n in list_matched_names]
+
+
+def decompress_zip_block(data_bytes,
+                         n_bytes_uncompressed):
+    """
+    Decompress a ZIP/ZIPS block: inflate, undo the byte differences and interleave the two halves
+
+    :param data_bytes: compressed data of the block
+    :param n_bytes_uncompressed: size of the uncompressed data
+    :return: uint8 array of shape (n_bytes_uncompressed,)
+    """
+    deltas = np.frombuffer(zlib.decompress(data_bytes, bufsize=n_bytes_uncompressed), dtype=np.uint8).copy()
+    deltas[1:] -= 128
+    values = np.cumsum(deltas, dtype=np.uint8)
+    block_bytes = np.empty(n_bytes_uncompressed, dtype=np.uint8)
+    n_even = (n_bytes_uncompressed + 1) // 2
+    block_bytes[0::2] = values[:n_even]
+    block_bytes[1::2] = values[n_even:]
+    return block_bytes
+
+
+def decode_block(header_dict,
+                 file_buffer,
+                 idx_block):
+    """
+    Get the uncompressed data of a block of scanlines
+
+    :param header_dict: see read_exr_header
+    :param file_buffer: buffer with the file contents (e.g. an mmap)
+    :param idx_block: index of the block in the offset table
+    :return: y coord of the first scanline of the block (relative to the data window), and the block data as a uint8
+        array of shape (n_lines, n_bytes_per_line)
+    """
+    offset = int(header_dict['block_offsets'][idx_block])
+    if offset <= 0 or offset + 8 > len(file_buffer):
+        sys.exit('ERROR in exr_reader: block {} of {} is missing (incomplete file?)'.format(idx_block,
+                                                                                          header_dict['filename']))
+    y, data_size = struct.unpack_from('<2i', file_buffer, offset)
+    y_in_window = y - header_dict['data_window'][1]
+    n_lines = min(header_dict['n_lines_per_block'], header_dict['image_shape'][0] - y_in_window)
+    n_bytes_uncompressed = n_lines * header_dict['n_bytes_per_line']
+    data_bytes = file_buffer[offset + 8:offset + 8 + data_size]
+    if header_dict['compression'] == 'NONE' or data_size >= n_bytes_uncompressed:
+        block_bytes = np.frombuffer(data_bytes, dtype=np.uint8)
+    else:
+        block_bytes = decompress_zip_block(data_bytes, n_bytes_uncompressed)
+    return y_in_window, block_bytes.reshape(n_lines, header_dict['n_bytes_per_line'])
+
+
+def read_exr_channels(filename,
+                      list_channel_patterns=None,
+                      row_start_end=None,
+                      n_threads=None,
+                      header_dict=None):
+    """
+    Read channels of an EXR file as arrays
+
+    :param filename: path to the .exr file
+    :param list_channel_patterns: names or patterns of the channels to read (see get_channel_names); if None, all
+    :param row_start_end: if given, only rows row_start to row_end (excluded) are read (and only the blocks with them
+        are decoded)
+    :param n_threads: number of threads decoding blocks (default: number of cores; 1 to decode in this thread)
+    :param header_dict: header of the file, if already read (see read_exr_header)
+    :return: dict with an array of shape (n_rows, n_cols) per channel name, with the channel's dtype
+        (float32 for FLOAT, float16 for HALF, uint32 for UINT)
+    """
+    header_dict = header_dict or read_exr_header(filename)
+    n_rows, n_cols = header_dict['image_shape']
+    row_start, row_end = row_start_end if row_start_end is not None else (0, n_rows)
+    list_channels = [c for c in header_dict['channels']
+                     if c['name'] in get_channel_names(header_dict, list_channel_patterns)]
+    channels_dict = {c['name']: np.empty((row_end - row_start, n_cols), dtype=c['dtype']) for c in list_channels}
+
+    # blocks with the rows required (the block index of each row is independent of the line order)
+    n_lines_per_block = header_dict['n_lines_per_block']
+    idcs_blocks = range(row_start // n_lines_per_block, -(-row_end // n_lines_per_block))
+
+    def copy_block_to_channels(file_buffer, idx_block):
+        y_in_window, block_bytes = decode_block(header_dict, file_buffer, idx_block)
+        row_0, row_1 = max(y_in_window, row_start), min(y_in_window + block_bytes.shape[0], row_end)
+        for channel_dict in list_channels:
+            n_bytes = n_cols * channel_dict['dtype'].itemsize
+            channel_bytes = block_bytes[row_0 - y_in_window:row_1 - y_in_window,
+                                        channel_dict['offset_in_line']:channel_dict['offset_in_line'] + n_bytes]
+            channels_dict[channel_dict['name']][row_0 - row_start:row_1 - row_start] = \
+                np.ascontiguousarray(channel_bytes).view(channel_dict['dtype'])
+
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_buffer:
+        n_threads = n_threads or os.cpu_count() or 1
+        if n_threads <= 1:
+            for idx_block in idcs_blocks:
+                copy_block_to_channels(file_buffer, idx_block)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+                # (result() raises the exceptions of the threads, if any)
+                for future in [executor.submit(copy_block_to_channels, file_buffer, i) for i in idcs_blocks]:
+                    future.result()
+    return channels_dict
+
+
+def read_exr_passes(filename,
+                    list_pass_str=('Depth', 'IndexOB', 'Vector'),
+                    n_threads=None):
+    """
+    Read Blender passes from a multilayer EXR file, with the channels of each pass stacked in the last axis
+
+    :param filename: path to the .exr file
+    :param list_pass_str: names of the passes (e.g. 'Depth', 'IndexOB', 'Vector', 'Combined')
+    :param n_threads: see read_exr_channels
+    :return: dict with an array per pass, of shape (n_rows, n_cols) for single channel passes (Depth, IndexOB)
+        and (n_rows, n_cols, n_channels) otherwise (channels in R, G, B, A or X, Y, Z, W order, rather than the
+        alphabetical order in the file)
+    """
+    header_dict = read_exr_header(filename)
+    channels_dict = read_exr_channels(filename,
+                                      [pass_str + '.*' for pass_str in list_pass_str],
+                                      n_threads=n_threads,
+                                      header_dict=header_dict)
+    passes_dict = {}
+    for pass_str in list_pass_str:
+        list_names = sorted(get_channel_names(header_dict, [pass_str + '.*']),
+                            key=lambda n: 'RGBAXYZW'.find(n.split('.')[-1]))
+        passes_dict[pass_str] = channels_dict[list_names[0]] if len(list_names) == 1 \
+            else np.stack([channels_dict[n] for n in list_names], axis=-1)
+    return passes_dict
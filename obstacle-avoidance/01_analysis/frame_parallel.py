@@ -0,0 +1,219 @@
+import concurrent.futures
+import multiprocessing
+import os
+import time
+import numpy as np
+import optic_flow
+import raycast_renderer
+
+# Frame-parallel computation of the software passes (depth and object index from raycast_renderer, and optic flow
+# from optic_flow), outside Blender
+#
+# The camera poses (camera_poses.compute_camera_poses, the same poses passed to define_camera.insert_camera_keyframes)
+# are split in chunks of consecutive frames, which are processed by a pool of worker processes:
+# - the scene (primitives, meshes' BVH and ray tiles) is set up once in the parent process, and sent once
+#   to each worker (in the pool initializer)
+# - the outputs are .npy files of shape (n_frames, n_rows, n_cols[, 2]), created by the parent process and opened
+#   as memory maps by the workers. Each worker writes its chunks directly into them, so no image arrays are sent
+#   back to the parent (only the frame range and time of each chunk)
+# - chunks write disjoint slices of the outputs, so no locks are needed
+#
+# The flow of the last frame of a chunk needs the pose of the next frame only (not its depth), so chunks are
+# independent. The flow of the last frame in camera_poses_dict is nan (as in optic_flow.compute_optic_flow_for_camera_poses).
+#
+# Each worker should run single-threaded numpy: if numpy is linked to a multi-threaded BLAS, set OMP_NUM_THREADS=1
+# (or OPENBLAS_NUM_THREADS / MKL_NUM_THREADS) before starting Python, so that the workers do not oversubscribe the cores.
+
+# output .npy files in the output folder (the optic flow ones only if it is computed)
+OUTPUT_FILE_STR_PER_PASS = {'frame': 'frame.npy',
+                            'depth': 'depth.npy',
+                            'object_index': 'object_index.npy',
+                            'displacement_x_y_in_pixels': 'optic_flow_displacement_x_y_in_pixels.npy',
+                            'angular_velocity_lon_lat_in_rad_per_s': 'optic_flow_angular_velocity_lon_lat_in_rad_per_s.npy',
+                            'angular_speed_in_rad_per_s': 'optic_flow_angular_speed_in_rad_per_s.npy'}
+
+# state of each worker process (set by init_worker)
+worker_state_dict = {}
+
+
+def create_output_arrays(output_folder_path,
+                         frames_array,
+                         image_shape,
+                         flag_optic_flow):
+    """
+    Create the output .npy files (filled with nan, or 0 for the object index), with the frames in frames_array
+
+    :param output_folder_path: path to folder for the output files (created if it doesn't exist)
+    :param frames_array: array of shape (n_frames,) with the frame numbers
+    :param image_shape: (n_rows, n_cols)
+    :param flag_optic_flow: if True, the optic flow files are created too
+    :return: dict with the path to each output file per pass (see OUTPUT_FILE_STR_PER_PASS)
+    """
+    os.makedirs(output_folder_path, exist_ok=True)
+    n_frames = len(frames_array)
+    shape_per_pass = {'depth': (n_frames,) + tuple(image_shape),
+                      'object_index': (n_frames,) + tuple(image_shape)}
+    if flag_optic_flow:
+        shape_per_pass.update({'displacement_x_y_in_pixels': (n_frames,) + tuple(image_shape) + (2,),
+                               'angular_velocity_lon_lat_in_rad_per_s': (n_frames,) + tuple(image_shape) + (2,),
+                               'angular_speed_in_rad_per_s': (n_frames,) + tuple(image_shape)})
+
+    output_paths_dict = {'frame': os.path.join(output_folder_path, OUTPUT_FILE_STR_PER_PASS['frame'])}
+    np.save(output_paths_dict['frame'], np.asarray(frames_array, dtype=np.int64))
+    for pass_str, shape in shape_per_pass.items():
+        output_paths_dict[pass_str] = os.path.join(output_folder_path, OUTPUT_FILE_STR_PER_PASS[pass_str])
+        array = np.lib.format.open_memmap(output_paths_dict[pass_str],
+                                          mode='w+',
+                                          dtype=np.float32,
+                                          shape=shape)
+        array[:] = 0 if pass_str == 'object_index' else np.nan
+        array.flush()
+        del array
+    return output_paths_dict
+
+
+def init_worker(scene_dict,
+                camera_poses_dict,
+                input_config,
+                output_paths_dict):
+    """
+    Initializer of the worker processes: keep the scene and the camera poses, and open the outputs as memory maps
+
+    :param scene_dict: see raycast_renderer.get_scene_for_rendering
+    :param camera_poses_dict: dict with 'frame', 'location' and 'rotation_quaternion' (see camera_poses.compute_camera_poses)
+    :param input_config: config
+    :param output_paths_dict: see create_output_arrays
+    """
+    worker_state_dict.clear()
+    worker_state_dict.update({'scene_dict': scene_dict,
+                              'camera_poses_dict': camera_poses_dict,
+                              'input_config': input_config,
+                              'output_arrays_dict': {pass_str: np.load(path, mmap_mode='r+')
+                                                     for pass_str, path in output_paths_dict.items()
+                                                     if pass_str != 'frame'}})
+
+
+def compute_chunk(idx_frame_start,
+                  idx_frame_end):
+    """
+    Compute the passes of the frames in rows idx_frame_start to idx_frame_end (excluded) of the camera poses,
+    and write them into the output memory maps (in a worker process, after init_worker)
+
+    :param idx_frame_start: first row of the chunk in the camera poses
+    :param idx_frame_end: last row of the chunk in the camera poses (excluded)
+    :return: idx_frame_start, idx_frame_end, time to compute the chunk in s
+    """
+    t0 = time.perf_counter()
+    scene_dict = worker_state_dict['scene_dict']
+    camera_poses_dict = worker_state_dict['camera_poses_dict']
+    output_arrays_dict = worker_state_dict['output_arrays_dict']
+
+    ### Depth and object index
+    depth_output_array = output_arrays_dict['depth']
+    object_index_output_array = output_arrays_dict['object_index']
+    for idx_frame in range(idx_frame_start, idx_frame_end):
+        depth_output_array[idx_frame], object_index_output_array[idx_frame] = \
+            raycast_renderer.render_frame(scene_dict,
+                                          camera_poses_dict['location'][idx_frame],
+                                          camera_poses_dict['rotation_quaternion'][idx_frame])
+
+    ### Optic flow (for the frames of the chunk that have a next frame)
+    idx_frame_end_with_next = min(idx_frame_end, len(camera_poses_dict['frame']) - 1)
+    if 'angular_speed_in_rad_per_s' in output_arrays_dict and idx_frame_end_with_next > idx_frame_start:
+        frames_slice = slice(idx_frame_start, idx_frame_end_with_next)
+        next_frames_slice = slice(idx_frame_start + 1, idx_frame_end_with_next + 1)
+        optic_flow_dict = optic_flow.compute_optic_flow(depth_output_array[frames_slice],
+                                                        scene_dict['ray_table'],
+                                                        camera_poses_dict['location'][frames_slice],
+                                                        camera_poses_dict['rotation_quaternion'][frames_slice],
+                                                        camera_poses_dict['location'][next_frames_slice],
+                                                        camera_poses_dict['rotation_quaternion'][next_frames_slice],
+                                                        worker_state_dict['input_config'])
+        for pass_str, array in optic_flow_dict.items():
+            output_arrays_dict[pass_str][frames_slice] = array
+
+    for array in output_arrays_dict.values():
+        array.flush()
+    return idx_frame_start, idx_frame_end, time.perf_counter() - t0
+
+
+def render_frames_in_parallel(geometry_dict,
+                              camera_poses_dict,
+                              input_config,
+                              output_folder_path,
+                              n_workers=None,
+                              n_frames_per_chunk=8,
+                              flag_optic_flow=False,
+                              tile_size_in_pixels=32,
+                              ray_table_cache_folder_path=None,
+                              data_cache_folder_path=None,
+                              flag_verbose=True):
+    """
+    Render the depth and object index maps (and optionally compute the optic flow) for every frame in
+    camera_poses_dict, in chunks of frames processed by a pool of worker processes
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param camera_poses_dict: dict with 'frame', 'location' and 'rotation_quaternion' (see camera_poses.compute_camera_poses)
+    :param input_config: config
+    :param output_folder_path: path to folder for the output .npy files (see OUTPUT_FILE_STR_PER_PASS)
+    :param n_workers: number of worker processes (default: number of cores). If 1, the chunks are processed in
+        this process (no pool)
+    :param n_frames_per_chunk: number of consecutive frames per chunk
+    :param flag_optic_flow: if True, the optic flow is computed too (see optic_flow.compute_optic_flow)
+    :param tile_size_in_pixels: number of pixels per side of the tiles of rays (see raycast_renderer.get_ray_tiles)
+    :param ray_table_cache_folder_path: path to folder for the ray tables saved to disk (see ray_tables.get_ray_table)
+    :param data_cache_folder_path: path to the data cache folder, where the meshes' BVH are cached
+    :param flag_verbose: if True, print the progress per chunk
+    :return: output_arrays_dict, with the outputs opened as read-only memory maps (and 'frame'), and the
+        time per chunk in s ('time_per_chunk_in_s')
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    camera_poses_dict = {k: np.asarray(camera_poses_dict[k]) for k in ['frame', 'location', 'rotation_quaternion']}
+    n_frames = len(camera_poses_dict['frame'])
+    list_chunks = [(i0, min(i0 + n_frames_per_chunk, n_frames)) for i0 in range(0, n_frames, n_frames_per_chunk)]
+
+    ### Set up the scene and create the outputs
+    scene_dict = raycast_renderer.get_scene_for_rendering(geometry_dict,
+                                                          input_config,
+                                                          tile_size_in_pixels,
+                                                          ray_table_cache_folder_path,
+                                                          data_cache_folder_path)
+    output_paths_dict = create_output_arrays(output_folder_path,
+                                             camera_poses_dict['frame'],
+                                             scene_dict['ray_table'].shape[:2],
+                                             flag_optic_flow)
+    initargs = (scene_dict, camera_poses_dict, input_config, output_paths_dict)
+
+    ### Compute chunks
+    time_per_chunk_in_s = np.zeros(len(list_chunks))
+    n_workers = min(n_workers, len(list_chunks))
+    if flag_verbose:
+        print('Computing {} frames in {} chunks with {} worker(s)...'.format(n_frames, len(list_chunks), n_workers))
+    if n_workers <= 1:
+        init_worker(*initargs)
+        list_results = (compute_chunk(*chunk) for chunk in list_chunks)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                          mp_context=multiprocessing.get_context(),
+                                                          initializer=init_worker,
+                                                          initargs=initargs)
+        list_results = (future.result() for future in
+                        concurrent.futures.as_completed([executor.submit(compute_chunk, *chunk)
+                                                         for chunk in list_chunks]))
+    try:
+        for n_done, (idx_frame_start, idx_frame_end, time_in_s) in enumerate(list_results, start=1):
+            time_per_chunk_in_s[idx_frame_start // n_frames_per_chunk] = time_in_s
+            if flag_verbose:
+                print('    chunk {}/{} (frames {}-{}): {:.2f} s'.format(n_done,
+                                                                       len(list_chunks),
+                                                                       camera_poses_dict['frame'][idx_frame_start],
+                                                                       camera_poses_dict['frame'][idx_frame_end - 1],
+                                                                       time_in_s))
+    finally:
+        if n_workers > 1:
+            executor.shutdown(cancel_futures=True)
+        worker_state_dict.clear()
+
+    output_arrays_dict = {pass_str: np.load(path, mmap_mode='r') for pass_str, path in output_paths_dict.items()}
+    output_arrays_dict['time_per_chunk_in_s'] = time_per_chunk_in_s
+    return output_arrays_dict
@@ -5,7 +5,16 @@
 #  Copyright (c) 2021, Sofia Minano Gonzalez
 #  All rights reserved.
 
+import argparse
 import csv
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
 import numpy as np
 import config
 
@@ -38,7 +47,7 @@ def csv_to_dict_keys_per_row(filename,
             if '' in rows[idx_col_start_data:]: #if any is empty: assign all nan
                 dict_geometry[rows[0]] = np.array([np.nan]*len(rows[idx_col_start_data:]))
             else:
-                dict_geometry[rows[0]] = np.array([np.float(r) for r in rows[idx_col_start_data:]]) # rows is a list where each elem is a comma-sep value
+                dict_geometry[rows[0]] = np.array([float(r) for r in rows[idx_col_start_data:]]) # rows is a list where each elem is a comma-sep value
 
     return dict_geometry
 
@@ -81,36 +90,329 @@ def csv_to_dict_keys_per_col(filename,
 
     return dict_transforms
 
+
+def csv_lines_to_float_array(list_of_lines,
+                             n_cols):
+    """
+    Parses a list of csv lines (numeric data only) into a 2-dim float64 numpy array of shape (n_lines, n_cols)
+
+    - All cells of the block are converted in one numpy call (rather than one float() per cell)
+    - Empty cells are set to nan
+    - Empty lines at the end of the block (e.g. at the end of the file) are ignored
+
+    :param list_of_lines: list of strings, one per csv row, as read from the file (i.e., with trailing newline)
+    :param n_cols: number of columns expected per row
+    :return: data_array
+    """
+    block_str = ''.join(list_of_lines).replace('\r', '').rstrip('\n')
+    if not block_str:
+        return np.empty((0, n_cols), dtype=np.float64)
+    n_rows = block_str.count('\n') + 1
+
+    # make the block one comma-sep string, and fill empty cells with nan
+    # (padded with commas so that empty cells at the start/end of the block are also filled;
+    # replace is applied until no ',,' is left because consecutive empty cells overlap)
+    block_str = ',' + block_str.replace('\n', ',') + ','
+    while ',,' in block_str:
+        block_str = block_str.replace(',,', ',nan,')
+
+    # parse all cells at once
+    data_array = np.fromstring(block_str[1:-1], sep=',')
+    if data_array.size != n_rows * n_cols:
+        raise ValueError('Some rows in the csv block do not have {} numeric columns'.format(n_cols))
+
+    return data_array.reshape(n_rows, n_cols)
+
+
+def csv_to_dict_keys_per_col_bulk(filename,
+                                  n_header_rows_to_skip,
+                                  n_rows_per_chunk=100000):
+    """
+    Bulk version of csv_to_dict_keys_per_col: returns the same dictionary, but parses the data in blocks of rows
+    with numpy rather than cell by cell
+
+    - keys = every element in first csv row, after skipping the required ones (header parsed once)
+    - values = for every key, a numpy array with the column data:
+        - if key contains the string 'frame': int array
+        - else: float64 array (empty cells are nan)
+
+    The file is read in a single pass, n_rows_per_chunk rows at a time, so that the intermediate strings for very long
+    exports (e.g. 200 Hz sessions) are never all in memory at once.
+
+    Inputs
+    - filename: name of csv file
+    - n_header_rows_to_skip: number of header rows to skip
+    - n_rows_per_chunk: number of data rows parsed per numpy call
+    """
+
+    with open(filename, mode='r') as infile:
+        # skip required rows
+        for i in range(n_header_rows_to_skip):
+            next(infile)
+        # take first row as keys (parsed with csv module in case they are quoted)
+        list_of_keys_in_order = next(csv.reader([next(infile)]))
+        n_cols = len(list_of_keys_in_order)
+
+        # parse data rows in chunks
+        list_of_data_chunks = []
+        while True:
+            list_of_lines = list(itertools.islice(infile, n_rows_per_chunk))
+            if not list_of_lines:
+                break
+            list_of_data_chunks.append(csv_lines_to_float_array(list_of_lines,
+                                                                n_cols))
+
+    if list_of_data_chunks:
+        data_array = np.concatenate(list_of_data_chunks, axis=0)
+    else:
+        data_array = np.empty((0, n_cols), dtype=np.float64)
+
+    return data_array_to_dict_keys_per_col(data_array,
+                                           list_of_keys_in_order)
+
+
+def data_array_to_dict_keys_per_col(data_array,
+                                    list_of_keys_in_order):
+    """
+    Splits a 2-dim array of csv data into a dict with keys per column (as in csv_to_dict_keys_per_col)
+    - if key contains the string 'frame': format as int; else format as float
+
+    :param data_array: 2-dim float array (rows x columns)
+    :param list_of_keys_in_order: list of keys, one per column
+    :return: dict_transforms
+    """
+    dict_transforms = dict()
+    for i, k in enumerate(list_of_keys_in_order):
+        if 'frame' in k:
+            dict_transforms[k] = data_array[:, i].astype(int)
+        else:
+            dict_transforms[k] = np.ascontiguousarray(data_array[:, i])
+
+    return dict_transforms
+
+
+def csv_to_npy_files_keys_per_col_bulk(filename,
+                                        n_header_rows_to_skip,
+                                        dir_path,
+                                        n_rows_per_chunk=100000):
+    """
+    Writes the table returned by csv_to_dict_keys_per_col_bulk to a dir, as one .npy file per key (as saved by
+    write_table_to_dir), parsing and writing n_rows_per_chunk rows at a time
+
+    The csv is read twice: first to count the data rows (to allocate the .npy files), then to parse them. Only one chunk
+    of rows is in memory at a time, so long exports can be cached in bounded memory (see load_csv_with_cache).
+
+    :param filename: path to csv file
+    :param n_header_rows_to_skip: number of header rows to skip
+    :param dir_path: path to dir for the .npy files
+    :param n_rows_per_chunk: number of data rows parsed and written at a time
+    :return: dict with the table details for the manifest (as write_table_to_dir)
+    """
+    with open(filename, mode='r') as infile:
+        for i in range(n_header_rows_to_skip + 1):
+            next(infile)
+        n_rows = sum(1 for line in infile if line.strip())
+
+    with open(filename, mode='r') as infile:
+        # skip required rows
+        for i in range(n_header_rows_to_skip):
+            next(infile)
+        # take first row as keys (parsed with csv module in case they are quoted)
+        list_of_keys_in_order = next(csv.reader([next(infile)]))
+        n_cols = len(list_of_keys_in_order)
+
+        # one .npy file per key, with the dtype of data_array_to_dict_keys_per_col
+        list_of_npy_paths = [os.path.join(dir_path, '{:04d}.npy'.format(i)) for i in range(n_cols)]
+        list_of_dtypes = [np.dtype(int) if 'frame' in k else np.dtype(np.float64) for k in list_of_keys_in_order]
+        if n_rows == 0:
+            for npy_path, dtype in zip(list_of_npy_paths, list_of_dtypes):
+                np.save(npy_path, np.empty(0, dtype=dtype))
+            return {'keys': list_of_keys_in_order,
+                    'table_type': 'dict_of_arrays'}
+        list_of_npy_arrays = [np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=(n_rows,))
+                              for npy_path, dtype in zip(list_of_npy_paths, list_of_dtypes)]
+
+        # parse data rows in chunks, and write them to the .npy files
+        idx_row = 0
+        while True:
+            list_of_lines = list(itertools.islice(infile, n_rows_per_chunk))
+            if not list_of_lines:
+                break
+            chunk_array = csv_lines_to_float_array(list_of_lines,
+                                                   n_cols)
+            if idx_row + chunk_array.shape[0] > n_rows:
+                raise ValueError('The number of data rows in {} changed while reading it'.format(filename))
+            for i, npy_array in enumerate(list_of_npy_arrays):
+                npy_array[idx_row:idx_row + chunk_array.shape[0]] = chunk_array[:, i]
+            idx_row += chunk_array.shape[0]
+
+        for npy_array in list_of_npy_arrays:
+            npy_array.flush()
+    if idx_row != n_rows:
+        raise ValueError('The number of data rows in {} changed while reading it'.format(filename))
+
+    return {'keys': list_of_keys_in_order,
+            'table_type': 'dict_of_arrays'}
+
+
+def get_frame_from_csv_line(line,
+                            idx_frame_col):
+    """
+    Get frame number from a csv line, without parsing the rest of the line
+
+    :param line: csv line
+    :param idx_frame_col: idx of frame column
+    :return: frame (int)
+    """
+    return int(float(line.split(',', idx_frame_col + 1)[idx_frame_col]))
+
+
+def csv_to_frame_windows(filename,
+                         n_header_rows_to_skip,
+                         frame_start_end,
+                         n_frames_per_window=1000,
+                         frame_key_str='frame',
+                         n_rows_per_chunk=10000):
+    """
+    Streams a csv with data per column and rows per frame (e.g. transforms csv), and yields only the data within
+    a range of frames, in windows of a fixed number of frames
+
+    - Each window is a dict with keys per column (as in csv_to_dict_keys_per_col), for the frames
+    [frame_start + k*n_frames_per_window, frame_start + (k+1)*n_frames_per_window - 1] (cropped at frame_end)
+    - Windows with no rows are not yielded
+    - Rows in chunks of the file before frame_start are skipped without parsing (only their frame is read)
+    - Reading stops once a frame after frame_end is found (rows must be sorted by frame, as in the transforms exports)
+
+    The memory used is bounded by the window and chunk sizes, rather than by the length of the recording.
+
+    :param filename: path to csv file
+    :param n_header_rows_to_skip: number of header rows to skip
+    :param frame_start_end: list with first and last frame to load (both inclusive), e.g. config.animation_frame_start_end
+    :param n_frames_per_window: number of frames per yielded window
+    :param frame_key_str: key of the frame column
+    :param n_rows_per_chunk: number of rows read from the file at a time
+    :return: generator of dict_transforms (one per window)
+    """
+    frame_start, frame_end = int(frame_start_end[0]), int(frame_start_end[1])
+
+    with open(filename, mode='r') as infile:
+        # skip required rows
+        for i in range(n_header_rows_to_skip):
+            next(infile)
+        # take first row as keys
+        list_of_keys_in_order = next(csv.reader([next(infile)]))
+        n_cols = len(list_of_keys_in_order)
+        idx_frame_col = list_of_keys_in_order.index(frame_key_str)
+
+        buffer_array = np.empty((0, n_cols), dtype=np.float64)
+        window_start = frame_start
+        flag_end_of_range = False
+        while not flag_end_of_range:
+            ### Read next chunk of lines
+            list_of_lines = [l for l in itertools.islice(infile, n_rows_per_chunk) if l.strip()]
+            if not list_of_lines:
+                flag_end_of_range = True
+            else:
+                # first and last frame in chunk
+                first_frame_in_chunk = get_frame_from_csv_line(list_of_lines[0], idx_frame_col)
+                last_frame_in_chunk = get_frame_from_csv_line(list_of_lines[-1], idx_frame_col)
+                if first_frame_in_chunk > frame_end:
+                    flag_end_of_range = True
+                elif last_frame_in_chunk >= frame_start:
+                    # parse chunk and keep rows in range
+                    chunk_array = csv_lines_to_float_array(list_of_lines,
+                                                           n_cols)
+                    mask_in_range = (chunk_array[:, idx_frame_col] >= frame_start) & \
+                                    (chunk_array[:, idx_frame_col] <= frame_end)
+                    buffer_array = np.concatenate((buffer_array,
+                                                   chunk_array[mask_in_range]),
+                                                  axis=0)
+                    flag_end_of_range = last_frame_in_chunk >= frame_end
+
+            ### Yield complete windows
+            # (a window is complete if the buffer has frames after it, or if there is no more data in range)
+            while window_start <= frame_end:
+                window_end = min(window_start + n_frames_per_window - 1, frame_end)
+                if not flag_end_of_range and \
+                        (buffer_array.shape[0] == 0 or buffer_array[-1, idx_frame_col] <= window_end):
+                    break
+                mask_in_window = buffer_array[:, idx_frame_col] <= window_end
+                if np.any(mask_in_window):
+                    yield data_array_to_dict_keys_per_col(buffer_array[mask_in_window],
+                                                          list_of_keys_in_order)
+                buffer_array = buffer_array[~mask_in_window]
+                window_start = window_end + 1
+
+
+def csv_to_dict_keys_per_col_frame_range(filename,
+                                         n_header_rows_to_skip,
+                                         frame_start_end,
+                                         frame_key_str='frame'):
+    """
+    Reads csv with data per column and rows per frame, but only for the frames in the range frame_start_end
+    (both inclusive). Returns the same dict as csv_to_dict_keys_per_col, restricted to those frames.
+
+    Reading stops once a frame after frame_end is found (see csv_to_frame_windows).
+
+    :param filename: path to csv file
+    :param n_header_rows_to_skip: number of header rows to skip
+    :param frame_start_end: list with first and last frame to load, e.g. config.animation_frame_start_end
+    :param frame_key_str: key of the frame column
+    :return: dict_transforms
+    """
+    n_frames_in_range = int(frame_start_end[1]) - int(frame_start_end[0]) + 1
+    list_of_windows = list(csv_to_frame_windows(filename,
+                                                n_header_rows_to_skip,
+                                                frame_start_end,
+                                                n_frames_per_window=max(n_frames_in_range, 1),
+                                                frame_key_str=frame_key_str))
+    if list_of_windows:
+        return list_of_windows[0]
+
+    # no rows in range: empty arrays for every key
+    with open(filename, mode='r') as infile:
+        for i in range(n_header_rows_to_skip):
+            next(infile)
+        list_of_keys_in_order = next(csv.reader([next(infile)]))
+    return data_array_to_dict_keys_per_col(np.empty((0, len(list_of_keys_in_order))),
+                                           list_of_keys_in_order)
+
+
 def csv_transforms_concatenated_to_dict(config):
     """
     Creates a dict for the csv transform data per columns, and concatenates the numpy arrays of the required fields
     (typically to concatenate X,Y,Z coords into one key)
 
+    If config.flag_load_only_animation_frames is True, only the frames in config.animation_frame_start_end are loaded
+    in memory:
+    - if the data cache is disabled, the csv is read only up to the last animation frame (see
+    csv_to_dict_keys_per_col_frame_range): this is the only case where the flag reduces the csv I/O
+    - if the data cache is enabled, the cached table is sliced (the arrays are memory-mapped, so only the frame column
+    and the frames in range are read). If the table is not cached yet, the whole csv is read once to build the cache
+    entry (streamed in chunks of rows, see csv_to_npy_files_keys_per_col_bulk, so it is never fully parsed in memory),
+    so the flag gives no I/O benefit for that first run (prewarm the cache before a batch, see prewarm_data_cache)
+
     :param config:, contains details of fields to concatenate
     :return:
     """
 
     # Get dict with keys per column
-    dict_transforms = csv_to_dict_keys_per_col(config.transforms_csv_path_to_file,
-                                               config.transforms_csv_n_header_rows_to_skip)
+    if config.flag_load_only_animation_frames and not config.flag_use_data_cache:
+        dict_transforms = csv_to_dict_keys_per_col_frame_range(config.transforms_csv_path_to_file,
+                                                               config.transforms_csv_n_header_rows_to_skip,
+                                                               config.animation_frame_start_end)
+    else:
+        # from the data cache if enabled
+        dict_transforms = load_csv_with_cache(csv_to_dict_keys_per_col_bulk,
+                                              config.transforms_csv_path_to_file,
+                                              [config.transforms_csv_n_header_rows_to_skip],
+                                              config.data_cache_folder_path if config.flag_use_data_cache else None,
+                                              csv_to_cache_writer=csv_to_npy_files_keys_per_col_bulk)
+        if config.flag_load_only_animation_frames:
+            mask_in_range = (dict_transforms['frame'] >= config.animation_frame_start_end[0]) & \
+                            (dict_transforms['frame'] <= config.animation_frame_start_end[1])
+            dict_transforms = {k: np.asarray(v[mask_in_range]) for k, v in dict_transforms.items()}
 
-    ### concatenate XYZ/WXYZ arrays
-    dict_transforms_concatenated = dict()
-    # get list of original fields to concatenate
-    list_of_fields_to_concatenate = [i
-                                     for d in config.dict_fields_after_concat_to_list_of_fields_to_concatenate.values()
-                                     for i in d] #it's a dict_values of nested lists, unpack
-
-    # take keys and values from previous dict if not in list of fields to concatenate
-    for k in dict_transforms.keys():
-        if k not in list_of_fields_to_concatenate:
-            dict_transforms_concatenated[k] = dict_transforms[k]
-
-    # for the fields to concatenate:
-    for k in config.dict_fields_after_concat_to_list_of_fields_to_concatenate.keys():
-        dict_transforms_concatenated[k] = np.concatenate(tuple(dict_transforms[v][:, np.newaxis]
-                                                               for v in config.dict_fields_after_concat_to_list_of_fields_to_concatenate[k]),
-                                                         axis=1)
     #--------------------------------------------------------------------
     # dict_transforms_concatenated = dict()
     # if config.flag_concatenate_selected_transforms:
@@ -130,8 +432,62 @@ def csv_transforms_concatenated_to_dict(config):
     #                                                                for v in config.dict_fields_after_concat_to_list_of_fields_to_concatenate[k]),
     #                                                          axis=1)
 
+    return concatenate_transforms_fields(dict_transforms,
+                                         config)
+
+
+def csv_transforms_concatenated_frame_windows(config,
+                                              n_frames_per_window=1000):
+    """
+    Streams the transforms csv in the config, and yields windows of n_frames_per_window frames within
+    config.animation_frame_start_end, with the required fields concatenated (as in csv_transforms_concatenated_to_dict)
+
+    Reading stops after the last animation frame, so long recordings can be processed in bounded memory
+
+    :param config: contains path to transforms csv, animation frames and details of fields to concatenate
+    :param n_frames_per_window: number of frames per window
+    :return: generator of dict_transforms_concatenated (one per window)
+    """
+    for dict_transforms in csv_to_frame_windows(config.transforms_csv_path_to_file,
+                                                config.transforms_csv_n_header_rows_to_skip,
+                                                config.animation_frame_start_end,
+                                                n_frames_per_window=n_frames_per_window):
+        yield concatenate_transforms_fields(dict_transforms,
+                                            config)
+
+
+def concatenate_transforms_fields(dict_transforms,
+                                  config):
+    """
+    Concatenates the numpy arrays of the required fields of a transforms dict with keys per column
+    (typically to concatenate X,Y,Z coords into one key)
+
+    :param dict_transforms: dict with keys per column of the transforms csv
+    :param config: contains details of fields to concatenate
+    :return: dict_transforms_concatenated
+    """
+
+    ### concatenate XYZ/WXYZ arrays
+    dict_transforms_concatenated = dict()
+    # get list of original fields to concatenate
+    list_of_fields_to_concatenate = [i
+                                     for d in config.dict_fields_after_concat_to_list_of_fields_to_concatenate.values()
+                                     for i in d] #it's a dict_values of nested lists, unpack
+
+    # take keys and values from previous dict if not in list of fields to concatenate
+    for k in dict_transforms.keys():
+        if k not in list_of_fields_to_concatenate:
+            dict_transforms_concatenated[k] = dict_transforms[k]
+
+    # for the fields to concatenate:
+    for k in config.dict_fields_after_concat_to_list_of_fields_to_concatenate.keys():
+        dict_transforms_concatenated[k] = np.concatenate(tuple(dict_transforms[v][:, np.newaxis]
+                                                               for v in config.dict_fields_after_concat_to_list_of_fields_to_concatenate[k]),
+                                                         axis=1)
+
     return dict_transforms_concatenated
 
+
 def csv_to_dict_TO_L_frames(filename,
                              n_header_rows_to_skip,
                              idx_col_start_data):
@@ -170,27 +526,458 @@ def csv_to_dict_TO_L_frames(filename,
     return dict_TO_L_frames
 
 
-if __name__ == '__main__':
-    config = config.config()
+########################################################################################################################
+### On-disk cache of parsed csv tables
+# Each parsed table is saved in its own entry dir inside the cache folder, with a manifest json and a data dir with one
+# .npy file per array (so that they can be memory-mapped when loading). The manifest records the source csv path, size,
+# mtime and content hash, the loader function and arguments used to parse it, and the name of its data dir.
+# - An entry is identified by the source csv path, the loader function, the hash of its source code (see
+#   get_loader_source_hash, including the writer of the table to the cache if any) and its arguments, so changing the
+#   way a csv is parsed (or written to the cache) creates a new entry.
+# - An entry is valid if the size and mtime of the csv match the manifest, or, if they don't, if the content hash does.
+#   Otherwise the csv is parsed again and a new data dir is saved in the entry (i.e., invalidation is automatic).
+# Several processes may read and build the same entry at once (e.g. the Blender processes of a batch, see
+# run_rendering.py): data dirs are written to a tmp dir and renamed, and the manifest is written to a tmp file and
+# replaced, so a partial entry is never read. Data dirs are never removed while loading (a reader may still have their
+# arrays memory-mapped): the data dirs no longer referenced by their manifest are only removed by
+# remove_unused_cache_data (python load_data.py --prune, when nothing is reading the cache).
+
+CACHE_MANIFEST_FILENAME = 'manifest.json'
+CACHE_VERSION = 2
+
+
+def compute_file_content_hash(filename,
+                              n_bytes_per_block=2**20):
+    """
+    Compute the sha256 hash of the content of a file, reading it in blocks
+
+    :param filename: path to file
+    :param n_bytes_per_block: number of bytes read per block
+    :return: hex string with the content hash
+    """
+    content_hash = hashlib.sha256()
+    with open(filename, mode='rb') as infile:
+        for block in iter(lambda: infile.read(n_bytes_per_block), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def get_loader_source_hash(csv_loader,
+                           csv_to_cache_writer=None):
+    """
+    Get a hash of the source code of a loader function (and of the writer of its table to the cache, if any), and of
+    the functions of their module that they call (recursively, e.g. csv_to_dict_keys_per_col_bulk and
+    csv_lines_to_float_array)
+
+    :param csv_loader: function used to parse the csv
+    :param csv_to_cache_writer: function that writes the table of csv_loader to the cache (see load_csv_with_cache),
+        or None
+    :return: hex string with the source hash
+    """
+    module = inspect.getmodule(csv_loader)
+    source_hash = hashlib.sha1()
+    list_functions_to_hash = [csv_loader] + ([csv_to_cache_writer] if csv_to_cache_writer is not None else [])
+    list_hashed_functions = []
+    while list_functions_to_hash:
+        function = list_functions_to_hash.pop(0)
+        if function in list_hashed_functions:
+            continue
+        list_hashed_functions.append(function)
+        source_hash.update(inspect.getsource(function).encode('utf-8'))
+        # global names used in the function (and in its comprehensions and lambdas)
+        list_code_objects = [function.__code__]
+        set_global_names = set()
+        while list_code_objects:
+            code_object = list_code_objects.pop()
+            set_global_names.update(code_object.co_names)
+            list_code_objects += [c for c in code_object.co_consts if inspect.iscode(c)]
+        for name in sorted(set_global_names):
+            called_function = getattr(module, name, None)
+            if inspect.isfunction(called_function) and called_function.__module__ == module.__name__:
+                list_functions_to_hash.append(called_function)
+    return source_hash.hexdigest()
+
+
+def get_cache_entry_path(cache_folder_path,
+                         csv_loader,
+                         filename,
+                         loader_args,
+                         csv_to_cache_writer=None):
+    """
+    Get path to the cache entry dir for a csv file parsed with csv_loader(filename, *loader_args)
+
+    The name of the entry dir is the csv file basename, followed by a hash of the absolute path to the csv file,
+    the loader function name, the hash of its source code (and of that of the cache writer, if any) and the loader
+    arguments
+
+    :param cache_folder_path: path to cache folder
+    :param csv_loader: function used to parse the csv
+    :param filename: path to csv file
+    :param loader_args: list of positional arguments passed to csv_loader after filename
+    :param csv_to_cache_writer: function that writes the table of csv_loader to the cache, or None
+    :return: path to cache entry dir
+    """
+    entry_id_str = json.dumps([os.path.abspath(filename),
+                               csv_loader.__name__,
+                               get_loader_source_hash(csv_loader, csv_to_cache_writer),
+                               list(loader_args)])
+    entry_hash = hashlib.sha1(entry_id_str.encode('utf-8')).hexdigest()[0:16]
+    return os.path.join(cache_folder_path,
+                        os.path.splitext(os.path.basename(filename))[0] + '_' + entry_hash)
+
+
+def write_table_to_dir(table_dict,
+                       dir_path):
+    """
+    Save a parsed table as .npy files in a dir
+
+    Supported tables (i.e. outputs of the loaders in this module):
+    - dict of numpy arrays ('dict_of_arrays'): one .npy file per key
+    - dict of dicts of floats ('dict_of_dicts_of_floats', e.g. TO/L frames): one 2-dim .npy file with the values
+    (rows = keys, columns = subkeys) and one with a boolean mask of the subkeys present for each key
+
+    :param table_dict: parsed table
+    :param dir_path: path to dir for the .npy files
+    :return: dict with the table details for the manifest ('keys', 'table_type' and 'subkeys' if required)
+    """
+    list_keys = list(table_dict.keys())
+    table_details_dict = {'keys': list_keys}
+    if all(isinstance(v, dict) for v in table_dict.values()) and table_dict:
+        list_subkeys = list(dict.fromkeys(sk for v in table_dict.values() for sk in v.keys()))
+        values_array = np.full((len(list_keys), len(list_subkeys)), np.nan)
+        mask_array = np.zeros((len(list_keys), len(list_subkeys)), dtype=bool)
+        for i, k in enumerate(list_keys):
+            for j, sk in enumerate(list_subkeys):
+                if sk in table_dict[k]:
+                    values_array[i, j] = table_dict[k][sk]
+                    mask_array[i, j] = True
+        np.save(os.path.join(dir_path, 'values.npy'), values_array)
+        np.save(os.path.join(dir_path, 'mask.npy'), mask_array)
+        table_details_dict['table_type'] = 'dict_of_dicts_of_floats'
+        table_details_dict['subkeys'] = list_subkeys
+    else:
+        for i, k in enumerate(list_keys):
+            np.save(os.path.join(dir_path, '{:04d}.npy'.format(i)),
+                    np.asarray(table_dict[k]))
+        table_details_dict['table_type'] = 'dict_of_arrays'
+    return table_details_dict
+
+
+def write_cache_manifest(entry_path,
+                         manifest_dict):
+    """
+    Write the manifest of a cache entry (to a tmp file in the entry dir, which then replaces the manifest)
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=entry_path,
+                                    prefix='.tmp_' + CACHE_MANIFEST_FILENAME)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest_dict, f, indent=4)
+    os.replace(tmp_path, os.path.join(entry_path, CACHE_MANIFEST_FILENAME))
+
+
+def save_table_to_cache_entry(write_table_function,
+                              entry_path,
+                              manifest_dict):
+    """
+    Save a parsed table and its manifest to a cache entry dir
+
+    - The table is saved in a data dir of the entry named after the csv content hash, by write_table_function (see
+    write_table_to_dir). The data dir is first written to a tmp dir and then renamed, so that other processes never
+    read a partial table. If the data dir already exists (e.g. saved by another process), the tmp dir is discarded.
+    - The manifest is then replaced (see write_cache_manifest). The data dir of the previous manifest is kept (see
+    remove_unused_cache_data).
+
+    :param write_table_function: function that saves the table as .npy files in the dir passed as only argument, and
+        returns the table details for the manifest (e.g. lambda dir_path: write_table_to_dir(table_dict, dir_path))
+    :param entry_path: path to cache entry dir
+    :param manifest_dict: dict with source csv and loader details (table details and data dir are added here)
+    :return: manifest_dict
+    """
+    os.makedirs(entry_path, exist_ok=True)
+    manifest_dict = dict(manifest_dict)
+    manifest_dict['data_dir_str'] = 'data_' + manifest_dict['content_hash'][0:16]
+    data_path = os.path.join(entry_path, manifest_dict['data_dir_str'])
+
+    tmp_data_path = tempfile.mkdtemp(dir=entry_path,
+                                     prefix='.tmp_' + manifest_dict['data_dir_str'])
+    manifest_dict.update(write_table_function(tmp_data_path))
+    try:
+        os.replace(tmp_data_path, data_path)
+    except OSError:
+        # saved by another process in the meantime (same csv content, loader and arguments, so the same table)
+        shutil.rmtree(tmp_data_path, ignore_errors=True)
+
+    write_cache_manifest(entry_path,
+                         manifest_dict)
+    return manifest_dict
+
+
+def load_table_from_cache_entry(entry_path,
+                                manifest_dict,
+                                mmap_mode='r'):
+    """
+    Load a parsed table from a cache entry dir (no csv parsing)
+
+    :param entry_path: path to cache entry dir
+    :param manifest_dict: manifest of the entry
+    :param mmap_mode: mmap_mode passed to numpy.load for dict of arrays tables ('r' = read-only memory map; None = load in memory)
+    :return: table_dict
+    """
+    data_path = os.path.join(entry_path, manifest_dict['data_dir_str'])
+    list_keys = manifest_dict['keys']
+    if manifest_dict['table_type'] == 'dict_of_dicts_of_floats':
+        values_array = np.load(os.path.join(data_path, 'values.npy'))
+        mask_array = np.load(os.path.join(data_path, 'mask.npy'))
+        return {k: {sk: float(values_array[i, j])
+                    for j, sk in enumerate(manifest_dict['subkeys']) if mask_array[i, j]}
+                for i, k in enumerate(list_keys)}
+    else:
+        return {k: np.load(os.path.join(data_path, '{:04d}.npy'.format(i)),
+                           mmap_mode=mmap_mode)
+                for i, k in enumerate(list_keys)}
+
+
+def read_cache_manifest(entry_path):
+    """
+    Read the manifest of a cache entry
+
+    :param entry_path: path to cache entry dir
+    :return: manifest_dict, or None if there is no valid manifest for this cache version (or its data dir is missing)
+    """
+    try:
+        with open(os.path.join(entry_path, CACHE_MANIFEST_FILENAME), 'r') as f:
+            manifest_dict = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest_dict.get('cache_version') != CACHE_VERSION or \
+            not os.path.isdir(os.path.join(entry_path, manifest_dict.get('data_dir_str', ''))):
+        return None
+    return manifest_dict
+
+
+def load_csv_with_cache(csv_loader,
+                        filename,
+                        loader_args,
+                        cache_folder_path,
+                        mmap_mode='r',
+                        csv_to_cache_writer=None):
+    """
+    Returns the output of csv_loader(filename, *loader_args), served from the on-disk cache if a valid entry exists
+
+    - If there is no entry for this csv and loader, the csv is parsed and the entry is created
+    - If there is an entry, and the csv size and mtime match the manifest: the table is loaded from the cache
+    - If size or mtime do not match, the csv content hash is computed
+        - if it matches the manifest: the table is loaded from the cache (and the manifest is replaced with the new mtime)
+        - else: the csv is parsed again and saved to a new data dir of the entry
+    - If cache_folder_path is None: the csv is parsed with no caching
+
+    :param csv_loader: function to parse the csv (e.g. csv_to_dict_keys_per_row)
+    :param filename: path to csv file
+    :param loader_args: list of positional arguments passed to csv_loader after filename
+    :param cache_folder_path: path to the cache folder (created if it doesn't exist)
+    :param mmap_mode: mmap_mode for loading arrays from the cache (see load_table_from_cache_entry)
+    :param csv_to_cache_writer: if not None, function that writes the table of csv_loader directly to the data dir of
+        the entry, with args (filename, *loader_args, dir_path) (e.g. csv_to_npy_files_keys_per_col_bulk). The entry is
+        then built without parsing the whole csv in memory, and the table is loaded from the cache
+    :return: table_dict
+    """
+    if cache_folder_path is None:
+        return csv_loader(filename, *loader_args)
+
+    os.makedirs(cache_folder_path, exist_ok=True)
+    entry_path = get_cache_entry_path(cache_folder_path,
+                                      csv_loader,
+                                      filename,
+                                      loader_args,
+                                      csv_to_cache_writer)
+    csv_stat = os.stat(filename)
+
+    # check if entry is valid
+    manifest_dict = read_cache_manifest(entry_path)
+    if manifest_dict is not None:
+        if manifest_dict['size'] == csv_stat.st_size and manifest_dict['mtime_ns'] == csv_stat.st_mtime_ns:
+            return load_table_from_cache_entry(entry_path,
+                                               manifest_dict,
+                                               mmap_mode)
+        if manifest_dict['size'] == csv_stat.st_size and \
+                manifest_dict['content_hash'] == compute_file_content_hash(filename):
+            # only mtime changed (e.g. file copied): update manifest
+            manifest_dict['mtime_ns'] = csv_stat.st_mtime_ns
+            write_cache_manifest(entry_path,
+                                 manifest_dict)
+            return load_table_from_cache_entry(entry_path,
+                                               manifest_dict,
+                                               mmap_mode)
+
+    # (re)build entry
+    manifest_dict = {'cache_version': CACHE_VERSION,
+                     'source_path': os.path.abspath(filename),
+                     'size': csv_stat.st_size,
+                     'mtime_ns': csv_stat.st_mtime_ns,
+                     'content_hash': compute_file_content_hash(filename),
+                     'csv_loader': csv_loader.__name__,
+                     'loader_source_hash': get_loader_source_hash(csv_loader, csv_to_cache_writer),
+                     'loader_args': list(loader_args)}
+    if csv_to_cache_writer is not None:
+        manifest_dict = save_table_to_cache_entry(lambda dir_path: csv_to_cache_writer(filename, *loader_args, dir_path),
+                                                  entry_path,
+                                                  manifest_dict)
+        return load_table_from_cache_entry(entry_path,
+                                           manifest_dict,
+                                           mmap_mode)
+    table_dict = csv_loader(filename, *loader_args)
+    save_table_to_cache_entry(lambda dir_path: write_table_to_dir(table_dict, dir_path),
+                              entry_path,
+                              manifest_dict)
 
-    #### Dict of geometry
-    map_geometry = csv_to_dict_keys_per_row(config.geometry_csv_path_to_file,
-                                            config.geometry_csv_n_header_rows_to_skip,
-                                            config.geometry_csv_idx_col_start_data)
+    return table_dict
+
+
+def remove_unused_cache_data(cache_folder_path):
+    """
+    Remove the data dirs of the cache entries that are no longer referenced by their manifest (tables of previous
+    versions of the csv files), and the tmp dirs and files left by interrupted processes
+
+    Only run this when no process is reading the cache (their arrays may be memory-mapped from these data dirs).
+    Entries of previous versions of a loader or of the cache are not identified here: remove the cache folder to
+    remove them.
+
+    :param cache_folder_path: path to cache folder
+    :return: list of removed paths
+    """
+    list_removed_paths = []
+    if not os.path.isdir(cache_folder_path):
+        return list_removed_paths
+    for entry_str in sorted(os.listdir(cache_folder_path)):
+        entry_path = os.path.join(cache_folder_path, entry_str)
+        manifest_dict = read_cache_manifest(entry_path)
+        if manifest_dict is None:
+            continue  # not a cache entry of this version (e.g. the ray tables folder)
+        for path_str in os.listdir(entry_path):
+            path = os.path.join(entry_path, path_str)
+            if path_str == manifest_dict['data_dir_str'] or path_str == CACHE_MANIFEST_FILENAME:
+                continue
+            if os.path.isdir(path) and (path_str.startswith('data_') or path_str.startswith('.tmp_')):
+                shutil.rmtree(path, ignore_errors=True)
+                list_removed_paths.append(path)
+            elif os.path.isfile(path) and path_str.startswith('.tmp_'):
+                os.remove(path)
+                list_removed_paths.append(path)
+    return list_removed_paths
 
-    ### Dict of eyesRF rotation quaternion
-    map_eyesRF_quat = csv_to_dict_keys_per_row(config.eyesRF_csv_path_to_file,
-                                               config.eyesRF_csv_n_header_rows_to_skip,
-                                               config.eyesRF_csv_idx_col_start_data)
 
-    quat_from_headRF_to_eyesRF = map_eyesRF_quat[config.date_bird_HP_pair_str]
+# loaders whose table can be written to the cache in chunks (see load_csv_with_cache)
+DICT_CSV_LOADER_TO_CACHE_WRITER = {csv_to_dict_keys_per_col_bulk: csv_to_npy_files_keys_per_col_bulk}
+
+
+def prewarm_data_cache(data_folder_path,
+                       cache_folder_path,
+                       list_input_json_paths):
+    """
+    Parse and cache all the csv tables in a data folder before a batch starts
+
+    For every input json in list_input_json_paths (the config is instantiated), it caches:
+    - the TO/L frames and eyesRF csv files, and the geometry and transforms csv files of the config
+    - every geometry csv in data_folder_path/Geometry, and every transforms csv in data_folder_path/Transforms and
+    data_folder_path/Transforms_trajectoryRF, with the header rows and data columns of the config (as loaded in
+    main.main and csv_transforms_concatenated_to_dict). Each csv file is cached once per distinct set of loader args.
+
+    :param data_folder_path: path to data folder (typically '00_data')
+    :param cache_folder_path: path to cache folder
+    :param list_input_json_paths: list of paths to input json files for the config class
+    :return: list of cached csv paths
+    """
+    list_cached_csv_paths = []
+    list_csv_loaders_and_args = []
+
+    # csv files referred to in input jsons
+    # (if the config for a json cannot be instantiated or a csv is missing, a warning is printed and the json is skipped)
+    for json_path in list_input_json_paths:
+        try:
+            input_config = config.config(json_path)
+            geometry_loader_args = [input_config.geometry_csv_n_header_rows_to_skip,
+                                    input_config.geometry_csv_idx_col_start_data]
+            transforms_loader_args = [input_config.transforms_csv_n_header_rows_to_skip]
+            for csv_loader, csv_path, loader_args in [(csv_to_dict_TO_L_frames,
+                                                       input_config.frames_TO_L_csv_path_to_file,
+                                                       [input_config.frames_csv_n_header_rows_to_skip,
+                                                        input_config.frames_csv_idx_col_start_data]),
+                                                      (csv_to_dict_keys_per_row,
+                                                       input_config.eyesRF_csv_path_to_file,
+                                                       [input_config.eyesRF_csv_n_header_rows_to_skip,
+                                                        input_config.eyesRF_csv_idx_col_start_data]),
+                                                      (csv_to_dict_keys_per_row,
+                                                       input_config.geometry_csv_path_to_file,
+                                                       geometry_loader_args),
+                                                      (csv_to_dict_keys_per_col_bulk,
+                                                       input_config.transforms_csv_path_to_file,
+                                                       transforms_loader_args)]:
+                load_csv_with_cache(csv_loader,
+                                    csv_path,
+                                    loader_args,
+                                    cache_folder_path,
+                                    csv_to_cache_writer=DICT_CSV_LOADER_TO_CACHE_WRITER.get(csv_loader))
+                list_cached_csv_paths.append(os.path.abspath(csv_path))
+        except (OSError, SystemExit) as e:
+            print('WARNING: csv files for {} not cached ({})'.format(json_path, e))
+            continue
+        for csv_loader_and_args in [('Geometry', csv_to_dict_keys_per_row, geometry_loader_args),
+                                    ('Transforms', csv_to_dict_keys_per_col_bulk, transforms_loader_args),
+                                    ('Transforms_trajectoryRF', csv_to_dict_keys_per_col_bulk, transforms_loader_args)]:
+            if csv_loader_and_args not in list_csv_loaders_and_args:
+                list_csv_loaders_and_args.append(csv_loader_and_args)
+
+    # geometry and transforms csv files in data folder
+    for subfolder_str, csv_loader, loader_args in list_csv_loaders_and_args:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(data_folder_path, subfolder_str)):
+            for csv_file_str in sorted(f for f in filenames if f.endswith('.csv')):
+                csv_path = os.path.join(dirpath, csv_file_str)
+                load_csv_with_cache(csv_loader,
+                                    csv_path,
+                                    loader_args,
+                                    cache_folder_path,
+                                    csv_to_cache_writer=DICT_CSV_LOADER_TO_CACHE_WRITER.get(csv_loader))
+                list_cached_csv_paths.append(os.path.abspath(csv_path))
+
+    return list(dict.fromkeys(list_cached_csv_paths))
+
+
+if __name__ == '__main__':
+    ## Pre-warm the data cache for a data folder and a dir of input json files
+    # Example:
+    #   python load_data.py ../00_data --input_jsons_dir ../00_data/config_input_files
+    # Remove the data of previous versions of the csv files (when no render is running):
+    #   python load_data.py ../00_data --prune
+    parser = argparse.ArgumentParser(description='Parse and cache all csv tables in a data folder')
+    parser.add_argument('data_folder_path',
+                        help='Path to data folder (typically 00_data)')
+    parser.add_argument('--cache_folder_path',
+                        default=None,
+                        help="Path to cache folder. Default: '_cache' subdir of data folder")
+    parser.add_argument('--input_jsons_dir',
+                        default=None,
+                        help="Path to dir with input json files for the config class (templates are skipped). "
+                             "Default: 'config_input_files' subdir of data folder")
+    parser.add_argument('--prune',
+                        dest='flag_prune',
+                        action='store_true',
+                        help='If present, remove the cached data no longer used instead (see remove_unused_cache_data)')
+    args = parser.parse_args()
+    cache_folder_path = args.cache_folder_path or os.path.join(args.data_folder_path, '_cache')
 
-    #### Dict of transforms
-    map_transforms_concat = csv_transforms_concatenated_to_dict(config)
+    if args.flag_prune:
+        list_removed_paths = remove_unused_cache_data(cache_folder_path)
+        print('Removed {} unused cache dirs and files'.format(len(list_removed_paths)))
+        sys.exit(0)
 
+    input_jsons_dir = args.input_jsons_dir or os.path.join(args.data_folder_path, 'config_input_files')
+    list_input_json_paths = sorted(os.path.join(input_jsons_dir, f)
+                                   for f in os.listdir(input_jsons_dir)
+                                   if f.endswith('.json') and not f.startswith('template_dict_'))
 
-    ### TO/L frames
-    map_TO_L_frames = csv_to_dict_TO_L_frames(config.frames_TO_L_csv_path_to_file,
-                                              config.frames_csv_n_header_rows_to_skip,
-                                              config.frames_csv_idx_col_start_data)
-    #pdb.set_trace()
\ No newline at end of file
+    list_cached_csv_paths = prewarm_data_cache(args.data_folder_path,
+                                               cache_folder_path,
+                                               list_input_json_paths)
+    print('Cached {} csv files:'.format(len(list_cached_csv_paths)))
+    for csv_path in list_cached_csv_paths:
+        print(csv_path)
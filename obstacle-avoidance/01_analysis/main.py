@@ -9,6 +9,10 @@ The process is as follows:
 - create a virtual camera with the required rendering parameters,
 - inserts the camera keyframes
 - save the input config as a json file
+- save the time and memory used in each of the previous stages as a json file, if required (and cProfile stats)
+- record the render time of each frame, saved as a json file, if required (see render_timing)
+In worker mode (--queue_dir), these steps are run for each job of a queue, followed by its rendering, in the same
+Blender process (see render_worker).
 
 This script is based on an earlier version (main.py) for Blender 2.79.
 This version should works for 2.81 (API breaking release)
@@ -44,6 +48,14 @@ NOTES:
     - Python inputs
             --config_class_inputs_json (positional and required)
             --modules_path="D://EXPTS NOV 2018//Visual field reconstruction Nov 2020//Geometry and pose reconstruction in Blender//01_analysis" (optional)
+            --cprofile (optional): if present, each stage is also profiled with cProfile (and the profiling json is
+              saved even if flag_save_profiling_as_json is False)
+            --shard_id (optional): id of the chunk of frames rendered by this process, if several processes render
+              the same trial (set by run_rendering.py -k)
+            --queue_dir (optional): if present, run as a long-lived render worker instead (no json file needed): the
+              scene of each job in the queue dir is set up and rendered in this Blender process (see render_worker)
+                blender --background --python main.py -- --queue_dir <queue dir> [--worker_id <id>] [--idle_timeout <s>]
+              and jobs are submitted with render_queue.py (or run_rendering.py --server)
     - if modules_path is not specified, the default value is used (the parent dir to this python script)
 
 
@@ -90,23 +102,46 @@ All rights reserved.
 """
 
 
-def main():
+def main(config_class_inputs_json,
+         flag_cprofile=False,
+         environment_key_in_scene=None,
+         shard_id=None):
+    """
+    Set up the scene for a trial: geometry, camera, rendering params and camera keyframes
+
+    :param config_class_inputs_json: path to json file with input parameters to config class
+    :param flag_cprofile: if True, profile each stage with cProfile (stats saved next to the config json)
+    :param environment_key_in_scene: key of the environment already built in the scene (see
+        scene_cache.get_scene_cache_key), if any. If it is the key of this trial's environment, only the camera and
+        its keyframes are created again (used by the render worker, see render_worker)
+    :param shard_id: id of the chunk of frames of the trial rendered by this process, if the trial is rendered by
+        several processes into the same output dir (see run_rendering.py -k). The profiling json is saved per shard
+        (the config json and render hashes are the same for all shards, and are replaced atomically)
+    :return: input_config, environment_key
+    """
+    # record time and memory per stage (see profiling.StageProfiler)
+    profiler = profiling.StageProfiler(flag_cprofile=flag_cprofile)
 
     #####################
     # Instantiate config
     ######################
     # get params for config class from input json file
-    input_config = config.config(args.config_class_inputs_json)
+    with profiler.stage('config'):
+        input_config = config.config(config_class_inputs_json)
 
     #####################################
     # Load geometry and transforms data
     #####################################
-    # geometry
-    geometry_dict = load_data.csv_to_dict_keys_per_row(input_config.geometry_csv_path_to_file,
-                                                       input_config.geometry_csv_n_header_rows_to_skip,
-                                                       input_config.geometry_csv_idx_col_start_data)
+    # geometry (from the data cache if enabled)
+    with profiler.stage('load_geometry'):
+        geometry_dict = load_data.load_csv_with_cache(load_data.csv_to_dict_keys_per_row,
+                                                      input_config.geometry_csv_path_to_file,
+                                                      [input_config.geometry_csv_n_header_rows_to_skip,
+                                                       input_config.geometry_csv_idx_col_start_data],
+                                                      input_config.data_cache_folder_path if input_config.flag_use_data_cache else None)
     # transforms
-    transforms_dict = load_data.csv_transforms_concatenated_to_dict(input_config)
+    with profiler.stage('load_transforms'):
+        transforms_dict = load_data.csv_transforms_concatenated_to_dict(input_config)
 
     ##################
     # Prepare scene
@@ -121,43 +156,96 @@ def main():
     ##############################
     # Build geometry in the scene
     ##############################
-    define_geometry.create_environment(geometry_dict,
-                                       input_config)
+    # (from the scene cache if enabled: only built for the first trial with this geometry)
+    # (if the environment is already in the scene, only the camera and its keyframes are removed)
+    environment_key = scene_cache.get_scene_cache_key(geometry_dict,
+                                                      input_config,
+                                                      bpy.app.version_string)
+    if environment_key == environment_key_in_scene:
+        with profiler.stage('remove_camera_and_animation'):
+            define_camera.remove_camera_and_animation()
+    else:
+        with profiler.stage('create_environment'):
+            if input_config.flag_use_scene_cache:
+                scene_cache.create_environment_with_cache(geometry_dict,
+                                                          input_config)
+            else:
+                define_geometry.create_environment(geometry_dict,
+                                                   input_config)
 
 
     ###############################################################
     # Add virtual camera with required camera and rendering params
     ###############################################################
     # Create camera
-    camera_object = define_camera.create_camera(scene,
-                                                input_config)
+    with profiler.stage('create_camera'):
+        camera_object = define_camera.create_camera(scene,
+                                                    input_config)
 
     # Set rendering params
-    define_camera.set_rendering_parameters(scene,
-                                           input_config)
+    with profiler.stage('set_rendering_parameters'):
+        define_camera.set_rendering_parameters(scene,
+                                               input_config)
 
     # Insert camera keyframes
-    define_camera.insert_camera_keyframes(camera_object,
-                                          transforms_dict,
-                                          input_config)
+    with profiler.stage('insert_camera_keyframes'):
+        define_camera.insert_camera_keyframes(camera_object,
+                                              transforms_dict,
+                                              input_config)
 
 
     ################################################
     # Save config used for rendering as json
     #############################################
     # create output dir if it doesnt exist
-    if not os.path.exists(input_config.render_output_parent_dir_path):
-        os.makedirs(input_config.render_output_parent_dir_path)
+    # (several processes may render the same trial into this dir, see run_rendering.py -k)
+    os.makedirs(input_config.render_output_parent_dir_path, exist_ok=True)
 
     # add json file with config info
+    # (written to a tmp file and renamed, so that processes rendering the same trial never read or leave it half-written)
     if input_config.flag_save_config_as_json:
         json_filename = os.path.join(input_config.render_output_parent_dir_path,
                                      input_config.render_output_parent_dir_str + '.json')
-        with open(json_filename, 'w') as f:
-            config_dict = input_config.__dict__
-            for kr in input_config.keys_to_exclude_from_config_dict:
-                config_dict.pop(kr, None)
+        fd, tmp_path = tempfile.mkstemp(dir=input_config.render_output_parent_dir_path, prefix='.tmp_')
+        with os.fdopen(fd, 'w') as f:
+            # (a copy without the excluded keys: the config is still used after this, e.g. by the render timer)
+            config_dict = {k: v for k, v in input_config.__dict__.items()
+                           if k not in input_config.keys_to_exclude_from_config_dict}
             json.dump(config_dict, f)
+        os.replace(tmp_path, json_filename)
+
+    # record the render time of each frame in a json file (with the render profile)
+    if input_config.flag_save_render_times_as_json:
+        render_timing.start_render_timer(input_config)
+
+    # add json file with the hash of the inputs of each frame (for incremental re-renders)
+    if input_config.flag_save_render_hashes:
+        with profiler.stage('save_render_hashes'):
+            render_dependencies.save_render_hashes(render_dependencies.compute_render_hashes(geometry_dict,
+                                                                                             transforms_dict,
+                                                                                             input_config),
+                                                   input_config.render_output_parent_dir_path)
+
+    # add json file with profiling info (and cProfile stats if required)
+    if input_config.flag_save_profiling_as_json or flag_cprofile:
+        profiling_json_filename = os.path.join(input_config.render_output_parent_dir_path,
+                                               input_config.render_output_parent_dir_str + '_profiling'
+                                               + ('_' + shard_id if shard_id else '') + '.json')
+        profiling_dict = profiler.save_json(profiling_json_filename,
+                                            {'config_class_inputs_json': os.path.abspath(config_class_inputs_json),
+                                             'trial_str': input_config.trial_str,
+                                             'shard_id': shard_id,
+                                             'n_animation_frames': int(input_config.animation_frame_start_end[1]
+                                                                       - input_config.animation_frame_start_end[0] + 1),
+                                             'n_transforms_rows': int(len(transforms_dict['frame'])),
+                                             'blender_version': bpy.app.version_string})
+        print('Setup time per stage (wall / CPU, in s):')
+        for stage_dict in profiling_dict['stages']:
+            print('    {}: {:.2f} / {:.2f}'.format(stage_dict['stage'],
+                                                   stage_dict['wall_time_in_s'],
+                                                   stage_dict['cpu_time_in_s']))
+
+    return input_config, environment_key
 
 
 if __name__ == '__main__':
@@ -176,6 +264,7 @@ if __name__ == '__main__':
     # import math
     # import pdb
     import json
+    import tempfile
     import importlib
     #import code
     #import IPython
@@ -203,9 +292,12 @@ if __name__ == '__main__':
 
 
     ## Add required argument: config_class_inputs [positional]
+    # (not required in worker mode, each job of the queue has its own json file)
     parser.add_argument(
         "config_class_inputs_json",
         metavar='CONFIG_CLASS_INPUTS_JSON',  # A name for the argument in usage messages.
+        nargs='?',
+        default=None,
         help="Json file with input parameters to config class",
     )
 
@@ -218,8 +310,52 @@ if __name__ == '__main__':
         help="Path to config, data, geometry and camera modules",
     )
 
+    ## Add optional argument: cprofile
+    parser.add_argument(
+        "-cprof", "--cprofile",
+        dest="flag_cprofile",
+        action="store_true",
+        help="If present, profile each stage of main with cProfile (stats saved next to the config json)",
+    )
+
+    ## Add optional argument: shard_id
+    parser.add_argument(
+        "--shard_id",
+        dest="shard_id",
+        default=None,
+        help="If present, id of the chunk of frames rendered by this process, when several processes render the same "
+             "trial (see run_rendering.py -k); the profiling json is saved per shard",
+    )
+
+    ## Add optional arguments for worker mode: queue_dir, worker_id, idle_timeout
+    parser.add_argument(
+        "-q", "--queue_dir",
+        dest="queue_dir_path",
+        metavar='QUEUE_DIR',
+        default=None,
+        help="If present, run as a render worker: render the jobs of this queue dir until a stop is requested "
+             "(see render_worker and render_queue)",
+    )
+    parser.add_argument(
+        "--worker_id",
+        dest="worker_id",
+        default='worker_{}'.format(os.getpid()),
+        help="Worker id, recorded in the jobs it renders (worker mode only)",
+    )
+    parser.add_argument(
+        "--idle_timeout",
+        dest="idle_timeout_in_s",
+        type=float,
+        default=None,
+        help="If present, the worker exits after this time (in s) without pending jobs (worker mode only)",
+    )
+
     ## Parse arguments
     args = parser.parse_args(argv)
+    if args.config_class_inputs_json is None and args.queue_dir_path is None:
+        parser.error('the json file with input parameters to config class is required (unless --queue_dir is given)')
+    if args.queue_dir_path is not None:
+        args.queue_dir_path = os.path.abspath(args.queue_dir_path)  # (before changing the working dir)
 
 
     ###############################
@@ -237,15 +373,41 @@ if __name__ == '__main__':
     import config
     import load_data
     import define_geometry
+    import scene_cache
+    import camera_poses
     import define_camera
+    import profiling
+    import render_manifest
+    import render_dependencies
+    import render_queue
+    import render_worker
+    import render_timing
 
     # Force a reload (in case I edit the source after I start the Blender session)
     importlib.reload(config)
     importlib.reload(load_data)
     importlib.reload(define_geometry)
+    importlib.reload(scene_cache)
+    importlib.reload(camera_poses)
     importlib.reload(define_camera)
+    importlib.reload(profiling)
+    importlib.reload(render_manifest)
+    importlib.reload(render_dependencies)
+    importlib.reload(render_queue)
+    importlib.reload(render_worker)
+    importlib.reload(render_timing)
 
     #############################################
     # Call main (sets up scene: geometry, camera and rendering params)
+    # or, in worker mode, set up and render the scene of each job in the queue
     #############################################
-    main()
+    if args.queue_dir_path is not None:
+        render_worker.serve(args.queue_dir_path,
+                            main,
+                            args.worker_id,
+                            idle_timeout_in_s=args.idle_timeout_in_s,
+                            flag_cprofile=args.flag_cprofile)
+    else:
+        main(args.config_class_inputs_json,
+             args.flag_cprofile,
+             shard_id=args.shard_id)
@@ -0,0 +1,571 @@
+import os
+import sys
+import warnings
+import numpy as np
+import load_data
+
+# Triangle meshes (e.g. captured with SLAM) for the numpy ray caster, with a bounding volume hierarchy (BVH)
+#
+# - Meshes are read from .obj or .ply files (polygons are fan-triangulated) and scaled to m
+# - The BVH is a complete binary tree, built by splitting the triangles of each node in two halves at the median of
+#   their centroids along the node's longest axis. Nodes are stored in heap order (children of node i are 2i+1 and
+#   2i+2), and each leaf holds up to n_triangles_per_leaf triangles, so it can be built and traversed with array
+#   operations only (one sort per level).
+# - The BVH is built by mesh_file_to_bvh_dict, which can be cached per mesh file with load_data.load_csv_with_cache
+#   (arrays are then memory-mapped from disk)
+#
+# Rays are traversed in packets (the tiles of raycast_renderer.get_ray_tiles, with the directions in world RF):
+# 1. the bounding cones of a hierarchy of packets (e.g. tiles of 32, 16, 8 and 4 pixels) are tested against the bounding
+#    spheres of the nodes, splitting packets or nodes level by level, for all packets at once, to get the
+#    (packet, leaf) pairs that may hit
+# 2. the pairs of each packet are sorted by distance to the leaf, and intersected in rounds (the nearest leaf of every
+#    packet in the first round, the second nearest in the second round...). Leaves further than the furthest hit of
+#    all rays in a packet are skipped, so occluded parts of the mesh are mostly never intersected.
+#
+# The ray-triangle test is Moller-Trumbore, rearranged so that for a ray origin O and each triangle (V0, E1, E2)
+# with T0 = O - V0, the four quantities per ray are dot products with the ray direction D, computed as one matmul
+# per (packet, leaf) pair:
+#   det = D.(E2 x E1), u * det = D.(E2 x T0), v * det = D.(T0 x E1), and t * det = E2.(T0 x E1) (same for all rays)
+# Triangles are double-sided.
+#
+# This is an offline renderer, not an interactive one: with pure numpy on one CPU core, a SLAM-size mesh (~505k
+# triangles, see benchmark_mesh_bvh.py) takes about 4 s per frame at 1800x900 pixels, and about 1 s per frame at 25%
+# resolution. About half of it is spent in the ray-triangle test, and the rest in the packet traversal. Frames are
+# independent, so batches of frames can be split across CPU cores (see frame_parallel).
+
+MESH_FILE_EXTENSIONS = ['.obj', '.ply']
+
+# PLY property types to numpy dtypes (without byte order)
+PLY_TYPES_TO_DTYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+                       'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+                       'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+                       'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+
+########################################################################################################################
+### Mesh files
+def polygons_to_triangles(list_polygons):
+    """
+    Fan-triangulate a list of polygons (lists of vertex indices)
+
+    :param list_polygons: list of lists of vertex indices (3 or more per polygon)
+    :return: faces_array, int array of shape (n_triangles, 3)
+    """
+    list_triangles = [(polygon[0], polygon[kk], polygon[kk + 1])
+                      for polygon in list_polygons
+                      for kk in range(1, len(polygon) - 1)]
+    return np.array(list_triangles, dtype=np.int64).reshape(-1, 3)
+
+
+def load_obj_file(filename):
+    """
+    Read the vertices and faces of a Wavefront .obj file (other elements are ignored)
+
+    :param filename: path to .obj file
+    :return: vertices_array (n_vertices, 3), faces_array (n_triangles, 3) (0-based indices)
+    """
+    list_vertices = []
+    list_polygons = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith('v '):
+                list_vertices.append(line.split()[1:4])
+            elif line.startswith('f '):
+                # face vertices as v, v/vt, v//vn or v/vt/vn; indices are 1-based, or relative to the end if negative
+                list_polygons.append([int(s.split('/')[0]) for s in line.split()[1:]])
+    vertices_array = np.array(list_vertices, dtype=np.float64).reshape(-1, 3)
+    n_vertices = len(list_vertices)
+    list_polygons = [[i - 1 if i > 0 else n_vertices + i for i in polygon] for polygon in list_polygons]
+    return vertices_array, polygons_to_triangles(list_polygons)
+
+
+def load_ply_file(filename):
+    """
+    Read the vertices (x, y, z properties of the 'vertex' element) and faces ('vertex_indices' or 'vertex_index' list
+    property of the 'face' element) of a .ply file, in ascii or binary format
+
+    :param filename: path to .ply file
+    :return: vertices_array (n_vertices, 3), faces_array (n_triangles, 3)
+    """
+    with open(filename, 'rb') as f:
+        ### Header
+        if f.readline().strip() != b'ply':
+            sys.exit('ERROR in mesh_bvh: {} is not a ply file'.format(filename))
+        list_elements = []  # list of [name, count, list of (property name, dtype or (count dtype, item dtype))]
+        ply_format = None
+        for line in iter(f.readline, b''):
+            tokens = line.decode('ascii').split()
+            if not tokens or tokens[0] in ['comment', 'obj_info']:
+                continue
+            if tokens[0] == 'format':
+                ply_format = tokens[1]
+            elif tokens[0] == 'element':
+                list_elements.append([tokens[1], int(tokens[2]), []])
+            elif tokens[0] == 'property' and tokens[1] == 'list':
+                list_elements[-1][2].append((tokens[4], (PLY_TYPES_TO_DTYPES[tokens[2]], PLY_TYPES_TO_DTYPES[tokens[3]])))
+            elif tokens[0] == 'property':
+                list_elements[-1][2].append((tokens[2], PLY_TYPES_TO_DTYPES[tokens[1]]))
+            elif tokens[0] == 'end_header':
+                break
+        byte_order = {'binary_little_endian': '<', 'binary_big_endian': '>', 'ascii': None}[ply_format]
+
+        ### Data
+        vertices_array = np.zeros((0, 3))
+        faces_array = np.zeros((0, 3), dtype=np.int64)
+        if byte_order is None:
+            list_lines = f.read().decode('ascii').split('\n')
+            idx_line = 0
+        for element_str, n_items, list_properties in list_elements:
+            list_names = [p[0] for p in list_properties]
+            flag_list_properties = any(isinstance(p[1], tuple) for p in list_properties)
+            if byte_order is None:
+                ### ascii: one item per line
+                lines = list_lines[idx_line:idx_line + n_items]
+                idx_line += n_items
+                if element_str == 'vertex':
+                    values = np.array([line.split()[:len(list_names)] for line in lines], dtype=np.float64)
+                    vertices_array = values[:, [list_names.index(c) for c in 'xyz']]
+                elif element_str == 'face':
+                    # (assuming the vertex indices list is the first property)
+                    faces_array = polygons_to_triangles([[int(s) for s in line.split()[1:1 + int(line.split()[0])]]
+                                                         for line in lines])
+            elif not flag_list_properties:
+                ### binary, fixed size items
+                item_dtype = np.dtype([(name, byte_order + dtype_str) for name, dtype_str in list_properties])
+                items = np.frombuffer(f.read(item_dtype.itemsize * n_items), dtype=item_dtype)
+                if element_str == 'vertex':
+                    vertices_array = np.stack([items[c].astype(np.float64) for c in 'xyz'], axis=1)
+            else:
+                ### binary, with list properties: fast path if all lists have 3 items (triangles), else item by item
+                list_fields = []
+                for name, p in list_properties:
+                    if isinstance(p, tuple):
+                        list_fields += [(name + '_count', byte_order + p[0]), (name, byte_order + p[1], (3,))]
+                    else:
+                        list_fields.append((name, byte_order + p))
+                item_dtype = np.dtype(list_fields)
+                data_start = f.tell()
+                buffer = f.read(item_dtype.itemsize * n_items)
+                items = np.frombuffer(buffer, dtype=item_dtype) if len(buffer) == item_dtype.itemsize * n_items else None
+                if items is not None and all(np.all(items[name + '_count'] == 3)
+                                             for name, p in list_properties if isinstance(p, tuple)):
+                    if element_str == 'face':
+                        faces_name = [n for n in ['vertex_indices', 'vertex_index'] if n in list_names][0]
+                        faces_array = items[faces_name].astype(np.int64)
+                else:
+                    f.seek(data_start)
+                    list_polygons = []
+                    for _ in range(n_items):
+                        for name, p in list_properties:
+                            if isinstance(p, tuple):
+                                count_dtype, index_dtype = np.dtype(byte_order + p[0]), np.dtype(byte_order + p[1])
+                                n = int(np.frombuffer(f.read(count_dtype.itemsize), dtype=count_dtype)[0])
+                                values = np.frombuffer(f.read(index_dtype.itemsize * n), dtype=index_dtype)
+                                if name in ['vertex_indices', 'vertex_index']:
+                                    list_polygons.append(values.tolist())
+                            else:
+                                f.read(np.dtype(p).itemsize)
+                    if element_str == 'face':
+                        faces_array = polygons_to_triangles(list_polygons)
+    return vertices_array, faces_array
+
+
+def load_mesh_file(filename):
+    """
+    Read the vertices and triangles of a mesh file (.obj or .ply)
+
+    :param filename: path to mesh file
+    :return: vertices_array (n_vertices, 3), faces_array (n_triangles, 3)
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.obj':
+        return load_obj_file(filename)
+    elif extension == '.ply':
+        return load_ply_file(filename)
+    else:
+        sys.exit('ERROR in mesh_bvh: mesh file extension {} not supported (only {})'.format(extension,
+                                                                                           MESH_FILE_EXTENSIONS))
+
+
+########################################################################################################################
+### BVH
+def sort_triangles_by_median_splits(centroids_array,
+                                    n_levels):
+    """
+    Sort triangles so that, for each level of a complete binary tree with n_levels levels below the root, node i of the
+    level holds the triangles in [floor(i * n / 2^level), floor((i + 1) * n / 2^level)), and the two children of each
+    node split its triangles at the median of their centroids along the longest axis of the node
+
+    :param centroids_array: centroids of the triangles, array of shape (n, 3)
+    :param n_levels: number of levels of the tree (below the root)
+    :return: sort_idcs, array of shape (n,)
+    """
+    n_triangles = len(centroids_array)
+    sort_idcs = np.arange(n_triangles)
+    for level in range(n_levels):
+        n_nodes = 1 << level
+        node_start_end = (np.arange(n_nodes + 1) * n_triangles) // n_nodes
+        node_sizes = np.diff(node_start_end)
+        node_of_triangle = np.repeat(np.arange(n_nodes), node_sizes)
+        centroids_sorted = centroids_array[sort_idcs]
+        # longest axis of the bounding box of the centroids of each (non-empty) node
+        idcs_node_start = node_start_end[:-1][node_sizes > 0]
+        extent = np.zeros((n_nodes, 3))
+        extent[node_sizes > 0] = np.maximum.reduceat(centroids_sorted, idcs_node_start) \
+            - np.minimum.reduceat(centroids_sorted, idcs_node_start)
+        axis_of_triangle = np.argmax(extent, axis=1)[node_of_triangle]
+        sort_idcs = sort_idcs[np.lexsort((centroids_sorted[np.arange(n_triangles), axis_of_triangle],
+                                          node_of_triangle))]
+    return sort_idcs
+
+
+def build_bvh(triangles_array,
+              n_triangles_per_leaf=8):
+    """
+    Build the BVH of a set of triangles (see header of this module)
+
+    :param triangles_array: array of shape (n_triangles, 3 vertices, 3), in m
+    :param n_triangles_per_leaf: number of triangles per leaf
+    :return: bvh_dict, with keys
+        - 'V0', 'E1', 'E2': first vertex and edges V1-V0, V2-V0 of the triangles of each leaf, float32 arrays of
+          shape (n_leaves, n_triangles_per_leaf, 3) (padded with degenerate triangles, which are never hit)
+        - 'triangle_index': index of each triangle in triangles_array, int array of shape (n_leaves, n_triangles_per_leaf)
+          (-1 for padding)
+        - 'node_min', 'node_max': bounding box of each node in heap order, arrays of shape (2 * n_leaves - 1, 3)
+          (nan for empty nodes); the leaves are the last n_leaves nodes
+    """
+    triangles_array = np.asarray(triangles_array, dtype=np.float64)
+    n_triangles = len(triangles_array)
+    n_levels = int(np.ceil(np.log2(max(-(-n_triangles // n_triangles_per_leaf), 1))))
+    n_leaves = 1 << n_levels
+
+    ### Sort triangles by recursive median splits, and group them in leaves (of n_triangles / n_leaves triangles)
+    sort_idcs = sort_triangles_by_median_splits(triangles_array.mean(axis=1),
+                                                n_levels)
+    leaf_start_end = (np.arange(n_leaves + 1) * n_triangles) // n_leaves
+    leaf_of_triangle = np.repeat(np.arange(n_leaves), np.diff(leaf_start_end))
+    triangle_index = np.full((n_leaves, n_triangles_per_leaf), -1, dtype=np.int64)
+    triangle_index[leaf_of_triangle, np.arange(n_triangles) - leaf_start_end[leaf_of_triangle]] = sort_idcs
+    triangles_per_leaf = np.where((triangle_index >= 0)[..., None, None],
+                                  triangles_array[np.maximum(triangle_index, 0)] if n_triangles > 0
+                                  else np.zeros(triangle_index.shape + (3, 3)),
+                                  np.nan)
+
+    ### Bounding boxes: leaves, then parents from the bottom level up (nan for empty nodes)
+    node_min = np.full((2 * n_leaves - 1, 3), np.nan)
+    node_max = np.full((2 * n_leaves - 1, 3), np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)  # all-nan (empty) leaves
+        node_min[n_leaves - 1:] = np.nanmin(triangles_per_leaf, axis=(1, 2))
+        node_max[n_leaves - 1:] = np.nanmax(triangles_per_leaf, axis=(1, 2))
+    idx_level_start = n_leaves - 1
+    while idx_level_start > 0:
+        idx_parent_start = (idx_level_start - 1) // 2
+        idx_parents = np.arange(idx_parent_start, idx_level_start)
+        node_min[idx_parents] = np.fmin(node_min[2 * idx_parents + 1], node_min[2 * idx_parents + 2])
+        node_max[idx_parents] = np.fmax(node_max[2 * idx_parents + 1], node_max[2 * idx_parents + 2])
+        idx_level_start = idx_parent_start
+
+    triangles_per_leaf = np.nan_to_num(triangles_per_leaf)
+    return {'V0': triangles_per_leaf[:, :, 0].astype(np.float32),
+            'E1': (triangles_per_leaf[:, :, 1] - triangles_per_leaf[:, :, 0]).astype(np.float32),
+            'E2': (triangles_per_leaf[:, :, 2] - triangles_per_leaf[:, :, 0]).astype(np.float32),
+            'triangle_index': triangle_index,
+            'node_min': node_min,
+            'node_max': node_max}
+
+
+def mesh_file_to_bvh_dict(filename,
+                          n_triangles_per_leaf,
+                          vertices_to_m):
+    """
+    Read a mesh file and build its BVH (loader for load_data.load_csv_with_cache, so that the BVH is cached per mesh file)
+
+    :param filename: path to mesh file (.obj or .ply)
+    :param n_triangles_per_leaf: number of triangles per leaf of the BVH
+    :param vertices_to_m: factor to convert the vertices coords to m
+    :return: bvh_dict (see build_bvh)
+    """
+    vertices_array, faces_array = load_mesh_file(filename)
+    return build_bvh(vertices_array[faces_array] * vertices_to_m,
+                     n_triangles_per_leaf)
+
+
+def get_mesh_paths_from_config(input_config):
+    """
+    Get the paths to the mesh files in config (relative paths are relative to the folder of the geometry csv file)
+
+    :param input_config: config
+    :return: list of (mesh_file_str, path) tuples
+    """
+    geometry_folder_path = os.path.dirname(input_config.geometry_csv_path_to_file)
+    return [(mesh_file_str, os.path.join(geometry_folder_path, mesh_file_str))
+            for mesh_file_str in input_config.mesh_file_paths_list]
+
+
+def load_meshes_from_config(input_config,
+                            cache_folder_path=None):
+    """
+    Load the BVH of each mesh file in config
+
+    :param input_config: config
+    :param cache_folder_path: path to the data cache folder (see load_data.load_csv_with_cache); if None, no caching
+    :return: list of dicts with 'name', 'pass_index' and 'bvh' (see build_bvh)
+    """
+    list_meshes = []
+    for mesh_file_str, mesh_path in get_mesh_paths_from_config(input_config):
+        if not os.path.isfile(mesh_path):
+            sys.exit('ERROR in mesh_bvh: mesh file {} not found'.format(mesh_path))
+        list_meshes.append({'name': os.path.splitext(os.path.basename(mesh_file_str))[0],
+                            'pass_index': input_config.dict_mesh_file_str_to_object_index[mesh_file_str],
+                            'bvh': load_data.load_csv_with_cache(mesh_file_to_bvh_dict,
+                                                                 mesh_path,
+                                                                 [input_config.mesh_bvh_n_triangles_per_leaf,
+                                                                  input_config.mesh_vertices_to_m],
+                                                                 cache_folder_path)})
+    return list_meshes
+
+
+########################################################################################################################
+### Traversal
+def get_nodes_as_seen_from_origin(bvh_dict,
+                                  camera_location,
+                                  max_distance):
+    """
+    Get the bounding sphere of each node of the BVH as seen from the camera: direction to its centre, angular radius
+    and distance (once per camera location, so that testing (packet, node) pairs only needs a dot product)
+
+    :param bvh_dict: see build_bvh
+    :param camera_location: origin of the rays, in world RF (3,)
+    :param max_distance: max distance along the rays (nodes further than this are never hit)
+    :return: nodes_dict, with arrays of shape (n_nodes, ...)
+        - 'direction': unit vector from the camera to the centre of the sphere
+        - 'cos_alpha', 'sin_alpha': of the angular radius of the sphere
+        - 'flag_visible': False for empty nodes and nodes further than max_distance, True for nodes that contain
+          the camera (these may be hit in any direction, so sin_alpha is set to 1 and cos_alpha to -1)
+        - 'near_distance': lower bound of the distance from the camera to the node
+    """
+    node_min = np.asarray(bvh_dict['node_min'])
+    node_max = np.asarray(bvh_dict['node_max'])
+    centres = 0.5 * (node_min + node_max) - camera_location
+    # (padded by 1 mm, so that the cone tests in float32 stay conservative)
+    radii = 0.5 * np.linalg.norm(node_max - node_min, axis=1) + 1e-3
+    distance = np.linalg.norm(centres, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        flag_contains_camera = distance <= radii
+        sin_alpha = np.where(flag_contains_camera, 1.0, radii / distance)
+        cos_alpha = np.where(flag_contains_camera, -1.0, np.sqrt(1 - sin_alpha ** 2))
+        return {'direction': (centres / np.maximum(distance, 1e-12)[:, None]).astype(np.float32),
+                'cos_alpha': cos_alpha.astype(np.float32),
+                'sin_alpha': sin_alpha.astype(np.float32),
+                'flag_visible': (distance - radii <= max_distance),  # (False for nan, i.e. empty, nodes)
+                'near_distance': np.maximum(distance - radii, 0)}
+
+
+def get_flag_cones_may_hit_nodes(nodes_dict,
+                                 node_idcs,
+                                 cone_axis,
+                                 cone_cos_half_angle,
+                                 cone_sin_half_angle):
+    """
+    Test pairs of cones (with apex at the camera) and bounding spheres of nodes, conservatively
+    (the same test as raycast_renderer.get_tiles_that_may_hit_spheres, but for pairs instead of all combinations):
+    a cone may hit a sphere if the angle between the cone axis and the sphere centre is at most the sum of the cone
+    half angle and the angular radius of the sphere
+
+    :param nodes_dict: see get_nodes_as_seen_from_origin
+    :param node_idcs: array of shape (n,)
+    :param cone_axis: unit vectors, array of shape (n, 3)
+    :param cone_cos_half_angle, cone_sin_half_angle: arrays of shape (n,)
+    :return: boolean array of shape (n,)
+    """
+    cos_alpha = nodes_dict['cos_alpha'][node_idcs]
+    sin_alpha = nodes_dict['sin_alpha'][node_idcs]
+    cos_theta = np.einsum('ij,ij->i', nodes_dict['direction'][node_idcs], cone_axis)
+    # cos(alpha + half_angle), and whether alpha + half_angle >= pi (then any direction may hit)
+    cos_alpha_plus_half_angle = cos_alpha * cone_cos_half_angle - sin_alpha * cone_sin_half_angle
+    flag_any_direction = (sin_alpha * cone_cos_half_angle + cos_alpha * cone_sin_half_angle) <= 0
+    return nodes_dict['flag_visible'][node_idcs] & ((cos_theta >= cos_alpha_plus_half_angle) | flag_any_direction)
+
+
+def get_leaves_that_may_hit_ray_packets(bvh_dict,
+                                        camera_location,
+                                        list_packet_levels,
+                                        max_distance):
+    """
+    Get the (packet, leaf) pairs whose bounding cone and sphere overlap, by traversing at the same time the BVH and
+    a hierarchy of ray packets (e.g. tiles of 32, 16, 8 and 4 pixels, see raycast_renderer.get_ray_tiles_hierarchy)
+
+    All pairs in the frontier are at the same BVH level and packet level. At each step, the pairs that do not overlap
+    are discarded, and the rest are split into the children of their node or the children of their packet, whichever
+    are angularly larger (median over the frontier), until they reach the leaves and the finest packets.
+
+    :param bvh_dict: see build_bvh
+    :param camera_location: origin of the rays, in world RF (3,)
+    :param list_packet_levels: list of dicts with 'axis' (world RF), 'cos_half_angle' and 'sin_half_angle' of the
+        bounding cone of each packet, from the coarsest to the finest level, and (except for the finest)
+        'idcs_children' (n_packets, 4) with the index of its children packets in the next level (-1 for none)
+    :param max_distance: max distance along the rays
+    :return: packet_idcs (in the finest level), leaf_idcs, near_distance (lower bound of the distance to the leaf),
+        arrays of shape (n_pairs,)
+    """
+    nodes_dict = get_nodes_as_seen_from_origin(bvh_dict,
+                                               np.asarray(camera_location, dtype=np.float64),
+                                               max_distance)
+    n_leaves = (len(nodes_dict['cos_alpha']) + 1) // 2
+    list_packet_half_angles = [np.median(np.arccos(packets_dict['cos_half_angle']))
+                               for packets_dict in list_packet_levels]
+
+    level_packets = 0
+    packet_idcs = np.arange(len(list_packet_levels[0]['axis']))
+    node_idcs = np.zeros(len(packet_idcs), dtype=np.int64)
+    while True:
+        packets_dict = list_packet_levels[level_packets]
+        flag_may_hit = get_flag_cones_may_hit_nodes(nodes_dict,
+                                                    node_idcs,
+                                                    packets_dict['axis'][packet_idcs],
+                                                    packets_dict['cos_half_angle'][packet_idcs],
+                                                    packets_dict['sin_half_angle'][packet_idcs])
+        packet_idcs = packet_idcs[flag_may_hit]
+        node_idcs = node_idcs[flag_may_hit]
+        flag_leaves = len(node_idcs) == 0 or node_idcs[0] >= n_leaves - 1
+        flag_finest_packets = level_packets == len(list_packet_levels) - 1
+        if flag_leaves and flag_finest_packets:
+            break
+        # (median over up to ~1000 pairs of the frontier)
+        if flag_leaves or (not flag_finest_packets and
+                           list_packet_half_angles[level_packets]
+                           > np.median(np.arcsin(nodes_dict['sin_alpha'][node_idcs[::len(node_idcs) // 1000 + 1]]))):
+            # children packets
+            idcs_children = packets_dict['idcs_children'][packet_idcs]
+            flag_child = idcs_children >= 0
+            node_idcs = np.repeat(node_idcs, flag_child.sum(axis=1))
+            packet_idcs = idcs_children[flag_child]
+            level_packets += 1
+        else:
+            # children nodes
+            packet_idcs = np.repeat(packet_idcs, 2)
+            node_idcs = np.stack((2 * node_idcs + 1, 2 * node_idcs + 2), axis=1).ravel()
+
+    return packet_idcs, node_idcs - (n_leaves - 1), nodes_dict['near_distance'][node_idcs]
+
+
+def get_cross_product(a,
+                      b):
+    """
+    Cross product of arrays of 3D vectors along the last axis (as np.cross, without its overhead for small arrays)
+    """
+    return np.stack((a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1],
+                     a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2],
+                     a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]), axis=-1)
+
+
+def intersect_ray_packets_with_leaves(bvh_dict,
+                                      camera_location,
+                                      ray_directions_packets,
+                                      packet_idcs,
+                                      leaf_idcs):
+    """
+    Intersect the rays of each packet with the triangles of a leaf, for a list of (packet, leaf) pairs
+
+    :param bvh_dict: see build_bvh
+    :param camera_location: origin of the rays, in world RF (3,)
+    :param ray_directions_packets: array of shape (3, n_packets, n_rays_per_packet) (float32, world RF)
+    :param packet_idcs, leaf_idcs: arrays of shape (n_pairs,)
+    :return: distance to the closest hit of each ray in the leaf (inf if none), float32 array of shape (n_pairs, n_rays_per_packet)
+    """
+    # triangles relative to the ray origin (T0 = -V0)
+    T0 = (np.asarray(camera_location, dtype=np.float64) - bvh_dict['V0'][leaf_idcs]).astype(np.float32)
+    E1 = bvh_dict['E1'][leaf_idcs]
+    E2 = bvh_dict['E2'][leaf_idcs]
+    n_triangles_per_leaf = T0.shape[1]
+    A = get_cross_product(E2, E1)
+    B = get_cross_product(E2, T0)
+    C = get_cross_product(T0, E1)
+    t_times_det = np.einsum('pkj,pkj->pk', E2, C)
+
+    # t > 0 requires sign(det) = sign(t * det), which does not depend on the ray: flip each triangle so that both are
+    # positive (degenerate triangles and triangles whose plane contains the origin get t * det = inf, so t = inf)
+    sign = np.where(t_times_det < 0, np.float32(-1), np.float32(1))[:, :, None]
+    t_times_det = np.where(t_times_det != 0, np.abs(t_times_det), np.inf).astype(np.float32)[:, :, None]
+
+    # det, u * det and v * det for each (triangle, ray): matmul of (n_pairs, 3 * n_triangles_per_leaf, 3) by
+    # (n_pairs, 3, n_rays), written as (3 * n_triangles_per_leaf, n_pairs, n_rays) so that det, u and v are contiguous
+    dots = np.empty((3 * n_triangles_per_leaf, len(packet_idcs), ray_directions_packets.shape[2]), dtype=np.float32)
+    np.matmul(np.concatenate((A * sign, B * sign, C * sign), axis=1),
+              ray_directions_packets[:, packet_idcs].transpose(1, 0, 2),
+              out=dots.transpose(1, 0, 2))
+    det = dots[:n_triangles_per_leaf]
+    u_times_det = dots[n_triangles_per_leaf:2 * n_triangles_per_leaf]
+    v_times_det = dots[2 * n_triangles_per_leaf:]
+    # (det <= 0 fails the second condition, except for det = u = v = 0, where t = inf)
+    mask = (np.minimum(u_times_det, v_times_det) >= 0) & (u_times_det + v_times_det <= det)
+    t_array = np.full(det.shape, np.inf, dtype=np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.divide(t_times_det.transpose(1, 0, 2), det, out=t_array, where=mask)
+    return t_array.min(axis=0)
+
+
+def render_depth_of_bvh(bvh_dict,
+                        camera_location,
+                        ray_directions_packets,
+                        list_packet_levels,
+                        clip_start_end_in_m,
+                        n_pairs_per_chunk=16384):
+    """
+    Get the distance to the closest hit of each ray with the triangles of a BVH (see header of this module)
+
+    :param bvh_dict: see build_bvh
+    :param camera_location: origin of the rays, in world RF (3,)
+    :param ray_directions_packets: array of shape (3, n_packets, n_rays_per_packet) (float32, world RF; nan for no ray)
+    :param list_packet_levels: bounding cones of the hierarchy of packets, with the finest level being the packets of
+        ray_directions_packets (see get_leaves_that_may_hit_ray_packets)
+    :param clip_start_end_in_m: hits outside this range are ignored
+    :param n_pairs_per_chunk: number of (packet, leaf) pairs intersected at once (to limit memory)
+    :return: depth array of shape (n_packets, n_rays_per_packet) (float32, inf for no hit)
+    """
+    n_packets = ray_directions_packets.shape[1]
+    # (rays with no direction start at -inf, so that the furthest hit per packet is just the max over its rays)
+    depth_array = np.where(np.isnan(ray_directions_packets[0]), -np.inf, np.inf).astype(np.float32)
+    camera_location = np.asarray(camera_location, dtype=np.float64)
+
+    ### Candidate leaves per packet
+    packet_idcs, leaf_idcs, near_distance = get_leaves_that_may_hit_ray_packets(bvh_dict,
+                                                                                camera_location,
+                                                                                list_packet_levels,
+                                                                                clip_start_end_in_m[1])
+    if len(packet_idcs) == 0:
+        depth_array[np.isneginf(depth_array)] = np.inf
+        return depth_array
+
+    ### Rank of each leaf per packet, by distance
+    # (sorted by packet and by near distance quantized to 16 bits, packed in one int64 key)
+    near_distance_quantized = np.minimum(near_distance / clip_start_end_in_m[1] * 65535, 65535).astype(np.int64)
+    sort_idcs = np.argsort((packet_idcs << 16) | near_distance_quantized)
+    packet_idcs, leaf_idcs, near_distance = packet_idcs[sort_idcs], leaf_idcs[sort_idcs], near_distance[sort_idcs]
+    idx_first_pair_of_packet = np.searchsorted(packet_idcs, np.arange(n_packets))
+    rank = np.arange(len(packet_idcs)) - idx_first_pair_of_packet[packet_idcs]
+    rank = rank.astype(np.uint16) if rank.max() < 2 ** 16 else rank
+    sort_idcs = np.argsort(rank, kind='stable')
+    packet_idcs, leaf_idcs, near_distance = packet_idcs[sort_idcs], leaf_idcs[sort_idcs], near_distance[sort_idcs]
+    idx_rank_start_end = np.searchsorted(rank[sort_idcs], np.arange(int(rank.max()) + 2))
+
+    ### Intersect in rounds of increasing rank (each packet is at most once per round)
+    # furthest hit per packet so far (inf while any ray has no hit): leaves further than this are skipped
+    packet_max_depth = np.full(n_packets, np.inf)
+    for idx_start, idx_end in zip(idx_rank_start_end[:-1], idx_rank_start_end[1:]):
+        flag_not_occluded = near_distance[idx_start:idx_end] <= packet_max_depth[packet_idcs[idx_start:idx_end]]
+        round_packet_idcs = packet_idcs[idx_start:idx_end][flag_not_occluded]
+        round_leaf_idcs = leaf_idcs[idx_start:idx_end][flag_not_occluded]
+        for i0 in range(0, len(round_packet_idcs), n_pairs_per_chunk):
+            chunk_packet_idcs = round_packet_idcs[i0:i0 + n_pairs_per_chunk]
+            t_array = intersect_ray_packets_with_leaves(bvh_dict,
+                                                        camera_location,
+                                                        ray_directions_packets,
+                                                        chunk_packet_idcs,
+                                                        round_leaf_idcs[i0:i0 + n_pairs_per_chunk])
+            t_array[(t_array < clip_start_end_in_m[0]) | (t_array > clip_start_end_in_m[1])] = np.inf
+            depth_array[chunk_packet_idcs] = np.minimum(depth_array[chunk_packet_idcs], t_array)
+        packet_max_depth[round_packet_idcs] = depth_array[round_packet_idcs].max(axis=1)
+    depth_array[np.isneginf(depth_array)] = np.inf
+    return depth_array
@@ -0,0 +1,355 @@
+import os
+import numpy as np
+import camera_poses
+import raycast_renderer
+import ray_tables
+
+# Where each object of the arena (perches, obstacles, walls, floor and ceiling) lies in the camera's visual field,
+# and how large it looks, per frame, computed analytically from the geometry and the camera poses (no rendering)
+#
+# The objects are those of raycast_renderer.get_primitives_from_geometry_dict: cylinders (perches and obstacles) and
+# planes (walls, floor and ceiling, grouped by name). Each object is described by:
+# - its centre: the midpoint of the cylinder's axis, or the mean of the plane's vertices
+# - its outline points: the vertices of the 32-sided prism Blender builds for each cylinder
+#   (primitive_cylinder_add default), or the plane's vertices
+#
+# Per frame and object, in the camera reference frame (any tracking mode, see camera_poses.compute_camera_poses):
+# - azimuth_in_rad, elevation_in_rad: longitude and latitude of the direction to the centre, as in ray_tables
+#   (azimuth 0 along the camera's forward axis (-z) and increasing to the left (-x), elevation increasing up (+y))
+# - col, row: pixel coords of the centre in the rendered image (see ray_tables.get_pixel_coords_from_directions),
+#   and flag_centre_in_image
+# - distance_to_centre_in_m, and distance_to_closest_point_in_m (to the surface of the solid cylinder or
+#   the plane; 0 if the camera is inside a cylinder)
+# - angular_size_in_rad: largest angle between the directions to any two outline points (the angular diameter of
+#   the object; for a convex object the extreme points of its outline are among these vertices)
+# Occlusions between objects are not taken into account.
+
+# number of sides of the prisms Blender builds for perches and obstacles
+N_SIDES_PER_CYLINDER = 32
+
+# columns of the table (besides 'object_name'), and their dtypes
+OBJECT_TABLE_COLUMNS_DTYPES = {'frame': np.int64,
+                               'object_id': np.int64,
+                               'pass_index': np.int64,
+                               'azimuth_in_rad': np.float32,
+                               'elevation_in_rad': np.float32,
+                               'col': np.float32,
+                               'row': np.float32,
+                               'flag_centre_in_image': np.bool_,
+                               'distance_to_centre_in_m': np.float32,
+                               'distance_to_closest_point_in_m': np.float32,
+                               'angular_size_in_rad': np.float32}
+
+
+def get_objects_from_geometry_dict(geometry_dict,
+                                   input_config):
+    """
+    Get the centre and outline points of each object in the arena
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param input_config: config
+    :return: objects_dict, with keys
+        - 'name' (list), 'pass_index' (array (n_objects,)), 'centre' (array (n_objects, 3), in m)
+        - 'outline_points': array (n_objects, n_points, 3), in m (objects with fewer points are padded
+          with copies of their first point), and 'n_outline_points' (array (n_objects,))
+        - 'cylinders': dict with 'P1', 'P2', 'radius' and 'object_id' of the cylinder objects
+        - 'triangles': dict with 'V0', 'V1', 'V2' and 'object_id' of the triangles of the plane objects
+    """
+    primitives_dict = raycast_renderer.get_primitives_from_geometry_dict(geometry_dict,
+                                                                         input_config)
+    cylinders_dict = primitives_dict['cylinders']
+    triangles_dict = primitives_dict['triangles']
+    list_names = []
+    list_pass_indices = []
+    list_centres = []
+    list_outline_points = []
+
+    ### Cylinders: vertices of the prism's bases
+    angles = 2 * np.pi * np.arange(N_SIDES_PER_CYLINDER) / N_SIDES_PER_CYLINDER
+    for name, P1, P2, radius, pass_index in zip(cylinders_dict['name'],
+                                                cylinders_dict['P1'],
+                                                cylinders_dict['P2'],
+                                                cylinders_dict['radius'],
+                                                cylinders_dict['pass_index']):
+        # two unit vectors orthogonal to the axis
+        axis = (P2 - P1) / np.linalg.norm(P2 - P1)
+        ortho_1 = np.cross(axis, [1.0, 0, 0] if abs(axis[0]) < 0.9 else [0, 1.0, 0])
+        ortho_1 /= np.linalg.norm(ortho_1)
+        ortho_2 = np.cross(axis, ortho_1)
+        rim = radius * (np.cos(angles)[:, None] * ortho_1 + np.sin(angles)[:, None] * ortho_2)
+        list_names.append(name)
+        list_pass_indices.append(pass_index)
+        list_centres.append((P1 + P2) / 2)
+        list_outline_points.append(np.concatenate((P1 + rim, P2 + rim)))
+    cylinder_object_ids = np.arange(len(list_names))
+
+    ### Planes: vertices of their triangles
+    triangle_object_ids = np.zeros(len(triangles_dict['name']), dtype=np.int64)
+    for plane_name in sorted(set(triangles_dict['name'])):
+        idcs_triangles = [i for i, n in enumerate(triangles_dict['name']) if n == plane_name]
+        triangle_object_ids[idcs_triangles] = len(list_names)
+        vertices = np.unique(np.concatenate([triangles_dict[v][idcs_triangles] for v in ['V0', 'V1', 'V2']]), axis=0)
+        list_names.append(plane_name)
+        list_pass_indices.append(triangles_dict['pass_index'][idcs_triangles[0]])
+        list_centres.append(vertices.mean(axis=0))
+        list_outline_points.append(vertices)
+
+    n_points = max([len(p) for p in list_outline_points], default=1)
+    outline_points = np.array([np.concatenate((p, np.repeat(p[:1], n_points - len(p), axis=0)))
+                               for p in list_outline_points]).reshape(-1, n_points, 3)
+    return {'name': list_names,
+            'pass_index': np.array(list_pass_indices, dtype=np.int64),
+            'centre': np.array(list_centres, dtype=np.float64).reshape(-1, 3),
+            'outline_points': outline_points,
+            'n_outline_points': np.array([len(p) for p in list_outline_points], dtype=np.int64),
+            'cylinders': {'P1': cylinders_dict['P1'],
+                          'P2': cylinders_dict['P2'],
+                          'radius': cylinders_dict['radius'],
+                          'object_id': cylinder_object_ids},
+            'triangles': {'V0': triangles_dict['V0'],
+                          'V1': triangles_dict['V1'],
+                          'V2': triangles_dict['V2'],
+                          'object_id': triangle_object_ids}}
+
+
+def get_distance_to_cylinders(points,
+                              P1,
+                              P2,
+                              radius):
+    """
+    Distance from points to solid capped cylinders (0 for points inside)
+
+    :param points: array of shape (n_points, 3)
+    :param P1, P2: centres of the cylinders' bases, arrays of shape (n_cylinders, 3)
+    :param radius: array of shape (n_cylinders,)
+    :return: array of shape (n_points, n_cylinders)
+    """
+    axis_length = np.linalg.norm(P2 - P1, axis=1)
+    axis = (P2 - P1) / axis_length[:, None]
+    P1_to_points = points[:, None, :] - P1[None, :, :]
+    axial = np.einsum('pci,ci->pc', P1_to_points, axis)
+    radial = np.linalg.norm(P1_to_points - axial[..., None] * axis, axis=-1)
+    axial_excess = np.maximum(np.maximum(-axial, axial - axis_length), 0)
+    radial_excess = np.maximum(radial - radius, 0)
+    return np.hypot(axial_excess, radial_excess)
+
+
+def get_distance_to_segments(points,
+                             A,
+                             B):
+    """
+    Distance from points to segments AB
+
+    :param points: array of shape (n_points, 3)
+    :param A, B: ends of the segments, arrays of shape (n_segments, 3)
+    :return: array of shape (n_points, n_segments)
+    """
+    AB = B - A
+    A_to_points = points[:, None, :] - A[None, :, :]
+    s = np.clip(np.einsum('psi,si->ps', A_to_points, AB) / np.einsum('si,si->s', AB, AB), 0, 1)
+    return np.linalg.norm(A_to_points - s[..., None] * AB, axis=-1)
+
+
+def get_distance_to_triangles(points,
+                              V0,
+                              V1,
+                              V2):
+    """
+    Distance from points to triangles: to the plane of the triangle if the point projects inside it,
+    and to its closest edge otherwise
+
+    :param points: array of shape (n_points, 3)
+    :param V0, V1, V2: vertices of the triangles, arrays of shape (n_triangles, 3)
+    :return: array of shape (n_points, n_triangles)
+    """
+    normal = np.cross(V1 - V0, V2 - V0)
+    normal /= np.linalg.norm(normal, axis=1, keepdims=True)
+    V0_to_points = points[:, None, :] - V0[None, :, :]
+    distance_to_plane = np.einsum('pti,ti->pt', V0_to_points, normal)
+    projections = points[:, None, :] - distance_to_plane[..., None] * normal
+    # the projection is inside if it is on the inner side of the three edges
+    flag_inside = np.ones(distance_to_plane.shape, dtype=bool)
+    for Va, Vb in [(V0, V1), (V1, V2), (V2, V0)]:
+        flag_inside &= np.einsum('pti,ti->pt', np.cross(Vb - Va, projections - Va), normal) >= 0
+    distance_to_edges = np.minimum(np.minimum(get_distance_to_segments(points, V0, V1),
+                                              get_distance_to_segments(points, V1, V2)),
+                                   get_distance_to_segments(points, V2, V0))
+    return np.where(flag_inside, np.abs(distance_to_plane), distance_to_edges)
+
+
+def compute_object_table(objects_dict,
+                         camera_poses_dict,
+                         input_config,
+                         n_frames_per_chunk=256):
+    """
+    Compute the bearing, angular size and distance of every object for every frame (see header)
+
+    :param objects_dict: see get_objects_from_geometry_dict
+    :param camera_poses_dict: dict with 'frame', 'location' and 'rotation_quaternion' (see camera_poses.compute_camera_poses)
+    :param input_config: config (for the camera projection)
+    :param n_frames_per_chunk: number of frames processed at once (to limit the memory used for the angular sizes)
+    :return: object_table_dict, with one row per frame and object (frame-major), with the columns in
+        OBJECT_TABLE_COLUMNS_DTYPES, and 'object_name' (list of the names per object_id)
+    """
+    frames_array = np.asarray(camera_poses_dict['frame'])
+    locations = np.asarray(camera_poses_dict['location'], dtype=np.float64)
+    n_frames = len(frames_array)
+    n_objects = len(objects_dict['name'])
+    camera_projection_params_dict = ray_tables.get_camera_projection_params(input_config)
+    n_cols = camera_projection_params_dict['n_cols']
+    n_rows = camera_projection_params_dict['n_rows']
+
+    ### World to camera RF (as row vectors: (v - loc) @ R)
+    rotation_matrices = camera_poses.quaternion_to_rotation_matrix(camera_poses_dict['rotation_quaternion'])
+    centres_cameraRF = np.einsum('foi,fij->foj', objects_dict['centre'][None] - locations[:, None], rotation_matrices)
+
+    ### Bearing of the centres
+    distance_to_centre = np.linalg.norm(centres_cameraRF, axis=-1)
+    azimuth = np.arctan2(-centres_cameraRF[..., 0], -centres_cameraRF[..., 2])
+    elevation = np.arcsin(np.clip(centres_cameraRF[..., 1] / distance_to_centre, -1, 1))
+    col, row = ray_tables.get_pixel_coords_from_directions(centres_cameraRF,
+                                                           camera_projection_params_dict)
+    flag_centre_in_image = (col >= -0.5) & (col < n_cols - 0.5) & (row >= -0.5) & (row < n_rows - 0.5)
+    if camera_projection_params_dict['camera_panorama_type'] == 'FISHEYE_EQUIDISTANT':
+        flag_centre_in_image &= np.hypot((col + 0.5) / n_cols - 0.5, (row + 0.5) / n_rows - 0.5) <= 0.5
+
+    ### Distance to the closest point (rotation-independent, so computed in worldRF)
+    distance_to_closest_point = np.full((n_frames, n_objects), np.inf)
+    cylinders_dict = objects_dict['cylinders']
+    if len(cylinders_dict['object_id']):
+        distance_to_closest_point[:, cylinders_dict['object_id']] = get_distance_to_cylinders(locations,
+                                                                                              cylinders_dict['P1'],
+                                                                                              cylinders_dict['P2'],
+                                                                                              cylinders_dict['radius'])
+    triangles_dict = objects_dict['triangles']
+    if len(triangles_dict['object_id']):
+        distance_to_triangles = get_distance_to_triangles(locations,
+                                                          triangles_dict['V0'],
+                                                          triangles_dict['V1'],
+                                                          triangles_dict['V2'])
+        np.minimum.at(distance_to_closest_point.T, triangles_dict['object_id'], distance_to_triangles.T)
+
+    ### Angular size: largest angle between the directions to two outline points
+    # (objects with the same number of outline points are processed together, so planes are not padded to the
+    # number of points of the cylinders)
+    angular_size = np.zeros((n_frames, n_objects))
+    for n_points in np.unique(objects_dict['n_outline_points']):
+        idcs_objects = np.flatnonzero(objects_dict['n_outline_points'] == n_points)
+        outline_points = objects_dict['outline_points'][idcs_objects, :n_points]
+        for i0 in range(0, n_frames, n_frames_per_chunk):
+            i1 = min(i0 + n_frames_per_chunk, n_frames)
+            directions = outline_points[None] - locations[i0:i1, None, None]
+            directions /= np.linalg.norm(directions, axis=-1, keepdims=True)
+            min_cos = np.min(directions @ directions.swapaxes(-1, -2), axis=(-2, -1))
+            angular_size[i0:i1, idcs_objects] = np.arccos(np.clip(min_cos, -1, 1))
+
+    ### Table (frame-major)
+    object_table_dict = {'frame': np.repeat(frames_array, n_objects),
+                         'object_id': np.tile(np.arange(n_objects), n_frames),
+                         'pass_index': np.tile(objects_dict['pass_index'], n_frames),
+                         'azimuth_in_rad': azimuth.ravel(),
+                         'elevation_in_rad': elevation.ravel(),
+                         'col': col.ravel(),
+                         'row': row.ravel(),
+                         'flag_centre_in_image': flag_centre_in_image.ravel(),
+                         'distance_to_centre_in_m': distance_to_centre.ravel(),
+                         'distance_to_closest_point_in_m': distance_to_closest_point.ravel(),
+                         'angular_size_in_rad': angular_size.ravel()}
+    object_table_dict = {k: v.astype(OBJECT_TABLE_COLUMNS_DTYPES[k]) for k, v in object_table_dict.items()}
+    object_table_dict['object_name'] = list(objects_dict['name'])
+    return object_table_dict
+
+
+def save_object_table(object_table_dict,
+                      output_path):
+    """
+    Save the object table as a compressed .npz file (one array per column, and 'object_name' per object_id),
+    or as a .csv file (one row per frame and object, with the object name instead of the object_id)
+
+    :param object_table_dict: see compute_object_table
+    :param output_path: path to the output file (.npz or .csv)
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    if output_path.endswith('.csv'):
+        object_names = np.asarray(object_table_dict['object_name'])
+        list_columns = [k for k in OBJECT_TABLE_COLUMNS_DTYPES if k != 'object_id']
+        with open(output_path, 'w') as f:
+            f.write(','.join(['object_name'] + list_columns) + '\n')
+            for row_values in zip(object_names[object_table_dict['object_id']],
+                                  *[object_table_dict[k].astype(np.int64)
+                                    if k == 'flag_centre_in_image' else object_table_dict[k]
+                                    for k in list_columns]):
+                f.write(','.join(str(v) for v in row_values) + '\n')
+    else:
+        np.savez_compressed(output_path,
+                            object_name=np.asarray(object_table_dict['object_name']),
+                            **{k: object_table_dict[k] for k in OBJECT_TABLE_COLUMNS_DTYPES})
+
+
+def load_object_table(output_path):
+    """
+    Load an object table saved as .npz by save_object_table
+
+    :param output_path: path to the .npz file
+    :return: object_table_dict (see compute_object_table)
+    """
+    with np.load(output_path) as npz:
+        object_table_dict = {k: npz[k] for k in OBJECT_TABLE_COLUMNS_DTYPES}
+        object_table_dict['object_name'] = npz['object_name'].tolist()
+    return object_table_dict
+
+
+def compute_object_table_for_trial(geometry_dict,
+                                   camera_poses_dict,
+                                   input_config,
+                                   output_path=None):
+    """
+    Compute the object table of a trial, and save it if output_path is given
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param camera_poses_dict: dict with 'frame', 'location' and 'rotation_quaternion' (see camera_poses.compute_camera_poses)
+    :param input_config: config
+    :param output_path: path to the output file (.npz or .csv, see save_object_table). If None, not saved
+    :return: object_table_dict (see compute_object_table)
+    """
+    objects_dict = get_objects_from_geometry_dict(geometry_dict,
+                                                  input_config)
+    object_table_dict = compute_object_table(objects_dict,
+                                             camera_poses_dict,
+                                             input_config)
+    if output_path is not None:
+        save_object_table(object_table_dict,
+                          output_path)
+    return object_table_dict
+
+
+if __name__ == '__main__':
+    # compute the object table of the trial in the input json file, without Blender:
+    #     python object_bearings.py <input json> [output .npz or .csv]
+    # (default output: <render_output_parent_dir_path>/<render_output_parent_dir_str>_objects.npz)
+    import sys
+    import time
+    import config
+    import load_data
+
+    input_config = config.config(sys.argv[1])
+    output_path = sys.argv[2] if len(sys.argv) > 2 else \
+        os.path.join(input_config.render_output_parent_dir_path,
+                     input_config.render_output_parent_dir_str + '_objects.npz')
+    geometry_dict = load_data.load_csv_with_cache(load_data.csv_to_dict_keys_per_row,
+                                                  input_config.geometry_csv_path_to_file,
+                                                  [input_config.geometry_csv_n_header_rows_to_skip,
+                                                   input_config.geometry_csv_idx_col_start_data],
+                                                  input_config.data_cache_folder_path if input_config.flag_use_data_cache else None)
+    transforms_dict = load_data.csv_transforms_concatenated_to_dict(input_config)
+    camera_poses_dict = camera_poses.compute_camera_poses(transforms_dict,
+                                                          input_config)
+    t0 = time.perf_counter()
+    object_table_dict = compute_object_table_for_trial(geometry_dict,
+                                                       camera_poses_dict,
+                                                       input_config,
+                                                       output_path)
+    print('Object table ({} frames x {} objects) saved to {} in {:.3f} s'.format(len(camera_poses_dict['frame']),
+                                                                              len(object_table_dict['object_name']),
+                                                                              output_path,
+                                                                              time.perf_counter() - t0))
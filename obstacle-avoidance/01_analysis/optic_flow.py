@@ -0,0 +1,144 @@
+import numpy as np
+import camera_poses
+import raycast_renderer
+import ray_tables
+
+# Optic flow over the panoramic image, computed from the depth at frame t and the camera poses at t and t+1
+# (instead of Cycles' Vector pass, so render_use_pass_vector can be set to False)
+#
+# For each pixel, the 3D point seen at frame t (ray direction * depth) is expressed in the camera reference frame
+# at t+1 and projected back to the image. Pixels with depth >= BACKGROUND_DEPTH are considered infinitely far,
+# so only the camera rotation moves them.
+#
+# Outputs per pixel:
+# - displacement_x_y_in_pixels: displacement in the image from t to t+1, in pixels, with x to the right and y up
+#   (as Blender's image coords). For EQUIRECTANGULAR cameras, it is wrapped to the shortest displacement in longitude.
+# - angular_velocity_lon_lat_in_rad_per_s: angular velocity of the viewing direction on the sphere, as its components
+#   along the longitude (d_longitude * cos(latitude), longitude increasing to the left of the image) and
+#   latitude directions (increasing upwards)
+# - angular_speed_in_rad_per_s: angle between the viewing directions at t and t+1, times the sampling rate
+# Pixels without a ray (outside the fisheye circle) have nan flow
+
+
+def compute_optic_flow(depth_stack,
+                       ray_directions_cameraRF,
+                       location_t,
+                       quat_t,
+                       location_t_next,
+                       quat_t_next,
+                       input_config,
+                       n_frames_per_chunk=8):
+    """
+    Compute the optic flow between t and t+1 for a stack of frames
+
+    The stack is processed in chunks of n_frames_per_chunk frames, to limit the memory used by the intermediate
+    (float64) arrays.
+
+    :param depth_stack: array of shape (n_frames, n_rows, n_cols) with the depth (distance along the ray) at t, in m
+    :param ray_directions_cameraRF: array of shape (n_rows, n_cols, 3) (see ray_tables.get_ray_table)
+    :param location_t: camera location at t, array of shape (n_frames, 3), in m
+    :param quat_t: camera rotation quaternion at t, array of shape (n_frames, 4) (w,x,y,z)
+    :param location_t_next: camera location at t+1, array of shape (n_frames, 3), in m
+    :param quat_t_next: camera rotation quaternion at t+1, array of shape (n_frames, 4)
+    :param input_config: config (camera params and mocap_sampling_rate_in_Hz)
+    :param n_frames_per_chunk: number of frames processed at once
+    :return: optic_flow_dict, with float32 arrays
+        - 'displacement_x_y_in_pixels': shape (n_frames, n_rows, n_cols, 2)
+        - 'angular_velocity_lon_lat_in_rad_per_s': shape (n_frames, n_rows, n_cols, 2)
+        - 'angular_speed_in_rad_per_s': shape (n_frames, n_rows, n_cols)
+    """
+    depth_stack = np.asarray(depth_stack)
+    n_frames, n_rows, n_cols = depth_stack.shape
+    rate_in_Hz = input_config.mocap_sampling_rate_in_Hz
+
+    ### Pixel coords and viewing directions at t (same for all frames)
+    camera_projection_params_dict = ray_tables.get_camera_projection_params(input_config)
+    ray_directions_cameraRF = np.asarray(ray_directions_cameraRF, dtype=np.float64)
+    col_grid, row_grid = np.meshgrid(np.arange(n_cols), np.arange(n_rows))
+    longitude_t = np.arctan2(-ray_directions_cameraRF[..., 0], -ray_directions_cameraRF[..., 2])
+    latitude_t = np.arcsin(np.clip(ray_directions_cameraRF[..., 1], -1, 1))
+    # number of pixels for a full turn in longitude (to wrap the displacement in x), None if not equirectangular
+    n_cols_per_turn = ray_tables.get_n_cols_per_turn(camera_projection_params_dict)
+
+    ### Relative pose: rotation from camera RF at t to camera RF at t+1, and location of camera at t in camera RF at t+1
+    rotation_t = camera_poses.quaternion_to_rotation_matrix(quat_t)
+    rotation_t_next = camera_poses.quaternion_to_rotation_matrix(quat_t_next)
+    rotation_relative = np.einsum('kji,kjl->kil', rotation_t_next, rotation_t)  # R_next^T @ R_t
+    translation_relative = np.einsum('kji,kj->ki',
+                                     rotation_t_next,
+                                     np.asarray(location_t, dtype=np.float64) - np.asarray(location_t_next, dtype=np.float64))
+
+    optic_flow_dict = {'displacement_x_y_in_pixels': np.empty((n_frames, n_rows, n_cols, 2), dtype=np.float32),
+                       'angular_velocity_lon_lat_in_rad_per_s': np.empty((n_frames, n_rows, n_cols, 2), dtype=np.float32),
+                       'angular_speed_in_rad_per_s': np.empty((n_frames, n_rows, n_cols), dtype=np.float32)}
+
+    for i0 in range(0, n_frames, n_frames_per_chunk):
+        i1 = min(i0 + n_frames_per_chunk, n_frames)
+
+        ### Viewing direction of each pixel's point at t+1, in camera RF at t+1
+        directions_rotated = np.einsum('kij,hwj->khwi', rotation_relative[i0:i1], ray_directions_cameraRF)
+        depth = depth_stack[i0:i1].astype(np.float64)[..., None]
+        flag_background = depth >= raycast_renderer.BACKGROUND_DEPTH
+        points_t_next = np.where(flag_background,
+                                 directions_rotated,
+                                 depth * directions_rotated + translation_relative[i0:i1, None, None, :])
+        directions_t_next = points_t_next / np.linalg.norm(points_t_next, axis=-1, keepdims=True)
+
+        ### Displacement in the image
+        col_t_next, row_t_next = ray_tables.get_pixel_coords_from_directions(directions_t_next,
+                                                                             camera_projection_params_dict)
+        displacement_x = col_t_next - col_grid
+        if n_cols_per_turn is not None:
+            displacement_x = (displacement_x + 0.5 * n_cols_per_turn) % n_cols_per_turn - 0.5 * n_cols_per_turn
+        displacement_y = -(row_t_next - row_grid)
+        optic_flow_dict['displacement_x_y_in_pixels'][i0:i1] = np.stack((displacement_x, displacement_y), axis=-1)
+
+        ### Angular velocity on the sphere
+        longitude_t_next = np.arctan2(-directions_t_next[..., 0], -directions_t_next[..., 2])
+        latitude_t_next = np.arcsin(np.clip(directions_t_next[..., 1], -1, 1))
+        delta_longitude = (longitude_t_next - longitude_t + np.pi) % (2 * np.pi) - np.pi
+        optic_flow_dict['angular_velocity_lon_lat_in_rad_per_s'][i0:i1] = \
+            np.stack((delta_longitude * np.cos(latitude_t),
+                      latitude_t_next - latitude_t), axis=-1) * rate_in_Hz
+        optic_flow_dict['angular_speed_in_rad_per_s'][i0:i1] = \
+            np.arctan2(np.linalg.norm(np.cross(ray_directions_cameraRF, directions_t_next), axis=-1),
+                       np.einsum('hwi,khwi->khw', ray_directions_cameraRF, directions_t_next)) * rate_in_Hz
+
+    return optic_flow_dict
+
+
+def compute_optic_flow_for_camera_poses(depth_stack,
+                                        camera_poses_dict,
+                                        input_config,
+                                        n_frames_per_chunk=8,
+                                        ray_table_cache_folder_path=None):
+    """
+    Compute the optic flow from each frame to the next one, for the frames in camera_poses_dict
+
+    :param depth_stack: array of shape (n_frames, n_rows, n_cols), with the depth for the first n_frames frames
+        in camera_poses_dict
+    :param camera_poses_dict: dict with 'frame', 'location' and 'rotation_quaternion' (see camera_poses.compute_camera_poses)
+    :param input_config: config
+    :param n_frames_per_chunk: number of frames processed at once
+    :param ray_table_cache_folder_path: path to folder for the ray tables saved to disk (see ray_tables.get_ray_table)
+    :return: optic_flow_dict (see compute_optic_flow), with 'frame' added. The flow is nan for a frame
+        without a next frame in camera_poses_dict
+    """
+    n_frames = depth_stack.shape[0]
+    n_frames_with_next = min(n_frames, len(camera_poses_dict['frame']) - 1)
+    ray_directions_cameraRF = ray_tables.get_ray_table(input_config,
+                                                       ray_table_cache_folder_path)
+
+    optic_flow_dict = compute_optic_flow(depth_stack[:n_frames_with_next],
+                                         ray_directions_cameraRF,
+                                         camera_poses_dict['location'][:n_frames_with_next],
+                                         camera_poses_dict['rotation_quaternion'][:n_frames_with_next],
+                                         camera_poses_dict['location'][1:n_frames_with_next + 1],
+                                         camera_poses_dict['rotation_quaternion'][1:n_frames_with_next + 1],
+                                         input_config,
+                                         n_frames_per_chunk)
+    for k, v in optic_flow_dict.items():
+        optic_flow_dict[k] = np.concatenate((v, np.full((n_frames - n_frames_with_next,) + v.shape[1:], np.nan,
+                                                        dtype=v.dtype)))
+    optic_flow_dict['frame'] = np.asarray(camera_poses_dict['frame'][:n_frames])
+    return optic_flow_dict
@@ -0,0 +1,134 @@
+import contextlib
+import cProfile
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# resource is not available in Windows (peak RSS is then not recorded)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Timing of the stages of main.main (config, data loading, geometry, camera...), to compare runs
+# on different machines and datasets
+
+
+def get_peak_rss_in_mb():
+    """
+    Get the peak resident set size (max memory used so far) of the current process, in MB
+
+    :return: peak RSS in MB, or None if not available (Windows)
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes in macOS and in KB in Linux
+    if sys.platform == 'darwin':
+        return peak_rss / 1e6
+    return peak_rss * 1024 / 1e6
+
+
+class StageProfiler:
+    """
+    Record wall time, CPU time and peak RSS per stage, and optionally a cProfile dump per stage
+
+    Usage:
+        profiler = StageProfiler(flag_cprofile=True)
+        with profiler.stage('load_data'):
+            ...
+        profiler.save_json(path_to_json, metadata_dict)  # cProfile stats are saved next to the json file
+    """
+
+    def __init__(self,
+                 flag_cprofile=False):
+        """
+        :param flag_cprofile: if True, each stage is also profiled with cProfile
+        """
+        self.flag_cprofile = flag_cprofile
+        self.start_time = datetime.now()
+        self.list_stages = []
+        self.dict_stage_to_cprofile = dict()
+
+    @contextlib.contextmanager
+    def stage(self,
+              stage_str):
+        """
+        Context manager to record a stage (the stage is recorded even if it raises an error)
+
+        - peak RSS is the max memory used by the process up to the end of the stage (the increase during
+          the stage is 0 if the stage did not use more memory than previous stages)
+
+        :param stage_str: name of the stage
+        """
+        if self.flag_cprofile:
+            cprofile = cProfile.Profile()
+            self.dict_stage_to_cprofile[stage_str] = cprofile
+        peak_rss_start = get_peak_rss_in_mb()
+        wall_time_start = time.perf_counter()
+        cpu_time_start = time.process_time()
+        if self.flag_cprofile:
+            cprofile.enable()
+        try:
+            yield
+        finally:
+            if self.flag_cprofile:
+                cprofile.disable()
+            cpu_time_in_s = time.process_time() - cpu_time_start
+            wall_time_in_s = time.perf_counter() - wall_time_start
+            peak_rss_end = get_peak_rss_in_mb()
+            self.list_stages.append({'stage': stage_str,
+                                     'wall_time_in_s': wall_time_in_s,
+                                     'cpu_time_in_s': cpu_time_in_s,
+                                     'peak_rss_in_mb': peak_rss_end,
+                                     'peak_rss_increase_in_mb': (peak_rss_end - peak_rss_start
+                                                                 if peak_rss_end is not None else None)})
+
+    def to_dict(self,
+                metadata_dict=None):
+        """
+        Get the recorded stages and info on the machine as a dict
+
+        :param metadata_dict: additional info to include (e.g., trial, number of frames, Blender version)
+        :return: profiling_dict
+        """
+        return {'start_time': self.start_time.isoformat(timespec='seconds'),
+                'machine': {'hostname': platform.node(),
+                            'platform': platform.platform(),
+                            'processor': platform.processor(),
+                            'n_cpus': os.cpu_count(),
+                            'python_version': platform.python_version()},
+                'metadata': metadata_dict or dict(),
+                'total_wall_time_in_s': sum(s['wall_time_in_s'] for s in self.list_stages),
+                'total_cpu_time_in_s': sum(s['cpu_time_in_s'] for s in self.list_stages),
+                'peak_rss_in_mb': get_peak_rss_in_mb(),
+                'stages': self.list_stages}
+
+    def save_json(self,
+                  json_path,
+                  metadata_dict=None):
+        """
+        Save the profiling dict as json, and the cProfile stats of each stage (if recorded) next to it,
+        as <json filename without extension>_<stage>.prof (these can be inspected with pstats or snakeviz)
+
+        :param json_path: path to output json file
+        :param metadata_dict: additional info to include (see to_dict)
+        :return: profiling_dict
+        """
+        profiling_dict = self.to_dict(metadata_dict)
+        if self.dict_stage_to_cprofile:
+            profiling_dict['cprofile_paths'] = dict()
+            for stage_str, cprofile in self.dict_stage_to_cprofile.items():
+                prof_path = os.path.splitext(json_path)[0] + '_' + stage_str + '.prof'
+                cprofile.dump_stats(prof_path)
+                profiling_dict['cprofile_paths'][stage_str] = prof_path
+        # (written to a tmp file and renamed, so that the json file is never read half-written)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(json_path)), prefix='.tmp_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(profiling_dict, f, indent=4)
+        os.replace(tmp_path, json_path)
+        return profiling_dict
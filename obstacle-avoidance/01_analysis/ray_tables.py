@@ -0,0 +1,264 @@
+import collections
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+import camera_poses
+
+# Ray direction per pixel of the panoramic camera ('ray table'), as in Cycles' EQUIRECTANGULAR and
+# FISHEYE_EQUIDISTANT cameras, and its inverse (pixel coords of a direction)
+#
+# Conventions:
+# - directions are unit vectors in the Blender camera reference frame (camera looking along -Z, with Y up)
+# - tables have shape (n_rows, n_cols, 3), with row 0 the top row of the image (as in the images saved by
+#   Blender) and column 0 the left column
+# - u and v are the pixel coords normalised to [0, 1], u from left to right and v from bottom to top
+#   (pixel centres at u = (col + 0.5) / n_cols, v = 1 - (row + 0.5) / n_rows)
+# - Cycles defines panoramic directions with X forward, Y left and Z up ('panorama RF'), and rotates them to the
+#   camera RF (forward = -Z, left = -X, up = Y)
+#
+# A table only depends on the camera projection params (see get_camera_projection_params), so it is computed once per
+# camera configuration, kept in memory (the RAY_TABLE_CACHE_MAX_N_TABLES last used) and optionally saved to disk as a
+# float32 .npy file, loaded memory-mapped
+
+RAY_TABLE_CACHE_VERSION = 1
+RAY_TABLE_CACHE_MAX_N_TABLES = 4
+
+# in-memory cache: key -> ray table (least recently used first)
+ray_tables_in_memory = collections.OrderedDict()
+
+
+def get_camera_projection_params(input_config):
+    """
+    Get the config params that define the ray direction of each pixel
+
+    :param input_config: config
+    :return: camera_projection_params_dict
+    """
+    if input_config.camera_panorama_type not in ['EQUIRECTANGULAR', 'FISHEYE_EQUIDISTANT']:
+        sys.exit("ERROR in ray_tables: camera_panorama_type {} not implemented (only 'EQUIRECTANGULAR' or 'FISHEYE_EQUIDISTANT')"
+                 .format(input_config.camera_panorama_type))
+    if any(input_config.camera_shift_x_y):
+        sys.exit('ERROR in ray_tables: camera shift {} not implemented for panoramic cameras (only [0, 0])'
+                 .format(input_config.camera_shift_x_y))
+
+    camera_projection_params_dict = {'camera_panorama_type': input_config.camera_panorama_type,
+                                     'camera_shift_x_y': [float(x) for x in input_config.camera_shift_x_y],
+                                     'n_cols': int(round(input_config.render_resolution_x_y_in_pixels[0]
+                                                         * input_config.render_resolution_percentage / 100)),
+                                     'n_rows': int(round(input_config.render_resolution_x_y_in_pixels[1]
+                                                         * input_config.render_resolution_percentage / 100))}
+    if input_config.camera_panorama_type == 'EQUIRECTANGULAR':
+        camera_projection_params_dict['camera_longitude_min_max_in_rad'] = [float(x) for x in input_config.camera_longitude_min_max_in_rad]
+        camera_projection_params_dict['camera_latitude_min_max_in_rad'] = [float(x) for x in input_config.camera_latitude_min_max_in_rad]
+    else:
+        camera_projection_params_dict['camera_fisheye_equidistant_FOV_in_rad'] = float(input_config.camera_fisheye_equidistant_FOV_in_rad)
+    return camera_projection_params_dict
+
+
+def get_ray_table_key(camera_projection_params_dict):
+    """
+    Get a key that identifies a camera configuration (hash of its projection params)
+
+    :return: key str
+    """
+    params_str = json.dumps(dict(camera_projection_params_dict, cache_version=RAY_TABLE_CACHE_VERSION),
+                            sort_keys=True)
+    return hashlib.sha1(params_str.encode()).hexdigest()[:16]
+
+
+def panoramaRF_to_cameraRF(directions_panoramaRF):
+    """
+    Rotate directions from the panorama RF (X forward, Y left, Z up) to the Blender camera RF (forward = -Z,
+    left = -X, up = Y), as Cycles does for panoramic cameras
+
+    :param directions_panoramaRF: array of shape (..., 3)
+    :return: directions_cameraRF, array of shape (..., 3)
+    """
+    return np.stack((-directions_panoramaRF[..., 1],
+                     directions_panoramaRF[..., 2],
+                     -directions_panoramaRF[..., 0]), axis=-1)
+
+
+def cameraRF_to_panoramaRF(directions_cameraRF):
+    """
+    Inverse of panoramaRF_to_cameraRF
+    """
+    return np.stack((-directions_cameraRF[..., 2],
+                     -directions_cameraRF[..., 0],
+                     directions_cameraRF[..., 1]), axis=-1)
+
+
+def compute_ray_table(camera_projection_params_dict):
+    """
+    Compute the ray direction through the centre of each pixel
+
+    - EQUIRECTANGULAR (as Cycles' equirectangular_range_to_direction):
+        longitude = (longitude_min - longitude_max) * u - longitude_min
+        latitude = latitude_min + (latitude_max - latitude_min) * v
+        direction in panorama RF = (cos(lat) cos(long), cos(lat) sin(long), sin(lat))
+    - FISHEYE_EQUIDISTANT (as Cycles' fisheye_to_direction): with (x, y) = 2 * (u, v) - 1 and r = |(x, y)|,
+        the angle to the forward axis is r * fov / 2 and the angle around it atan2(y, x);
+        pixels with r > 1 have no ray (nan direction)
+
+    :param camera_projection_params_dict: see get_camera_projection_params
+    :return: ray_table, float32 array of shape (n_rows, n_cols, 3) with unit directions in camera RF
+    """
+    n_cols = camera_projection_params_dict['n_cols']
+    n_rows = camera_projection_params_dict['n_rows']
+    u = (np.arange(n_cols) + 0.5) / n_cols
+    v = 1 - (np.arange(n_rows) + 0.5) / n_rows
+    u, v = np.meshgrid(u, v)  # arrays of shape (n_rows, n_cols)
+
+    if camera_projection_params_dict['camera_panorama_type'] == 'EQUIRECTANGULAR':
+        longitude_min, longitude_max = camera_projection_params_dict['camera_longitude_min_max_in_rad']
+        latitude_min, latitude_max = camera_projection_params_dict['camera_latitude_min_max_in_rad']
+        longitude = (longitude_min - longitude_max) * u - longitude_min
+        latitude = latitude_min + (latitude_max - latitude_min) * v
+        directions_panoramaRF = np.stack((np.cos(latitude) * np.cos(longitude),
+                                          np.cos(latitude) * np.sin(longitude),
+                                          np.sin(latitude)), axis=-1)
+    else:
+        fov = camera_projection_params_dict['camera_fisheye_equidistant_FOV_in_rad']
+        x = 2 * u - 1
+        y = 2 * v - 1
+        r = np.hypot(x, y)
+        theta = r * fov / 2  # angle to the forward axis
+        phi = np.arctan2(y, x)  # angle around the forward axis
+        directions_panoramaRF = np.stack((np.cos(theta),
+                                          -np.cos(phi) * np.sin(theta),
+                                          np.sin(phi) * np.sin(theta)), axis=-1)
+        directions_panoramaRF[r > 1] = np.nan
+
+    return panoramaRF_to_cameraRF(directions_panoramaRF).astype(np.float32)
+
+
+def get_pixel_coords_from_directions(directions_cameraRF,
+                                     camera_projection_params_dict):
+    """
+    Get the (continuous) pixel coords of directions in camera RF (inverse of compute_ray_table)
+
+    For EQUIRECTANGULAR, the longitude is taken as the 2*pi-equivalent value closest to the centre of the image;
+    directions outside the camera field of view have pixel coords outside the image (or nan for FISHEYE_EQUIDISTANT
+    if further than pi from the forward axis).
+
+    :param directions_cameraRF: array of shape (..., 3) (need not be unit vectors)
+    :param camera_projection_params_dict: see get_camera_projection_params
+    :return: col_array, row_array of shape (...), with col from the left and row from the top,
+        and integer values at the pixels' centres
+    """
+    n_cols = camera_projection_params_dict['n_cols']
+    n_rows = camera_projection_params_dict['n_rows']
+    directions_panoramaRF = cameraRF_to_panoramaRF(np.asarray(directions_cameraRF, dtype=np.float64))
+    dir_x, dir_y, dir_z = np.moveaxis(directions_panoramaRF, -1, 0)
+
+    if camera_projection_params_dict['camera_panorama_type'] == 'EQUIRECTANGULAR':
+        longitude_min, longitude_max = camera_projection_params_dict['camera_longitude_min_max_in_rad']
+        latitude_min, latitude_max = camera_projection_params_dict['camera_latitude_min_max_in_rad']
+        longitude = np.arctan2(dir_y, dir_x)
+        latitude = np.arctan2(dir_z, np.hypot(dir_x, dir_y))
+        u_per_turn = 2 * np.pi / (longitude_max - longitude_min)
+        u = (longitude + longitude_min) / (longitude_min - longitude_max)
+        u = u - np.round((u - 0.5) / u_per_turn) * u_per_turn
+        v = (latitude - latitude_min) / (latitude_max - latitude_min)
+    else:
+        fov = camera_projection_params_dict['camera_fisheye_equidistant_FOV_in_rad']
+        theta = np.arctan2(np.hypot(dir_y, dir_z), dir_x)
+        phi = np.arctan2(dir_z, -dir_y)
+        r = theta / (fov / 2)
+        u = (r * np.cos(phi) + 1) / 2
+        v = (r * np.sin(phi) + 1) / 2
+
+    return u * n_cols - 0.5, (1 - v) * n_rows - 0.5
+
+
+def get_n_cols_per_turn(camera_projection_params_dict):
+    """
+    Get the number of pixels for a full turn in longitude (to wrap displacements in x), or None if the image
+    does not wrap in longitude (FISHEYE_EQUIDISTANT)
+    """
+    if camera_projection_params_dict['camera_panorama_type'] != 'EQUIRECTANGULAR':
+        return None
+    longitude_min, longitude_max = camera_projection_params_dict['camera_longitude_min_max_in_rad']
+    return camera_projection_params_dict['n_cols'] * 2 * np.pi / (longitude_max - longitude_min)
+
+
+def get_ray_table(input_config,
+                  cache_folder_path=None):
+    """
+    Get the ray table for the camera in config, computing it only if it is not cached
+
+    Lookup order: in-memory cache (LRU, up to RAY_TABLE_CACHE_MAX_N_TABLES tables), then <cache_folder_path>/<key>.npy
+    (loaded memory-mapped, read-only), then computed (and saved to cache_folder_path).
+
+    :param input_config: config
+    :param cache_folder_path: path to folder for the ray tables saved to disk; if None, tables are only cached in memory
+    :return: ray_table, float32 array of shape (n_rows, n_cols, 3) (read-only; see compute_ray_table)
+    """
+    camera_projection_params_dict = get_camera_projection_params(input_config)
+    key = get_ray_table_key(camera_projection_params_dict)
+
+    ### In memory
+    if key in ray_tables_in_memory:
+        ray_tables_in_memory.move_to_end(key)
+        return ray_tables_in_memory[key]
+
+    ### On disk, or compute
+    ray_table = None
+    if cache_folder_path is not None:
+        table_path = os.path.join(cache_folder_path, key + '.npy')
+        if os.path.isfile(table_path):
+            try:
+                ray_table = np.load(table_path, mmap_mode='r')
+            except (OSError, ValueError):
+                ray_table = None  # corrupt file: computed again and overwritten
+            if ray_table is not None and ray_table.shape != (camera_projection_params_dict['n_rows'],
+                                                             camera_projection_params_dict['n_cols'], 3):
+                ray_table = None
+        if ray_table is None:
+            ray_table = compute_ray_table(camera_projection_params_dict)
+            save_ray_table(ray_table,
+                           camera_projection_params_dict,
+                           cache_folder_path,
+                           key)
+            ray_table = np.load(table_path, mmap_mode='r')
+    else:
+        ray_table = compute_ray_table(camera_projection_params_dict)
+        ray_table.setflags(write=False)
+
+    ray_tables_in_memory[key] = ray_table
+    while len(ray_tables_in_memory) > RAY_TABLE_CACHE_MAX_N_TABLES:
+        ray_tables_in_memory.popitem(last=False)
+    return ray_table
+
+
+def save_ray_table(ray_table,
+                   camera_projection_params_dict,
+                   cache_folder_path,
+                   key):
+    """
+    Save a ray table as <key>.npy and its projection params as <key>.json in cache_folder_path
+    (written to temporary files and then renamed, so that a table is never read half-written)
+    """
+    os.makedirs(cache_folder_path, exist_ok=True)
+    for ext, write_function in [('.json', lambda f: f.write(json.dumps(camera_projection_params_dict, indent=4).encode())),
+                                ('.npy', lambda f: np.save(f, ray_table))]:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_folder_path, suffix=ext + '.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            write_function(f)
+        os.replace(tmp_path, os.path.join(cache_folder_path, key + ext))
+
+
+def get_ray_directions_in_worldRF(ray_table,
+                                  camera_rotation_quaternion):
+    """
+    Rotate a ray table to the world RF, for a camera pose
+
+    :param ray_table: array of shape (n_rows, n_cols, 3) (see get_ray_table)
+    :param camera_rotation_quaternion: camera rotation quaternion (w,x,y,z)
+    :return: ray_directions_worldRF, float32 array of shape (n_rows, n_cols, 3)
+    """
+    rotation_matrix = camera_poses.quaternion_to_rotation_matrix(camera_rotation_quaternion).astype(np.float32)
+    return ray_table @ rotation_matrix.T
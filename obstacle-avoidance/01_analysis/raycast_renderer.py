@@ -0,0 +1,534 @@
+import numpy as np
+import camera_poses
+import mesh_bvh
+import ray_tables
+
+# Depth and object index passes computed by ray casting the analytic geometry of the arena with numpy
+# (no bpy required, so this can run outside Blender)
+#
+# The geometry is built from the geometry dict as in define_geometry.create_environment:
+# - perches and obstacles as capped cylinders (in Blender these are 32-sided prisms, so depth at the perches and
+#   obstacles edges may differ slightly)
+# - walls, floor and ceiling as quads, split in two triangles along the diagonal from the first vertex (0-1-2, 0-2-3)
+# Meshes in config (mesh_file_paths_list) are added to this geometry, and intersected through their BVH (see mesh_bvh)
+#
+# The rays are those of the panoramic camera in config (see ray_tables). The output images follow the layout of the
+# images saved by Blender: row 0 is the top row and column 0 the left column. As in the Cycles passes:
+# - depth is the distance along the ray (Z pass for panoramic cameras), in m, and BACKGROUND_DEPTH for no hit
+#   (or no ray, outside the fisheye circle)
+# - object index is the pass_index of the object hit (IndexOB pass), and 0 for no hit
+
+# depth value for pixels that hit no object (as in Cycles' Z pass)
+BACKGROUND_DEPTH = 1e10
+
+
+def get_primitives_from_geometry_dict(geometry_dict,
+                                      input_config):
+    """
+    Get the cylinders and triangles of the arena geometry, as built in define_geometry.create_environment
+
+    Obstacles with nan coordinates are skipped.
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param input_config: config
+    :return: primitives_dict, with keys
+        - 'cylinders': dict with 'name' (list), 'P1', 'P2' (arrays (n, 3) with the bases' centres, in m),
+          'radius' (array (n,), in m) and 'pass_index' (array (n,))
+        - 'triangles': dict with 'name' (list), 'V0', 'V1', 'V2' (arrays (n, 3) with the vertices, in m)
+          and 'pass_index' (array (n,))
+    """
+    list_cylinders = []  # tuples of (name, P1, P2, radius, pass_index)
+    list_triangles = []  # tuples of (name, V0, V1, V2, pass_index)
+
+    ### Perches
+    list_edges_str_all_perches = [k for k in geometry_dict.keys() if 'perch' in k]
+    for perch_str in sorted(set([e_i[0:9] for e_i in list_edges_str_all_perches])):
+        z_offset = np.array([0, 0, input_config.perch_marker_centre_to_cyl_axis_z_offset])
+        list_cylinders.append((perch_str,
+                               (geometry_dict[perch_str + '_xmax_edge_centroid_XYZ'][0:3] - z_offset) * input_config.mm_to_m,
+                               (geometry_dict[perch_str + '_xmin_edge_centroid_XYZ'][0:3] - z_offset) * input_config.mm_to_m,
+                               input_config.perch_radius * input_config.mm_to_m,
+                               input_config.dict_perch_str_to_object_index[perch_str]))
+
+    ### Obstacles
+    for obs_str in [k for k in geometry_dict.keys() if 'obs' in k]:
+        if np.any(np.isnan(geometry_dict[obs_str])):
+            continue
+        top_obs_marker = geometry_dict[obs_str][:] - np.array([0, 0, input_config.marker_centre_to_top_obs_base])
+        bottom_obs_marker = np.concatenate((top_obs_marker[0:2], 0.0), axis=None)
+        obs_name = obs_str[0:[i for i, p in enumerate(obs_str) if p == '_'][2]]
+        if input_config.flag_use_obstacle_ID_as_object_index:
+            pass_index = [int(s) for s in obs_str.split('_') if s.isdigit()][-1]
+        else:
+            pass_index = input_config.dict_obs_ID_to_object_index[obs_name]
+        list_cylinders.append((obs_name,
+                               top_obs_marker * input_config.mm_to_m,
+                               bottom_obs_marker * input_config.mm_to_m,
+                               input_config.obs_radius * input_config.mm_to_m,
+                               pass_index))
+
+    ### Walls, floor and ceiling
+    list_of_vertices_str_all_planes = [k for k in geometry_dict.keys()
+                                       if 'wall' in k or 'floor' in k or 'ceiling' in k]
+    for p_str in sorted(set([v_i[0:-1] for v_i in list_of_vertices_str_all_planes])):
+        plane_name = p_str[0:[i for i, p in enumerate(p_str) if p == '_'][-2]]
+        vertices = [np.asarray(geometry_dict[p_str + str(kk)], dtype=np.float64) * input_config.mm_to_m
+                    for kk in range(1, input_config.n_vertices_per_plane + 1)]
+        # fan triangulation from the first vertex
+        for kk in range(1, len(vertices) - 1):
+            list_triangles.append((plane_name,
+                                   vertices[0],
+                                   vertices[kk],
+                                   vertices[kk + 1],
+                                   input_config.dict_planes_str_to_object_index[plane_name]))
+
+    return {'cylinders': {'name': [c[0] for c in list_cylinders],
+                          'P1': np.array([c[1] for c in list_cylinders], dtype=np.float64).reshape(-1, 3),
+                          'P2': np.array([c[2] for c in list_cylinders], dtype=np.float64).reshape(-1, 3),
+                          'radius': np.array([c[3] for c in list_cylinders], dtype=np.float64),
+                          'pass_index': np.array([c[4] for c in list_cylinders], dtype=np.int64)},
+            'triangles': {'name': [t[0] for t in list_triangles],
+                          'V0': np.array([t[1] for t in list_triangles], dtype=np.float64).reshape(-1, 3),
+                          'V1': np.array([t[2] for t in list_triangles], dtype=np.float64).reshape(-1, 3),
+                          'V2': np.array([t[3] for t in list_triangles], dtype=np.float64).reshape(-1, 3),
+                          'pass_index': np.array([t[4] for t in list_triangles], dtype=np.int64)}}
+
+
+def intersect_rays_with_cylinder(ray_origin,
+                                 ray_directions,
+                                 P1,
+                                 P2,
+                                 radius):
+    """
+    Distance along each ray to its first intersection with a capped cylinder (all rays from the same origin)
+
+    Since all rays share the origin, every term reduces to dot products of the ray directions with constant vectors
+    (e.g., for unit directions d, |d_perp|^2 = 1 - (d.axis)^2 and d_perp.w_perp = d.w_perp)
+
+    :param ray_origin: array of shape (3,)
+    :param ray_directions: array of shape (3, n_rays) (unit vectors, components first)
+    :param P1: centre of one of the bases, array of shape (3,)
+    :param P2: centre of the other base, array of shape (3,)
+    :param radius: radius of the cylinder
+    :return: t_array of shape (n_rays,), with the distance to the closest intersection ahead of the origin
+        (inf if no intersection)
+    """
+    axis = P2 - P1
+    length = np.linalg.norm(axis)
+    axis = axis / length
+    w = ray_origin - P1
+    w_dot_axis = np.dot(w, axis)
+    w_perp = w - w_dot_axis * axis
+    c = np.dot(w_perp, w_perp) - radius ** 2
+
+    # (computed in float64, since the discriminant below is prone to cancellation)
+    d_dot_axis, d_dot_w_perp = np.stack((axis, w_perp)) @ ray_directions.astype(np.float64)
+
+    ### Lateral surface: |w_perp + t * d_perp|^2 = radius^2, i.e. a*t^2 + 2*b_half*t + c = 0
+    a = 1.0 - d_dot_axis ** 2
+    b_half = d_dot_w_perp
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sqrt_discriminant = np.sqrt(b_half ** 2 - a * c)  # nan if no intersection
+        t_list = [(-b_half - sqrt_discriminant) / a,
+                  (-b_half + sqrt_discriminant) / a]
+        t_list = [np.where((t > 0) & (w_dot_axis + t * d_dot_axis >= 0) & (w_dot_axis + t * d_dot_axis <= length),
+                           t, np.inf)
+                  for t in t_list]
+
+        ### Caps: planes at s=0 and s=length (s: coordinate along the axis)
+        for s_cap in [0.0, length]:
+            t = (s_cap - w_dot_axis) / d_dot_axis
+            r_squared = c + t * (2 * b_half + t * a)  # = |w_perp + t * d_perp|^2 - radius^2
+            t_list.append(np.where((t > 0) & (r_squared <= 0), t, np.inf))
+
+    return np.minimum(np.minimum(t_list[0], t_list[1]), np.minimum(t_list[2], t_list[3]))
+
+
+def intersect_rays_with_triangle(ray_origin,
+                                 ray_directions,
+                                 V0,
+                                 V1,
+                                 V2):
+    """
+    Distance along each ray to its intersection with a triangle (Moller-Trumbore, all rays from the same origin)
+
+    Since all rays share the origin, the triple products reduce to dot products of the ray directions
+    with constant vectors
+
+    :param ray_origin: array of shape (3,)
+    :param ray_directions: array of shape (3, n_rays) (components first)
+    :param V0, V1, V2: vertices of the triangle, arrays of shape (3,)
+    :return: t_array of shape (n_rays,), with the distance to the intersection (inf if no intersection ahead of the origin)
+    """
+    edge_1 = V1 - V0
+    edge_2 = V2 - V0
+    t_vec = ray_origin - V0
+    q_vec = np.cross(t_vec, edge_1)
+
+    # det = (d x e2).e1 = d.(e2 x e1);  u = (d x e2).t_vec / det = d.(e2 x t_vec) / det;  v = d.q_vec / det;
+    # t = e2.q_vec / det
+    # The vectors are multiplied by the sign of e2.q_vec, so that t > 0 <=> det > 0, and the inside test
+    # (u >= 0, v >= 0, u + v <= 1) can be done before dividing by det
+    t_numerator = np.dot(edge_2, q_vec)
+    sign = 1.0 if t_numerator >= 0 else -1.0
+    det, u_times_det, v_times_det = (sign * np.stack((np.cross(edge_2, edge_1),
+                                                      np.cross(edge_2, t_vec),
+                                                      q_vec))).astype(ray_directions.dtype) @ ray_directions
+    mask = (det > 0) & (u_times_det >= 0) & (v_times_det >= 0) & (u_times_det + v_times_det <= det)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(mask, abs(t_numerator) / det, np.inf)
+
+
+def get_ray_tiles(ray_directions_cameraRF,
+                  tile_size_in_pixels=32):
+    """
+    Group the rays of an image in square tiles of pixels, and compute the cone that bounds the rays of each tile
+
+    The image is padded with nan directions to a multiple of the tile size (nan rays hit nothing).
+
+    :param ray_directions_cameraRF: array of shape (n_rows, n_cols, 3) (see ray_tables.get_ray_table)
+    :param tile_size_in_pixels: number of pixels per side of each tile
+    :return: ray_tiles_dict, with keys
+        - 'ray_directions': array of shape (3, n_tiles, tile_size_in_pixels**2) (float32, components first)
+        - 'axis': unit vector along the axis of each tile's cone, array of shape (n_tiles, 3)
+        - 'cos_half_angle', 'sin_half_angle': of each tile's cone, arrays of shape (n_tiles,)
+        - 'image_shape', 'tile_size_in_pixels'
+    """
+    n_rows, n_cols = ray_directions_cameraRF.shape[:2]
+    n_tiles_y = -(-n_rows // tile_size_in_pixels)
+    n_tiles_x = -(-n_cols // tile_size_in_pixels)
+    ray_directions_padded = np.full((n_tiles_y * tile_size_in_pixels, n_tiles_x * tile_size_in_pixels, 3), np.nan)
+    ray_directions_padded[:n_rows, :n_cols] = ray_directions_cameraRF
+    ray_directions_tiles = ray_directions_padded.reshape(n_tiles_y, tile_size_in_pixels,
+                                                         n_tiles_x, tile_size_in_pixels, 3)\
+        .transpose(0, 2, 1, 3, 4).reshape(n_tiles_y * n_tiles_x, tile_size_in_pixels ** 2, 3)
+
+    # bounding cone per tile: axis along the mean direction, half angle to the furthest ray (+ margin)
+    # (tiles with only nan rays, e.g. outside the fisheye circle, get a zero-angle cone, so they are always culled)
+    flag_ray = ~np.isnan(ray_directions_tiles[..., 0])
+    flag_empty_tile = ~np.any(flag_ray, axis=1)
+    axis = np.nansum(ray_directions_tiles, axis=1)
+    axis[flag_empty_tile] = [0, 0, -1]
+    axis = axis / np.linalg.norm(axis, axis=1, keepdims=True)
+    cos_angle_to_axis = np.where(flag_ray,
+                                 np.einsum('tij,tj->ti', np.nan_to_num(ray_directions_tiles), axis),
+                                 1.0)
+    half_angle = np.minimum(np.arccos(np.clip(np.min(cos_angle_to_axis, axis=1), -1, 1)) + 1e-6, np.pi)
+    half_angle[flag_empty_tile] = 0.0
+
+    return {'ray_directions': np.ascontiguousarray(ray_directions_tiles.transpose(2, 0, 1), dtype=np.float32),
+            'axis': axis,
+            'cos_half_angle': np.cos(half_angle),
+            'sin_half_angle': np.sin(half_angle),
+            'image_shape': (n_rows, n_cols),
+            'tile_size_in_pixels': tile_size_in_pixels}
+
+
+def get_ray_tiles_hierarchy(ray_directions_cameraRF,
+                            tile_size_in_pixels=4,
+                            n_levels=4):
+    """
+    Group the rays of an image in square tiles of pixels at several levels, each tile containing (up to) 4 tiles
+    of half its size (e.g. tiles of 32, 16, 8 and 4 pixels)
+
+    :param ray_directions_cameraRF: array of shape (n_rows, n_cols, 3) (see ray_tables.get_ray_table)
+    :param tile_size_in_pixels: number of pixels per side of the tiles at the finest level
+    :param n_levels: number of levels
+    :return: list of ray_tiles_dicts (see get_ray_tiles), from the coarsest to the finest level. Except the finest,
+        these have no 'ray_directions', and have 'idcs_children' (n_tiles, 4) with the index of the tiles they contain
+        in the next level (-1 for tiles outside the image)
+    """
+    list_ray_tiles_dicts = [get_ray_tiles(ray_directions_cameraRF,
+                                          tile_size_in_pixels * 2 ** (n_levels - 1 - k))
+                            for k in range(n_levels)]
+    n_rows, n_cols = ray_directions_cameraRF.shape[:2]
+    for coarse_tiles_dict, fine_tiles_dict in zip(list_ray_tiles_dicts[:-1], list_ray_tiles_dicts[1:]):
+        n_tiles_x_coarse = -(-n_cols // coarse_tiles_dict['tile_size_in_pixels'])
+        n_tiles_y_fine = -(-n_rows // fine_tiles_dict['tile_size_in_pixels'])
+        n_tiles_x_fine = -(-n_cols // fine_tiles_dict['tile_size_in_pixels'])
+        tile_y, tile_x = np.divmod(np.arange(len(coarse_tiles_dict['axis'])), n_tiles_x_coarse)
+        list_idcs_children = []
+        for dy, dx in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+            child_y, child_x = 2 * tile_y + dy, 2 * tile_x + dx
+            list_idcs_children.append(np.where((child_y < n_tiles_y_fine) & (child_x < n_tiles_x_fine),
+                                               child_y * n_tiles_x_fine + child_x,
+                                               -1))
+        coarse_tiles_dict['idcs_children'] = np.stack(list_idcs_children, axis=1)
+        del coarse_tiles_dict['ray_directions']
+    return list_ray_tiles_dicts
+
+
+def ray_tiles_to_image(array_per_tile,
+                       ray_tiles_dict):
+    """
+    Rearrange an array with one value per ray, of shape (n_tiles, n_rays_per_tile), as an image (n_rows, n_cols)
+    """
+    n_rows, n_cols = ray_tiles_dict['image_shape']
+    tile_size = ray_tiles_dict['tile_size_in_pixels']
+    n_tiles_y = -(-n_rows // tile_size)
+    n_tiles_x = -(-n_cols // tile_size)
+    return array_per_tile.reshape(n_tiles_y, n_tiles_x, tile_size, tile_size)\
+        .transpose(0, 2, 1, 3).reshape(n_tiles_y * tile_size, n_tiles_x * tile_size)[:n_rows, :n_cols]
+
+
+def get_tiles_that_may_hit_spheres(sphere_centres,
+                                   sphere_radii,
+                                   ray_tiles_dict,
+                                   max_distance):
+    """
+    Check which tiles' cones may intersect each bounding sphere (cone apex at the origin)
+
+    A tile is discarded for a sphere if the angle between the cone axis and the sphere centre is larger than the cone
+    half angle plus the angular radius of the sphere, or if the sphere is further than max_distance.
+
+    :param sphere_centres: array of shape (n_spheres, 3), relative to the cone apex
+    :param sphere_radii: array of shape (n_spheres,)
+    :param ray_tiles_dict: see get_ray_tiles
+    :param max_distance: max distance along the rays (e.g., clip end)
+    :return: boolean array of shape (n_spheres, n_tiles)
+    """
+    distance = np.linalg.norm(sphere_centres, axis=1)
+    flag_origin_in_sphere = distance <= sphere_radii
+    # angular radius of each sphere (as cos and sin)
+    sin_alpha = np.clip(sphere_radii / np.maximum(distance, 1e-12), 0, 1)
+    cos_alpha = np.sqrt(1 - sin_alpha ** 2)
+    # cos of the angle between each sphere centre and each tile axis
+    cos_theta = (sphere_centres / np.maximum(distance, 1e-12)[:, None]) @ ray_tiles_dict['axis'].T
+    # theta <= alpha + half_angle  <=>  cos(theta) >= cos(alpha + half_angle) (if alpha + half_angle < pi)
+    cos_alpha_plus_half_angle = cos_alpha[:, None] * ray_tiles_dict['cos_half_angle'][None, :] \
+        - sin_alpha[:, None] * ray_tiles_dict['sin_half_angle'][None, :]
+    flag_angle_ok = (cos_theta >= cos_alpha_plus_half_angle) | \
+                    (np.arcsin(sin_alpha)[:, None] + np.arccos(ray_tiles_dict['cos_half_angle'])[None, :] >= np.pi)
+    return (flag_angle_ok & (distance - sphere_radii <= max_distance)[:, None]) | flag_origin_in_sphere[:, None]
+
+
+def get_runs_of_true_values(flag_array):
+    """
+    Get the start and end (exclusive) indices of each run of consecutive True values in a 1-dim boolean array
+
+    E.g.: [False, True, True, False, True] -> [(1, 3), (4, 5)]
+    """
+    flag_array_padded = np.concatenate(([False], flag_array, [False])).astype(np.int8)
+    idx_changes = np.flatnonzero(np.diff(flag_array_padded))
+    return list(zip(idx_changes[0::2], idx_changes[1::2]))
+
+
+def render_depth_and_object_index(camera_location,
+                                  camera_rotation_quaternion,
+                                  ray_tiles_dict,
+                                  primitives_dict,
+                                  clip_start_end_in_m):
+    """
+    Render depth and object index maps for one camera pose
+
+    The primitives are transformed to the camera reference frame (so the rays do not need to be rotated),
+    and each primitive is only intersected with the tiles of rays whose bounding cone may hit its bounding sphere.
+
+    :param camera_location: camera location in worldRF, in m (3,)
+    :param camera_rotation_quaternion: camera rotation quaternion (w,x,y,z) (4,)
+    :param ray_tiles_dict: rays grouped in tiles (see get_ray_tiles)
+    :param primitives_dict: dict with cylinders and triangles (see get_primitives_from_geometry_dict)
+    :param clip_start_end_in_m: camera clipping distances (hits outside this range are ignored)
+    :return: depth_array (float32, in m), object_index_array (float32), both of shape (n_rows, n_cols)
+    """
+    # world to camera RF: v_cam = R^T @ (v_world - camera_location) (as row vectors: (v - loc) @ R)
+    rotation_matrix = camera_poses.quaternion_to_rotation_matrix(camera_rotation_quaternion)
+    camera_location = np.asarray(camera_location, dtype=np.float64)
+    ray_origin = np.zeros(3)
+    ray_directions_tiles = ray_tiles_dict['ray_directions']
+
+    depth_array = np.full(ray_directions_tiles.shape[1:], np.inf)
+    object_index_array = np.zeros(ray_directions_tiles.shape[1:], dtype=np.float32)
+
+    ### List of primitives in camera RF, with their bounding spheres
+    list_primitives = []  # tuples of (intersect function, args, pass_index)
+    list_sphere_centres = []
+    list_sphere_radii = []
+    cylinders_dict = primitives_dict['cylinders']
+    for i in range(len(cylinders_dict['name'])):
+        P1 = (cylinders_dict['P1'][i] - camera_location) @ rotation_matrix
+        P2 = (cylinders_dict['P2'][i] - camera_location) @ rotation_matrix
+        list_primitives.append((intersect_rays_with_cylinder,
+                                (P1, P2, cylinders_dict['radius'][i]),
+                                cylinders_dict['pass_index'][i]))
+        list_sphere_centres.append(0.5 * (P1 + P2))
+        list_sphere_radii.append(np.sqrt((0.5 * np.linalg.norm(P2 - P1)) ** 2 + cylinders_dict['radius'][i] ** 2))
+    triangles_dict = primitives_dict['triangles']
+    for i in range(len(triangles_dict['name'])):
+        list_vertices = [(triangles_dict[v_str][i] - camera_location) @ rotation_matrix
+                         for v_str in ['V0', 'V1', 'V2']]
+        list_primitives.append((intersect_rays_with_triangle,
+                                tuple(list_vertices),
+                                triangles_dict['pass_index'][i]))
+        list_sphere_centres.append(np.mean(list_vertices, axis=0))
+        list_sphere_radii.append(max(np.linalg.norm(v - list_sphere_centres[-1]) for v in list_vertices))
+    if not list_primitives:
+        return (np.full(ray_tiles_dict['image_shape'], BACKGROUND_DEPTH, dtype=np.float32),
+                np.zeros(ray_tiles_dict['image_shape'], dtype=np.float32))
+
+    flag_tiles_per_primitive = get_tiles_that_may_hit_spheres(np.array(list_sphere_centres),
+                                                              np.array(list_sphere_radii),
+                                                              ray_tiles_dict,
+                                                              clip_start_end_in_m[1])
+
+    ### Intersect each primitive with its candidate tiles, and keep the closest hit per ray
+    # (candidate tiles are processed in runs of consecutive tiles, so that the rays and outputs are views, not copies)
+    for (intersect_function, args, pass_index), flag_tiles in zip(list_primitives, flag_tiles_per_primitive):
+        for idx_tile_start, idx_tile_end in get_runs_of_true_values(flag_tiles):
+            t_array = intersect_function(ray_origin,
+                                         ray_directions_tiles[:, idx_tile_start:idx_tile_end].reshape(3, -1),
+                                         *args).reshape(idx_tile_end - idx_tile_start, -1)
+            depth_in_tiles = depth_array[idx_tile_start:idx_tile_end]
+            mask = (t_array >= clip_start_end_in_m[0]) & (t_array <= clip_start_end_in_m[1]) & (t_array < depth_in_tiles)
+            np.copyto(depth_in_tiles, t_array, where=mask)
+            np.copyto(object_index_array[idx_tile_start:idx_tile_end], np.float32(pass_index), where=mask)
+
+    depth_array[np.isinf(depth_array)] = BACKGROUND_DEPTH
+    return (ray_tiles_to_image(depth_array.astype(np.float32), ray_tiles_dict),
+            ray_tiles_to_image(object_index_array, ray_tiles_dict))
+
+
+def render_depth_and_object_index_of_meshes(camera_location,
+                                           camera_rotation_quaternion,
+                                           list_ray_packets_dicts,
+                                           list_meshes,
+                                           clip_start_end_in_m):
+    """
+    Render depth and object index maps of the meshes for one camera pose
+
+    The rays (and the axes of their packets' cones) are rotated to the world RF, where the meshes' BVH are defined.
+
+    :param camera_location: camera location in worldRF, in m (3,)
+    :param camera_rotation_quaternion: camera rotation quaternion (w,x,y,z) (4,)
+    :param list_ray_packets_dicts: rays grouped in a hierarchy of packets (see get_ray_tiles_hierarchy)
+    :param list_meshes: list of meshes (see mesh_bvh.load_meshes_from_config)
+    :param clip_start_end_in_m: camera clipping distances (hits outside this range are ignored)
+    :return: depth_array (float32, in m), object_index_array (float32), both of shape (n_rows, n_cols)
+    """
+    rotation_matrix = camera_poses.quaternion_to_rotation_matrix(camera_rotation_quaternion)
+    ray_packets_dict = list_ray_packets_dicts[-1]
+    ray_directions_packets = ray_packets_dict['ray_directions']
+    ray_directions_packets_worldRF = (rotation_matrix.astype(np.float32)
+                                      @ ray_directions_packets.reshape(3, -1)).reshape(ray_directions_packets.shape)
+    list_packet_levels_worldRF = [dict(packets_dict,
+                                       axis=(packets_dict['axis'] @ rotation_matrix.T).astype(np.float32),
+                                       cos_half_angle=packets_dict['cos_half_angle'].astype(np.float32),
+                                       sin_half_angle=packets_dict['sin_half_angle'].astype(np.float32))
+                                  for packets_dict in list_ray_packets_dicts]
+
+    depth_array = np.full(ray_directions_packets.shape[1:], np.inf, dtype=np.float32)
+    object_index_array = np.zeros(ray_directions_packets.shape[1:], dtype=np.float32)
+    for mesh_dict in list_meshes:
+        mesh_depth_array = mesh_bvh.render_depth_of_bvh(mesh_dict['bvh'],
+                                                        camera_location,
+                                                        ray_directions_packets_worldRF,
+                                                        list_packet_levels_worldRF,
+                                                        clip_start_end_in_m)
+        mask = mesh_depth_array < depth_array
+        np.copyto(depth_array, mesh_depth_array, where=mask)
+        np.copyto(object_index_array, np.float32(mesh_dict['pass_index']), where=mask)
+
+    depth_array[np.isinf(depth_array)] = BACKGROUND_DEPTH
+    return (ray_tiles_to_image(depth_array, ray_packets_dict),
+            ray_tiles_to_image(object_index_array, ray_packets_dict))
+
+
+def get_scene_for_rendering(geometry_dict,
+                            input_config,
+                            tile_size_in_pixels=32,
+                            ray_table_cache_folder_path=None,
+                            data_cache_folder_path=None):
+    """
+    Set up everything needed to render any frame of a trial: the primitives, the meshes' BVH, and the rays grouped
+    in tiles (it does not depend on the camera pose, so it is computed once per trial)
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param input_config: config
+    :param tile_size_in_pixels: number of pixels per side of the tiles of rays (see get_ray_tiles)
+    :param ray_table_cache_folder_path: path to folder for the ray tables saved to disk (see ray_tables.get_ray_table)
+    :param data_cache_folder_path: path to the data cache folder, where the meshes' BVH are cached
+        (see mesh_bvh.load_meshes_from_config)
+    :return: scene_dict, with keys 'primitives_dict', 'list_meshes', 'ray_table', 'ray_tiles_dict',
+        'list_ray_packets_dicts' (None if there are no meshes) and 'clip_start_end_in_m'
+    """
+    list_meshes = mesh_bvh.load_meshes_from_config(input_config,
+                                                   data_cache_folder_path)
+    ray_table = ray_tables.get_ray_table(input_config,
+                                         ray_table_cache_folder_path)
+    scene_dict = {'primitives_dict': get_primitives_from_geometry_dict(geometry_dict,
+                                                                       input_config),
+                  'list_meshes': list_meshes,
+                  'ray_table': ray_table,
+                  'ray_tiles_dict': get_ray_tiles(ray_table,
+                                                  tile_size_in_pixels),
+                  'list_ray_packets_dicts': None,
+                  'clip_start_end_in_m': input_config.camera_clip_start_end_in_m}
+    if list_meshes:
+        scene_dict['list_ray_packets_dicts'] = get_ray_tiles_hierarchy(ray_table,
+                                                                       input_config.mesh_ray_packet_size_in_pixels,
+                                                                       input_config.mesh_ray_packet_n_levels)
+    return scene_dict
+
+
+def render_frame(scene_dict,
+                 camera_location,
+                 camera_rotation_quaternion):
+    """
+    Render depth and object index maps of the primitives and meshes of the scene, for one camera pose
+
+    The primitives and the meshes are rendered separately, and merged keeping the closest hit per pixel.
+
+    :param scene_dict: see get_scene_for_rendering
+    :param camera_location: camera location in worldRF, in m (3,)
+    :param camera_rotation_quaternion: camera rotation quaternion (w,x,y,z) (4,)
+    :return: depth_array (float32, in m), object_index_array (float32), both of shape (n_rows, n_cols)
+    """
+    depth_array, object_index_array = render_depth_and_object_index(camera_location,
+                                                                    camera_rotation_quaternion,
+                                                                    scene_dict['ray_tiles_dict'],
+                                                                    scene_dict['primitives_dict'],
+                                                                    scene_dict['clip_start_end_in_m'])
+    if scene_dict['list_meshes']:
+        mesh_depth_array, mesh_object_index_array = render_depth_and_object_index_of_meshes(camera_location,
+                                                                                            camera_rotation_quaternion,
+                                                                                            scene_dict['list_ray_packets_dicts'],
+                                                                                            scene_dict['list_meshes'],
+                                                                                            scene_dict['clip_start_end_in_m'])
+        mask = mesh_depth_array < depth_array
+        np.copyto(depth_array, mesh_depth_array, where=mask)
+        np.copyto(object_index_array, mesh_object_index_array, where=mask)
+    return depth_array, object_index_array
+
+
+def render_frames(geometry_dict,
+                  camera_poses_dict,
+                  input_config,
+                  tile_size_in_pixels=32,
+                  ray_table_cache_folder_path=None,
+                  data_cache_folder_path=None):
+    """
+    Render depth and object index maps for every frame in camera_poses_dict (generator)
+
+    To render the frames in parallel, see frame_parallel.render_frames_in_parallel.
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param camera_poses_dict: dict with 'frame', 'location' and 'rotation_quaternion' (see camera_poses.compute_camera_poses)
+    :param input_config: config
+    :param tile_size_in_pixels: number of pixels per side of the tiles of rays (see get_ray_tiles)
+    :param ray_table_cache_folder_path: path to folder for the ray tables saved to disk (see ray_tables.get_ray_table)
+    :param data_cache_folder_path: path to the data cache folder, where the meshes' BVH are cached
+        (see mesh_bvh.load_meshes_from_config)
+    :return: yields (frame, depth_array, object_index_array) per frame
+    """
+    scene_dict = get_scene_for_rendering(geometry_dict,
+                                         input_config,
+                                         tile_size_in_pixels,
+                                         ray_table_cache_folder_path,
+                                         data_cache_folder_path)
+    for frame, location, quat in zip(camera_poses_dict['frame'],
+                                     camera_poses_dict['location'],
+                                     camera_poses_dict['rotation_quaternion']):
+        depth_array, object_index_array = render_frame(scene_dict,
+                                                       location,
+                                                       quat)
+        yield int(frame), depth_array, object_index_array
@@ -0,0 +1,262 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+# Autotuning of the CPU render settings (number of threads and tile size) per machine and resolution
+#
+# The autotune command renders a few frames of a trial with each candidate setting (one Blender process per setting,
+# with main.py), and saves the fastest one (median render and save time per frame, see render_timing) to the
+# autotune file (by default, in the data cache folder), with key:
+#     <hostname>|<number of CPUs>|<resolution x>x<resolution y>|<samples per pixel>spp
+# config reads it if flag_use_render_autotune is set in the input json (off by default) and the threads and tile size
+# are not, so later batch runs use the fastest settings of the machine when rendering on CPU (or when Cycles falls
+# back to CPU, see define_camera.set_rendering_parameters). The settings applied are saved with the config
+# (render_cpu_settings_source and render_device_applied). The rendered images do not depend on these settings.
+#
+# Run from the terminal (no Blender required for this script, but Blender must be on the path or given):
+#     python render_autotune.py ../00_data/config_input_files/201124_Drogon16_eyesRF.json --frames 714..716
+#         [--threads 0 8 16] [--tile_sizes 16 32 64 128] [--blender blender]
+# (0 threads: one per CPU, Blender's AUTO mode)
+
+RENDER_AUTOTUNE_FILENAME = 'render_autotune.json'
+RENDER_TIMES_FILENAME_SUFFIX = '_render_times'  # as in render_timing (which requires Blender)
+
+# input json params set by the autotune (if any is in the input json, the autotuned settings are not used)
+LIST_AUTOTUNED_PARAMS_STR = ['render_cpu_threads',
+                             'render_cpu_tile_x_y_in_pixels']
+
+
+def get_render_autotune_key(input_config,
+                            hostname=None,
+                            n_cpus=None):
+    """
+    Get the key of the autotuned settings for this machine and the resolution and samples of the config
+
+    :param input_config: config
+    :param hostname: hostname; default: this machine's
+    :param n_cpus: number of CPUs; default: this machine's
+    :return: key str
+    """
+    return '{}|{}|{}x{}|{}spp'.format(hostname or socket.gethostname(),
+                                      n_cpus or os.cpu_count(),
+                                      int(input_config.render_resolution_x_y_in_pixels[0] * input_config.render_resolution_percentage / 100),
+                                      int(input_config.render_resolution_x_y_in_pixels[1] * input_config.render_resolution_percentage / 100),
+                                      input_config.render_samples)
+
+
+def load_autotuned_settings(render_autotune_file_path,
+                            key):
+    """
+    Load the autotuned settings for a key
+
+    :return: dict with the params in LIST_AUTOTUNED_PARAMS_STR (and the autotune results), or None if not autotuned
+    """
+    try:
+        with open(render_autotune_file_path) as f:
+            return json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+
+
+def save_autotuned_settings(render_autotune_file_path,
+                            key,
+                            autotuned_settings_dict):
+    """
+    Save the autotuned settings for a key to the autotune file, keeping those of other keys
+    (written to a temporary file and renamed, so that it is never read half-written)
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(render_autotune_file_path)), exist_ok=True)
+    try:
+        with open(render_autotune_file_path) as f:
+            dict_key_to_settings = json.load(f)
+    except (OSError, ValueError):
+        dict_key_to_settings = {}
+    dict_key_to_settings[key] = autotuned_settings_dict
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(render_autotune_file_path)), prefix='.tmp_')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(dict_key_to_settings, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, render_autotune_file_path)
+
+
+def render_frames_with_settings(input_json_path,
+                                settings_str,
+                                dict_params,
+                                frames_cli_str,
+                                output_parent_dir_path,
+                                blender_path='blender'):
+    """
+    Render frames of a trial with some params of the input json changed (Blender in background mode with main.py),
+    recording the render time of each frame (flag_save_render_times_as_json, see render_timing)
+
+    :param input_json_path: path to input json file of the trial
+    :param settings_str: name of the settings (used for the render output dir, the json file and the log)
+    :param dict_params: input json params to change
+    :param frames_cli_str: frames to render, as in Blender's --render-frame (e.g. '714..721')
+    :param output_parent_dir_path: path to dir for the render output dir of these settings
+    :param blender_path: path to Blender executable
+    :return: path to render output dir
+    """
+    with open(input_json_path) as f:
+        input_json_dict = json.load(f)
+    render_output_dir_path = os.path.join(os.path.abspath(output_parent_dir_path), settings_str)
+    input_json_dict.update(dict_params,
+                           flag_save_render_times_as_json=True,
+                           render_output_parent_dir_str=settings_str,
+                           render_output_parent_dir_path=os.path.join(render_output_dir_path, ''))
+    settings_json_path = os.path.join(os.path.abspath(output_parent_dir_path), settings_str + '.json')
+    with open(settings_json_path, 'w') as f:
+        json.dump(input_json_dict, f, indent=4)
+
+    completed_process = subprocess.run([blender_path, '--background',
+                                        '--python', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'),
+                                        '--render-frame', frames_cli_str,
+                                        '--', settings_json_path],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       universal_newlines=True)
+    with open(os.path.join(os.path.abspath(output_parent_dir_path), settings_str + '_log.txt'), 'w') as f:
+        f.write(completed_process.stdout)
+    if completed_process.returncode != 0:
+        print('WARNING: Blender exited with code {} for {} (see log in {})'.format(completed_process.returncode,
+                                                                                  settings_str,
+                                                                                  output_parent_dir_path))
+    return render_output_dir_path
+
+
+def read_render_times(render_output_dir_path):
+    """
+    Read the render times recorded in a render output dir (all the Blender processes that rendered it, see
+    render_timing)
+
+    :return: dict with 'render_params' (of the first file) and 'frames' (render times per frame), or None if there
+        are no render times
+    """
+    list_paths = sorted(glob.glob(os.path.join(glob.escape(render_output_dir_path),
+                                               '*' + RENDER_TIMES_FILENAME_SUFFIX + '_*.json')))
+    if not list_paths:
+        return None
+    render_times_dict = {'render_params': None, 'frames': []}
+    for render_times_path in list_paths:
+        with open(render_times_path) as f:
+            file_dict = json.load(f)
+        render_times_dict['render_params'] = render_times_dict['render_params'] or file_dict['render_params']
+        render_times_dict['frames'] += file_dict['frames']
+    return render_times_dict
+
+
+def autotune(input_json_path,
+             frames_cli_str,
+             list_threads,
+             list_tile_sizes,
+             output_dir_path,
+             blender_path='blender'):
+    """
+    Render frames of a trial on CPU with each candidate number of threads and tile size, and save the fastest
+    setting for this machine and resolution to the autotune file of the config
+
+    :param input_json_path: path to input json file of the trial
+    :param frames_cli_str: frames to render, as in Blender's --render-frame (e.g. '714..716')
+    :param list_threads: candidate numbers of threads (0: one per CPU)
+    :param list_tile_sizes: candidate tile sizes (square tiles, in pixels)
+    :param output_dir_path: path to dir for the render output dirs (one per candidate)
+    :param blender_path: path to Blender executable
+    :return: autotuned_settings_dict, or None if no candidate was rendered
+    """
+    import config  # (config imports this module)
+    input_config = config.config(input_json_path)
+    key = get_render_autotune_key(input_config)
+    print('Autotuning CPU render settings for {} ({} candidates, frames {})'.format(key,
+                                                                                len(list_threads) * len(list_tile_sizes),
+                                                                                frames_cli_str))
+
+    list_results = []
+    for n_threads, tile_size in itertools.product(list_threads, list_tile_sizes):
+        dict_params = {'render_device': 'CPU',
+                       'render_cpu_threads': n_threads,
+                       'render_cpu_tile_x_y_in_pixels': [tile_size, tile_size],
+                       'flag_use_render_autotune': False,
+                       'flag_save_render_hashes': False}
+        render_output_dir_path = render_frames_with_settings(input_json_path,
+                                                             'threads{}_tile{}'.format(n_threads, tile_size),
+                                                             dict_params,
+                                                             frames_cli_str,
+                                                             output_dir_path,
+                                                             blender_path)
+        render_times_dict = read_render_times(render_output_dir_path)
+        if render_times_dict is None or not render_times_dict['frames']:
+            print('    {} threads, {}x{} tiles: no frames rendered'.format(n_threads, tile_size, tile_size))
+            continue
+        median_time_in_s = statistics.median(d['render_and_save_time_in_s'] for d in render_times_dict['frames'])
+        list_results.append({'render_cpu_threads': n_threads,
+                             'render_cpu_tile_x_y_in_pixels': [tile_size, tile_size],
+                             'median_render_and_save_time_in_s': median_time_in_s,
+                             'n_frames': len(render_times_dict['frames'])})
+        print('    {} threads, {}x{} tiles: {:.3f} s per frame'.format(n_threads, tile_size, tile_size, median_time_in_s))
+    if not list_results:
+        return None
+
+    best_result_dict = min(list_results, key=lambda d: d['median_render_and_save_time_in_s'])
+    autotuned_settings_dict = {'render_cpu_threads': best_result_dict['render_cpu_threads'],
+                               'render_cpu_tile_x_y_in_pixels': best_result_dict['render_cpu_tile_x_y_in_pixels'],
+                               'median_render_and_save_time_in_s': best_result_dict['median_render_and_save_time_in_s'],
+                               'frames': frames_cli_str,
+                               'input_json_path': os.path.abspath(input_json_path),
+                               'time': datetime.now().isoformat(timespec='seconds'),
+                               'results': list_results}
+    save_autotuned_settings(input_config.render_autotune_file_path,
+                            key,
+                            autotuned_settings_dict)
+    print('Fastest: {} threads, {}x{} tiles ({:.3f} s per frame, {:.1f}x faster than the slowest); saved to {}'
+          .format(best_result_dict['render_cpu_threads'],
+                  *best_result_dict['render_cpu_tile_x_y_in_pixels'],
+                  best_result_dict['median_render_and_save_time_in_s'],
+                  max(d['median_render_and_save_time_in_s'] for d in list_results) / best_result_dict['median_render_and_save_time_in_s'],
+                  input_config.render_autotune_file_path))
+    return autotuned_settings_dict
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the fastest CPU render threads and tile size for this machine '
+                                                 'and the resolution of a trial')
+    parser.add_argument('input_json_path',
+                        help='Path to input json file of a representative trial')
+    parser.add_argument('--frames', default=None,
+                        help="Frames to render per candidate, as in Blender's --render-frame (e.g. 714..716); "
+                             "default: the first 3 frames of the suggested range of leg 1")
+    parser.add_argument('--threads', nargs='+', type=int, default=None,
+                        help='Candidate numbers of threads (0: one per CPU); default: 0 and half the CPUs')
+    parser.add_argument('--tile_sizes', nargs='+', type=int, default=[16, 32, 64, 128],
+                        help='Candidate tile sizes (square tiles, in pixels)')
+    parser.add_argument('--output_dir', default=None,
+                        help='Dir for the render output dirs (one per candidate); default: a temporary dir')
+    parser.add_argument('--blender', dest='blender_path', default='blender',
+                        help='Path to Blender executable')
+    args = parser.parse_args()
+
+    frames_cli_str = args.frames
+    if frames_cli_str is None:
+        with open(args.input_json_path) as f:
+            input_json_dict = json.load(f)
+        if not input_json_dict.get('suggested_frame_range_for_cli_rendering_leg_1'):
+            sys.exit('ERROR in render_autotune: no suggested frame range in the input json, frames are required (--frames)')
+        first_frame = int(input_json_dict['suggested_frame_range_for_cli_rendering_leg_1'][0])
+        frames_cli_str = '{}..{}'.format(first_frame, first_frame + 2)
+    list_threads = args.threads or sorted(set([0, max(os.cpu_count() // 2, 1)]))
+    output_dir_path = args.output_dir or tempfile.mkdtemp(prefix='render_autotune_')
+    os.makedirs(output_dir_path, exist_ok=True)
+
+    if autotune(args.input_json_path,
+                frames_cli_str,
+                list_threads,
+                args.tile_sizes,
+                output_dir_path,
+                args.blender_path) is None:
+        sys.exit('ERROR in render_autotune: no candidate setting was rendered (see logs in {})'.format(output_dir_path))
@@ -0,0 +1,463 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+import numpy as np
+import camera_poses
+import raycast_renderer
+from render_manifest import RENDER_MANIFEST_FILENAME, compute_file_sha256, read_render_manifest
+
+# Hashes of the inputs of each rendered frame, to re-render only the frames whose inputs changed
+# (e.g. after a new geometry_csv_date_str, or re-exporting the transforms with a few frames fixed)
+#
+# The hash of a frame combines:
+# - the scene hash: a canonical hash of the scene built by define_geometry.create_environment (perches and obstacles
+#   as cylinders, walls, floor and ceiling, with their pass indices and materials, and the lamps). It is computed from
+#   the geometry as in raycast_renderer.get_primitives_from_geometry_dict, so changes in the geometry csv that do not
+#   change the scene (e.g. other columns) do not change the hash
+# - the render settings hash: the config params set in define_camera.create_camera and
+#   define_camera.set_rendering_parameters that change the saved images (LIST_RENDER_SETTINGS_STR; not e.g. the output
+#   path or the frame range)
+# - the camera pose at the frame, as keyframed by define_camera.insert_camera_keyframes (after keyframe decimation, the
+#   pose of the last keyframe). If the Vector pass is rendered, also the poses at the previous and next frames (the
+#   motion vectors depend on them)
+# Floats are rounded to N_DECIMALS_IN_HASH decimals (1e-9 m for locations) before hashing.
+#
+# The hashes of all the frames of the animation are saved in each render output dir (RENDER_HASHES_FILENAME). Before
+# rendering a trial into a new output dir (see prepare_incremental_render), the frames whose hash matches that of a
+# previous output dir of the same trial are linked (or copied) from it and added to the render manifest of the new dir
+# (see run_rendering.py), so only the frames that changed (or are missing) are rendered.
+
+RENDER_HASHES_FILENAME = 'render_hashes.json'
+# change if define_geometry or define_camera change the images for the same inputs
+RENDER_HASHES_VERSION = 1
+N_DECIMALS_IN_HASH = 9
+
+# config params that change the rendered images (camera and rendering params)
+LIST_RENDER_SETTINGS_STR = ['camera_type',
+                            'camera_panorama_type',
+                            'camera_longitude_min_max_in_rad',
+                            'camera_latitude_min_max_in_rad',
+                            'camera_fisheye_equidistant_FOV_in_rad',
+                            'camera_shift_x_y',
+                            'camera_clip_start_end_in_m',
+                            'camera_sensor_width',
+                            'sensor_fit',
+                            'render_device',
+                            'pixel_filter_type',
+                            'render_samples',
+                            'render_use_adaptive_sampling',
+                            'render_adaptive_threshold',
+                            'render_use_denoising',
+                            'render_max_bounces',
+                            'render_diffuse_bounces',
+                            'render_glossy_bounces',
+                            'render_transmission_bounces',
+                            'render_volume_bounces',
+                            'render_transparent_max_bounces',
+                            'render_caustics_reflective',
+                            'render_caustics_refractive',
+                            'render_resolution_x_y_in_pixels',
+                            'render_resolution_percentage',
+                            'render_pixel_aspect_x_y',
+                            'render_use_pass_combined',
+                            'render_use_pass_z',
+                            'render_use_pass_object_index',
+                            'render_use_pass_vector',
+                            'render_use_stamp',
+                            'render_use_stamp_time',
+                            'render_use_stamp_date',
+                            'render_use_stamp_render_time',
+                            'render_use_stamp_frame',
+                            'render_use_stamp_scene',
+                            'render_use_stamp_filename',
+                            'render_use_stamp_camera',
+                            'render_output_file_format',
+                            'render_image_color_mode',
+                            'render_image_color_depth',
+                            'render_image_exr_codec',
+                            'render_image_use_preview',
+                            'interpolation_between_keyframes']
+
+
+def get_canonical_value(value):
+    """
+    Get a json-serialisable value with floats rounded to N_DECIMALS_IN_HASH decimals (and -0.0 as 0.0)
+    """
+    if isinstance(value, dict):
+        return {str(k): get_canonical_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [get_canonical_value(v) for v in value]
+    if isinstance(value, (bool, np.bool_, str)) or value is None:
+        return value.item() if isinstance(value, np.bool_) else value
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    return round(float(value), N_DECIMALS_IN_HASH) + 0.0
+
+
+def get_hash(value):
+    """
+    Get the sha1 hex digest of the canonical json of a value
+    """
+    return hashlib.sha1(json.dumps(get_canonical_value(value), sort_keys=True).encode()).hexdigest()
+
+
+def get_scene_hash(geometry_dict,
+                   input_config):
+    """
+    Get the canonical hash of the scene built by define_geometry.create_environment (see header)
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param input_config: config
+    :return: hash str
+    """
+    primitives_dict = raycast_renderer.get_primitives_from_geometry_dict(geometry_dict,
+                                                                        input_config)
+    cylinders_dict = primitives_dict['cylinders']
+    triangles_dict = primitives_dict['triangles']
+    list_object_names = sorted(set(cylinders_dict['name']) | set(triangles_dict['name']))
+    scene_dict = {'render_hashes_version': RENDER_HASHES_VERSION,
+                  'cylinders': sorted([name, P1, P2, radius, pass_index]
+                                      for name, P1, P2, radius, pass_index in zip(cylinders_dict['name'],
+                                                                                  get_canonical_value(cylinders_dict['P1']),
+                                                                                  get_canonical_value(cylinders_dict['P2']),
+                                                                                  get_canonical_value(cylinders_dict['radius']),
+                                                                                  get_canonical_value(cylinders_dict['pass_index']))),
+                  'triangles': sorted([name, V0, V1, V2, pass_index]
+                                      for name, V0, V1, V2, pass_index in zip(triangles_dict['name'],
+                                                                              get_canonical_value(triangles_dict['V0']),
+                                                                              get_canonical_value(triangles_dict['V1']),
+                                                                              get_canonical_value(triangles_dict['V2']),
+                                                                              get_canonical_value(triangles_dict['pass_index']))),
+                  'materials': {name: input_config.dict_geometry_to_material_hex_str_and_alpha[name]
+                                for name in list_object_names
+                                if name in input_config.dict_geometry_to_material_hex_str_and_alpha},
+                  'lamps': [[[x * input_config.mm_to_m for x in location], rotation, strength]
+                            for location, rotation, strength in zip(input_config.list_tuples_location_lamps_in_mm,
+                                                                    input_config.list_tuples_rotation_euler_lamps_in_rad,
+                                                                    input_config.list_lamps_strength)]}
+    return get_hash(scene_dict)
+
+
+def get_render_settings_hash(input_config):
+    """
+    Get the hash of the config params in LIST_RENDER_SETTINGS_STR
+
+    :return: hash str
+    """
+    return get_hash({'render_hashes_version': RENDER_HASHES_VERSION,
+                     **{param_str: getattr(input_config, param_str) for param_str in LIST_RENDER_SETTINGS_STR}})
+
+
+def get_keyframed_camera_poses(transforms_dict,
+                               input_config):
+    """
+    Get the camera pose at every frame of the animation, as keyframed by define_camera.insert_camera_keyframes
+
+    With keyframe decimation (CONSTANT interpolation only), the pose at a frame without keyframe is the pose of the
+    previous keyframe.
+
+    :param transforms_dict: dict with concatenated transforms data (see load_data.csv_transforms_concatenated_to_dict)
+    :param input_config: config
+    :return: camera_poses_dict (see camera_poses.compute_camera_poses), with all the frames of the animation
+    """
+    camera_poses_dict = camera_poses.compute_camera_poses(transforms_dict,
+                                                          input_config)
+    if input_config.flag_decimate_keyframes and input_config.interpolation_between_keyframes == 'CONSTANT':
+        keyframes_dict, _ = camera_poses.decimate_camera_poses(camera_poses_dict,
+                                                               input_config.keyframe_decimation_max_translation_in_mm * input_config.mm_to_m,
+                                                               input_config.keyframe_decimation_max_rotation_in_deg)
+        # index of the last keyframe at or before each frame
+        idcs_keyframe = np.searchsorted(keyframes_dict['frame'], camera_poses_dict['frame'], side='right') - 1
+        camera_poses_dict = {'frame': camera_poses_dict['frame'],
+                             'location': np.asarray(keyframes_dict['location'])[idcs_keyframe],
+                             'rotation_quaternion': np.asarray(keyframes_dict['rotation_quaternion'])[idcs_keyframe]}
+    return camera_poses_dict
+
+
+def compute_render_hashes(geometry_dict,
+                          transforms_dict,
+                          input_config):
+    """
+    Compute the hash of every frame of the animation (see header)
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param transforms_dict: dict with concatenated transforms data (see load_data.csv_transforms_concatenated_to_dict)
+    :param input_config: config
+    :return: render_hashes_dict, with 'render_hashes_version', 'scene_hash', 'render_settings_hash' and
+        'frame_hashes' (dict with the frame (str) as key and its hash as value)
+    """
+    scene_hash = get_scene_hash(geometry_dict,
+                                input_config)
+    render_settings_hash = get_render_settings_hash(input_config)
+    camera_poses_dict = get_keyframed_camera_poses(transforms_dict,
+                                                   input_config)
+
+    # pose of each frame as bytes (rounded, with -0.0 as 0.0)
+    poses_array = np.round(np.hstack((camera_poses_dict['location'],
+                                      camera_poses_dict['rotation_quaternion'])).astype(np.float64),
+                           N_DECIMALS_IN_HASH) + 0.0
+    n_frames = poses_array.shape[0]
+    # frames whose pose changes the image of each frame (the previous and next frames for the Vector pass;
+    # beyond the animation range, Blender holds the first and last keyframes)
+    list_offsets = [-1, 0, 1] if input_config.render_use_pass_vector else [0]
+    frame_hashes_dict = {}
+    for i, frame in enumerate(camera_poses_dict['frame']):
+        sha = hashlib.sha1((scene_hash + render_settings_hash).encode())
+        for offset in list_offsets:
+            sha.update(poses_array[min(max(i + offset, 0), n_frames - 1)].tobytes())
+        frame_hashes_dict[str(int(frame))] = sha.hexdigest()
+
+    return {'render_hashes_version': RENDER_HASHES_VERSION,
+            'scene_hash': scene_hash,
+            'render_settings_hash': render_settings_hash,
+            'frame_hashes': frame_hashes_dict}
+
+
+def save_render_hashes(render_hashes_dict,
+                       output_dir_path):
+    """
+    Save the hashes in a render output dir (written to a tmp file and renamed, as several Blender processes may save
+    the same hashes to the same dir)
+    """
+    os.makedirs(output_dir_path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir_path, prefix='.tmp_' + RENDER_HASHES_FILENAME)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(render_hashes_dict, f, indent=4)
+    os.replace(tmp_path, os.path.join(output_dir_path, RENDER_HASHES_FILENAME))
+
+
+def load_render_hashes(output_dir_path):
+    """
+    Load the hashes of a render output dir
+
+    :return: render_hashes_dict (see compute_render_hashes), or None if there are none (or of another version)
+    """
+    hashes_path = os.path.join(output_dir_path, RENDER_HASHES_FILENAME)
+    try:
+        with open(hashes_path) as f:
+            render_hashes_dict = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if render_hashes_dict.get('render_hashes_version') != RENDER_HASHES_VERSION:
+        return None
+    return render_hashes_dict
+
+
+def find_previous_output_dir(output_dir_path,
+                             input_config):
+    """
+    Find the latest previous render output dir of the same trial and render suffix with hashes
+    (sibling dirs named <trial_str>_<render_output_suffix>_<timestamp>, as in config)
+
+    :param output_dir_path: path to the new render output dir (excluded)
+    :param input_config: config
+    :return: path to previous output dir, or None
+    """
+    output_dir_path = os.path.normpath(output_dir_path)
+    prefix = '_'.join([input_config.trial_str, input_config.render_output_suffix]) + '_'
+    list_candidates = [os.path.normpath(os.path.dirname(p))
+                       for p in glob.glob(os.path.join(glob.escape(os.path.dirname(output_dir_path)),
+                                                       glob.escape(prefix) + '*',
+                                                       RENDER_HASHES_FILENAME))]
+    list_candidates = [p for p in list_candidates if p != output_dir_path]
+    if not list_candidates:
+        return None
+    return max(list_candidates, key=lambda p: os.path.getmtime(os.path.join(p, RENDER_HASHES_FILENAME)))
+
+
+def get_rendered_files_per_frame(output_dir_path):
+    """
+    Get the rendered files of each frame in a render output dir: from its render manifest (files with the size
+    recorded), or, if there is no manifest, the image files named by frame (e.g. 0900.exr)
+
+    :return: dict with the frame as key and a list of manifest entries (dicts with 'filename', 'frame',
+        'size_in_bytes' and 'sha256' (None without manifest)) as value. Frames missing any of the file extensions
+        of the dir are not included
+    """
+    list_entries = []
+    if os.path.isfile(os.path.join(output_dir_path, RENDER_MANIFEST_FILENAME)):
+        for manifest_entry in read_render_manifest(output_dir_path).values():
+            file_path = os.path.join(output_dir_path, manifest_entry['filename'])
+            if manifest_entry['frame'] is not None and os.path.isfile(file_path) and \
+                    os.path.getsize(file_path) == manifest_entry['size_in_bytes']:
+                list_entries.append(manifest_entry)
+    else:
+        for file_path in glob.glob(os.path.join(glob.escape(output_dir_path), '*')):
+            match = re.fullmatch(r'(\d+)\.(exr|png|jpg)', os.path.basename(file_path))
+            if match:
+                list_entries.append({'filename': os.path.basename(file_path),
+                                     'frame': int(match.group(1)),
+                                     'size_in_bytes': os.path.getsize(file_path),
+                                     'sha256': None})
+
+    list_extensions = sorted(set(os.path.splitext(e['filename'])[1] for e in list_entries))
+    dict_frame_to_entries = {}
+    for manifest_entry in list_entries:
+        dict_frame_to_entries.setdefault(manifest_entry['frame'], []).append(manifest_entry)
+    return {frame: entries for frame, entries in dict_frame_to_entries.items()
+            if sorted(os.path.splitext(e['filename'])[1] for e in entries) == list_extensions}
+
+
+def link_or_copy_file(source_path,
+                      destination_path,
+                      link_mode='hardlink'):
+    """
+    Link or copy a file (replacing the destination if it exists)
+
+    :param link_mode: 'hardlink' (copied if the dirs are in different file systems), 'symlink' or 'copy'
+    """
+    if os.path.lexists(destination_path):
+        os.remove(destination_path)  # (removes only this link, not the file of the previous dir)
+    if link_mode == 'hardlink':
+        try:
+            os.link(source_path, destination_path)
+            return
+        except OSError:
+            pass
+    elif link_mode == 'symlink':
+        os.symlink(os.path.abspath(source_path), destination_path)
+        return
+    shutil.copy2(source_path, destination_path)
+
+
+def prepare_incremental_render(geometry_dict,
+                               transforms_dict,
+                               input_config,
+                               previous_output_dir_path=None,
+                               link_mode='hardlink'):
+    """
+    Prepare the render output dir of a trial so that only the frames whose inputs changed are rendered
+
+    - computes the hashes of every frame and saves them in the output dir (render_output_parent_dir_path)
+    - if the output dir already has hashes (e.g. a resumed batch), removes the rendered files of the frames whose
+      hash changed, so that they are rendered again
+    - links (or copies) from the previous output dir the files of the frames with the same hash that are not in the
+      output dir yet, and adds them to the render manifest of the output dir
+
+    The frames to render are then those missing in the output dir (see run_rendering.get_frames_to_render).
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param transforms_dict: dict with concatenated transforms data (see load_data.csv_transforms_concatenated_to_dict)
+    :param input_config: config
+    :param previous_output_dir_path: path to previous render output dir; if None, the latest one of the same trial
+        with hashes (see find_previous_output_dir)
+    :param link_mode: see link_or_copy_file
+    :return: result_dict, with 'output_dir_path', 'previous_output_dir_path', 'frames' (all frames of the animation),
+        'frames_changed' (frames whose hash differs from, or is not in, the previous dir), 'frames_carried_forward'
+        and 'frames_removed' (rendered frames of the output dir with a different hash)
+    """
+    output_dir_path = os.path.normpath(input_config.render_output_parent_dir_path)
+    render_hashes_dict = compute_render_hashes(geometry_dict,
+                                               transforms_dict,
+                                               input_config)
+    frame_hashes_dict = render_hashes_dict['frame_hashes']
+    list_frames = sorted(int(f) for f in frame_hashes_dict)
+
+    ### Frames already in the output dir with a different hash: remove their files
+    list_frames_removed = []
+    existing_hashes_dict = load_render_hashes(output_dir_path)
+    dict_frame_to_entries = get_rendered_files_per_frame(output_dir_path) if os.path.isdir(output_dir_path) else {}
+    if existing_hashes_dict is not None:
+        for frame, list_entries in dict_frame_to_entries.items():
+            if existing_hashes_dict['frame_hashes'].get(str(frame)) != frame_hashes_dict.get(str(frame)):
+                for manifest_entry in list_entries:
+                    os.remove(os.path.join(output_dir_path, manifest_entry['filename']))
+                list_frames_removed.append(frame)
+        for frame in list_frames_removed:
+            del dict_frame_to_entries[frame]
+    save_render_hashes(render_hashes_dict,
+                       output_dir_path)
+
+    ### Frames with the same hash in the previous output dir
+    if previous_output_dir_path is None:
+        previous_output_dir_path = find_previous_output_dir(output_dir_path,
+                                                            input_config)
+    previous_hashes_dict = load_render_hashes(previous_output_dir_path) if previous_output_dir_path else None
+    if previous_hashes_dict is None:
+        list_frames_unchanged = []
+    else:
+        list_frames_unchanged = [f for f in list_frames
+                                 if previous_hashes_dict['frame_hashes'].get(str(f)) == frame_hashes_dict[str(f)]]
+
+    ### Link or copy them to the output dir, and add them to its manifest
+    list_frames_carried_forward = []
+    if list_frames_unchanged:
+        dict_previous_frame_to_entries = get_rendered_files_per_frame(previous_output_dir_path)
+        list_manifest_lines = []
+        for frame in list_frames_unchanged:
+            if frame in dict_frame_to_entries or frame not in dict_previous_frame_to_entries:
+                continue
+            for manifest_entry in dict_previous_frame_to_entries[frame]:
+                link_or_copy_file(os.path.join(previous_output_dir_path, manifest_entry['filename']),
+                                  os.path.join(output_dir_path, manifest_entry['filename']),
+                                  link_mode)
+                if manifest_entry['sha256'] is None:
+                    manifest_entry = dict(manifest_entry,
+                                          sha256=compute_file_sha256(os.path.join(output_dir_path, manifest_entry['filename'])))
+                list_manifest_lines.append(json.dumps(dict(manifest_entry,
+                                                           time=datetime.now().isoformat(timespec='seconds'),
+                                                           carried_forward_from=previous_output_dir_path)) + '\n')
+            list_frames_carried_forward.append(frame)
+        with open(os.path.join(output_dir_path, RENDER_MANIFEST_FILENAME), 'a') as f:
+            f.writelines(list_manifest_lines)
+
+    return {'output_dir_path': output_dir_path,
+            'previous_output_dir_path': previous_output_dir_path,
+            'frames': list_frames,
+            'frames_changed': sorted(set(list_frames) - set(list_frames_unchanged)),
+            'frames_carried_forward': list_frames_carried_forward,
+            'frames_removed': sorted(list_frames_removed)}
+
+
+if __name__ == '__main__':
+    # prepare the render output dir of a trial for an incremental render (run from this dir, as main.py):
+    #     python render_dependencies.py <input json> [--previous_output_dir <dir>] [--link_mode hardlink|symlink|copy]
+    #                                   [--result_json <path>]
+    # (run_rendering.py --incremental runs it for each trial before rendering)
+    import argparse
+    import config
+    import load_data
+
+    parser = argparse.ArgumentParser(description='Link the unchanged frames of a previous render of a trial to its '
+                                                 'new render output dir')
+    parser.add_argument('input_json_path',
+                        help='Path to input json file of the trial (with the new render output dir)')
+    parser.add_argument('--previous_output_dir', default=None,
+                        help='Previous render output dir; default: the latest one of the same trial with hashes')
+    parser.add_argument('--link_mode', default='hardlink', choices=['hardlink', 'symlink', 'copy'],
+                        help='How unchanged frames are carried forward')
+    parser.add_argument('--result_json', default=None,
+                        help='If given, the result (frames changed and carried forward) is saved to this json file')
+    args = parser.parse_args()
+
+    input_config = config.config(args.input_json_path)
+    geometry_dict = load_data.load_csv_with_cache(load_data.csv_to_dict_keys_per_row,
+                                                  input_config.geometry_csv_path_to_file,
+                                                  [input_config.geometry_csv_n_header_rows_to_skip,
+                                                   input_config.geometry_csv_idx_col_start_data],
+                                                  input_config.data_cache_folder_path if input_config.flag_use_data_cache else None)
+    transforms_dict = load_data.csv_transforms_concatenated_to_dict(input_config)
+    if args.previous_output_dir is not None and load_render_hashes(args.previous_output_dir) is None:
+        sys.exit('ERROR in render_dependencies: no render hashes in {}'.format(args.previous_output_dir))
+
+    result_dict = prepare_incremental_render(geometry_dict,
+                                             transforms_dict,
+                                             input_config,
+                                             args.previous_output_dir,
+                                             args.link_mode)
+    print('Incremental render of {} ({} frames): {} frames changed since {}, {} frames carried forward, '
+          '{} frames removed'.format(result_dict['output_dir_path'],
+                                     len(result_dict['frames']),
+                                     len(result_dict['frames_changed']),
+                                     result_dict['previous_output_dir_path'],
+                                     len(result_dict['frames_carried_forward']),
+                                     len(result_dict['frames_removed'])))
+    if args.result_json:
+        with open(args.result_json, 'w') as f:
+            json.dump(result_dict, f, indent=4)
@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+
+# Manifest of completed frames, in each render output dir: a json-lines file with one entry per saved image
+# ('filename', 'frame', 'size_in_bytes', 'sha256' and 'time'). It is appended to by run_rendering.py as Blender saves
+# each image, and by render_dependencies.prepare_incremental_render for the frames carried forward; and read by
+# run_rendering.py (--resume), render_dependencies and trial_store.
+# (standard library only, so that run_rendering.py can import it outside Blender)
+
+RENDER_MANIFEST_FILENAME = 'render_manifest.jsonl'
+
+
+def compute_file_sha256(file_path,
+                        n_bytes_per_block=1 << 20):
+    """
+    Compute sha256 checksum of a file, reading it in blocks
+
+    :return: hex digest str
+    """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(n_bytes_per_block), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_render_manifest(output_dir_path):
+    """
+    Read the manifest of a render output dir
+
+    If an image is saved again, the last entry is the valid one. A crash can at most leave the last line truncated,
+    and truncated lines are skipped.
+
+    :param output_dir_path: path to render output dir
+    :return: dict with filename as key and last manifest entry for that file as value (empty if no manifest)
+    """
+    manifest_dict = dict()
+    manifest_path = os.path.join(output_dir_path, RENDER_MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        return manifest_dict
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                manifest_entry = json.loads(line)
+            except ValueError:
+                continue  # truncated line (e.g., if the batch was killed while writing it)
+            manifest_dict[manifest_entry['filename']] = manifest_entry
+    return manifest_dict
@@ -0,0 +1,230 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Local queue of render jobs, shared by the clients that submit jobs (e.g. run_rendering.py --server) and the
+# Blender processes that render them (main.py --queue_dir, see render_worker)
+#
+# The queue is a directory with one json file per job, moved between subdirs as the job progresses:
+#   pending/<job_id>.json   submitted, waiting for a worker (taken in order of submission)
+#   running/<job_id>.json   claimed by a worker (with its 'worker_id')
+#   finished/<job_id>.json  job dict with the result of the render ('status', 'list_saved_paths', etc.)
+#   collected/<job_id>.json results already read by the client (see collect_finished_jobs)
+# and a STOP file: if present, workers exit when they finish their current job.
+#
+# Files are written to a temporary file and renamed, and jobs are claimed by renaming their file from pending/ to
+# running/ (atomic in the same file system), so several workers can share the queue without locks.
+# Only the standard library is used, so that the queue can be used from Blender's Python and from the system Python.
+
+LIST_QUEUE_SUBDIRS_STR = ['pending', 'running', 'finished', 'collected']
+STOP_FILENAME = 'STOP'
+
+
+def create_queue(queue_dir_path):
+    """
+    Create the subdirs of a queue (if they don't exist)
+    """
+    for subdir_str in LIST_QUEUE_SUBDIRS_STR:
+        os.makedirs(os.path.join(queue_dir_path, subdir_str), exist_ok=True)
+
+
+def write_json_atomically(file_path,
+                          data_dict):
+    """
+    Write a dict to a json file (to a temporary file in the same dir, then renamed)
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.tmp_')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data_dict, f, indent=4)
+    os.replace(tmp_path, file_path)
+
+
+def get_job_path(queue_dir_path,
+                 subdir_str,
+                 job_id):
+    return os.path.join(queue_dir_path, subdir_str, job_id + '.json')
+
+
+def submit_job(queue_dir_path,
+               job_id,
+               json_path,
+               list_frame_ranges=None,
+               **kwargs):
+    """
+    Submit a render job to the queue
+
+    :param queue_dir_path: path to queue dir
+    :param job_id: job id (unique in the queue; a finished job with the same id is submitted again)
+    :param json_path: path to input json file of the trial (absolute, as workers may run in another dir)
+    :param list_frame_ranges: list of [first_frame, last_frame] to render; if None the complete animation is rendered
+    :param kwargs: other fields saved in the job dict (e.g. 'attempt')
+    :return: job_dict
+    """
+    create_queue(queue_dir_path)
+    job_dict = dict(kwargs,
+                    job_id=job_id,
+                    json_path=os.path.abspath(json_path),
+                    list_frame_ranges=list_frame_ranges,
+                    submit_time=datetime.now().isoformat(timespec='seconds'),
+                    submit_time_ns=time.time_ns())
+    for subdir_str in ['finished', 'collected']:
+        if os.path.isfile(get_job_path(queue_dir_path, subdir_str, job_id)):
+            os.remove(get_job_path(queue_dir_path, subdir_str, job_id))
+    write_json_atomically(get_job_path(queue_dir_path, 'pending', job_id),
+                          job_dict)
+    return job_dict
+
+
+def read_jobs(queue_dir_path,
+              subdir_str):
+    """
+    Read the job dicts in a subdir of the queue
+
+    :return: list of job dicts, in order of submission
+    """
+    list_job_dicts = []
+    for job_path in glob.glob(os.path.join(glob.escape(os.path.join(queue_dir_path, subdir_str)), '*.json')):
+        try:
+            with open(job_path) as f:
+                list_job_dicts.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # moved by another process while listing
+    return sorted(list_job_dicts, key=lambda d: (d.get('submit_time_ns', 0), d['job_id']))
+
+
+def claim_next_job(queue_dir_path,
+                   worker_id):
+    """
+    Claim the first pending job of the queue for a worker (moving it to running/)
+
+    :return: job_dict (with 'worker_id' and 'start_time'), or None if there are no pending jobs
+    """
+    for job_dict in read_jobs(queue_dir_path, 'pending'):
+        running_job_path = get_job_path(queue_dir_path, 'running', job_dict['job_id'])
+        try:
+            os.rename(get_job_path(queue_dir_path, 'pending', job_dict['job_id']),
+                      running_job_path)
+        except OSError:
+            continue  # claimed by another worker
+        job_dict.update(worker_id=worker_id,
+                        start_time=datetime.now().isoformat(timespec='seconds'))
+        write_json_atomically(running_job_path,
+                              job_dict)
+        return job_dict
+    return None
+
+
+def finish_job(queue_dir_path,
+               job_dict):
+    """
+    Move a running job to finished/, with its result
+
+    :param job_dict: job dict with the result of the render (at least 'status': 'success' or 'failed')
+    """
+    write_json_atomically(get_job_path(queue_dir_path, 'finished', job_dict['job_id']),
+                          dict(job_dict,
+                               end_time=datetime.now().isoformat(timespec='seconds')))
+    if os.path.isfile(get_job_path(queue_dir_path, 'running', job_dict['job_id'])):
+        os.remove(get_job_path(queue_dir_path, 'running', job_dict['job_id']))
+
+
+def fail_running_jobs_of_worker(queue_dir_path,
+                                worker_id,
+                                error_str):
+    """
+    Move the running jobs of a worker to finished/ as failed (e.g. if its Blender process exited while rendering)
+
+    :return: list of failed job dicts
+    """
+    list_failed_job_dicts = []
+    for job_dict in read_jobs(queue_dir_path, 'running'):
+        if job_dict.get('worker_id') == worker_id:
+            job_dict.update(status='failed',
+                            error=error_str,
+                            list_saved_paths=job_dict.get('list_saved_paths', []))
+            finish_job(queue_dir_path,
+                       job_dict)
+            list_failed_job_dicts.append(job_dict)
+    return list_failed_job_dicts
+
+
+def collect_finished_jobs(queue_dir_path):
+    """
+    Get the finished jobs not collected yet (and move them to collected/)
+
+    :return: list of finished job dicts
+    """
+    list_job_dicts = read_jobs(queue_dir_path, 'finished')
+    for job_dict in list_job_dicts:
+        os.replace(get_job_path(queue_dir_path, 'finished', job_dict['job_id']),
+                   get_job_path(queue_dir_path, 'collected', job_dict['job_id']))
+    return list_job_dicts
+
+
+def request_stop(queue_dir_path):
+    """
+    Ask the workers of the queue to exit after their current job
+    """
+    with open(os.path.join(queue_dir_path, STOP_FILENAME), 'w') as f:
+        f.write(datetime.now().isoformat(timespec='seconds') + '\n')
+
+
+def is_stop_requested(queue_dir_path):
+    return os.path.isfile(os.path.join(queue_dir_path, STOP_FILENAME))
+
+
+def get_queue_status(queue_dir_path):
+    """
+    Get the number of jobs in each subdir of the queue
+
+    :return: dict with subdir str as key and number of jobs as value (and 'stop_requested')
+    """
+    status_dict = {subdir_str: len(glob.glob(os.path.join(glob.escape(os.path.join(queue_dir_path, subdir_str)),
+                                                          '*.json')))
+                   for subdir_str in LIST_QUEUE_SUBDIRS_STR}
+    status_dict['stop_requested'] = is_stop_requested(queue_dir_path)
+    return status_dict
+
+
+if __name__ == '__main__':
+    # Manage a render queue from the terminal (workers are started with main.py --queue_dir, see render_worker):
+    #     python render_queue.py <queue dir> submit <input json> [--frames 714-1145,1922-2303] [--job_id <id>]
+    #     python render_queue.py <queue dir> status
+    #     python render_queue.py <queue dir> stop
+    parser = argparse.ArgumentParser(description='Submit render jobs to a local queue and check its status')
+    parser.add_argument('queue_dir_path',
+                        help='Path to queue dir')
+    parser.add_argument('command', choices=['submit', 'status', 'stop'],
+                        help='submit a job, print the number of jobs per state, or ask the workers to exit')
+    parser.add_argument('input_json_path', nargs='?', default=None,
+                        help='Path to input json file of the trial to render (submit only)')
+    parser.add_argument('--frames', default=None,
+                        help='Frame ranges to render, as in Blender --render-frame (e.g. 714..1145,1922..2303 or '
+                             '714-1145); default: the complete animation')
+    parser.add_argument('--job_id', default=None,
+                        help='Job id; default: the name of the input json file')
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        if args.input_json_path is None:
+            sys.exit('ERROR in render_queue: submit requires the path to an input json file')
+        list_frame_ranges = None
+        if args.frames:
+            list_frame_ranges = []
+            for range_str in args.frames.split(','):
+                list_range_ends = [int(s) for s in range_str.replace('..', '-').split('-')]
+                list_frame_ranges.append([list_range_ends[0], list_range_ends[-1]])
+        job_dict = submit_job(args.queue_dir_path,
+                              args.job_id or os.path.splitext(os.path.basename(args.input_json_path))[0],
+                              args.input_json_path,
+                              list_frame_ranges)
+        print('Submitted {}'.format(job_dict['job_id']))
+    elif args.command == 'stop':
+        request_stop(args.queue_dir_path)
+        print('Stop requested')
+    print(json.dumps(get_queue_status(args.queue_dir_path)))
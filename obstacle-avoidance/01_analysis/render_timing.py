@@ -0,0 +1,114 @@
+import json
+import os
+import socket
+import tempfile
+import time
+import bpy
+
+# Render time per frame, recorded with Blender's render handlers and saved as a json file in the render output dir,
+# with the render profile and its params (see config.DICT_RENDER_PROFILES), to compare profiles
+# (see benchmark_render_profiles.py), and to autotune the CPU render settings (see render_autotune)
+# Only if config.flag_save_render_times_as_json is True (off by default; set in the input jsons rendered by
+# render_autotune and benchmark_render_profiles)
+#
+# For each rendered frame:
+# - render_time_in_s: from render_pre to render_post (Cycles render, including scene sync and BVH build)
+# - render_and_save_time_in_s: from render_pre to render_write (including saving the image)
+# The json file is rewritten after each frame (so it is kept if the render is interrupted). Its name includes the
+# host and process id, as several Blender processes may render the same trial (see run_rendering.py -k).
+
+RENDER_TIMES_FILENAME_SUFFIX = '_render_times'
+
+# render params recorded with the times
+LIST_RENDER_TIMES_PARAMS_STR = ['render_profile',
+                                'render_device',
+                                'render_device_applied',
+                                'render_cpu_threads',
+                                'render_cpu_tile_x_y_in_pixels',
+                                'render_cpu_settings_source',
+                                'pixel_filter_type',
+                                'render_samples',
+                                'render_use_adaptive_sampling',
+                                'render_use_denoising',
+                                'render_max_bounces',
+                                'render_resolution_x_y_in_pixels',
+                                'render_resolution_percentage',
+                                'render_use_pass_combined',
+                                'render_use_pass_z',
+                                'render_use_pass_object_index',
+                                'render_use_pass_vector',
+                                'render_frame_step']
+
+# handlers registered by start_render_timer: list of (handlers list, function)
+list_registered_handlers = []
+
+
+def get_render_times_json_path(input_config):
+    return os.path.join(input_config.render_output_parent_dir_path,
+                        '{}{}_{}_{}.json'.format(input_config.render_output_parent_dir_str,
+                                                 RENDER_TIMES_FILENAME_SUFFIX,
+                                                 socket.gethostname(),
+                                                 os.getpid()))
+
+
+def start_render_timer(input_config):
+    """
+    Record the render time of each frame rendered from now on, and save them to the render output dir
+    (replaces the timer of a previous trial set up in the same Blender process, see render_worker)
+
+    :param input_config: config
+    :return: path to json file with the render times
+    """
+    stop_render_timer()
+    render_times_json_path = get_render_times_json_path(input_config)
+    render_times_dict = {'hostname': socket.gethostname(),
+                         'blender_version': bpy.app.version_string,
+                         'render_params': {param_str: getattr(input_config, param_str)
+                                           for param_str in LIST_RENDER_TIMES_PARAMS_STR},
+                         'frames': []}
+    if os.path.isfile(render_times_json_path):
+        with open(render_times_json_path) as f:
+            render_times_dict['frames'] = json.load(f)['frames']  # same process and trial (e.g. a retried job)
+    frame_timer_dict = {}
+
+    def on_render_pre(scene, *args):
+        frame_timer_dict.update(frame=scene.frame_current,
+                                start_time=time.perf_counter(),
+                                render_time_in_s=None)
+
+    def on_render_post(scene, *args):
+        if frame_timer_dict.get('frame') == scene.frame_current:
+            frame_timer_dict['render_time_in_s'] = time.perf_counter() - frame_timer_dict['start_time']
+
+    def on_render_write(scene, *args):
+        if frame_timer_dict.get('frame') != scene.frame_current:
+            return
+        render_times_dict['frames'].append({'frame': scene.frame_current,
+                                            'render_time_in_s': frame_timer_dict['render_time_in_s'],
+                                            'render_and_save_time_in_s': time.perf_counter() - frame_timer_dict['start_time']})
+        list_render_times = [d['render_time_in_s'] for d in render_times_dict['frames']
+                             if d['render_time_in_s'] is not None]
+        render_times_dict['mean_render_time_in_s'] = sum(list_render_times) / max(len(list_render_times), 1)
+        frame_timer_dict.clear()
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(render_times_json_path), prefix='.tmp_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(render_times_dict, f, indent=4)
+        os.replace(tmp_path, render_times_json_path)
+
+    for handlers_list, function in [(bpy.app.handlers.render_pre, on_render_pre),
+                                    (bpy.app.handlers.render_post, on_render_post),
+                                    (bpy.app.handlers.render_write, on_render_write)]:
+        handlers_list.append(function)
+        list_registered_handlers.append((handlers_list, function))
+    return render_times_json_path
+
+
+def stop_render_timer():
+    """
+    Remove the handlers registered by start_render_timer
+    """
+    while list_registered_handlers:
+        handlers_list, function = list_registered_handlers.pop()
+        if function in handlers_list:
+            handlers_list.remove(function)
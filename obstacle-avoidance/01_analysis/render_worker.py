@@ -0,0 +1,136 @@
+import glob
+import os
+import time
+import traceback
+from datetime import datetime
+import bpy
+import render_queue
+
+# Long-lived render worker: renders the jobs of a local queue (see render_queue) in a single Blender process
+# (main.py --queue_dir), so that Blender startup, module imports and Cycles kernel loading are paid once per session
+# rather than once per trial
+#
+# For each job, the worker:
+# - sets up the scene for the trial with main.main. If the environment is the same as in the previous job (same
+#   scene cache key, see scene_cache.get_scene_cache_key), only the camera and its keyframes are removed and created
+#   again; otherwise the environment is built (or loaded from the scene cache)
+# - renders the frame ranges of the job (or the complete animation), as Blender's --render-frame (--render-anim)
+# - records the images saved (with a render_write handler) and moves the job to finished/ with its result
+# If a job raises an exception, it is reported as failed (with the traceback) and the next job starts from an empty
+# scene. The worker exits when the STOP file of the queue is present, or after idle_timeout_in_s without jobs.
+#
+# With use_persistent_data (config.render_server_use_persistent_data), Cycles keeps the scene data (e.g. the BVH)
+# between frames and between jobs with the same environment.
+
+
+def get_saved_paths_of_current_frame(scene):
+    """
+    Get the paths of the images saved for the current frame (e.g. the .exr and its .jpg preview)
+    """
+    frame_path = scene.render.frame_path(frame=scene.frame_current)
+    return sorted(glob.glob(glob.escape(os.path.splitext(frame_path)[0]) + '.*'))
+
+
+def render_frame_ranges(scene,
+                        list_frame_ranges=None):
+    """
+    Render frame ranges of the animation of the scene (as Blender's --render-frame), or the complete animation if
+    list_frame_ranges is None (as Blender's --render-anim, i.e. with the frame step of the scene)
+
+    :param scene: Blender scene
+    :param list_frame_ranges: list of [first_frame, last_frame]
+    """
+    if list_frame_ranges is None:
+        bpy.ops.render.render(animation=True)
+        return
+
+    frame_start, frame_end, frame_step = scene.frame_start, scene.frame_end, scene.frame_step
+    try:
+        scene.frame_step = 1
+        for first_frame, last_frame in list_frame_ranges:
+            scene.frame_start = first_frame
+            scene.frame_end = last_frame
+            bpy.ops.render.render(animation=True)
+    finally:
+        scene.frame_start, scene.frame_end, scene.frame_step = frame_start, frame_end, frame_step
+
+
+def serve(queue_dir_path,
+          set_up_scene_function,
+          worker_id,
+          poll_interval_in_s=1.0,
+          idle_timeout_in_s=None,
+          flag_cprofile=False):
+    """
+    Render the jobs of a queue until a stop is requested (or there are no jobs for idle_timeout_in_s)
+
+    :param queue_dir_path: path to queue dir (see render_queue)
+    :param set_up_scene_function: function that sets up the scene for a trial (main.main), with args
+        (config_class_inputs_json, flag_cprofile, environment_key_in_scene, shard_id) and returning (input_config,
+        environment_key)
+    :param worker_id: worker id str (recorded in the jobs it claims)
+    :param poll_interval_in_s: time between checks of the queue when there are no pending jobs
+    :param idle_timeout_in_s: if not None, the worker exits after this time without pending jobs
+    :param flag_cprofile: if True, each stage of the scene set up is also profiled with cProfile
+    :return: number of jobs rendered
+    """
+    render_queue.create_queue(queue_dir_path)
+    list_saved_paths = []
+
+    def record_saved_paths(scene, *args):
+        list_saved_paths.extend(get_saved_paths_of_current_frame(scene))
+
+    bpy.app.handlers.render_write.append(record_saved_paths)
+    environment_key = None
+    n_jobs = 0
+    last_job_end_time = time.time()
+    print('Render worker {} waiting for jobs in {}'.format(worker_id, os.path.abspath(queue_dir_path)))
+    try:
+        while not render_queue.is_stop_requested(queue_dir_path):
+            job_dict = render_queue.claim_next_job(queue_dir_path,
+                                                   worker_id)
+            if job_dict is None:
+                if idle_timeout_in_s is not None and time.time() - last_job_end_time > idle_timeout_in_s:
+                    break
+                time.sleep(poll_interval_in_s)
+                continue
+
+            print('Render worker {}: starting job {} [{}]'.format(worker_id,
+                                                                  job_dict['job_id'],
+                                                                  datetime.now().strftime('%H:%M:%S')))
+            start_time = time.time()
+            list_saved_paths.clear()
+            previous_environment_key = environment_key
+            try:
+                input_config, environment_key = set_up_scene_function(job_dict['json_path'],
+                                                                      flag_cprofile,
+                                                                      environment_key,
+                                                                      job_dict.get('shard_id'))
+                scene = bpy.context.scene
+                scene.render.use_persistent_data = input_config.render_server_use_persistent_data
+                render_frame_ranges(scene,
+                                    job_dict['list_frame_ranges'])
+                job_dict['status'] = 'success' if list_saved_paths else 'failed'
+                job_dict['render_output_dir_path'] = os.path.abspath(input_config.render_output_parent_dir_path)
+                job_dict['flag_environment_reused'] = environment_key == previous_environment_key
+            except Exception:
+                job_dict['status'] = 'failed'
+                job_dict['error'] = traceback.format_exc()
+                print(job_dict['error'])
+                environment_key = None  # the scene may be half set up: start from scratch in the next job
+            job_dict['list_saved_paths'] = list(list_saved_paths)
+            job_dict['n_saved_images'] = len(list_saved_paths)
+            job_dict['duration_in_s'] = time.time() - start_time
+            render_queue.finish_job(queue_dir_path,
+                                    job_dict)
+            print('Render worker {}: job {} {} ({} images in {:.1f} s)'.format(worker_id,
+                                                                               job_dict['job_id'],
+                                                                               job_dict['status'],
+                                                                               job_dict['n_saved_images'],
+                                                                               job_dict['duration_in_s']))
+            n_jobs += 1
+            last_job_end_time = time.time()
+    finally:
+        bpy.app.handlers.render_write.remove(record_saved_paths)
+    print('Render worker {} exiting after {} jobs'.format(worker_id, n_jobs))
+    return n_jobs
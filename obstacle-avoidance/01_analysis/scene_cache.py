@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import tempfile
+from datetime import datetime
+import numpy as np
+import bpy
+import define_geometry
+
+# Cache of the environment built by define_geometry.create_environment (perches, obstacles, walls, floor, ceiling,
+# lamps and materials), saved as a .blend library
+#
+# All the trials of a session usually share the same geometry csv, so the first trial builds the environment and saves
+# its objects (with their meshes, materials and lights) to <scene_cache_folder_path>/<key>.blend, and the next trials
+# append (or link) them instead of rebuilding it. Only the camera and its keyframes are then created per trial.
+#
+# The key is a hash of:
+# - the geometry dict (names, dtypes, shapes and values of its arrays)
+# - the config params used by create_environment (LIST_GEOMETRY_CONFIG_STR)
+# - the source of define_geometry.py, the Blender version and SCENE_CACHE_VERSION
+# so editing the geometry csv, these params or the way the environment is built invalidates the cache automatically.
+#
+# Each entry is a <key>.blend file and a <key>.json manifest with the names of the saved objects (both written to
+# temporary files and then renamed, so that several Blender processes can build the same entry). An entry is only
+# valid if both exist, and the appended objects match the manifest; otherwise the environment is built and the entry
+# saved again.
+
+SCENE_CACHE_VERSION = 1
+
+# config params used by define_geometry.create_environment
+LIST_GEOMETRY_CONFIG_STR = ['mm_to_m',
+                            'perch_radius',
+                            'perch_marker_centre_to_cyl_axis_z_offset',
+                            'obs_radius',
+                            'marker_centre_to_top_obs_base',
+                            'n_vertices_per_plane',
+                            'list_tuples_location_lamps_in_mm',
+                            'list_tuples_rotation_euler_lamps_in_rad',
+                            'list_lamps_strength',
+                            'dict_geometry_to_material_hex_str_and_alpha',
+                            'dict_perch_str_to_object_index',
+                            'flag_use_obstacle_ID_as_object_index',
+                            'dict_obs_ID_to_object_index',
+                            'dict_planes_str_to_object_index']
+
+
+def get_scene_cache_key(geometry_dict,
+                        input_config,
+                        blender_version_str):
+    """
+    Get the key of the cached environment for a geometry dict and config (see header)
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param input_config: config
+    :param blender_version_str: Blender version (bpy.app.version_string)
+    :return: key str (sha256 hex digest)
+    """
+    key_hash = hashlib.sha256()
+    key_hash.update(json.dumps({'scene_cache_version': SCENE_CACHE_VERSION,
+                                'blender_version': blender_version_str,
+                                **{param_str: getattr(input_config, param_str)
+                                   for param_str in LIST_GEOMETRY_CONFIG_STR}},
+                               sort_keys=True).encode())
+    for k in sorted(geometry_dict.keys()):
+        array = np.ascontiguousarray(geometry_dict[k])
+        key_hash.update(json.dumps([k, array.dtype.str, array.shape]).encode())
+        key_hash.update(array.tobytes())
+    with open(define_geometry.__file__, 'rb') as f:
+        key_hash.update(f.read())
+    return key_hash.hexdigest()
+
+
+def save_environment_to_cache(blend_path,
+                              list_objects,
+                              manifest_dict):
+    """
+    Save the objects of the environment (and the data blocks they use) to a .blend library, and its manifest
+    (written to temporary files and then renamed, so that an entry is never read half-written)
+
+    :param blend_path: path to .blend file (the manifest is saved with the same name and extension .json)
+    :param list_objects: list of objects to save
+    :param manifest_dict: dict saved as manifest
+    """
+    cache_folder_path = os.path.dirname(blend_path)
+    os.makedirs(cache_folder_path, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=cache_folder_path, suffix='.blend.tmp')
+    os.close(fd)
+    bpy.data.libraries.write(tmp_path,
+                             set(list_objects),
+                             fake_user=True)
+    os.replace(tmp_path, blend_path)
+
+    fd, tmp_path = tempfile.mkstemp(dir=cache_folder_path, suffix='.json.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest_dict, f, indent=4)
+    os.replace(tmp_path, os.path.splitext(blend_path)[0] + '.json')
+
+
+def load_environment_from_cache(blend_path,
+                                import_mode='APPEND'):
+    """
+    Remove the pre-existing objects in the scene, and append (or link) the objects of a cached environment to it
+
+    :param blend_path: path to .blend file (with its manifest)
+    :param import_mode: 'APPEND' (local copies of the objects) or 'LINK' (read-only objects from the .blend file)
+    :return: True if all the objects in the manifest were added to the scene, False otherwise
+    """
+    manifest_path = os.path.splitext(blend_path)[0] + '.json'
+    if not (os.path.isfile(blend_path) and os.path.isfile(manifest_path)):
+        return False
+    try:
+        with open(manifest_path) as f:
+            list_object_names = json.load(f)['list_object_names']
+    except (OSError, ValueError, KeyError):
+        return False
+
+    define_geometry.remove_pre_existing_objects()
+    try:
+        with bpy.data.libraries.load(blend_path,
+                                     link=(import_mode == 'LINK')) as (data_from, data_to):
+            data_to.objects = [name for name in data_from.objects if name in list_object_names]
+    except OSError:
+        return False  # corrupt .blend file
+
+    list_objects = [obj for obj in data_to.objects if obj is not None]
+    for obj in list_objects:
+        bpy.context.collection.objects.link(obj)
+        if import_mode != 'LINK':
+            obj.use_fake_user = False
+    return sorted(obj.name for obj in list_objects) == sorted(list_object_names)
+
+
+def create_environment_with_cache(geometry_dict,
+                                  input_config):
+    """
+    Create the lab environment (see define_geometry.create_environment) from the scene cache if possible; otherwise
+    build it and save it to the cache
+
+    :param geometry_dict: dict with geometry data (see load_data.csv_to_dict_keys_per_row)
+    :param input_config: config
+    :return: flag_cache_hit, True if the environment was loaded from the cache
+    """
+    key = get_scene_cache_key(geometry_dict,
+                              input_config,
+                              bpy.app.version_string)
+    blend_path = os.path.join(input_config.scene_cache_folder_path, key + '.blend')
+
+    ### Load from the cache
+    if load_environment_from_cache(blend_path,
+                                   input_config.scene_cache_import_mode):
+        print('Environment loaded from scene cache: {}'.format(blend_path))
+        return True
+
+    ### Build and save to the cache
+    define_geometry.create_environment(geometry_dict,
+                                       input_config)
+    list_objects = list(bpy.context.scene.objects)
+    save_environment_to_cache(blend_path,
+                              list_objects,
+                              {'scene_cache_version': SCENE_CACHE_VERSION,
+                               'blender_version': bpy.app.version_string,
+                               'geometry_csv_path_to_file': os.path.abspath(input_config.geometry_csv_path_to_file),
+                               'list_object_names': sorted(obj.name for obj in list_objects),
+                               'time': datetime.now().isoformat(timespec='seconds')})
+    print('Environment saved to scene cache: {}'.format(blend_path))
+    return False
@@ -0,0 +1,344 @@
+import os
+import sys
+import numpy as np
+import exr_reader
+import ray_tables
+import trial_store
+
+# Statistics of the visual field per frame and object (object index pass), weighted by the solid angle of each pixel
+#
+# The pixels of the equirectangular camera do not cover the same solid angle: a pixel of size d = 1 / pixels_per_deg
+# (in deg, the same in longitude and latitude) at latitude lat covers ~cos(lat) * d^2 (in rad^2), so pixel counts
+# overstate the objects near the poles of the image. Each pixel is weighted by its exact solid angle instead:
+# - EQUIRECTANGULAR: d_longitude * (sin(latitude top edge) - sin(latitude bottom edge)), with the latitude edges of
+#   the row from camera_latitude_min_max_in_rad (the sum over the image is 4 pi for the full sphere)
+# - FISHEYE_EQUIDISTANT: the area of the pixel in the normalised image plane times the Jacobian of the projection,
+#   (fov / 2)^2 * sin(theta) / theta, with theta the angle to the forward axis (0 for pixels outside the circle)
+#
+# Statistics per frame and object index (arrays of shape (n_frames, n_object_indices), index 0 is the background):
+# - pixel_count
+# - solid_angle_in_sr: sum of the solid angle of the pixels of the object
+# - centroid_longitude_in_rad, centroid_latitude_in_rad: direction (in camera RF, as in ray_tables) of the
+#   solid-angle-weighted mean of the ray directions of the object's pixels
+# - centroid_mean_resultant_length: norm of that weighted mean (1 for a point, ~0 for an object all around the camera)
+# - depth_percentiles: solid-angle-weighted percentiles of the depth of the object's pixels (pixels with finite depth),
+#   of shape (n_frames, n_object_indices, n_percentiles). The percentile p is the smallest depth d such that the
+#   pixels with depth <= d cover at least p% of the object's solid angle with finite depth
+# Statistics of objects not in a frame are nan (pixel_count 0), as are those of frames not rendered.
+#
+# The frames are processed in blocks of semantic_stats_frames_per_block frames (read from a trial store, see
+# trial_store, or from the EXR files of a render output dir), so only one block is in memory at a time.
+# The weighted percentiles of all the objects and frames of a block are computed with a single sort (see
+# compute_weighted_percentiles_per_group).
+
+LIST_STATS_STR = ['pixel_count',
+                  'solid_angle_in_sr',
+                  'centroid_longitude_in_rad',
+                  'centroid_latitude_in_rad',
+                  'centroid_mean_resultant_length',
+                  'depth_percentiles']
+
+
+def get_pixel_solid_angles(camera_projection_params_dict):
+    """
+    Get the solid angle covered by each pixel (see header)
+
+    :param camera_projection_params_dict: see ray_tables.get_camera_projection_params
+    :return: pixel_solid_angles_in_sr, float64 array of shape (n_rows, n_cols)
+    """
+    n_cols = camera_projection_params_dict['n_cols']
+    n_rows = camera_projection_params_dict['n_rows']
+    if camera_projection_params_dict['camera_panorama_type'] == 'EQUIRECTANGULAR':
+        longitude_min, longitude_max = camera_projection_params_dict['camera_longitude_min_max_in_rad']
+        latitude_min, latitude_max = camera_projection_params_dict['camera_latitude_min_max_in_rad']
+        # latitude of the row edges, from the top of the image (v = 1) to the bottom (v = 0), see ray_tables
+        latitude_edges = latitude_min + (latitude_max - latitude_min) * (1 - np.arange(n_rows + 1) / n_rows)
+        row_solid_angles = abs(longitude_max - longitude_min) / n_cols * np.abs(np.diff(-np.sin(latitude_edges)))
+        return np.repeat(row_solid_angles[:, None], n_cols, axis=1)
+    else:
+        half_fov = camera_projection_params_dict['camera_fisheye_equidistant_FOV_in_rad'] / 2
+        x = 2 * (np.arange(n_cols) + 0.5) / n_cols - 1
+        y = 2 * (np.arange(n_rows) + 0.5) / n_rows - 1
+        r = np.hypot(*np.meshgrid(x, y))
+        theta = r * half_fov
+        return np.where(r <= 1, half_fov ** 2 * np.sinc(theta / np.pi) * (2 / n_cols) * (2 / n_rows), 0.0)
+
+
+def compute_weighted_percentiles_per_group(group_idcs,
+                                           values,
+                                           weight_class_idcs,
+                                           class_weights,
+                                           n_groups,
+                                           list_percentiles,
+                                           flag_valid=None):
+    """
+    Compute the weighted percentiles of the values of each group (see header for the definition)
+
+    The group, the value (as the bits of a non-negative float32, which sort as the values) and the weight class of
+    each element are packed in a uint64 (group in the high bits), so a single sort (with no argsort) orders the
+    elements by group and value; the weights are then looked up from the weight class in the low bits
+
+    :param group_idcs: int array, from 0 to n_groups - 1
+    :param values: array of non-negative values (those not finite must be excluded with flag_valid)
+    :param weight_class_idcs: int array, index of the weight of each element in class_weights
+        (group_idcs, values and weight_class_idcs are broadcast together, e.g. (n_frames, 1), (n_frames, n_pixels)
+        and (n_pixels,))
+    :param class_weights: array of shape (n_classes,) of positive weights
+    :param n_groups: number of groups ((n_groups + 1) * 2^ceil(log2(n_classes)) must be <= 2^32)
+    :param list_percentiles: percentiles (from 0 to 100)
+    :param flag_valid: bool array with the broadcast shape, False for the elements to exclude (default: none)
+    :return: array of shape (n_groups, n_percentiles), nan for groups with no elements
+    """
+    n_class_bits = max(int(np.ceil(np.log2(len(class_weights)))), 1)
+    if int(np.ceil(np.log2(n_groups + 1))) + 32 + n_class_bits > 64:
+        sys.exit('ERROR in semantic_stats: too many groups ({}) for {} weight classes'.format(n_groups,
+                                                                                            len(class_weights)))
+
+    ### Sort the packed elements
+    packed = np.asarray(values, dtype=np.float32).view(np.uint32).astype(np.uint64) << np.uint64(n_class_bits)
+    packed |= np.asarray(group_idcs, dtype=np.uint64) << np.uint64(32 + n_class_bits)
+    packed |= np.asarray(weight_class_idcs, dtype=np.uint64)
+    packed = packed[flag_valid] if flag_valid is not None else packed.ravel()
+    if len(packed) == 0:
+        return np.full((n_groups, len(list_percentiles)), np.nan)
+    packed.sort()
+    cumulative_weights = np.cumsum(np.take(class_weights, packed & np.uint64((1 << n_class_bits) - 1)))
+
+    ### Per group: first element whose cumulative weight (from the group start) reaches each percentile
+    group_starts_packed = np.arange(n_groups + 1, dtype=np.uint64) << np.uint64(32 + n_class_bits)
+    idcs_group_start_end = np.searchsorted(packed, group_starts_packed, side='left')
+    idcs_group_start, idcs_group_end = idcs_group_start_end[:-1], idcs_group_start_end[1:]
+    cumulative_weights_with_0 = np.concatenate(([0], cumulative_weights))
+    weight_before_group = cumulative_weights_with_0[idcs_group_start]
+    group_weights = cumulative_weights_with_0[idcs_group_end] - weight_before_group
+    target_weights = weight_before_group[:, None] + group_weights[:, None] * np.asarray(list_percentiles)[None] / 100
+    idcs = np.searchsorted(cumulative_weights, target_weights, side='left')
+    idcs = np.clip(idcs, idcs_group_start[:, None], np.maximum(idcs_group_end - 1, idcs_group_start)[:, None])
+    # values of those elements, from their packed bits
+    percentiles_packed = packed[np.minimum(idcs, len(packed) - 1)]
+    percentiles = ((percentiles_packed >> np.uint64(n_class_bits)) & np.uint64(0xFFFFFFFF)).astype(np.uint32)\
+        .view(np.float32).astype(np.float64)
+    percentiles[idcs_group_end == idcs_group_start] = np.nan
+    return percentiles
+
+
+def compute_semantic_stats(object_index_stack,
+                           depth_stack,
+                           pixel_solid_angles,
+                           ray_table,
+                           n_object_indices,
+                           list_percentiles):
+    """
+    Compute the statistics in LIST_STATS_STR for a stack of frames (see header)
+
+    :param object_index_stack: int or float array of shape (n_frames, n_rows, n_cols), object index pass
+    :param depth_stack: array of shape (n_frames, n_rows, n_cols), depth pass
+    :param pixel_solid_angles: array of shape (n_rows, n_cols) (see get_pixel_solid_angles)
+    :param ray_table: array of shape (n_rows, n_cols, 3) (see ray_tables.compute_ray_table)
+    :param n_object_indices: number of object indices (max object index + 1)
+    :param list_percentiles: depth percentiles (from 0 to 100)
+    :return: stats dict, with an array of shape (n_frames, n_object_indices) per stat
+        (and (n_frames, n_object_indices, n_percentiles) for depth_percentiles)
+    """
+    n_frames = object_index_stack.shape[0]
+    object_index_stack = object_index_stack.reshape(n_frames, -1)
+    if not np.issubdtype(object_index_stack.dtype, np.integer):
+        object_index_stack = object_index_stack.astype(np.int32)
+    if object_index_stack.size and (object_index_stack.min() < 0 or object_index_stack.max() >= n_object_indices):
+        sys.exit('ERROR in semantic_stats: object indices out of the range 0-{}'.format(n_object_indices - 1))
+    pixel_solid_angles = pixel_solid_angles.ravel()
+    # pixels with no ray (outside the fisheye circle) have no solid angle
+    weighted_directions = np.nan_to_num(ray_table.reshape(-1, 3).astype(np.float64)).T * pixel_solid_angles
+
+    ### Solid angle and centroid direction (sums per frame and object)
+    pixel_count = np.zeros((n_frames, n_object_indices), dtype=np.int64)
+    solid_angle = np.zeros((n_frames, n_object_indices))
+    direction_sum = np.zeros((n_frames, n_object_indices, 3))
+    flag_pixel_with_ray = pixel_solid_angles > 0
+    flag_all_pixels_with_ray = np.all(flag_pixel_with_ray)
+    for i in range(n_frames):
+        object_index_frame = object_index_stack[i].astype(np.intp)
+        pixel_count[i] = np.bincount(object_index_frame if flag_all_pixels_with_ray
+                                     else object_index_frame[flag_pixel_with_ray], minlength=n_object_indices)
+        solid_angle[i] = np.bincount(object_index_frame, weights=pixel_solid_angles, minlength=n_object_indices)
+        for c in range(3):
+            direction_sum[i, :, c] = np.bincount(object_index_frame,
+                                                 weights=weighted_directions[c],
+                                                 minlength=n_object_indices)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_direction = direction_sum / solid_angle[..., None]
+    mean_resultant_length = np.linalg.norm(mean_direction, axis=-1)
+    with np.errstate(invalid='ignore'):
+        centroid_latitude = np.arcsin(np.clip(mean_direction[..., 1] / mean_resultant_length, -1, 1))
+    centroid_longitude = np.arctan2(-mean_direction[..., 0], -mean_direction[..., 2])
+    flag_not_in_frame = pixel_count == 0
+    solid_angle[flag_not_in_frame] = np.nan
+    for stat in (centroid_longitude, centroid_latitude, mean_resultant_length):
+        stat[flag_not_in_frame] = np.nan
+
+    ### Depth percentiles (one sort for the whole stack, in groups of frames that fit in the packed bits)
+    class_weights, pixel_weight_class_idcs = np.unique(pixel_solid_angles, return_inverse=True)
+    n_class_bits = max(int(np.ceil(np.log2(len(class_weights)))), 1)
+    n_frames_per_sort = max(((1 << (32 - n_class_bits)) - 1) // n_object_indices, 1)
+    depth_stack = depth_stack.reshape(n_frames, -1)
+    depth_percentiles = np.full((n_frames, n_object_indices, len(list_percentiles)), np.nan)
+    for idx_start in range(0, n_frames, n_frames_per_sort):
+        depth_block = np.asarray(depth_stack[idx_start:idx_start + n_frames_per_sort], dtype=np.float32)
+        n_frames_block = depth_block.shape[0]
+        with np.errstate(invalid='ignore'):
+            flag_valid = np.isfinite(depth_block) & (depth_block >= 0)
+        if not flag_all_pixels_with_ray:
+            flag_valid &= flag_pixel_with_ray
+        group_idcs = object_index_stack[idx_start:idx_start + n_frames_block].astype(np.uint64)
+        group_idcs += (np.arange(n_frames_block, dtype=np.uint64) * np.uint64(n_object_indices))[:, None]
+        percentiles = compute_weighted_percentiles_per_group(group_idcs,
+                                                             depth_block,
+                                                             pixel_weight_class_idcs,
+                                                             class_weights,
+                                                             n_frames_block * n_object_indices,
+                                                             list_percentiles,
+                                                             flag_valid)
+        depth_percentiles[idx_start:idx_start + n_frames_block] = percentiles.reshape(n_frames_block,
+                                                                                     n_object_indices,
+                                                                                     -1)
+
+    return {'pixel_count': pixel_count,
+            'solid_angle_in_sr': solid_angle,
+            'centroid_longitude_in_rad': centroid_longitude,
+            'centroid_latitude_in_rad': centroid_latitude,
+            'centroid_mean_resultant_length': mean_resultant_length,
+            'depth_percentiles': depth_percentiles}
+
+
+def get_frame_blocks_from_store(store_dict,
+                                n_frames_per_block):
+    """
+    Read the object index and depth of the frames written in a store, in blocks of frames
+
+    :param store_dict: see trial_store.open_trial_store
+    :param n_frames_per_block: number of frames per block (rounded up to a multiple of the store's frames per chunk)
+    :return: generator of (frames array, object index stack, depth stack)
+    """
+    frames_per_chunk = store_dict['chunk_shape'][0]
+    n_frames_per_block = -(-n_frames_per_block // frames_per_chunk) * frames_per_chunk
+    frame_start, frame_end = store_dict['frame_start_end']
+    for block_start in range(frame_start, frame_end + 1, n_frames_per_block):
+        block_end = min(block_start + n_frames_per_block - 1, frame_end)
+        flag_written = store_dict['frames_written'][block_start - frame_start:block_end - frame_start + 1]
+        if not np.any(flag_written):
+            continue
+        yield (np.arange(block_start, block_end + 1)[flag_written],
+               trial_store.read_array(store_dict, 'object_index', (block_start, block_end))[flag_written],
+               trial_store.read_array(store_dict, 'depth', (block_start, block_end))[flag_written])
+
+
+def get_frame_blocks_from_render_dir(render_output_dir_path,
+                                     n_frames_per_block,
+                                     n_threads=None):
+    """
+    Read the object index and depth of the EXR files of a render output dir, in blocks of frames
+
+    :param render_output_dir_path: path to render output dir (see trial_store.get_rendered_frames)
+    :param n_frames_per_block: number of frames per block
+    :param n_threads: see exr_reader.read_exr_channels
+    :return: generator of (frames array, object index stack, depth stack)
+    """
+    dict_frame_to_path = trial_store.get_rendered_frames(render_output_dir_path)
+    list_frames = sorted(dict_frame_to_path)
+    for idx_start in range(0, len(list_frames), n_frames_per_block):
+        list_block_frames = list_frames[idx_start:idx_start + n_frames_per_block]
+        list_passes_dicts = [exr_reader.read_exr_passes(dict_frame_to_path[frame], ('IndexOB', 'Depth'), n_threads)
+                             for frame in list_block_frames]
+        yield (np.array(list_block_frames),
+               np.stack([d['IndexOB'] for d in list_passes_dicts]),
+               np.stack([d['Depth'] for d in list_passes_dicts]))
+
+
+def compute_semantic_stats_for_frame_blocks(frame_blocks,
+                                            frame_start_end,
+                                            camera_projection_params_dict,
+                                            input_config):
+    """
+    Compute the statistics of a trial, one block of frames at a time
+
+    :param frame_blocks: iterable of (frames array, object index stack, depth stack), e.g. from
+        get_frame_blocks_from_store or get_frame_blocks_from_render_dir
+    :param frame_start_end: first and last frame of the trial
+    :param camera_projection_params_dict: see ray_tables.get_camera_projection_params
+    :param input_config: config (object indices and depth percentiles)
+    :return: stats dict, with 'frame', 'object_index' and 'depth_percentiles_list', and an array per stat
+        (see compute_semantic_stats) for all the frames from frame_start to frame_end (nan for frames not read)
+    """
+    pixel_solid_angles = get_pixel_solid_angles(camera_projection_params_dict)
+    ray_table = ray_tables.compute_ray_table(camera_projection_params_dict)
+    n_object_indices = max(input_config.list_indices_for_object_ID) + 1
+    list_percentiles = [float(p) for p in input_config.semantic_stats_depth_percentiles]
+    frames = np.arange(frame_start_end[0], frame_start_end[1] + 1)
+    stats_dict = {'frame': frames,
+                  'object_index': np.arange(n_object_indices),
+                  'depth_percentiles_list': np.array(list_percentiles),
+                  'pixel_count': np.zeros((len(frames), n_object_indices), dtype=np.int64),
+                  'depth_percentiles': np.full((len(frames), n_object_indices, len(list_percentiles)), np.nan,
+                                               dtype=np.float32)}
+    for stat_str in LIST_STATS_STR[1:-1]:
+        stats_dict[stat_str] = np.full((len(frames), n_object_indices), np.nan, dtype=np.float32)
+
+    for block_frames, object_index_stack, depth_stack in frame_blocks:
+        if object_index_stack.shape[1:] != pixel_solid_angles.shape:
+            sys.exit('ERROR in semantic_stats: image shape {} does not match the camera ({})'
+                     .format(object_index_stack.shape[1:], pixel_solid_angles.shape))
+        flag_in_trial = (block_frames >= frame_start_end[0]) & (block_frames <= frame_start_end[1])
+        block_stats_dict = compute_semantic_stats(object_index_stack[flag_in_trial],
+                                                  depth_stack[flag_in_trial],
+                                                  pixel_solid_angles,
+                                                  ray_table,
+                                                  n_object_indices,
+                                                  list_percentiles)
+        for stat_str in LIST_STATS_STR:
+            stats_dict[stat_str][block_frames[flag_in_trial] - frame_start_end[0]] = block_stats_dict[stat_str]
+    return stats_dict
+
+
+def save_semantic_stats(stats_dict,
+                        output_path):
+    """
+    Save the statistics of a trial as a compressed .npz file
+
+    :param stats_dict: see compute_semantic_stats_for_frame_blocks
+    :param output_path: path to the .npz file
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    np.savez_compressed(output_path,
+                        **stats_dict)
+
+
+if __name__ == '__main__':
+    # compute the statistics of a trial, from its store (see trial_store) or from its render output dir:
+    #     python semantic_stats.py <input json> <store path or render output dir> [<output .npz path>]
+    # (default output: <render_output_parent_dir_path>/<render_output_parent_dir_str>_semantic_stats.npz)
+    import time
+    import config
+
+    input_config = config.config(sys.argv[1])
+    t0 = time.perf_counter()
+    if os.path.isfile(os.path.join(sys.argv[2], trial_store.TRIAL_STORE_METADATA_FILENAME)):
+        store_dict = trial_store.open_trial_store(sys.argv[2])
+        stats_dict = compute_semantic_stats_for_frame_blocks(get_frame_blocks_from_store(store_dict,
+                                                                                         input_config.semantic_stats_frames_per_block),
+                                                             store_dict['frame_start_end'],
+                                                             store_dict['camera_projection_params'],
+                                                             input_config)
+    else:
+        stats_dict = compute_semantic_stats_for_frame_blocks(get_frame_blocks_from_render_dir(sys.argv[2],
+                                                                                              input_config.semantic_stats_frames_per_block),
+                                                             [int(f) for f in input_config.animation_frame_start_end],
+                                                             ray_tables.get_camera_projection_params(input_config),
+                                                             input_config)
+    output_path = sys.argv[3] if len(sys.argv) > 3 else \
+        os.path.join(input_config.render_output_parent_dir_path,
+                     input_config.render_output_parent_dir_str + '_semantic_stats.npz')
+    print('Semantic stats of {} frames in {:.1f} s'.format(int(np.sum(stats_dict['pixel_count'].sum(axis=1) > 0)),
+                                                           time.perf_counter() - t0))
+    save_semantic_stats(stats_dict,
+                        output_path)
+    print('    saved to {}'.format(output_path))
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+# Tests of the modules in 01_analysis (and of run_rendering.py), run with pytest from the repo root:
+#   python -m pytest -q
+# Modules that import bpy are tested against the stand-in in fake_bpy.py (Blender is not required)
+
+TESTS_DIR_PATH = os.path.dirname(os.path.abspath(__file__))
+ANALYSIS_DIR_PATH = os.path.dirname(TESTS_DIR_PATH)
+OBSTACLE_AVOIDANCE_DIR_PATH = os.path.dirname(ANALYSIS_DIR_PATH)
+
+for dir_path in [TESTS_DIR_PATH, ANALYSIS_DIR_PATH, OBSTACLE_AVOIDANCE_DIR_PATH]:
+    if dir_path not in sys.path:
+        sys.path.insert(0, dir_path)
+
+import fake_bpy  # noqa: E402 (after the sys.path insert)
+
+# modules that import bpy (imported again in each test that uses the fake bpy)
+LIST_MODULES_IMPORTING_BPY_STR = ['define_camera',
+                                  'define_geometry',
+                                  'scene_cache',
+                                  'render_timing',
+                                  'render_worker']
+
+
+@pytest.fixture
+def bpy(monkeypatch):
+    """
+    Fake bpy (and mathutils, bmesh) for this test, see fake_bpy.py
+    """
+    for module_str in LIST_MODULES_IMPORTING_BPY_STR:
+        monkeypatch.delitem(sys.modules, module_str, raising=False)
+    return fake_bpy.install(monkeypatch)
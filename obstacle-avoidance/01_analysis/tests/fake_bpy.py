@@ -0,0 +1,523 @@
+import collections
+import contextlib
+import json
+import os
+import sys
+import types
+
+import numpy as np
+
+# Recording stand-in for the parts of the Blender API (bpy, mathutils, bmesh) used by the modules in 01_analysis, to
+# test them outside Blender
+#
+# - install(monkeypatch) puts new bpy, mathutils and bmesh modules in sys.modules (removed after the test), and returns
+#   the bpy module. Each call to the API that changes the blend data, or is expensive in Blender (e.g. keyframe_insert,
+#   keyframe_points.add, render), is counted in bpy.calls (a collections.Counter)
+# - data blocks (objects, meshes, materials, lights, cameras, actions) are kept in bpy.data collections, with
+#   unique names as in Blender (e.g. 'Camera.001')
+# - keyframes are kept per F-curve as in Blender: coordinates as float32 (frame, value) pairs sorted by frame, and
+#   interpolation as enum values. keyframe_insert creates the action <object name>Action and its F-curves in the
+#   'Object Transforms' group, and inserts BEZIER keyframes
+# - bpy.ops.render.render(animation=True) runs the render handlers and writes an empty image per frame, at
+#   scene.render.frame_path(frame)
+# - mathutils only has containers (Vector, Quaternion, Euler), no maths: tests of maths against mathutils are skipped
+#   unless the real module is available (see test_camera_poses.py)
+
+KEYFRAME_INTERPOLATION_ENUM = {'CONSTANT': 0,
+                               'LINEAR': 1,
+                               'BEZIER': 2}
+
+BLENDER_VERSION_STR = '2.93.0'
+
+
+class AutoAttributes:
+    """
+    Settings with any attribute (e.g. scene.cycles, camera_data.cycles): attributes not set are created on first
+    access as nested AutoAttributes
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = AutoAttributes()
+        setattr(self, name, value)
+        return value
+
+
+class DataCollection:
+    """
+    bpy.data collection of data blocks (e.g. bpy.data.meshes), with unique names
+    """
+
+    def __init__(self, bpy, collection_str, data_block_class):
+        self.bpy = bpy
+        self.collection_str = collection_str
+        self.data_block_class = data_block_class
+        self.list_data_blocks = []
+
+    def get_unique_name(self, name):
+        list_names = [data_block.name for data_block in self.list_data_blocks]
+        unique_name, i = name, 0
+        while unique_name in list_names:
+            i += 1
+            unique_name = '{}.{:03d}'.format(name, i)
+        return unique_name
+
+    def add(self, data_block):
+        data_block.name = self.get_unique_name(data_block.name)
+        self.list_data_blocks.append(data_block)
+        return data_block
+
+    def new(self, name, *args, **kwargs):
+        self.bpy.calls[self.collection_str + '.new'] += 1
+        return self.add(self.data_block_class(self.bpy, name, *args, **kwargs))
+
+    def remove(self, data_block):
+        self.bpy.calls[self.collection_str + '.remove'] += 1
+        self.list_data_blocks.remove(data_block)
+        for scene_collection in [self.bpy.context.collection]:
+            if data_block in scene_collection.objects.list_objects:
+                scene_collection.objects.list_objects.remove(data_block)
+
+    def __iter__(self):
+        return iter(list(self.list_data_blocks))
+
+    def __len__(self):
+        return len(self.list_data_blocks)
+
+    def __getitem__(self, name):
+        for data_block in self.list_data_blocks:
+            if data_block.name == name:
+                return data_block
+        raise KeyError(name)
+
+
+class Mesh:
+    def __init__(self, bpy, name):
+        self.name = name
+        self.materials = []
+        self.vertices = []
+        self.polygons = []
+
+    def from_pydata(self, vertices, edges, faces):
+        self.vertices = [tuple(v) for v in vertices]
+        self.polygons = [tuple(f) for f in faces]
+
+    def update(self, calc_edges=False):
+        pass
+
+
+class Material:
+    def __init__(self, bpy, name):
+        self.name = name
+        self.diffuse_color = (0.8, 0.8, 0.8, 1.0)
+
+
+class Light:
+    def __init__(self, bpy, name, type):
+        self.name = name
+        self.type = type
+        self.use_nodes = False
+        self.cycles = AutoAttributes()
+        emission_node = types.SimpleNamespace(inputs={'Strength': types.SimpleNamespace(default_value=1.0)})
+        self.node_tree = types.SimpleNamespace(nodes={'Emission': emission_node})
+
+
+class Camera(AutoAttributes):
+    def __init__(self, bpy, name):
+        self.name = name
+        self.type = 'PERSP'
+
+
+class Object:
+    def __init__(self, bpy, name, object_data=None):
+        self.bpy = bpy
+        self.name = name
+        self.data = object_data
+        self.type = {Camera: 'CAMERA', Mesh: 'MESH', Light: 'LIGHT'}.get(type(object_data), 'EMPTY')
+        self.location = (0.0, 0.0, 0.0)
+        self.rotation_mode = 'XYZ'
+        self.rotation_euler = [0.0, 0.0, 0.0]
+        self.rotation_quaternion = (1.0, 0.0, 0.0, 0.0)
+        self.pass_index = 0
+        self.animation_data = None
+        self.use_fake_user = False
+        self.flag_selected = False
+
+    def select_set(self, state):
+        self.flag_selected = state
+
+    def animation_data_create(self):
+        self.bpy.calls['animation_data_create'] += 1
+        if self.animation_data is None:
+            self.animation_data = types.SimpleNamespace(action=None)
+        return self.animation_data
+
+    def keyframe_insert(self, data_path, frame):
+        """
+        Insert a BEZIER keyframe for each component of the property at data_path (as Blender's keyframe_insert)
+        """
+        self.bpy.calls['keyframe_insert'] += 1
+        if self.animation_data is None:
+            self.animation_data = types.SimpleNamespace(action=None)
+        if self.animation_data.action is None:
+            self.animation_data.action = self.bpy.data.actions.add(Action(self.bpy, self.name + 'Action'))
+        action = self.animation_data.action
+        for idx, value in enumerate(getattr(self, data_path)):
+            fcurve = action.fcurves.find(data_path, idx)
+            if fcurve is None:
+                fcurve = action.fcurves.add_fcurve(data_path, idx, 'Object Transforms')
+            fcurve.keyframe_points.insert_keyframe(frame, value)
+        return True
+
+
+class Keyframe:
+    """
+    View of a keyframe point (as iterated from fcurve.keyframe_points)
+    """
+
+    def __init__(self, keyframe_points, idx):
+        self.keyframe_points = keyframe_points
+        self.idx = idx
+
+    @property
+    def co(self):
+        return tuple(self.keyframe_points.co_array[self.idx])
+
+    @property
+    def interpolation(self):
+        enum_value = self.keyframe_points.interpolation_array[self.idx]
+        return [k for k, v in KEYFRAME_INTERPOLATION_ENUM.items() if v == enum_value][0]
+
+    @interpolation.setter
+    def interpolation(self, interpolation_str):
+        self.keyframe_points.bpy.calls['keyframe.interpolation'] += 1
+        self.keyframe_points.interpolation_array[self.idx] = KEYFRAME_INTERPOLATION_ENUM[interpolation_str]
+
+
+class KeyframePoints:
+    def __init__(self, bpy):
+        self.bpy = bpy
+        self.co_array = np.zeros((0, 2), dtype=np.float32)
+        self.interpolation_array = np.zeros(0, dtype=np.int32)
+
+    def add(self, count):
+        self.bpy.calls['keyframe_points.add'] += 1
+        self.co_array = np.concatenate((self.co_array, np.zeros((count, 2), dtype=np.float32)))
+        self.interpolation_array = np.concatenate((self.interpolation_array,
+                                                   np.full(count, KEYFRAME_INTERPOLATION_ENUM['BEZIER'], dtype=np.int32)))
+
+    def insert_keyframe(self, frame, value):
+        # (replaces the keyframe at this frame if any, and keeps keyframes sorted by frame)
+        idx = np.searchsorted(self.co_array[:, 0], np.float32(frame))
+        if idx < self.co_array.shape[0] and self.co_array[idx, 0] == np.float32(frame):
+            self.co_array[idx, 1] = value
+            return
+        self.co_array = np.insert(self.co_array, idx, np.array([frame, value], dtype=np.float32), axis=0)
+        self.interpolation_array = np.insert(self.interpolation_array, idx, KEYFRAME_INTERPOLATION_ENUM['BEZIER'])
+
+    def foreach_set(self, attribute_str, sequence):
+        self.bpy.calls['keyframe_points.foreach_set'] += 1
+        if attribute_str == 'co':
+            self.co_array[:] = np.asarray(sequence, dtype=np.float32).reshape(-1, 2)
+        elif attribute_str == 'interpolation':
+            # (as Blender, enum properties require their integer values)
+            sequence_array = np.asarray(sequence)
+            if not np.issubdtype(sequence_array.dtype, np.integer):
+                raise TypeError('foreach_set: interpolation requires an int sequence')
+            self.interpolation_array[:] = sequence_array
+        else:
+            raise AttributeError(attribute_str)
+
+    def foreach_get(self, attribute_str, sequence):
+        if attribute_str == 'co':
+            sequence[:] = self.co_array.ravel()
+        elif attribute_str == 'interpolation':
+            sequence[:] = self.interpolation_array
+        else:
+            raise AttributeError(attribute_str)
+
+    def __len__(self):
+        return self.co_array.shape[0]
+
+    def __iter__(self):
+        return iter([Keyframe(self, idx) for idx in range(len(self))])
+
+
+class FCurve:
+    def __init__(self, bpy, data_path, array_index, group_str):
+        self.bpy = bpy
+        self.data_path = data_path
+        self.array_index = array_index
+        self.group = types.SimpleNamespace(name=group_str) if group_str else None
+        self.keyframe_points = KeyframePoints(bpy)
+
+    def update(self):
+        self.bpy.calls['fcurve.update'] += 1
+        idx_sorted = np.argsort(self.keyframe_points.co_array[:, 0], kind='stable')
+        self.keyframe_points.co_array = self.keyframe_points.co_array[idx_sorted]
+        self.keyframe_points.interpolation_array = self.keyframe_points.interpolation_array[idx_sorted]
+
+
+class FCurves:
+    def __init__(self, bpy):
+        self.bpy = bpy
+        self.list_fcurves = []
+
+    def find(self, data_path, index=0):
+        for fcurve in self.list_fcurves:
+            if fcurve.data_path == data_path and fcurve.array_index == index:
+                return fcurve
+        return None
+
+    def add_fcurve(self, data_path, index, action_group):
+        fcurve = FCurve(self.bpy, data_path, index, action_group)
+        self.list_fcurves.append(fcurve)
+        return fcurve
+
+    def new(self, data_path, index=0, action_group=''):
+        self.bpy.calls['fcurves.new'] += 1
+        if self.find(data_path, index) is not None:
+            raise RuntimeError('F-Curve {}[{}] already exists in action'.format(data_path, index))
+        return self.add_fcurve(data_path, index, action_group)
+
+    def __iter__(self):
+        return iter(list(self.list_fcurves))
+
+    def __len__(self):
+        return len(self.list_fcurves)
+
+
+class Action:
+    def __init__(self, bpy, name):
+        self.name = name
+        self.fcurves = FCurves(bpy)
+
+
+class SceneObjects:
+    """
+    Objects linked to the scene collection
+    """
+
+    def __init__(self, bpy):
+        self.bpy = bpy
+        self.list_objects = []
+
+    def link(self, obj):
+        self.bpy.calls['collection.objects.link'] += 1
+        if obj in self.list_objects:
+            raise RuntimeError("Object '{}' already in collection".format(obj.name))
+        self.list_objects.append(obj)
+
+    def __iter__(self):
+        return iter(list(self.list_objects))
+
+    def __len__(self):
+        return len(self.list_objects)
+
+
+class Render(AutoAttributes):
+    def __init__(self):
+        self.filepath = '/tmp/'
+        self.use_file_extension = True
+        self.image_settings = AutoAttributes()
+        self.image_settings.file_format = 'PNG'
+
+    def frame_path(self, frame=None):
+        # (as Blender with '#' not in filepath: the frame number is appended, padded to 4 digits)
+        extension_str = {'OPEN_EXR_MULTILAYER': '.exr', 'OPEN_EXR': '.exr', 'JPEG': '.jpg'}.get(
+            self.image_settings.file_format, '.png')
+        return self.filepath + '{:04d}'.format(frame) + (extension_str if self.use_file_extension else '')
+
+
+class Scene:
+    def __init__(self, scene_collection):
+        self.name = 'Scene'
+        self.camera = None
+        self.frame_start = 1
+        self.frame_end = 250
+        self.frame_step = 1
+        self.frame_current = 1
+        self.render = Render()
+        self.cycles = AutoAttributes()
+        self.unit_settings = AutoAttributes()
+        self.view_layers = {'ViewLayer': AutoAttributes()}
+        self.scene_collection = scene_collection
+
+    @property
+    def objects(self):
+        return self.scene_collection.objects
+
+
+class Libraries:
+    """
+    bpy.data.libraries: .blend libraries are saved as json files with the names of their objects (loaded as empty
+    mesh objects)
+    """
+
+    def __init__(self, bpy):
+        self.bpy = bpy
+
+    def write(self, filepath, datablocks, fake_user=False):
+        self.bpy.calls['libraries.write'] += 1
+        with open(filepath, 'w') as f:
+            json.dump({'objects': sorted(data_block.name for data_block in datablocks)}, f)
+
+    @contextlib.contextmanager
+    def load(self, filepath, link=False):
+        self.bpy.calls['libraries.load'] += 1
+        try:
+            with open(filepath) as f:
+                list_object_names = json.load(f)['objects']
+        except ValueError:
+            raise OSError('Cannot read file {}'.format(filepath))
+        data_from = types.SimpleNamespace(objects=list_object_names)
+        data_to = types.SimpleNamespace(objects=[])
+        yield data_from, data_to
+        data_to.objects = [self.bpy.data.objects.add(Object(self.bpy, name, Mesh(self.bpy, name)))
+                           for name in data_to.objects]
+
+
+def make_ops(bpy):
+    """
+    bpy.ops operators used in 01_analysis
+    """
+
+    def primitive_cylinder_add(radius=1.0, depth=2.0, location=(0.0, 0.0, 0.0)):
+        bpy.calls['ops.mesh.primitive_cylinder_add'] += 1
+        cylinder_object = bpy.data.objects.add(Object(bpy, 'Cylinder', bpy.data.meshes.add(Mesh(bpy, 'Cylinder'))))
+        cylinder_object.location = tuple(location)
+        bpy.context.collection.objects.link(cylinder_object)
+        bpy.context.object = cylinder_object
+        return {'FINISHED'}
+
+    def origin_set(type='ORIGIN_GEOMETRY', center='MEDIAN'):
+        bpy.calls['ops.object.origin_set'] += 1
+        return {'FINISHED'}
+
+    def delete(context_override=None):
+        bpy.calls['ops.object.delete'] += 1
+        list_objects = (context_override or {}).get('selected_objects',
+                                                    [obj for obj in bpy.context.scene.objects if obj.flag_selected])
+        for obj in list(list_objects):
+            if obj in bpy.data.objects.list_data_blocks:
+                bpy.data.objects.list_data_blocks.remove(obj)
+            if obj in bpy.context.collection.objects.list_objects:
+                bpy.context.collection.objects.list_objects.remove(obj)
+        return {'FINISHED'}
+
+    def render(animation=False):
+        """
+        Render the frames of the scene, running the render handlers and writing an empty image per frame
+        """
+        bpy.calls['ops.render.render'] += 1
+        scene = bpy.context.scene
+        if scene.camera is None or scene.camera not in bpy.data.objects.list_data_blocks:
+            raise RuntimeError('Error: No camera found in scene "{}"'.format(scene.name))
+        list_frames = range(scene.frame_start, scene.frame_end + 1, scene.frame_step) if animation \
+            else [scene.frame_current]
+        for frame in list_frames:
+            scene.frame_current = frame
+            for handler in list(bpy.app.handlers.render_pre):
+                handler(scene)
+            for handler in list(bpy.app.handlers.render_post):
+                handler(scene)
+            image_path = scene.render.frame_path(frame=frame)
+            os.makedirs(os.path.dirname(image_path) or '.', exist_ok=True)
+            with open(image_path, 'wb'):
+                pass
+            bpy.calls['rendered_frames'] += 1
+            for handler in list(bpy.app.handlers.render_write):
+                handler(scene)
+        return {'FINISHED'}
+
+    return types.SimpleNamespace(mesh=types.SimpleNamespace(primitive_cylinder_add=primitive_cylinder_add),
+                                 object=types.SimpleNamespace(origin_set=origin_set,
+                                                              delete=delete),
+                                 render=types.SimpleNamespace(render=render))
+
+
+def make_bpy(flag_gpu_available=False):
+    """
+    New fake bpy module (with an empty scene)
+
+    :param flag_gpu_available: value returned by the Cycles preferences' has_active_device()
+    :return: bpy module
+    """
+    bpy = types.ModuleType('bpy')
+    bpy.calls = collections.Counter()
+
+    bpy.data = types.SimpleNamespace(filepath='',
+                                     libraries=Libraries(bpy))
+    for collection_str, data_block_class in [('objects', Object),
+                                             ('meshes', Mesh),
+                                             ('materials', Material),
+                                             ('lights', Light),
+                                             ('cameras', Camera),
+                                             ('actions', Action)]:
+        setattr(bpy.data, collection_str, DataCollection(bpy, collection_str, data_block_class))
+
+    scene_collection = types.SimpleNamespace(objects=SceneObjects(bpy))
+    cycles_preferences = types.SimpleNamespace(has_active_device=lambda: flag_gpu_available)
+    bpy.context = types.SimpleNamespace(scene=Scene(scene_collection),
+                                        collection=scene_collection,
+                                        object=None,
+                                        preferences=types.SimpleNamespace(addons={'cycles': types.SimpleNamespace(preferences=cycles_preferences)}))
+    bpy.context.copy = lambda: {'scene': bpy.context.scene,
+                                'selected_objects': [obj for obj in bpy.context.scene.objects if obj.flag_selected]}
+
+    bpy.ops = make_ops(bpy)
+    bpy.app = types.SimpleNamespace(version_string=BLENDER_VERSION_STR,
+                                    binary_path=os.path.join(os.sep, 'fake', 'blender'),
+                                    handlers=types.SimpleNamespace(render_pre=[],
+                                                                   render_post=[],
+                                                                   render_write=[]))
+
+    enum_items_dict = {k: types.SimpleNamespace(identifier=k, value=v) for k, v in KEYFRAME_INTERPOLATION_ENUM.items()}
+    interpolation_property = types.SimpleNamespace(enum_items=enum_items_dict)
+    bpy.types = types.SimpleNamespace(Keyframe=types.SimpleNamespace(
+        bl_rna=types.SimpleNamespace(properties={'interpolation': interpolation_property})))
+    return bpy
+
+
+def make_mathutils():
+    """
+    New fake mathutils module (containers only)
+    """
+    mathutils = types.ModuleType('mathutils')
+
+    class Vector(tuple):
+        def __new__(cls, seq):
+            return super().__new__(cls, (float(v) for v in seq))
+
+    class Quaternion(tuple):
+        def __new__(cls, seq=(1.0, 0.0, 0.0, 0.0)):
+            return super().__new__(cls, (float(v) for v in seq))
+
+    class Euler(tuple):
+        def __new__(cls, angles=(0.0, 0.0, 0.0), order='XYZ'):
+            euler = super().__new__(cls, (float(v) for v in angles))
+            euler.order = order
+            return euler
+
+    mathutils.Vector = Vector
+    mathutils.Quaternion = Quaternion
+    mathutils.Euler = Euler
+    return mathutils
+
+
+def install(monkeypatch,
+            flag_gpu_available=False):
+    """
+    Put new fake bpy, mathutils and bmesh modules in sys.modules for a test (with pytest's monkeypatch, so they are
+    removed after the test)
+
+    :param monkeypatch: pytest monkeypatch fixture
+    :param flag_gpu_available: value returned by the Cycles preferences' has_active_device()
+    :return: bpy module
+    """
+    bpy = make_bpy(flag_gpu_available)
+    monkeypatch.setitem(sys.modules, 'bpy', bpy)
+    monkeypatch.setitem(sys.modules, 'mathutils', make_mathutils())
+    monkeypatch.setitem(sys.modules, 'bmesh', types.ModuleType('bmesh'))
+    return bpy
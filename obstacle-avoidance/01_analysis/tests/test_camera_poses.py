@@ -0,0 +1,172 @@
+import math
+import types
+
+import numpy as np
+import pytest
+
+import camera_poses
+
+# Tests of the vectorised camera poses (camera_poses.py)
+# - numpy only: Hamilton product and frame to row index
+# - with mathutils (skipped if not available, e.g. outside Blender): comparison against the per-frame
+#   mathutils.Quaternion path that define_camera.insert_camera_keyframes used before camera_poses.py
+
+LIST_RF_STR = ['eyesRF', 'headRF', 'trajectoryRF', 'worldRF']
+
+
+def get_random_unit_quaternions(rng, n_quaternions):
+    quat_array = rng.normal(size=(n_quaternions, 4))
+    return quat_array / np.linalg.norm(quat_array, axis=1, keepdims=True)
+
+
+def get_transforms_dict_and_config(camera_tracks_RF_str,
+                                   flag_use_transform_interp=True):
+    """
+    Synthetic transforms data (with a missing frame and a repeated frame outside the animation) and the config
+    fields used by camera_poses.compute_camera_poses
+    """
+    rng = np.random.default_rng(0)
+    frames_array = np.concatenate((np.arange(90, 130), np.arange(131, 140), [135]))
+    n_rows = frames_array.shape[0]
+    transforms_dict = {'frame': frames_array,
+                       'transform_t_XYZ': rng.normal(scale=1000, size=(n_rows, 3)),
+                       'transform_t_interp_XYZ': rng.normal(scale=1000, size=(n_rows, 3)),
+                       'transform_q_WXYZ': get_random_unit_quaternions(rng, n_rows),
+                       'transform_q_interp_WXYZ': get_random_unit_quaternions(rng, n_rows)}
+    input_config = types.SimpleNamespace(
+        flag_camera_tracks_trajectoryRF=camera_tracks_RF_str == 'trajectoryRF',
+        flag_camera_tracks_headRF=camera_tracks_RF_str == 'headRF',
+        flag_camera_tracks_worldRF=camera_tracks_RF_str == 'worldRF',
+        transforms_csv_path_to_file='201124_Drogon16_{}_transforms.csv'.format(camera_tracks_RF_str),
+        eul_worldRF_to_cameraRF_rad=((-.5 * math.pi, math.pi, 0.0), 'XYZ'),
+        eyesRF_quat_dict={'201124_Drogon16': list(get_random_unit_quaternions(rng, 1)[0])},
+        date_bird_HP_pair_str='201124_Drogon16',
+        animation_frame_start_end=[95, 125],
+        flag_use_transform_interp=flag_use_transform_interp,
+        mm_to_m=1 / 1000)
+    return transforms_dict, input_config
+
+
+########################################################################################################################
+### numpy only
+def test_quaternion_multiply_hamilton_product():
+    # basis quaternions: i @ j = k, j @ i = -k, j @ k = i, k @ i = j, i @ i = -1
+    one, i, j, k = np.eye(4)
+    np.testing.assert_allclose(camera_poses.quaternion_multiply(i, j), k)
+    np.testing.assert_allclose(camera_poses.quaternion_multiply(j, i), -k)
+    np.testing.assert_allclose(camera_poses.quaternion_multiply(j, k), i)
+    np.testing.assert_allclose(camera_poses.quaternion_multiply(k, i), j)
+    np.testing.assert_allclose(camera_poses.quaternion_multiply(i, i), -one)
+    np.testing.assert_allclose(camera_poses.quaternion_multiply(one, j), j)
+
+
+def test_quaternion_multiply_composes_rotations():
+    # R(q1 @ q2) = R(q1) R(q2) (q2 is applied first), vectorised and broadcast against a single quaternion
+    rng = np.random.default_rng(1)
+    q1_array = get_random_unit_quaternions(rng, 10)
+    q2 = get_random_unit_quaternions(rng, 1)[0]
+    product_array = camera_poses.quaternion_multiply(q1_array, q2)
+    assert product_array.shape == (10, 4)
+    np.testing.assert_allclose(camera_poses.quaternion_to_rotation_matrix(product_array),
+                               camera_poses.quaternion_to_rotation_matrix(q1_array) @
+                               camera_poses.quaternion_to_rotation_matrix(q2),
+                               atol=1e-12)
+
+
+def test_euler_to_quaternion_global_axes():
+    # 'XYZ': first around Xglobal, then around Yglobal, so R = R_Y R_X
+    angle_x, angle_y = 0.3, -1.2
+    rot_x = np.array([[1, 0, 0],
+                      [0, math.cos(angle_x), -math.sin(angle_x)],
+                      [0, math.sin(angle_x), math.cos(angle_x)]])
+    rot_y = np.array([[math.cos(angle_y), 0, math.sin(angle_y)],
+                      [0, 1, 0],
+                      [-math.sin(angle_y), 0, math.cos(angle_y)]])
+    quat = camera_poses.euler_to_quaternion((angle_x, angle_y, 0.0), 'XYZ')
+    np.testing.assert_allclose(camera_poses.quaternion_to_rotation_matrix(quat), rot_y @ rot_x, atol=1e-12)
+
+
+def test_dense_frame_to_row_index_matches_np_where():
+    frames_array = np.array([7, 3, 4, 5, 5, 9, 12, 4, 2])
+    frame_start_end = [3, 10]
+    frame_to_row = camera_poses.get_dense_frame_to_row_index(frames_array, frame_start_end)
+
+    assert frame_to_row.shape == (8,)
+    for frame in range(frame_start_end[0], frame_start_end[1] + 1):
+        idx_rows = np.where(frames_array == frame)[0]
+        expected_row = idx_rows[0] if idx_rows.size else -1  # first row if repeated, -1 if missing
+        assert frame_to_row[frame - frame_start_end[0]] == expected_row
+
+
+def test_compute_camera_poses_missing_frame_exits():
+    transforms_dict, input_config = get_transforms_dict_and_config('eyesRF')
+    input_config.animation_frame_start_end = [125, 132]  # frame 130 is missing
+    with pytest.raises(SystemExit):
+        camera_poses.compute_camera_poses(transforms_dict, input_config)
+
+
+########################################################################################################################
+### against mathutils
+def compute_camera_poses_per_frame(mathutils, transforms_dict, input_config):
+    """
+    Per-frame camera poses with mathutils, as in define_camera.insert_camera_keyframes before camera_poses.py
+    """
+    quat_worldRF_to_cameraRF = mathutils.Euler(input_config.eul_worldRF_to_cameraRF_rad[0],
+                                               input_config.eul_worldRF_to_cameraRF_rad[1]).to_quaternion()
+    quat_from_headRF_t0_to_eyesRF = mathutils.Quaternion(input_config.eyesRF_quat_dict[input_config.date_bird_HP_pair_str])
+
+    list_locations, list_quaternions = [], []
+    for frame in range(input_config.animation_frame_start_end[0],
+                       input_config.animation_frame_start_end[1] + 1):
+        idx_frame = np.where(transforms_dict['frame'] == frame)[0][0]
+        if input_config.flag_use_transform_interp:
+            location = mathutils.Vector(transforms_dict['transform_t_interp_XYZ'][idx_frame] * input_config.mm_to_m)
+            quat_from_transforms_csv = mathutils.Quaternion(transforms_dict['transform_q_interp_WXYZ'][idx_frame])
+        else:
+            location = mathutils.Vector(transforms_dict['transform_t_XYZ'][idx_frame] * input_config.mm_to_m)
+            quat_from_transforms_csv = mathutils.Quaternion(transforms_dict['transform_q_WXYZ'][idx_frame])
+
+        if input_config.flag_camera_tracks_trajectoryRF or input_config.flag_camera_tracks_headRF:
+            rotation_quaternion = quat_from_transforms_csv @ quat_worldRF_to_cameraRF
+        elif input_config.flag_camera_tracks_worldRF:
+            rotation_quaternion = quat_worldRF_to_cameraRF
+        else:
+            rotation_quaternion = quat_from_transforms_csv @ quat_from_headRF_t0_to_eyesRF @ quat_worldRF_to_cameraRF
+
+        list_locations.append(tuple(location))
+        list_quaternions.append(tuple(rotation_quaternion))
+    return np.array(list_locations), np.array(list_quaternions)
+
+
+@pytest.mark.parametrize('flag_use_transform_interp', [True, False])
+@pytest.mark.parametrize('camera_tracks_RF_str', LIST_RF_STR)
+def test_compute_camera_poses_matches_mathutils(camera_tracks_RF_str, flag_use_transform_interp):
+    mathutils = pytest.importorskip('mathutils')
+    transforms_dict, input_config = get_transforms_dict_and_config(camera_tracks_RF_str,
+                                                                   flag_use_transform_interp)
+    camera_poses_dict = camera_poses.compute_camera_poses(transforms_dict, input_config)
+    location_array, quat_array = compute_camera_poses_per_frame(mathutils, transforms_dict, input_config)
+
+    np.testing.assert_array_equal(camera_poses_dict['frame'], np.arange(95, 126))
+    # mathutils is single precision
+    np.testing.assert_allclose(camera_poses_dict['location'], location_array, rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(camera_poses_dict['rotation_quaternion'], quat_array, atol=1e-6)
+
+
+@pytest.mark.parametrize('eul_order_str', ['XYZ', 'XZY', 'YXZ', 'YZX', 'ZXY', 'ZYX'])
+def test_euler_to_quaternion_matches_mathutils(eul_order_str):
+    mathutils = pytest.importorskip('mathutils')
+    eul_angles_in_rad = (-.5 * math.pi, math.pi, 0.3)
+    np.testing.assert_allclose(camera_poses.euler_to_quaternion(eul_angles_in_rad, eul_order_str),
+                               tuple(mathutils.Euler(eul_angles_in_rad, eul_order_str).to_quaternion()),
+                               atol=1e-6)
+
+
+def test_quaternion_multiply_matches_mathutils():
+    mathutils = pytest.importorskip('mathutils')
+    rng = np.random.default_rng(2)
+    q1_array = get_random_unit_quaternions(rng, 20)
+    q2_array = get_random_unit_quaternions(rng, 20)
+    expected_array = np.array([tuple(mathutils.Quaternion(q1) @ mathutils.Quaternion(q2))
+                               for q1, q2 in zip(q1_array, q2_array)])
+    np.testing.assert_allclose(camera_poses.quaternion_multiply(q1_array, q2_array), expected_array, atol=1e-6)
@@ -0,0 +1,109 @@
+import math
+import types
+
+import numpy as np
+import pytest
+
+# Tests of the camera keyframes (define_camera.insert_camera_keyframes), against the fake bpy (see fake_bpy.py):
+# the keyframes inserted in bulk (insert_keyframes_in_bulk) are compared to those inserted frame by frame
+
+N_FRAMES = 120
+
+
+def get_transforms_dict_and_config(interpolation_str,
+                                   flag_insert_keyframes_in_bulk):
+    rng = np.random.default_rng(0)
+    frames_array = np.arange(700, 700 + N_FRAMES)
+    quat_array = rng.normal(size=(N_FRAMES, 4))
+    quat_array /= np.linalg.norm(quat_array, axis=1, keepdims=True)
+    transforms_dict = {'frame': frames_array,
+                       'transform_t_interp_XYZ': rng.normal(scale=1000, size=(N_FRAMES, 3)),
+                       'transform_q_interp_WXYZ': quat_array}
+    input_config = types.SimpleNamespace(
+        flag_camera_tracks_trajectoryRF=False,
+        flag_camera_tracks_headRF=False,
+        flag_camera_tracks_worldRF=False,
+        transforms_csv_path_to_file='201124_Drogon16_headRF_transforms.csv',
+        eul_worldRF_to_cameraRF_rad=((-.5 * math.pi, math.pi, 0.0), 'XYZ'),
+        eyesRF_quat_dict={'201124_Drogon16': [0.5, 0.5, -0.5, 0.5]},
+        date_bird_HP_pair_str='201124_Drogon16',
+        animation_frame_start_end=[705, 705 + N_FRAMES - 11],
+        flag_use_transform_interp=True,
+        mm_to_m=1 / 1000,
+        flag_decimate_keyframes=False,
+        interpolation_between_keyframes=interpolation_str,
+        flag_insert_keyframes_in_bulk=flag_insert_keyframes_in_bulk)
+    return transforms_dict, input_config
+
+
+def insert_camera_keyframes(bpy, interpolation_str, flag_insert_keyframes_in_bulk):
+    """
+    Create a camera in the fake bpy and insert its keyframes
+
+    :return: camera_object, calls (Counter of bpy calls while inserting keyframes)
+    """
+    import define_camera
+    transforms_dict, input_config = get_transforms_dict_and_config(interpolation_str,
+                                                                   flag_insert_keyframes_in_bulk)
+    camera_object = bpy.data.objects.new('Camera', bpy.data.cameras.new('Camera'))
+    bpy.context.collection.objects.link(camera_object)
+    camera_object.rotation_mode = 'QUATERNION'
+
+    bpy.calls.clear()
+    define_camera.insert_camera_keyframes(camera_object,
+                                          transforms_dict,
+                                          input_config)
+    return camera_object, bpy.calls.copy()
+
+
+def get_fcurves_dict(camera_object):
+    """
+    Get dict with (data_path, array_index) as keys, and (group name, co array, interpolation array) as values
+    """
+    fcurves_dict = {}
+    for fcurve in camera_object.animation_data.action.fcurves:
+        n_keyframes = len(fcurve.keyframe_points)
+        co_array = np.empty(2 * n_keyframes, dtype=np.float32)
+        interpolation_array = np.empty(n_keyframes, dtype=np.int32)
+        fcurve.keyframe_points.foreach_get('co', co_array)
+        fcurve.keyframe_points.foreach_get('interpolation', interpolation_array)
+        fcurves_dict[(fcurve.data_path, fcurve.array_index)] = (fcurve.group.name, co_array, interpolation_array)
+    return fcurves_dict
+
+
+def test_insert_keyframes_in_bulk_api_calls(bpy):
+    camera_object, calls = insert_camera_keyframes(bpy, 'CONSTANT', True)
+    n_keyframes = N_FRAMES - 10
+
+    action = camera_object.animation_data.action
+    assert action.name == 'CameraAction'
+    assert len(action.fcurves) == 7
+    # one allocation of all the keyframe points per F-curve, and no per-frame calls
+    assert calls['fcurves.new'] == 7
+    assert calls['keyframe_points.add'] == 7
+    assert all(len(fcurve.keyframe_points) == n_keyframes for fcurve in action.fcurves)
+    assert calls['keyframe_insert'] == 0
+    assert calls['keyframe.interpolation'] == 0
+    assert calls['keyframe_points.foreach_set'] == 2 * 7
+    assert bpy.context.scene.camera is camera_object
+
+
+@pytest.mark.parametrize('interpolation_str', ['CONSTANT', 'LINEAR', 'BEZIER'])
+def test_insert_keyframes_in_bulk_matches_per_frame(bpy, interpolation_str):
+    camera_object_per_frame, calls_per_frame = insert_camera_keyframes(bpy, interpolation_str, False)
+    camera_object_in_bulk, calls_in_bulk = insert_camera_keyframes(bpy, interpolation_str, True)
+    assert calls_per_frame['keyframe_insert'] == 2 * (N_FRAMES - 10)
+
+    assert camera_object_in_bulk.animation_data.action.name == camera_object_in_bulk.name + 'Action'
+    fcurves_per_frame_dict = get_fcurves_dict(camera_object_per_frame)
+    fcurves_in_bulk_dict = get_fcurves_dict(camera_object_in_bulk)
+    assert sorted(fcurves_in_bulk_dict.keys()) == sorted(fcurves_per_frame_dict.keys())
+    for k, (group_str, co_array, interpolation_array) in fcurves_per_frame_dict.items():
+        assert fcurves_in_bulk_dict[k][0] == group_str
+        np.testing.assert_array_equal(fcurves_in_bulk_dict[k][1], co_array)
+        np.testing.assert_array_equal(fcurves_in_bulk_dict[k][2], interpolation_array)
+
+    # object left at the pose of the last keyframe in both cases
+    np.testing.assert_array_equal(camera_object_in_bulk.location, camera_object_per_frame.location)
+    np.testing.assert_array_equal(camera_object_in_bulk.rotation_quaternion,
+                                  camera_object_per_frame.rotation_quaternion)
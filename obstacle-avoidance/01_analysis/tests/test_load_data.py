@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+
+import load_data
+
+# Tests of the on-disk cache of parsed csv tables (load_data.load_csv_with_cache)
+
+
+def write_transforms_csv(tmp_path):
+    csv_path = tmp_path / 'transforms.csv'
+    with open(csv_path, 'w') as f:
+        f.write('frame,transform_t_X,transform_q_W\n')
+        for frame in range(700, 705):
+            f.write('{},{},{}\n'.format(frame, frame / 10, 'NaN' if frame == 702 else 1.0))
+    return str(csv_path)
+
+
+def csv_to_npy_files_keys_per_col_bulk_in_small_chunks(filename,
+                                                       n_header_rows_to_skip,
+                                                       dir_path):
+    return load_data.csv_to_npy_files_keys_per_col_bulk(filename,
+                                                        n_header_rows_to_skip,
+                                                        dir_path,
+                                                        n_rows_per_chunk=2)
+
+
+def test_cache_key_includes_cache_writer(tmp_path):
+    csv_path = write_transforms_csv(tmp_path)
+    cache_folder_path = str(tmp_path / 'cache')
+    loader = load_data.csv_to_dict_keys_per_col_bulk
+    writer = load_data.DICT_CSV_LOADER_TO_CACHE_WRITER[loader]
+
+    # the writer's source (and that of the functions it calls) is part of the key
+    assert load_data.get_loader_source_hash(loader) != load_data.get_loader_source_hash(loader, writer)
+    assert load_data.get_loader_source_hash(loader, writer) != \
+        load_data.get_loader_source_hash(loader, csv_to_npy_files_keys_per_col_bulk_in_small_chunks)
+
+    # so a table written by another writer is not served from the entry of the first one
+    list_entry_paths = []
+    for csv_to_cache_writer in [None, writer, csv_to_npy_files_keys_per_col_bulk_in_small_chunks]:
+        table_dict = load_data.load_csv_with_cache(loader, csv_path, [0], cache_folder_path,
+                                                   csv_to_cache_writer=csv_to_cache_writer)
+        np.testing.assert_array_equal(table_dict['frame'], np.arange(700, 705))
+        np.testing.assert_array_equal(table_dict['transform_t_X'], np.arange(700, 705) / 10)
+        assert np.isnan(table_dict['transform_q_W'][2])
+        list_entry_paths.append(load_data.get_cache_entry_path(cache_folder_path, loader, csv_path, [0],
+                                                               csv_to_cache_writer))
+    assert len(set(list_entry_paths)) == 3
+    assert sorted(os.listdir(cache_folder_path)) == sorted(os.path.basename(p) for p in list_entry_paths)
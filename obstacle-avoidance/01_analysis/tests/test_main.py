@@ -0,0 +1,170 @@
+import json
+import os
+import runpy
+import sys
+
+import pytest
+
+# Tests of main.py run as Blender would run it (blender --background --python main.py -- <json>), against the fake
+# bpy (see fake_bpy.py) and the input json and csv data of 201124_Drogon16 in 00_data
+
+ANALYSIS_DIR_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_PY_PATH = os.path.join(ANALYSIS_DIR_PATH, 'main.py')
+INPUT_JSON_PATH = os.path.join(os.path.dirname(ANALYSIS_DIR_PATH),
+                               '00_data', 'config_input_files', '201124_Drogon16_eyesRF.json')
+
+
+def write_input_json(tmp_path, json_filename='201124_Drogon16_eyesRF.json', **kwargs):
+    """
+    Copy of the input json of 201124_Drogon16, with the output and cache folders in tmp_path
+
+    :return: path to the json file
+    """
+    with open(INPUT_JSON_PATH) as f:
+        input_json_dict = json.load(f)
+    input_json_dict.update({'output_folder_path': str(tmp_path / 'output'),
+                            'data_cache_folder_path': str(tmp_path / 'cache'),
+                            **kwargs})
+    json_path = str(tmp_path / json_filename)
+    with open(json_path, 'w') as f:
+        json.dump(input_json_dict, f)
+    return json_path
+
+
+def run_main_py(monkeypatch, list_args):
+    """
+    Run main.py as a script, with the args after '--' in the Blender command line
+
+    :return: dict with the globals of main.py after running it
+    """
+    monkeypatch.chdir(ANALYSIS_DIR_PATH)  # (main.py changes the working dir to its modules path)
+    monkeypatch.setattr(sys, 'argv', ['blender', '--background', '--python', MAIN_PY_PATH, '--'] + list_args)
+    return runpy.run_path(MAIN_PY_PATH, run_name='__main__')
+
+
+def test_main_with_default_flags(bpy, monkeypatch, tmp_path):
+    json_path = write_input_json(tmp_path)
+    main_py_globals = run_main_py(monkeypatch, [json_path])
+
+    # run main again to get the config (the scene already has the environment, so only the camera is created again)
+    input_config, environment_key = main_py_globals['main'](json_path)
+    output_dir_path = input_config.render_output_parent_dir_path
+    assert os.path.dirname(os.path.dirname(output_dir_path)) == str(tmp_path / 'output')
+
+    # the config json has no excluded keys, but the config in memory still has them
+    with open(os.path.join(output_dir_path, input_config.render_output_parent_dir_str + '.json')) as f:
+        config_dict = json.load(f)
+    assert config_dict['trial_str'] == '201124_Drogon16'
+    assert input_config.keys_to_exclude_from_config_dict == ['frames_TO_L_frames_from_video_review_dict',
+                                                             'eyesRF_quat_dict']
+    for key_str in input_config.keys_to_exclude_from_config_dict:
+        assert key_str not in config_dict
+        assert key_str in vars(input_config)
+    assert '201124_Drogon16' in input_config.frames_TO_L_frames_from_video_review_dict
+
+    # render hashes json next to it (no profiling json by default, and no tmp files left)
+    assert sorted(os.listdir(output_dir_path)) == sorted([input_config.render_output_parent_dir_str + '.json',
+                                                          main_py_globals['render_dependencies'].RENDER_HASHES_FILENAME])
+
+    # one camera in the scene, with its keyframes
+    list_cameras = [obj for obj in bpy.context.scene.objects if obj.type == 'CAMERA']
+    assert len(list_cameras) == 1
+    assert bpy.context.scene.camera is list_cameras[0]
+    assert all(len(fcurve.keyframe_points) > 0 for fcurve in list_cameras[0].animation_data.action.fcurves)
+    assert environment_key is not None
+
+
+@pytest.mark.parametrize('flag_use_scene_cache', [None, True])
+def test_main_scene_cache_only_if_requested(bpy, monkeypatch, tmp_path, flag_use_scene_cache):
+    kwargs = {} if flag_use_scene_cache is None else {'flag_use_scene_cache': flag_use_scene_cache}
+    json_path = write_input_json(tmp_path, **kwargs)
+    run_main_py(monkeypatch, [json_path])
+
+    # off by default: the environment is built, and nothing is written to the scene cache
+    scene_cache_folder_path = tmp_path / 'cache' / 'scenes'
+    list_blend_filenames = [p.name for p in scene_cache_folder_path.glob('*.blend')]
+    assert bpy.calls['libraries.write'] == len(list_blend_filenames) == (1 if flag_use_scene_cache else 0)
+    assert any(obj.type == 'MESH' for obj in bpy.context.scene.objects)
+
+
+def test_main_worker_mode_two_jobs(bpy, monkeypatch, tmp_path):
+    # two jobs of the same trial (same environment) in one worker process: the second one only creates the camera
+    # and its keyframes again, and its config is read from its own json (the first job has a non-default resolution)
+    import render_queue
+    queue_dir_path = str(tmp_path / 'render_queue')
+    list_json_paths = [write_input_json(tmp_path, 'job_1.json',
+                                        render_output_parent_dir_str='201124_Drogon16_job_1',
+                                        render_resolution_percentage=25,
+                                        flag_save_profiling_as_json=True),
+                       write_input_json(tmp_path, 'job_2.json',
+                                        render_output_parent_dir_str='201124_Drogon16_job_2',
+                                        flag_save_profiling_as_json=True)]
+    for job_id, json_path, list_frame_ranges in zip(['job_1', 'job_2'], list_json_paths, [[[714, 716]], [[720, 721]]]):
+        render_queue.submit_job(queue_dir_path, job_id, json_path, list_frame_ranges)
+
+    run_main_py(monkeypatch, ['--queue_dir', queue_dir_path, '--worker_id', 'worker_test', '--idle_timeout', '0'])
+
+    list_job_dicts = render_queue.read_jobs(queue_dir_path, 'finished')
+    assert [(j['job_id'], j['status']) for j in list_job_dicts] == [('job_1', 'success'), ('job_2', 'success')]
+    assert [j['flag_environment_reused'] for j in list_job_dicts] == [False, True]
+    assert [[os.path.basename(p) for p in j['list_saved_paths']] for j in list_job_dicts] == \
+        [['0714.exr', '0715.exr', '0716.exr'], ['0720.exr', '0721.exr']]
+    assert [os.path.basename(j['render_output_dir_path']) for j in list_job_dicts] == ['201124_Drogon16_job_1',
+                                                                                       '201124_Drogon16_job_2']
+    # (no render times json by default)
+    assert not [fn for j in list_job_dicts for fn in os.listdir(j['render_output_dir_path']) if '_render_times' in fn]
+    assert bpy.app.handlers.render_pre == bpy.app.handlers.render_post == bpy.app.handlers.render_write == []
+
+    # only the camera and its keyframes were removed for the second job: the environment was built once
+    with open(os.path.join(list_job_dicts[1]['render_output_dir_path'], '201124_Drogon16_job_2_profiling.json')) as f:
+        list_stages_str = [stage_dict['stage'] for stage_dict in json.load(f)['stages']]
+    assert 'remove_camera_and_animation' in list_stages_str
+    assert 'create_environment' not in list_stages_str
+    assert bpy.calls['ops.object.delete'] == 1  # (clearing the empty scene before the first job)
+    assert bpy.calls['objects.remove'] == bpy.calls['cameras.remove'] == 1
+    assert bpy.calls['actions.remove'] == 1
+    assert bpy.calls['meshes.remove'] == bpy.calls['materials.remove'] == bpy.calls['lights.remove'] == 0
+    assert len(bpy.data.meshes) == bpy.calls['meshes.new'] + bpy.calls['ops.mesh.primitive_cylinder_add'] > 0
+
+    # the second job started from a clean scene (a single camera, with its keyframes only) and its own config
+    list_cameras = [obj for obj in bpy.context.scene.objects if obj.type == 'CAMERA']
+    assert len(list_cameras) == len(bpy.data.cameras) == len(bpy.data.actions) == 1
+    assert bpy.context.scene.camera is list_cameras[0]
+    with open(os.path.join(list_job_dicts[1]['render_output_dir_path'], '201124_Drogon16_job_2.json')) as f:
+        config_dict = json.load(f)
+    assert config_dict['render_output_parent_dir_str'] == '201124_Drogon16_job_2'
+    assert config_dict['render_resolution_percentage'] == 100
+    assert bpy.context.scene.render.resolution_percentage == 100
+
+
+@pytest.mark.parametrize('input_json_kwargs, expected_cpu_settings_source, expected_cpu_threads',
+                         [({}, 'default', 0),
+                          ({'flag_use_render_autotune': True}, 'render_autotune', 6),
+                          ({'flag_use_render_autotune': True, 'render_cpu_threads': 3}, 'input json', 3)])
+def test_main_saves_applied_render_settings(bpy, monkeypatch, tmp_path,
+                                            input_json_kwargs, expected_cpu_settings_source, expected_cpu_threads):
+    # autotuned settings for this machine in the cache: only used if the autotune is requested, and the CPU threads
+    # and tile size are not in the input json
+    import config
+    import render_autotune
+    json_path = write_input_json(tmp_path, **input_json_kwargs)
+    monkeypatch.chdir(ANALYSIS_DIR_PATH)
+    input_config = config.config(json_path)
+    render_autotune.save_autotuned_settings(input_config.render_autotune_file_path,
+                                            render_autotune.get_render_autotune_key(input_config),
+                                            {'render_cpu_threads': 6, 'render_cpu_tile_x_y_in_pixels': [32, 32]})
+
+    input_config, _ = run_main_py(monkeypatch, [json_path])['main'](json_path)
+    with open(os.path.join(input_config.render_output_parent_dir_path,
+                           input_config.render_output_parent_dir_str + '.json')) as f:
+        config_dict = json.load(f)
+
+    # no GPU in the fake bpy: rendered on CPU, with the threads and tile size of the config
+    assert config_dict['render_device'] == 'GPU'
+    assert config_dict['render_device_applied'] == 'CPU' == bpy.context.scene.cycles.device
+    assert config_dict['render_cpu_settings_source'] == expected_cpu_settings_source
+    assert config_dict['render_cpu_threads'] == expected_cpu_threads
+    assert bpy.context.scene.render.threads_mode == ('FIXED' if expected_cpu_threads else 'AUTO')
+    assert config_dict['render_cpu_tile_x_y_in_pixels'] == \
+        ([32, 32] if expected_cpu_settings_source == 'render_autotune' else [64, 64]) == \
+        [bpy.context.scene.render.tile_x, bpy.context.scene.render.tile_y]
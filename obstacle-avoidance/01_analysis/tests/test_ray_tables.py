@@ -0,0 +1,170 @@
+import types
+
+import numpy as np
+import pytest
+
+import ray_tables
+
+# Tests of the ray tables (ray_tables.py) on directions known from Cycles' EQUIRECTANGULAR and FISHEYE_EQUIDISTANT
+# projections (camera looking along -Z, with Y up and X to the right)
+
+
+def get_equirectangular_params(n_cols, n_rows, longitude_min_max_in_rad, latitude_min_max_in_rad):
+    return {'camera_panorama_type': 'EQUIRECTANGULAR', 'camera_shift_x_y': [0.0, 0.0], 'n_cols': n_cols, 'n_rows': n_rows,
+            'camera_longitude_min_max_in_rad': list(longitude_min_max_in_rad),
+            'camera_latitude_min_max_in_rad': list(latitude_min_max_in_rad)}
+
+
+def get_fisheye_params(n_cols, n_rows, fov_in_rad):
+    return {'camera_panorama_type': 'FISHEYE_EQUIDISTANT', 'camera_shift_x_y': [0.0, 0.0], 'n_cols': n_cols, 'n_rows': n_rows,
+            'camera_fisheye_equidistant_FOV_in_rad': fov_in_rad}
+
+
+def longitude_latitude_to_direction(longitude, latitude):
+    # longitude 0 is forward (-Z), positive longitude to the left (-X), positive latitude up (+Y)
+    return np.array([-np.cos(latitude) * np.sin(longitude), np.sin(latitude), -np.cos(latitude) * np.cos(longitude)])
+
+
+def get_config(**kwargs):
+    config_dict = dict(camera_panorama_type='EQUIRECTANGULAR',
+                       camera_shift_x_y=[0, 0],
+                       render_resolution_x_y_in_pixels=[1024, 512],
+                       render_resolution_percentage=50,
+                       camera_longitude_min_max_in_rad=[-np.pi, np.pi],
+                       camera_latitude_min_max_in_rad=[-np.pi / 2, np.pi / 2],
+                       camera_fisheye_equidistant_FOV_in_rad=np.pi)
+    config_dict.update(kwargs)
+    return types.SimpleNamespace(**config_dict)
+
+
+########################################################################################################################
+### EQUIRECTANGULAR
+@pytest.mark.parametrize('row, col', [(1, 3), (2, 4), (0, 0), (3, 7), (1, 1)])
+def test_equirectangular_full_sphere_pixel_centres(row, col):
+    # 8x4 pixels, so that pixel edges fall at multiples of 45 deg
+    ray_table = ray_tables.compute_ray_table(get_equirectangular_params(8, 4, [-np.pi, np.pi], [-np.pi / 2, np.pi / 2]))
+    longitude = np.pi - 2 * np.pi * (col + 0.5) / 8
+    latitude = np.pi / 2 - np.pi * (row + 0.5) / 4
+    assert ray_table.dtype == np.float32
+    np.testing.assert_allclose(ray_table[row, col], longitude_latitude_to_direction(longitude, latitude), atol=1e-6)
+
+
+@pytest.mark.parametrize('direction, list_expected_col_row', [([0, 0, -1], [(3.5, 1.5)]),     # forward: centre of the image
+                                                              ([-1, 0, 0], [(1.5, 1.5)]),     # left: quarter width
+                                                              ([1, 0, 0], [(5.5, 1.5)]),      # right: three quarters width
+                                                              ([0, 1, -1e-9], [(3.5, -0.5)]),  # up: top edge
+                                                              ([0, 0, 1], [(-0.5, 1.5), (7.5, 1.5)])])  # back: left or right edge
+def test_equirectangular_full_sphere_known_directions(direction, list_expected_col_row):
+    params_dict = get_equirectangular_params(8, 4, [-np.pi, np.pi], [-np.pi / 2, np.pi / 2])
+    col_row = ray_tables.get_pixel_coords_from_directions(np.array(direction, dtype=np.float64), params_dict)
+    assert any(np.allclose(col_row, expected_col_row, atol=1e-6) for expected_col_row in list_expected_col_row)
+
+
+def test_equirectangular_lat_long_bounds():
+    # asymmetric bounds: the left edge of the image is at longitude -longitude_min, the right edge at -longitude_max,
+    # the bottom edge at latitude_min and the top edge at latitude_max
+    longitude_min_max = [-np.pi / 2, np.pi]
+    latitude_min_max = [-0.5, 1.0]
+    n_cols, n_rows = 360, 120
+    params_dict = get_equirectangular_params(n_cols, n_rows, longitude_min_max, latitude_min_max)
+    ray_table = ray_tables.compute_ray_table(params_dict)
+
+    # pixel centres
+    for row, col in [(0, 0), (n_rows - 1, n_cols - 1), (60, 180), (17, 301)]:
+        u = (col + 0.5) / n_cols
+        v = 1 - (row + 0.5) / n_rows
+        longitude = -longitude_min_max[0] - (longitude_min_max[1] - longitude_min_max[0]) * u
+        latitude = latitude_min_max[0] + (latitude_min_max[1] - latitude_min_max[0]) * v
+        np.testing.assert_allclose(ray_table[row, col], longitude_latitude_to_direction(longitude, latitude), atol=1e-6)
+
+    # image edges
+    for longitude, latitude, expected_col_row in [(-longitude_min_max[0], 0.0, (-0.5, None)),
+                                                  (-longitude_min_max[1] + 1e-9, 0.0, (n_cols - 0.5, None)),
+                                                  (0.0, latitude_min_max[1], (None, -0.5)),
+                                                  (0.0, latitude_min_max[0], (None, n_rows - 0.5))]:
+        col_row = ray_tables.get_pixel_coords_from_directions(longitude_latitude_to_direction(longitude, latitude),
+                                                              params_dict)
+        for coord, expected_coord in zip(col_row, expected_col_row):
+            if expected_coord is not None:
+                assert coord == pytest.approx(expected_coord, abs=1e-6)
+
+    # a direction outside the longitude range is outside the image
+    col, row = ray_tables.get_pixel_coords_from_directions(longitude_latitude_to_direction(3 * np.pi / 4, 0.0),
+                                                           params_dict)
+    assert not -0.5 <= col <= n_cols - 0.5
+    assert ray_tables.get_n_cols_per_turn(params_dict) == pytest.approx(n_cols * 2 / 1.5)
+
+
+########################################################################################################################
+### FISHEYE_EQUIDISTANT
+def test_fisheye_known_directions():
+    # 180 deg FOV, 9x9 pixels
+    ray_table = ray_tables.compute_ray_table(get_fisheye_params(9, 9, np.pi))
+    np.testing.assert_allclose(ray_table[4, 4], [0, 0, -1], atol=1e-6)  # centre is forward
+    # pixel (4, 8): u = 17/18, v = 0.5 -> r = 8/9, 80 deg to the right of forward
+    theta = 8 / 9 * np.pi / 2
+    np.testing.assert_allclose(ray_table[4, 8], [np.sin(theta), 0, -np.cos(theta)], atol=1e-6)
+    np.testing.assert_allclose(ray_table[0, 4], [0, np.sin(theta), -np.cos(theta)], atol=1e-6)
+    np.testing.assert_allclose(ray_table[4, 0], [-np.sin(theta), 0, -np.cos(theta)], atol=1e-6)
+    assert np.all(np.isnan(ray_table[0, 0]))  # corner, outside the image circle
+
+
+@pytest.mark.parametrize('fov_in_rad', [np.pi, 277 * np.pi / 180])
+def test_fisheye_fov_bounds(fov_in_rad):
+    # directions at half the FOV from forward are on the edge of the image circle (r = 1)
+    n_cols, n_rows = 200, 100
+    params_dict = get_fisheye_params(n_cols, n_rows, fov_in_rad)
+    for phi in np.linspace(-np.pi, np.pi, 7):
+        theta = fov_in_rad / 2
+        direction = np.array([np.cos(phi) * np.sin(theta), np.sin(phi) * np.sin(theta), -np.cos(theta)])
+        col, row = ray_tables.get_pixel_coords_from_directions(direction, params_dict)
+        u, v = (col + 0.5) / n_cols, 1 - (row + 0.5) / n_rows
+        assert np.hypot(2 * u - 1, 2 * v - 1) == pytest.approx(1.0, abs=1e-6)
+    ray_table = ray_tables.compute_ray_table(params_dict)
+    theta_array = np.arccos(np.clip(-ray_table[..., 2], -1, 1))
+    assert np.nanmax(theta_array) <= fov_in_rad / 2 + 1e-6
+
+
+########################################################################################################################
+### Both
+@pytest.mark.parametrize('params_dict', [get_equirectangular_params(360, 120, [-np.pi / 2, np.pi], [-0.5, 1.0]),
+                                         get_fisheye_params(200, 100, 277 * np.pi / 180)],
+                         ids=['EQUIRECTANGULAR', 'FISHEYE_EQUIDISTANT'])
+def test_round_trip_pixel_direction_pixel(params_dict):
+    ray_table = ray_tables.compute_ray_table(params_dict)
+    col, row = ray_tables.get_pixel_coords_from_directions(ray_table, params_dict)
+    col_grid, row_grid = np.meshgrid(np.arange(params_dict['n_cols']), np.arange(params_dict['n_rows']))
+    mask = ~np.isnan(col)
+    assert mask.sum() > 0.5 * mask.size
+    np.testing.assert_allclose(col[mask], col_grid[mask], atol=1e-3)
+    np.testing.assert_allclose(row[mask], row_grid[mask], atol=1e-3)
+
+
+@pytest.mark.parametrize('camera_panorama_type', ['EQUIRECTANGULAR', 'FISHEYE_EQUIDISTANT'])
+def test_camera_projection_params_and_shift(camera_panorama_type):
+    params_dict = ray_tables.get_camera_projection_params(get_config(camera_panorama_type=camera_panorama_type))
+    assert params_dict['camera_shift_x_y'] == [0.0, 0.0]
+    assert (params_dict['n_cols'], params_dict['n_rows']) == (512, 256)
+    assert ('camera_longitude_min_max_in_rad' in params_dict) == (camera_panorama_type == 'EQUIRECTANGULAR')
+    assert ('camera_fisheye_equidistant_FOV_in_rad' in params_dict) == (camera_panorama_type == 'FISHEYE_EQUIDISTANT')
+
+    # a camera shift is not implemented for panoramic cameras
+    with pytest.raises(SystemExit):
+        ray_tables.get_camera_projection_params(get_config(camera_panorama_type=camera_panorama_type,
+                                                           camera_shift_x_y=[0.1, 0]))
+    with pytest.raises(SystemExit):
+        ray_tables.get_camera_projection_params(get_config(camera_panorama_type='MIRRORBALL'))
+
+
+def test_get_ray_table_cached_on_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(ray_tables, 'ray_tables_in_memory', type(ray_tables.ray_tables_in_memory)())
+    input_config = get_config(camera_longitude_min_max_in_rad=[-np.pi / 2, np.pi])
+    ray_table = ray_tables.get_ray_table(input_config, str(tmp_path))
+    key = ray_tables.get_ray_table_key(ray_tables.get_camera_projection_params(input_config))
+    assert sorted(p.name for p in tmp_path.iterdir()) == [key + '.json', key + '.npy']
+    assert not ray_table.flags.writeable
+    np.testing.assert_array_equal(ray_table,
+                                  ray_tables.compute_ray_table(ray_tables.get_camera_projection_params(input_config)))
+    # the same table from memory, and a new one for other lat/long bounds
+    assert ray_tables.get_ray_table(input_config, str(tmp_path)) is ray_table
+    assert ray_tables.get_ray_table(get_config(), str(tmp_path)) is not ray_table
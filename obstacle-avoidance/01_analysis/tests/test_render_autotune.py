@@ -0,0 +1,41 @@
+import json
+import os
+
+import pytest
+
+import render_autotune
+
+# Tests of the renders run by render_autotune (and benchmark_render_profiles), with the stub of the Blender executable
+# (bin/blender, see test_run_rendering.py)
+
+STUB_BLENDER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin', 'blender')
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='the stub Blender executable is a Python script with a shebang')
+
+
+def test_render_frames_with_settings_records_render_times(tmp_path):
+    # render times are off by default in config, so they are requested in the input json of each setting
+    input_json_path = str(tmp_path / '201124_Drogon16.json')
+    with open(input_json_path, 'w') as f:
+        json.dump({'trial_str': '201124_Drogon16',
+                   'output_folder_path': str(tmp_path / 'output'),
+                   'suggested_frame_range_for_cli_rendering_leg_1': [714.0, 719.0],
+                   'suggested_frame_range_for_cli_rendering_leg_2': [1922.0, 1925.0]}, f)
+
+    (tmp_path / 'autotune').mkdir()
+    render_output_dir_path = render_autotune.render_frames_with_settings(input_json_path,
+                                                                         'cpu_8_threads',
+                                                                         {'render_device': 'CPU',
+                                                                          'render_cpu_threads': 8},
+                                                                         '714..716',
+                                                                         str(tmp_path / 'autotune'),
+                                                                         STUB_BLENDER_PATH)
+
+    assert render_output_dir_path == str(tmp_path / 'autotune' / 'cpu_8_threads')
+    with open(tmp_path / 'autotune' / 'cpu_8_threads.json') as f:
+        settings_json_dict = json.load(f)
+    assert settings_json_dict['flag_save_render_times_as_json'] is True
+    assert settings_json_dict['render_cpu_threads'] == 8
+    assert settings_json_dict['render_output_parent_dir_str'] == 'cpu_8_threads'
+    with open(tmp_path / 'autotune' / 'cpu_8_threads_log.txt') as f:
+        assert f.read().count('Saved:') == 3
@@ -0,0 +1,216 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import run_rendering
+
+# Tests of the batch rendering script (run_rendering.py), with a stub of the Blender executable (bin/blender) that
+# prints the 'Saved:' lines of the frames it 'renders'
+
+STUB_BLENDER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin', 'blender')
+MAIN_PY_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='the stub Blender executable is a Python script with a shebang')
+
+
+def write_input_json(input_jsons_dir_path, output_folder_path, trial_str, **kwargs):
+    input_json_dict = {'trial_str': trial_str,
+                       'render_output_suffix': 'TEST',
+                       'output_folder_path': str(output_folder_path),
+                       'suggested_frame_range_for_cli_rendering_leg_1': [714.0, 719.0],
+                       'suggested_frame_range_for_cli_rendering_leg_2': [1922.0, 1925.0],
+                       **kwargs}
+    os.makedirs(input_jsons_dir_path, exist_ok=True)
+    json_path = os.path.join(input_jsons_dir_path, trial_str + '.json')
+    with open(json_path, 'w') as f:
+        json.dump(input_json_dict, f)
+    return json_path
+
+
+def get_job_dict(tmp_path, job_id, list_frame_ranges, **kwargs):
+    json_path = write_input_json(tmp_path / 'input_jsons', tmp_path / 'output', job_id,
+                                 render_output_parent_dir_str=job_id + '_TEST', **kwargs)
+    return {'job_id': job_id,
+            'json_path': json_path,
+            'list_frame_ranges': list_frame_ranges,
+            'cmd': run_rendering.get_blender_command(STUB_BLENDER_PATH, MAIN_PY_PATH, json_path, list_frame_ranges),
+            'log_path': str(tmp_path / ('LOG_' + job_id + '.txt'))}
+
+
+def test_get_blender_command():
+    assert run_rendering.get_blender_command('blender', 'main.py', 'trial.json', [[714, 1145], [1922, 2303]]) == \
+        ['blender', '--background', '--python', 'main.py', '--render-frame', '714..1145,1922..2303', '--', 'trial.json']
+    assert run_rendering.get_blender_command('blender', 'main.py', 'trial.json') == \
+        ['blender', '--background', '--python', 'main.py', '--render-anim', '--', 'trial.json']
+    assert run_rendering.get_blender_command('blender', 'main.py', 'trial.json', [[714, 720]], 'shard01') == \
+        ['blender', '--background', '--python', 'main.py', '--render-frame', '714..720', '--', 'trial.json',
+         '--shard_id', 'shard01']
+
+
+def test_saved_line_regexp():
+    list_lines = ["Saved: '/data/output/Drogon16_TEST/0714.exr'\n",
+                  " Saved: 'D:\\EXPTS NOV 2018\\02_output\\Drogon16 TEST\\0714.jpg'\n",
+                  "Fra:714 Mem:12.00M | Rendering 1 / 1 samples\n",
+                  "Saved: \n"]
+    list_paths = [m.group('path') for m in map(run_rendering.SAVED_LINE_REGEXP.search, list_lines) if m]
+    assert list_paths == ['/data/output/Drogon16_TEST/0714.exr',
+                          'D:\\EXPTS NOV 2018\\02_output\\Drogon16 TEST\\0714.jpg']
+
+
+def test_run_job_parses_saved_lines_and_writes_manifest(tmp_path):
+    job_dict = get_job_dict(tmp_path, '201124_Drogon16', [[714, 716], [720, 720]])
+    job_result_dict = run_rendering.run_job(job_dict, n_retries=0)
+
+    output_dir_path = str(tmp_path / 'output' / '201124_Drogon16_TEST')
+    assert job_result_dict['status'] == 'success'
+    assert job_result_dict['output_dir_path'] == output_dir_path
+    assert job_result_dict['list_saved_paths'] == [os.path.join(output_dir_path, '{:04d}.exr'.format(f))
+                                                   for f in [714, 715, 716, 720]]
+    assert [a['return_code'] for a in job_result_dict['attempts']] == [0]
+
+    manifest_dict = run_rendering.read_render_manifest(output_dir_path)
+    assert sorted(manifest_dict.keys()) == ['0714.exr', '0715.exr', '0716.exr', '0720.exr']
+    for filename, manifest_entry in manifest_dict.items():
+        file_path = os.path.join(output_dir_path, filename)
+        assert manifest_entry['frame'] == int(filename[:4])
+        assert manifest_entry['size_in_bytes'] == os.path.getsize(file_path)
+        assert manifest_entry['sha256'] == run_rendering.compute_file_sha256(file_path)
+    assert run_rendering.get_frames_to_render([[714, 716], [720, 721]], output_dir_path) == ([721], 0)
+
+
+@pytest.mark.parametrize('n_retries, expected_status', [(1, 'success'), (0, 'failed')])
+def test_run_job_retries_after_non_zero_exit(tmp_path, n_retries, expected_status):
+    job_dict = get_job_dict(tmp_path, '201124_Drogon16', [[714, 715]], stub_blender_n_failed_attempts=1)
+    job_result_dict = run_rendering.run_job(job_dict, n_retries=n_retries)
+
+    assert job_result_dict['status'] == expected_status
+    assert [a['return_code'] for a in job_result_dict['attempts']] == [1, 0][:n_retries + 1]
+    with open(job_dict['log_path']) as f:
+        log_str = f.read()
+    # the output of every attempt is kept in the log
+    assert log_str.count('##### Attempt') == n_retries + 1
+    assert 'Error: stub failure (attempt 1)' in log_str
+
+
+def test_run_jobs_concurrently_with_streamed_logs(tmp_path):
+    n_jobs = 3
+    started_dir_path = tmp_path / 'started'
+    started_dir_path.mkdir()
+    release_path = tmp_path / 'release'
+    list_job_dicts = [get_job_dict(tmp_path, '201124_Drogon{}'.format(i), [[714 + i, 716 + i]],
+                                   stub_blender_started_dir=str(started_dir_path),
+                                   stub_blender_release_path=str(release_path))
+                      for i in range(n_jobs)]
+
+    list_results = []
+    thread = threading.Thread(target=lambda: list_results.extend(run_rendering.run_jobs(list_job_dicts,
+                                                                                        n_workers=n_jobs,
+                                                                                        n_retries=0)))
+    thread.start()
+    try:
+        # all the jobs run at the same time, and the first saved frame of each is in its log while they wait
+        start_time = time.time()
+        while len(os.listdir(started_dir_path)) < n_jobs and time.time() - start_time < 20:
+            time.sleep(0.05)
+        assert len(os.listdir(started_dir_path)) == n_jobs
+        for i, job_dict in enumerate(list_job_dicts):
+            expected_line = "Saved: '{}'".format(os.path.join(str(tmp_path / 'output'),
+                                                              '201124_Drogon{}_TEST'.format(i),
+                                                              '{:04d}.exr'.format(714 + i)))
+            log_str = ''
+            while expected_line not in log_str and time.time() - start_time < 20:
+                time.sleep(0.05)
+                with open(job_dict['log_path']) as f:
+                    log_str = f.read()
+            assert expected_line in log_str
+            assert 'Blender quit' not in log_str
+        assert thread.is_alive()
+    finally:
+        release_path.touch()
+        thread.join(timeout=30)
+
+    assert [r['job_id'] for r in list_results] == [j['job_id'] for j in list_job_dicts]
+    assert all(r['status'] == 'success' and len(r['list_saved_paths']) == 3 for r in list_results)
+    for job_dict in list_job_dicts:
+        with open(job_dict['log_path']) as f:
+            assert f.read().rstrip().endswith('Blender quit')
+
+
+def test_main_summary_and_manifest(tmp_path):
+    input_jsons_dir_path = tmp_path / 'input_jsons'
+    for trial_str in ['201124_Drogon16', '201124_Drogon17']:
+        write_input_json(input_jsons_dir_path, tmp_path / 'output', trial_str)
+    write_input_json(input_jsons_dir_path, tmp_path / 'output', 'template_dict_201124')
+    logs_dir_path = tmp_path / 'logs'
+
+    return_code = run_rendering.main(['-p', MAIN_PY_PATH,
+                                      '-j', str(input_jsons_dir_path),
+                                      '-l', str(logs_dir_path),
+                                      '-w', '2',
+                                      '-k', '2',
+                                      '--blender', STUB_BLENDER_PATH])
+    assert return_code == 0
+
+    with open(logs_dir_path / 'batch_rendering_summary.json') as f:
+        summary_dict = json.load(f)
+    assert summary_dict['n_trials'] == 2
+    assert summary_dict['n_successful_trials'] == 2
+    assert summary_dict['n_jobs'] == 4
+    assert summary_dict['n_successful_jobs'] == 4
+    assert [os.path.basename(p) for p in summary_dict['skipped_json_paths']] == ['template_dict_201124.json']
+    assert summary_dict['settings']['n_shards_per_trial'] == 2
+    assert [j['job_id'] for j in summary_dict['jobs']] == ['201124_Drogon16_shard00', '201124_Drogon16_shard01',
+                                                            '201124_Drogon17_shard00', '201124_Drogon17_shard01']
+    assert [j['cmd'][-2:] for j in summary_dict['jobs'][0:2]] == [['--shard_id', 'shard00'], ['--shard_id', 'shard01']]
+    # (10 frames split in 2 chunks: the second one spans both legs)
+    assert [j['list_frame_ranges'] for j in summary_dict['jobs'][0:2]] == [[[714, 718]], [[719, 719], [1922, 1925]]]
+
+    list_frames = list(range(714, 720)) + list(range(1922, 1926))
+    for trial_result_dict in summary_dict['trials']:
+        output_dir_path = trial_result_dict['render_output_dir_path']
+        assert trial_result_dict['status'] == 'success'
+        assert trial_result_dict['output_dir_path'] == output_dir_path
+        assert os.path.dirname(output_dir_path) == str(tmp_path / 'output')
+        assert trial_result_dict['frames_check'] == {'.exr': {'missing_frames': [],
+                                                              'duplicated_frames': [],
+                                                              'unexpected_frames': []}}
+        # one manifest entry per frame, matching the files on disk
+        manifest_dict = run_rendering.read_render_manifest(output_dir_path)
+        assert sorted(e['frame'] for e in manifest_dict.values()) == list_frames
+        for filename, manifest_entry in manifest_dict.items():
+            assert manifest_entry['sha256'] == run_rendering.compute_file_sha256(os.path.join(output_dir_path, filename))
+        assert run_rendering.get_frames_to_render(trial_result_dict['list_frame_ranges'], output_dir_path) == ([], 0)
+
+
+def test_incremental_failure_only_affects_its_trial(tmp_path, monkeypatch):
+    # the render dependencies of the first trial fail (all its frames are rendered), those of the second one link its
+    # leg 1 frames from a previous render (only leg 2 is rendered)
+    list_json_paths = [write_input_json(tmp_path / 'input_jsons', tmp_path / 'output', trial_str,
+                                        render_output_parent_dir_str=trial_str + '_TEST')
+                       for trial_str in ['201124_Drogon16', '201124_Drogon17']]
+    list_frames_leg_1 = list(range(714, 720))
+
+    def run_render_dependencies(json_path, python_script_path, result_json_path, link_mode='hardlink'):
+        if os.path.basename(json_path).startswith('201124_Drogon16'):
+            return None
+        output_dir_path = str(tmp_path / 'output' / '201124_Drogon17_TEST')
+        os.makedirs(output_dir_path, exist_ok=True)
+        for frame in list_frames_leg_1:
+            saved_path = os.path.join(output_dir_path, '{:04d}.exr'.format(frame))
+            with open(saved_path, 'wb') as f:
+                f.write(b'linked')
+            run_rendering.append_to_render_manifest(saved_path)
+        return {'frames': list_frames_leg_1 + list(range(1922, 1926)),
+                'frames_carried_forward': list_frames_leg_1}
+
+    monkeypatch.setattr(run_rendering, 'run_render_dependencies', run_render_dependencies)
+    list_trial_dicts = run_rendering.get_list_of_trials(list_json_paths, MAIN_PY_PATH, STUB_BLENDER_PATH,
+                                                        str(tmp_path / 'logs'), False, 1, '202610171200',
+                                                        flag_incremental=True)
+
+    assert [t['n_frames_carried_forward'] for t in list_trial_dicts] == [0, 6]
+    assert [t['list_frame_ranges_to_render'] for t in list_trial_dicts] == [[[714, 719], [1922, 1925]],
+                                                                            [[1922, 1925]]]
@@ -0,0 +1,436 @@
+import glob
+import json
+import os
+import re
+import sys
+import tempfile
+import zlib
+import numpy as np
+import exr_reader
+import ray_tables
+from render_manifest import RENDER_MANIFEST_FILENAME, read_render_manifest
+
+# Per-trial store of the rendered passes (depth, object index and flow), as chunked and compressed arrays of shape
+# (n_frames, n_rows, n_cols[, n_channels]), so that analyses across time do not need to open one EXR file per frame
+#
+# Store layout (a folder):
+# - store.json: image shape, frame range, chunk shape, camera projection params and dtype of each array
+# - frames_written.npy: bool per frame of the frame range, True once the frame is written
+# - one folder per array, with one file per chunk ('<frame chunk>.<row chunk>.<col chunk>'), with the zlib-compressed
+#   bytes of the chunk, shuffled so that the i-th bytes of all values are together (for float16 depth and flow,
+#   this compresses ~3x better and ~2x faster than the plain bytes). Chunks span trial_store_frames_per_chunk frames
+#   and square tiles of trial_store_tile_size_in_pixels pixels (chunks at the edges are padded). Chunks not written
+#   yet read as the fill value of the array (nan, or 0 for integer arrays)
+#
+# Frames can be added in any order and at any time (e.g. as they finish rendering, see consolidate_trial_renders):
+# each chunk file is replaced atomically (written to a tmp file and renamed), so readers never see partial chunks.
+# A store has a single writer at a time (e.g. the consolidation of the trial, run periodically while rendering).
+#
+# Reads only decompress the chunks that overlap the requested frames, rows and cols. Windows in longitude and
+# latitude (camera RF, as in ray_tables and optic_flow) are mapped to the rows and cols of the pixels whose rays are
+# in the window.
+
+TRIAL_STORE_VERSION = 1
+TRIAL_STORE_METADATA_FILENAME = 'store.json'
+TRIAL_STORE_FRAMES_WRITTEN_FILENAME = 'frames_written.npy'
+
+# rendered passes in the store, and the EXR pass they are read from (see exr_reader.read_exr_passes)
+DICT_ARRAY_STR_TO_EXR_PASS_STR = {'depth': 'Depth',
+                                  'object_index': 'IndexOB',
+                                  'flow': 'Vector'}
+
+
+def write_file_atomically(file_path,
+                          data_bytes):
+    """
+    Write a file to a tmp file in the same folder and rename it, so that other processes never read a partial file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path),
+                                    prefix='.tmp_' + os.path.basename(file_path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data_bytes)
+    os.replace(tmp_path, file_path)
+
+
+def create_trial_store(store_path,
+                       image_shape,
+                       frame_start_end,
+                       dict_array_str_to_n_channels,
+                       input_config):
+    """
+    Create an empty store, or open it if it already exists with the same metadata (to add more frames)
+
+    :param store_path: path to the store folder
+    :param image_shape: (n_rows, n_cols)
+    :param frame_start_end: first and last frame of the store (e.g. animation_frame_start_end)
+    :param dict_array_str_to_n_channels: number of channels per array (None for single channel arrays, e.g.
+        {'depth': None, 'object_index': None, 'flow': 4})
+    :param input_config: config (chunk shape, dtypes and camera projection params)
+    :return: store_dict (see open_trial_store)
+    """
+    metadata_dict = {'store_version': TRIAL_STORE_VERSION,
+                     'image_shape': [int(x) for x in image_shape],
+                     'frame_start_end': [int(x) for x in frame_start_end],
+                     'chunk_shape': [int(input_config.trial_store_frames_per_chunk),
+                                     int(input_config.trial_store_tile_size_in_pixels),
+                                     int(input_config.trial_store_tile_size_in_pixels)],
+                     'camera_projection_params': ray_tables.get_camera_projection_params(input_config),
+                     'arrays': {array_str: {'dtype': input_config.trial_store_dtypes_dict[array_str],
+                                            'n_channels': n_channels}
+                                for array_str, n_channels in dict_array_str_to_n_channels.items()}}
+
+    metadata_path = os.path.join(store_path, TRIAL_STORE_METADATA_FILENAME)
+    if os.path.isfile(metadata_path):
+        with open(metadata_path) as f:
+            existing_metadata_dict = json.load(f)
+        if existing_metadata_dict != json.loads(json.dumps(metadata_dict)):
+            sys.exit('ERROR in trial_store: a store with different params exists in {}'.format(store_path))
+        return open_trial_store(store_path)
+
+    for array_str in metadata_dict['arrays']:
+        os.makedirs(os.path.join(store_path, array_str), exist_ok=True)
+    n_frames = frame_start_end[1] - frame_start_end[0] + 1
+    with open(os.path.join(store_path, TRIAL_STORE_FRAMES_WRITTEN_FILENAME), 'wb') as f:
+        np.save(f, np.zeros(n_frames, dtype=bool))
+    write_file_atomically(metadata_path,
+                          json.dumps(metadata_dict, indent=4).encode('utf-8'))
+    return open_trial_store(store_path)
+
+
+def open_trial_store(store_path):
+    """
+    Open a store
+
+    :param store_path: path to the store folder
+    :return: store_dict: the metadata in store.json (see header), with 'store_path' and 'frames_written'
+    """
+    metadata_path = os.path.join(store_path, TRIAL_STORE_METADATA_FILENAME)
+    if not os.path.isfile(metadata_path):
+        sys.exit('ERROR in trial_store: no store in {}'.format(store_path))
+    with open(metadata_path) as f:
+        store_dict = json.load(f)
+    if store_dict['store_version'] != TRIAL_STORE_VERSION:
+        sys.exit('ERROR in trial_store: store version {} in {} (expected {})'.format(store_dict['store_version'],
+                                                                                    store_path,
+                                                                                    TRIAL_STORE_VERSION))
+    store_dict['store_path'] = store_path
+    store_dict['frames_written'] = np.load(os.path.join(store_path, TRIAL_STORE_FRAMES_WRITTEN_FILENAME))
+    return store_dict
+
+
+def get_chunk_shape_and_fill_value(store_dict,
+                                   array_str):
+    """
+    Get the shape of the chunks of an array, its dtype and fill value
+    """
+    array_dict = store_dict['arrays'][array_str]
+    dtype = np.dtype(array_dict['dtype'])
+    chunk_shape = tuple(store_dict['chunk_shape']) + ((array_dict['n_channels'],) if array_dict['n_channels'] else ())
+    fill_value = np.nan if np.issubdtype(dtype, np.floating) else 0
+    return chunk_shape, dtype, fill_value
+
+
+def read_chunk(store_dict,
+               array_str,
+               chunk_idx):
+    """
+    Read a chunk (or get it filled with the fill value if it has not been written)
+
+    :param chunk_idx: (frame chunk, row chunk, col chunk)
+    :return: array with the chunk shape (see get_chunk_shape_and_fill_value)
+    """
+    chunk_shape, dtype, fill_value = get_chunk_shape_and_fill_value(store_dict, array_str)
+    chunk_path = os.path.join(store_dict['store_path'], array_str, '{}.{}.{}'.format(*chunk_idx))
+    if not os.path.isfile(chunk_path):
+        return np.full(chunk_shape, fill_value, dtype=dtype)
+    with open(chunk_path, 'rb') as f:
+        shuffled_bytes = np.frombuffer(zlib.decompress(f.read()), dtype=np.uint8)
+    return np.ascontiguousarray(shuffled_bytes.reshape(dtype.itemsize, -1).T).view(dtype).reshape(chunk_shape)
+
+
+def write_chunk(store_dict,
+                array_str,
+                chunk_idx,
+                chunk_array,
+                zlib_level=6):
+    """
+    Write a chunk (byte-shuffled and compressed, see header), replacing the file atomically
+
+    :param chunk_idx: (frame chunk, row chunk, col chunk)
+    :param chunk_array: array with the chunk shape and dtype (see get_chunk_shape_and_fill_value)
+    """
+    chunk_bytes = np.frombuffer(chunk_array.tobytes(), dtype=np.uint8).reshape(-1, chunk_array.dtype.itemsize)
+    write_file_atomically(os.path.join(store_dict['store_path'], array_str, '{}.{}.{}'.format(*chunk_idx)),
+                          zlib.compress(np.ascontiguousarray(chunk_bytes.T).tobytes(), zlib_level))
+
+
+def write_frames(store_dict,
+                 frames_array,
+                 arrays_dict,
+                 zlib_level=6):
+    """
+    Write frames to the store (in any order; frames already written are overwritten)
+
+    :param store_dict: see open_trial_store
+    :param frames_array: frame numbers, array of shape (n,)
+    :param arrays_dict: dict with an array of shape (n, n_rows, n_cols[, n_channels]) per array in the store. They are
+        converted to the store's dtypes (float values too large for float16 become inf; integer dtypes are rounded)
+    :param zlib_level: zlib compression level of the chunks
+    """
+    frames_per_chunk, tile_rows, tile_cols = store_dict['chunk_shape']
+    n_rows, n_cols = store_dict['image_shape']
+    idcs_frames = np.asarray(frames_array) - store_dict['frame_start_end'][0]
+    if np.any(idcs_frames < 0) or np.any(idcs_frames >= len(store_dict['frames_written'])):
+        sys.exit('ERROR in trial_store: frames {} out of the store range {}'.format(frames_array,
+                                                                                  store_dict['frame_start_end']))
+
+    for array_str, values_array in arrays_dict.items():
+        _, dtype, _ = get_chunk_shape_and_fill_value(store_dict, array_str)
+        with np.errstate(over='ignore', invalid='ignore'):
+            values_array = np.asarray(values_array)
+            if not np.issubdtype(dtype, np.floating):
+                values_array = np.round(values_array)
+            values_array = values_array.astype(dtype)
+
+        # every chunk with some of the frames: read it, update the frames and write it back
+        for frame_chunk in np.unique(idcs_frames // frames_per_chunk):
+            flag_in_chunk = idcs_frames // frames_per_chunk == frame_chunk
+            idcs_in_chunk = idcs_frames[flag_in_chunk] - frame_chunk * frames_per_chunk
+            for row_chunk in range(-(-n_rows // tile_rows)):
+                for col_chunk in range(-(-n_cols // tile_cols)):
+                    chunk_idx = (int(frame_chunk), row_chunk, col_chunk)
+                    chunk_array = read_chunk(store_dict, array_str, chunk_idx)
+                    row_0, col_0 = row_chunk * tile_rows, col_chunk * tile_cols
+                    tile_values = values_array[flag_in_chunk, row_0:row_0 + tile_rows, col_0:col_0 + tile_cols]
+                    chunk_array[idcs_in_chunk, :tile_values.shape[1], :tile_values.shape[2]] = tile_values
+                    write_chunk(store_dict, array_str, chunk_idx, chunk_array, zlib_level)
+
+    store_dict['frames_written'][idcs_frames] = True
+    with tempfile.NamedTemporaryFile(dir=store_dict['store_path'], prefix='.tmp_', delete=False) as f:
+        np.save(f, store_dict['frames_written'])
+    os.replace(f.name, os.path.join(store_dict['store_path'], TRIAL_STORE_FRAMES_WRITTEN_FILENAME))
+
+
+def read_array(store_dict,
+               array_str,
+               frame_start_end=None,
+               row_start_end=None,
+               col_start_end=None):
+    """
+    Read a block of an array of the store (only the chunks that overlap the block are decompressed)
+
+    :param store_dict: see open_trial_store
+    :param array_str: e.g. 'depth', 'object_index' or 'flow'
+    :param frame_start_end: first and last frame (included); default: all frames of the store
+    :param row_start_end: first and last row (excluded); default: all rows
+    :param col_start_end: first and last col (excluded); default: all cols
+    :return: array of shape (n_frames, n_rows, n_cols[, n_channels]) with the store's dtype
+        (frames not written have the fill value)
+    """
+    chunk_shape, dtype, _ = get_chunk_shape_and_fill_value(store_dict, array_str)
+    frames_per_chunk, tile_rows, tile_cols = store_dict['chunk_shape']
+    frame_start_end = frame_start_end if frame_start_end is not None else store_dict['frame_start_end']
+    idx_frame_start = frame_start_end[0] - store_dict['frame_start_end'][0]
+    idx_frame_end = frame_start_end[1] - store_dict['frame_start_end'][0] + 1
+    row_start, row_end = row_start_end if row_start_end is not None else (0, store_dict['image_shape'][0])
+    col_start, col_end = col_start_end if col_start_end is not None else (0, store_dict['image_shape'][1])
+    if idx_frame_start < 0 or idx_frame_end > len(store_dict['frames_written']):
+        sys.exit('ERROR in trial_store: frames {} out of the store range {}'.format(frame_start_end,
+                                                                                  store_dict['frame_start_end']))
+
+    output_array = np.empty((idx_frame_end - idx_frame_start, row_end - row_start, col_end - col_start)
+                            + chunk_shape[3:], dtype=dtype)
+    for frame_chunk in range(idx_frame_start // frames_per_chunk, -(-idx_frame_end // frames_per_chunk)):
+        for row_chunk in range(row_start // tile_rows, -(-row_end // tile_rows)):
+            for col_chunk in range(col_start // tile_cols, -(-col_end // tile_cols)):
+                chunk_array = read_chunk(store_dict, array_str, (frame_chunk, row_chunk, col_chunk))
+                # overlap of the chunk and the block, in image coords
+                f0, f1 = max(idx_frame_start, frame_chunk * frames_per_chunk), min(idx_frame_end, (frame_chunk + 1) * frames_per_chunk)
+                r0, r1 = max(row_start, row_chunk * tile_rows), min(row_end, (row_chunk + 1) * tile_rows)
+                c0, c1 = max(col_start, col_chunk * tile_cols), min(col_end, (col_chunk + 1) * tile_cols)
+                output_array[f0 - idx_frame_start:f1 - idx_frame_start,
+                             r0 - row_start:r1 - row_start,
+                             c0 - col_start:c1 - col_start] = \
+                    chunk_array[f0 - frame_chunk * frames_per_chunk:f1 - frame_chunk * frames_per_chunk,
+                                r0 - row_chunk * tile_rows:r1 - row_chunk * tile_rows,
+                                c0 - col_chunk * tile_cols:c1 - col_chunk * tile_cols]
+    return output_array
+
+
+def get_pixels_in_lon_lat_window(store_dict,
+                                 longitude_min_max_in_rad,
+                                 latitude_min_max_in_rad):
+    """
+    Get the pixels whose rays are within a window of longitude and latitude (in camera RF, see ray_tables)
+
+    :param store_dict: see open_trial_store
+    :param longitude_min_max_in_rad: longitude range; if min > max, the window wraps around +-pi
+    :param latitude_min_max_in_rad: latitude range
+    :return: (row_start, row_end), (col_start, col_end) of the bounding box of the pixels in the window, and a bool
+        array with the shape of the bounding box, True for the pixels in the window
+    """
+    ray_table = ray_tables.compute_ray_table(store_dict['camera_projection_params'])
+    longitude = np.arctan2(-ray_table[..., 0], -ray_table[..., 2])
+    latitude = np.arcsin(np.clip(ray_table[..., 1], -1, 1))
+    longitude_min, longitude_max = longitude_min_max_in_rad
+    with np.errstate(invalid='ignore'):
+        if longitude_min <= longitude_max:
+            flag_in_window = (longitude >= longitude_min) & (longitude <= longitude_max)
+        else:
+            flag_in_window = (longitude >= longitude_min) | (longitude <= longitude_max)
+        flag_in_window &= (latitude >= latitude_min_max_in_rad[0]) & (latitude <= latitude_min_max_in_rad[1])
+    if not np.any(flag_in_window):
+        sys.exit('ERROR in trial_store: no pixels in the window of longitude {} and latitude {}'
+                 .format(longitude_min_max_in_rad, latitude_min_max_in_rad))
+    idcs_rows = np.flatnonzero(np.any(flag_in_window, axis=1))
+    idcs_cols = np.flatnonzero(np.any(flag_in_window, axis=0))
+    row_start_end = (int(idcs_rows[0]), int(idcs_rows[-1]) + 1)
+    col_start_end = (int(idcs_cols[0]), int(idcs_cols[-1]) + 1)
+    return row_start_end, col_start_end, flag_in_window[row_start_end[0]:row_start_end[1],
+                                                        col_start_end[0]:col_start_end[1]]
+
+
+def read_array_in_lon_lat_window(store_dict,
+                                 array_str,
+                                 longitude_min_max_in_rad,
+                                 latitude_min_max_in_rad,
+                                 frame_start_end=None):
+    """
+    Read the pixels of an array in a window of longitude and latitude (see get_pixels_in_lon_lat_window)
+
+    :return: array with the bounding box of the window (see read_array), with the fill value for the pixels
+        outside the window, and (row_start, row_end), (col_start, col_end) of the bounding box
+    """
+    row_start_end, col_start_end, flag_in_window = get_pixels_in_lon_lat_window(store_dict,
+                                                                                longitude_min_max_in_rad,
+                                                                                latitude_min_max_in_rad)
+    output_array = read_array(store_dict,
+                              array_str,
+                              frame_start_end,
+                              row_start_end,
+                              col_start_end)
+    _, _, fill_value = get_chunk_shape_and_fill_value(store_dict, array_str)
+    output_array[:, ~flag_in_window] = fill_value
+    return output_array, row_start_end, col_start_end
+
+
+def get_rendered_frames(render_output_dir_path):
+    """
+    Get the EXR files of a render output dir that are complete: those in the render manifest with their size
+    unchanged (if the batch was run with run_rendering.py), or all the EXR files otherwise
+
+    :param render_output_dir_path: path to render output dir
+    :return: dict with the frame as key and the path to its EXR file as value
+    """
+    dict_frame_to_path = {}
+    if os.path.isfile(os.path.join(render_output_dir_path, RENDER_MANIFEST_FILENAME)):
+        for filename, manifest_entry in read_render_manifest(render_output_dir_path).items():
+            exr_path = os.path.join(render_output_dir_path, filename)
+            if filename.endswith('.exr') and manifest_entry['frame'] is not None and os.path.isfile(exr_path) \
+                    and os.path.getsize(exr_path) == manifest_entry['size_in_bytes']:
+                dict_frame_to_path[manifest_entry['frame']] = exr_path
+    else:
+        for exr_path in glob.glob(os.path.join(render_output_dir_path, '*.exr')):
+            match = re.search(r'(\d+)$', os.path.splitext(os.path.basename(exr_path))[0])
+            if match:
+                dict_frame_to_path[int(match.group(1))] = exr_path
+    return dict_frame_to_path
+
+
+def consolidate_trial_renders(render_output_dir_path,
+                              store_path,
+                              input_config,
+                              flag_verbose=True):
+    """
+    Add the frames rendered in render_output_dir_path that are not in the store yet (the store is created with the
+    passes in the first EXR file, if it does not exist). It can be run again as more frames finish rendering
+
+    The frames are read and written in groups of the frames of each frame chunk, so that each chunk is written once
+    per call if all its frames are rendered.
+
+    :param render_output_dir_path: path to render output dir, with one multilayer EXR file per frame
+    :param store_path: path to the store folder
+    :param input_config: config (frame range, chunk shape, dtypes and camera projection)
+    :param flag_verbose: if True, print the progress
+    :return: store_dict (see open_trial_store), and list of the frames added
+    """
+    dict_frame_to_path = get_rendered_frames(render_output_dir_path)
+    frame_start, frame_end = [int(f) for f in input_config.animation_frame_start_end]
+    dict_frame_to_path = {k: v for k, v in dict_frame_to_path.items() if frame_start <= k <= frame_end}
+    if not dict_frame_to_path:
+        if flag_verbose:
+            print('No rendered frames in {}'.format(render_output_dir_path))
+        return (open_trial_store(store_path) if os.path.isdir(store_path) else None), []
+
+    ### Create store (with the passes in the first EXR file)
+    if not os.path.isfile(os.path.join(store_path, TRIAL_STORE_METADATA_FILENAME)):
+        header_dict = exr_reader.read_exr_header(dict_frame_to_path[min(dict_frame_to_path)])
+        list_channel_names = [c['name'] for c in header_dict['channels']]
+        dict_array_str_to_n_channels = {}
+        for array_str, pass_str in DICT_ARRAY_STR_TO_EXR_PASS_STR.items():
+            n_channels = len([n for n in list_channel_names if n.split('.')[-2:-1] == [pass_str]])
+            if n_channels:
+                dict_array_str_to_n_channels[array_str] = n_channels if n_channels > 1 else None
+        store_dict = create_trial_store(store_path,
+                                        header_dict['image_shape'],
+                                        (frame_start, frame_end),
+                                        dict_array_str_to_n_channels,
+                                        input_config)
+    else:
+        store_dict = open_trial_store(store_path)
+
+    ### Add the frames not written yet, per frame chunk
+    list_frames_to_add = sorted(f for f in dict_frame_to_path
+                                if not store_dict['frames_written'][f - frame_start])
+    frames_per_chunk = store_dict['chunk_shape'][0]
+    list_frame_groups = {}
+    for frame in list_frames_to_add:
+        list_frame_groups.setdefault((frame - frame_start) // frames_per_chunk, []).append(frame)
+    for n_group, list_frames in enumerate(list_frame_groups.values(), start=1):
+        list_passes_dicts = [exr_reader.read_exr_passes(dict_frame_to_path[frame],
+                                                        [DICT_ARRAY_STR_TO_EXR_PASS_STR[a] for a in store_dict['arrays']])
+                             for frame in list_frames]
+        write_frames(store_dict,
+                     np.array(list_frames),
+                     {array_str: np.stack([d[DICT_ARRAY_STR_TO_EXR_PASS_STR[array_str]] for d in list_passes_dicts])
+                      for array_str in store_dict['arrays']})
+        if flag_verbose:
+            print('    added frames {}-{} ({}/{} frame chunks)'.format(list_frames[0],
+                                                                       list_frames[-1],
+                                                                       n_group,
+                                                                       len(list_frame_groups)))
+    return store_dict, list_frames_to_add
+
+
+if __name__ == '__main__':
+    # consolidate the renders of a trial (e.g. while they are rendering: run again, or with a poll interval in s):
+    #     python trial_store.py <input json> <render output dir> [<store path>] [--poll <s>]
+    # (default store path: <render output dir>/<render output dir name>_store)
+    import argparse
+    import time
+    import config
+
+    parser = argparse.ArgumentParser(description='Consolidate the rendered EXR files of a trial in a chunked array store')
+    parser.add_argument('input_json_path',
+                        help='Path to input json file of the trial')
+    parser.add_argument('render_output_dir_path',
+                        help='Path to the render output dir of the trial')
+    parser.add_argument('store_path', nargs='?', default=None,
+                        help='Path to the store folder')
+    parser.add_argument('--poll', type=float, default=None,
+                        help='If given, check for new frames every POLL seconds until all frames are in the store')
+    args = parser.parse_args()
+
+    input_config = config.config(args.input_json_path)
+    store_path = args.store_path or os.path.join(args.render_output_dir_path,
+                                                 os.path.basename(os.path.normpath(args.render_output_dir_path)) + '_store')
+    while True:
+        t0 = time.perf_counter()
+        store_dict, list_frames_added = consolidate_trial_renders(args.render_output_dir_path,
+                                                                  store_path,
+                                                                  input_config)
+        if list_frames_added:
+            print('{} frames added to {} in {:.1f} s'.format(len(list_frames_added), store_path, time.perf_counter() - t0))
+        if args.poll is None or (store_dict is not None and np.all(store_dict['frames_written'])):
+            break
+        time.sleep(args.poll)
@@ -0,0 +1,920 @@
+"""
+Batch rendering of trials, with a pool of parallel Blender processes
+
+This script (Python version of run_rendering.sh):
+- runs the Python-Blender script that sets up the Blender scene and defines the camera keyframes, for each input json
+  file in the specified directory (files starting with 'template_dict_' are skipped)
+- renders the scene using Cycles engine, either the range of frames suggested in the input json
+  (suggested_frame_range_for_cli_rendering_leg_1 and _leg_2, default) or the complete animation (with -a)
+
+Differences with run_rendering.sh:
+- N Blender processes run concurrently (-w)
+- the output of each Blender process is streamed to its own log file as it runs
+- failed jobs are retried (-r)
+- the status of every job is written to a json summary file in the logs directory (rather than grepping
+  the first 'Saved:' line of the Blender output)
+- the frame ranges of each trial can be split into K contiguous chunks (-k), each rendered by its own Blender process
+  into the same output dir. The summary then checks that every requested frame was saved exactly once. Each process
+  gets its shard id (--shard_id), and saves its profiling json per shard.
+- every saved image is added to a manifest in its render output dir (render_manifest.jsonl, with file size and
+  sha256 checksum). An interrupted batch can be resumed (--resume with the same -l): only the frames missing or
+  corrupt in the output dirs of the previous batch are rendered, into the same output dirs
+- with --server, each of the N Blender processes (-w) is a long-lived render worker (see 01_analysis/render_worker.py)
+  that takes the jobs from a local queue in the logs directory, so Blender startup and module imports are paid once
+  per worker rather than once per job, and the environment is only rebuilt when the geometry changes
+- with --incremental, the frames whose inputs (scene, render settings and camera pose) did not change since the
+  previous render of the trial are linked from its output dir, and only the frames that changed are rendered
+  (see 01_analysis/render_dependencies.py)
+
+------------------------------------------------------------------------
+Example
+------------------------------------------------------------------------
+    python run_rendering.py -j ./00_data/config_input_files -w 2 -r 1
+
+All options:
+    -p: path to Blender-Python script (default: ./01_analysis/main.py)
+    -j: path to directory with input json files (default: ./00_data/config_input_files)
+    -a: if present, the whole animation is rendered, and the suggested range of frames in the input json is ignored
+    -w: number of Blender processes running at the same time (default: 1)
+    -r: number of times a failed job is retried (default: 0)
+    -k: number of chunks the frame ranges of each trial are split into (default: 1, i.e. no split)
+    -l: path to directory for the logs and the json summary (default: ./02_output/LOG_batch_rendering_<timestamp>)
+    --resume: if present, resume the batch with the logs dir given in -l
+    --incremental: if present, only the frames that changed since the previous render of each trial are rendered
+    --link_mode: how unchanged frames are carried forward with --incremental: hardlink, symlink or copy (default: hardlink)
+    --server: if present, the jobs are rendered by N long-lived Blender processes (render workers) taking them from a queue
+    --blender: path to Blender executable (default: 'blender', i.e. on the system path)
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+# render manifest helpers, shared with the modules in 01_analysis (standard library only)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '01_analysis'))
+from render_manifest import RENDER_MANIFEST_FILENAME, compute_file_sha256, read_render_manifest  # noqa: E402
+
+# Blender prints one line per saved image, e.g.: Saved: '/path/to/output/dir/0900.exr'
+# (if a preview is saved as well, there are two lines per frame)
+SAVED_LINE_REGEXP = re.compile(r"Saved: '(?P<path>[^']+)'")
+
+# lock for printing to the terminal from several threads
+print_lock = threading.Lock()
+# lock for appending to the render manifests from several threads
+manifest_lock = threading.Lock()
+
+
+def print_with_lock(msg):
+    with print_lock:
+        print(msg, flush=True)
+
+
+def get_list_of_input_json_paths(input_jsons_dir):
+    """
+    Get list of input json files in a directory (not recursive), excluding templates
+
+    :param input_jsons_dir: path to directory with input json files
+    :return: list_valid_json_paths, list_skipped_paths
+    """
+    list_valid_json_paths = []
+    list_skipped_paths = []
+    for f in sorted(os.listdir(input_jsons_dir)):
+        path = os.path.join(input_jsons_dir, f)
+        if not f.endswith('.json') or not os.path.isfile(path):
+            continue
+        if f.startswith('template_dict_'):
+            list_skipped_paths.append(path)
+        else:
+            list_valid_json_paths.append(path)
+    return list_valid_json_paths, list_skipped_paths
+
+
+def get_frame_ranges_from_input_json(json_path):
+    """
+    Get the suggested frame ranges for rendering, per leg, from an input json file
+
+    If the input json defines render_frame_step (e.g. for RGB renders at a lower frame rate than the data passes),
+    only every render_frame_step-th frame of each range is rendered (as Blender does with --render-anim).
+
+    :param json_path: path to input json file
+    :return: list of [first_frame, last_frame] (as ints), one per leg with a suggested range (or one per frame
+        with a frame step)
+    """
+    with open(json_path) as f:
+        input_json_dict = json.load(f)
+    frame_step = int(input_json_dict.get('render_frame_step', 1))
+    list_frame_ranges = []
+    for leg_str in ['suggested_frame_range_for_cli_rendering_leg_1',
+                    'suggested_frame_range_for_cli_rendering_leg_2']:
+        frame_range = input_json_dict.get(leg_str, [])
+        if frame_range:
+            if frame_step > 1:
+                list_frame_ranges += frames_to_frame_ranges(range(int(frame_range[0]), int(frame_range[1]) + 1, frame_step))
+            else:
+                list_frame_ranges.append([int(frame_range[0]), int(frame_range[1])])
+    return list_frame_ranges
+
+
+def frame_ranges_to_cli_str(list_frame_ranges):
+    """
+    Format a list of frame ranges for Blender's --render-frame argument (e.g. [[714, 1145], [1922, 2303]] -> '714..1145,1922..2303')
+    """
+    return ','.join('{}..{}'.format(f0, f1) for f0, f1 in list_frame_ranges)
+
+
+def frames_to_frame_ranges(list_frames):
+    """
+    Group a sorted list of frames into ranges of consecutive frames (e.g. [1, 2, 3, 7, 8] -> [[1, 3], [7, 8]])
+    """
+    list_frame_ranges = []
+    for f in list_frames:
+        if list_frame_ranges and f == list_frame_ranges[-1][1] + 1:
+            list_frame_ranges[-1][1] = f
+        else:
+            list_frame_ranges.append([f, f])
+    return list_frame_ranges
+
+
+def get_render_output_dir_path(input_json_dict,
+                               python_script_path):
+    """
+    Get the render output dir of a trial, as computed in config (render_output_parent_dir_path)
+
+    The input json must define render_output_parent_dir_str (see write_input_json_with_fixed_output_dir).
+    Relative paths in the input json are relative to the dir of the Blender-Python script (main.py changes
+    the working directory to it).
+
+    :param input_json_dict: dict from input json file
+    :param python_script_path: path to Blender-Python script
+    :return: absolute path to render output dir
+    """
+    modules_path = os.path.dirname(os.path.abspath(python_script_path))
+    if 'render_output_parent_dir_path' in input_json_dict:
+        output_dir_path = input_json_dict['render_output_parent_dir_path']
+    else:
+        parent_dir_path = input_json_dict.get('parent_dir_path', os.path.dirname(modules_path))
+        output_folder_path = input_json_dict.get('output_folder_path', os.path.join(parent_dir_path, '02_output'))
+        output_dir_path = os.path.join(output_folder_path, input_json_dict['render_output_parent_dir_str'])
+    return os.path.normpath(os.path.join(modules_path, output_dir_path))
+
+
+def append_to_render_manifest(saved_path):
+    """
+    Add a saved image to the manifest of its render output dir, with its size and sha256 checksum
+
+    The manifest is a json-lines file, with one entry per saved image (if an image is saved again, the last entry
+    is the valid one). Appending one line per image means a crash can at most leave the last line truncated
+    (see read_render_manifest).
+
+    :param saved_path: path to saved image (from the 'Saved:' line of the Blender output)
+    :return:
+    """
+    try:
+        manifest_entry = {'filename': os.path.basename(saved_path),
+                          'frame': get_frame_from_saved_path(saved_path),
+                          'size_in_bytes': os.path.getsize(saved_path),
+                          'sha256': compute_file_sha256(saved_path),
+                          'time': datetime.now().isoformat(timespec='seconds')}
+    except OSError as e:
+        print_with_lock('WARNING: {} not added to render manifest ({})'.format(saved_path, e))
+        return
+    with manifest_lock:
+        with open(os.path.join(os.path.dirname(saved_path), RENDER_MANIFEST_FILENAME), 'a') as f:
+            f.write(json.dumps(manifest_entry) + '\n')
+
+
+def get_frames_to_render(list_frame_ranges,
+                         output_dir_path):
+    """
+    Get the frames in list_frame_ranges that are missing or corrupt in the render output dir
+
+    A frame is complete if, for every file extension in the manifest (e.g. .exr, and .jpg if previews are saved),
+    its image is in the manifest and the file on disk has the same size and sha256 checksum as recorded.
+
+    :param list_frame_ranges: list of [first_frame, last_frame] requested
+    :param output_dir_path: path to render output dir
+    :return: list_frames_to_render (sorted), n_corrupt_frames
+    """
+    manifest_dict = read_render_manifest(output_dir_path)
+    list_extensions = sorted(set(os.path.splitext(fn)[1] for fn in manifest_dict.keys()))
+    dict_frame_to_entries = dict()
+    for manifest_entry in manifest_dict.values():
+        dict_frame_to_entries.setdefault(manifest_entry['frame'], []).append(manifest_entry)
+
+    list_frames_to_render = []
+    n_corrupt_frames = 0
+    for frame in sorted(set(f for f0, f1 in list_frame_ranges for f in range(f0, f1 + 1))):
+        list_entries = dict_frame_to_entries.get(frame, [])
+        if not list_entries or \
+                sorted(os.path.splitext(e['filename'])[1] for e in list_entries) != list_extensions:
+            list_frames_to_render.append(frame)
+            continue
+        for manifest_entry in list_entries:
+            file_path = os.path.join(output_dir_path, manifest_entry['filename'])
+            if not os.path.isfile(file_path) or \
+                    os.path.getsize(file_path) != manifest_entry['size_in_bytes'] or \
+                    compute_file_sha256(file_path) != manifest_entry['sha256']:
+                list_frames_to_render.append(frame)
+                n_corrupt_frames += 1
+                break
+    return list_frames_to_render, n_corrupt_frames
+
+
+def run_render_dependencies(json_path,
+                            python_script_path,
+                            result_json_path,
+                            link_mode='hardlink'):
+    """
+    Prepare the render output dir of a trial for an incremental render: link the frames whose inputs did not change
+    since the previous render of the trial (see render_dependencies.prepare_incremental_render)
+
+    render_dependencies.py is run (with this Python interpreter, no Blender required) from the dir of the
+    Blender-Python script, as the paths in the input json are relative to it.
+
+    :param json_path: path to input json file (with a fixed render output dir)
+    :param python_script_path: path to Blender-Python script (render_dependencies.py is in the same dir)
+    :param result_json_path: path to json file for the result
+    :param link_mode: 'hardlink', 'symlink' or 'copy'
+    :return: result_dict (see render_dependencies.prepare_incremental_render), or None if it failed
+    """
+    modules_dir_path = os.path.dirname(os.path.abspath(python_script_path))
+    completed_process = subprocess.run([sys.executable,
+                                        os.path.join(modules_dir_path, 'render_dependencies.py'),
+                                        json_path,
+                                        '--link_mode', link_mode,
+                                        '--result_json', result_json_path],
+                                       cwd=modules_dir_path,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       universal_newlines=True)
+    print(completed_process.stdout, end='')
+    if completed_process.returncode != 0 or not os.path.isfile(result_json_path):
+        return None
+    with open(result_json_path) as f:
+        return json.load(f)
+
+
+def get_blender_command(blender_path,
+                        python_script_path,
+                        json_path,
+                        list_frame_ranges=None,
+                        shard_id=None):
+    """
+    Get the command to run Blender in background mode with the Blender-Python script and an input json file
+
+    :param blender_path: path to Blender executable
+    :param python_script_path: path to Blender-Python script
+    :param json_path: path to input json file
+    :param list_frame_ranges: list of frame ranges to render; if None the complete animation is rendered (--render-anim)
+    :param shard_id: if not None, id of the chunk of frames of the trial (-k), passed to the Blender-Python script so
+        that the files that differ per process are saved per shard
+    :return: command as list of str
+    """
+    cmd = [blender_path, '--background', '--python', python_script_path]
+    if list_frame_ranges is None:
+        cmd += ['--render-anim']
+    else:
+        cmd += ['--render-frame', frame_ranges_to_cli_str(list_frame_ranges)]
+    cmd += ['--', json_path]
+    if shard_id is not None:
+        cmd += ['--shard_id', shard_id]
+    return cmd
+
+
+def run_job(job_dict,
+            n_retries):
+    """
+    Run a Blender job, streaming its output to the job's log file, and retrying it if it fails
+
+    A job is successful if Blender exits with status 0 and at least one image is saved to an output directory
+    other than 'tmp' (as in run_rendering.sh).
+
+    :param job_dict: dict with 'job_id', 'cmd' and 'log_path'
+    :param n_retries: number of times the job is retried if it fails
+    :return: job_result_dict
+    """
+    job_result_dict = dict(job_dict)
+    job_result_dict['attempts'] = []
+
+    for attempt in range(n_retries + 1):
+        start_time = datetime.now()
+        list_saved_paths = []
+        # append to log, so that the output of previous attempts is kept
+        with open(job_dict['log_path'], 'a') as log_file:
+            log_file.write('##### Attempt {} [{}]: {}\n'.format(attempt + 1,
+                                                                 start_time.isoformat(timespec='seconds'),
+                                                                 subprocess.list2cmdline(job_dict['cmd'])))
+            log_file.flush()
+            try:
+                process = subprocess.Popen(job_dict['cmd'],
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT,
+                                           universal_newlines=True,
+                                           bufsize=1)
+                for line in process.stdout:
+                    log_file.write(line)
+                    log_file.flush()
+                    match = SAVED_LINE_REGEXP.search(line)
+                    if match:
+                        list_saved_paths.append(match.group('path'))
+                        append_to_render_manifest(match.group('path'))
+                return_code = process.wait()
+            except OSError as e:
+                log_file.write('ERROR: could not run Blender ({})\n'.format(e))
+                return_code = None
+
+        # Get render output dir from first saved image
+        output_dir_path = os.path.dirname(list_saved_paths[0]) if list_saved_paths else ''
+        flag_success = (return_code == 0) and \
+                       (os.path.basename(output_dir_path) not in ['tmp', ''])
+
+        job_result_dict['attempts'].append({'start_time': start_time.isoformat(timespec='seconds'),
+                                            'duration_in_s': (datetime.now() - start_time).total_seconds(),
+                                            'return_code': return_code,
+                                            'n_saved_images': len(list_saved_paths)})
+        job_result_dict['output_dir_path'] = output_dir_path
+        job_result_dict['list_saved_paths'] = list_saved_paths
+        job_result_dict['status'] = 'success' if flag_success else 'failed'
+
+        if flag_success:
+            print_with_lock('* [{}]: {} saved at {}'.format(datetime.now().strftime('%H:%M:%S'),
+                                                            job_dict['job_id'],
+                                                            output_dir_path))
+            break
+        elif attempt < n_retries:
+            print_with_lock('** [{}]: FAILED rendering {} (attempt {}), retrying'.format(datetime.now().strftime('%H:%M:%S'),
+                                                                                         job_dict['job_id'],
+                                                                                         attempt + 1))
+        else:
+            print_with_lock('** [{}]: FAILED rendering {}'.format(datetime.now().strftime('%H:%M:%S'),
+                                                                  job_dict['job_id']))
+
+    return job_result_dict
+
+
+def run_jobs(list_job_dicts,
+             n_workers,
+             n_retries):
+    """
+    Run a list of Blender jobs with a pool of n_workers concurrent processes
+
+    :param list_job_dicts: list of job dicts (see run_job)
+    :param n_workers: number of concurrent Blender processes
+    :param n_retries: number of times a failed job is retried
+    :return: list of job result dicts, in the same order as list_job_dicts
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        list_futures = [executor.submit(run_job, job_dict, n_retries)
+                        for job_dict in list_job_dicts]
+        return [f.result() for f in list_futures]
+
+
+def get_render_worker_command(blender_path,
+                              python_script_path,
+                              queue_dir_path,
+                              worker_id):
+    """
+    Get the command to run Blender in background mode with the Blender-Python script as a render worker of a queue
+
+    :return: command as list of str
+    """
+    return [blender_path, '--background', '--python', python_script_path,
+            '--', '--queue_dir', queue_dir_path, '--worker_id', worker_id]
+
+
+def run_jobs_with_render_server(list_job_dicts,
+                                n_workers,
+                                n_retries,
+                                blender_path,
+                                python_script_path,
+                                logs_dir_path,
+                                poll_interval_in_s=2.0):
+    """
+    Run a list of Blender jobs with n_workers long-lived Blender processes (render workers, see
+    01_analysis/render_worker.py) that take them from a queue in the logs dir (see 01_analysis/render_queue.py)
+
+    - the output of each worker is streamed to its own log file (LOG_worker_<i>.txt)
+    - the images saved by each job are added to the manifest of its render output dir when the job finishes
+    - failed jobs are submitted again (up to n_retries times)
+    - if a worker exits while rendering, its job fails and a new worker is started
+
+    :param list_job_dicts: list of job dicts (see get_list_of_trials)
+    :param n_workers: number of render workers
+    :param n_retries: number of times a failed job is retried
+    :param blender_path: path to Blender executable
+    :param python_script_path: path to Blender-Python script (render_queue.py is in the same dir)
+    :param logs_dir_path: path to logs dir
+    :param poll_interval_in_s: time between checks of the queue
+    :return: list of job result dicts, in the same order as list_job_dicts (as in run_jobs)
+    """
+    if not list_job_dicts:
+        return []
+    sys.path.insert(0, os.path.dirname(os.path.abspath(python_script_path)))
+    import render_queue
+
+    queue_dir_path = os.path.join(os.path.abspath(logs_dir_path), 'render_queue')
+    render_queue.create_queue(queue_dir_path)
+    if render_queue.is_stop_requested(queue_dir_path):
+        os.remove(os.path.join(queue_dir_path, render_queue.STOP_FILENAME))  # from a previous batch with this logs dir
+
+    dict_job_results = {job_dict['job_id']: dict(job_dict, attempts=[]) for job_dict in list_job_dicts}
+    for job_dict in list_job_dicts:
+        render_queue.submit_job(queue_dir_path,
+                                job_dict['job_id'],
+                                job_dict['json_path'],
+                                job_dict['list_frame_ranges'],
+                                attempt=0,
+                                shard_id=job_dict.get('shard_id'))
+
+    ### Start workers
+    dict_workers = dict()  # worker id: (process, log file)
+    max_n_workers_started = n_workers + len(list_job_dicts) * (n_retries + 1)
+
+    def start_worker():
+        worker_id = 'worker_{:02d}'.format(len(dict_workers) + n_workers_exited)
+        log_file = open(os.path.join(logs_dir_path, 'LOG_' + worker_id + '.txt'), 'a')
+        dict_workers[worker_id] = (subprocess.Popen(get_render_worker_command(blender_path,
+                                                                               python_script_path,
+                                                                               queue_dir_path,
+                                                                               worker_id),
+                                                     stdout=log_file,
+                                                     stderr=subprocess.STDOUT),
+                                   log_file)
+
+    n_workers_exited = 0
+    n_finished_jobs = 0
+    try:
+        for _ in range(max(min(n_workers, len(list_job_dicts)), 1)):
+            start_worker()
+
+        while n_finished_jobs < len(list_job_dicts):
+            ### Workers that exited: their running jobs fail
+            for worker_id, (process, log_file) in list(dict_workers.items()):
+                if process.poll() is not None:
+                    log_file.close()
+                    del dict_workers[worker_id]
+                    n_workers_exited += 1
+                    render_queue.fail_running_jobs_of_worker(queue_dir_path,
+                                                             worker_id,
+                                                             'render worker exited with code {}'.format(process.returncode))
+
+            ### Finished jobs
+            for result_dict in render_queue.collect_finished_jobs(queue_dir_path):
+                job_result_dict = dict_job_results[result_dict['job_id']]
+                list_saved_paths = result_dict.get('list_saved_paths', [])
+                for saved_path in list_saved_paths:
+                    append_to_render_manifest(saved_path)
+                output_dir_path = os.path.dirname(list_saved_paths[0]) if list_saved_paths else ''
+                flag_success = (result_dict['status'] == 'success') and \
+                               (os.path.basename(output_dir_path) not in ['tmp', ''])
+                job_result_dict['attempts'].append({'start_time': result_dict.get('start_time'),
+                                                    'duration_in_s': result_dict.get('duration_in_s'),
+                                                    'worker_id': result_dict.get('worker_id'),
+                                                    'flag_environment_reused': result_dict.get('flag_environment_reused'),
+                                                    'error': result_dict.get('error'),
+                                                    'n_saved_images': len(list_saved_paths)})
+                job_result_dict['log_path'] = os.path.join(logs_dir_path, 'LOG_{}.txt'.format(result_dict.get('worker_id')))
+                job_result_dict['output_dir_path'] = output_dir_path
+                job_result_dict['list_saved_paths'] = list_saved_paths
+                job_result_dict['status'] = 'success' if flag_success else 'failed'
+
+                attempt = result_dict.get('attempt', 0)
+                if flag_success:
+                    print_with_lock('* [{}]: {} saved at {}'.format(datetime.now().strftime('%H:%M:%S'),
+                                                                    result_dict['job_id'],
+                                                                    output_dir_path))
+                    n_finished_jobs += 1
+                elif attempt < n_retries:
+                    print_with_lock('** [{}]: FAILED rendering {} (attempt {}), retrying'.format(datetime.now().strftime('%H:%M:%S'),
+                                                                                                 result_dict['job_id'],
+                                                                                                 attempt + 1))
+                    render_queue.submit_job(queue_dir_path,
+                                            result_dict['job_id'],
+                                            result_dict['json_path'],
+                                            result_dict['list_frame_ranges'],
+                                            attempt=attempt + 1,
+                                            shard_id=result_dict.get('shard_id'))
+                else:
+                    print_with_lock('** [{}]: FAILED rendering {}'.format(datetime.now().strftime('%H:%M:%S'),
+                                                                          result_dict['job_id']))
+                    n_finished_jobs += 1
+
+            ### Replace workers that exited (while there are jobs left)
+            n_jobs_left = len(list_job_dicts) - n_finished_jobs
+            while n_jobs_left and len(dict_workers) < min(n_workers, n_jobs_left) and \
+                    len(dict_workers) + n_workers_exited < max_n_workers_started:
+                start_worker()
+            if n_jobs_left and not dict_workers:
+                print_with_lock('** [{}]: no render workers left, {} jobs not rendered'.format(datetime.now().strftime('%H:%M:%S'),
+                                                                                            n_jobs_left))
+                for job_result_dict in dict_job_results.values():
+                    job_result_dict.setdefault('status', 'failed')
+                break
+            if n_jobs_left:
+                time.sleep(poll_interval_in_s)
+    finally:
+        ### Stop workers
+        render_queue.request_stop(queue_dir_path)
+        for process, log_file in dict_workers.values():
+            if n_finished_jobs < len(list_job_dicts):
+                process.terminate()  # interrupted batch
+            process.wait()
+            log_file.close()
+
+    return [dict_job_results[job_dict['job_id']] for job_dict in list_job_dicts]
+
+
+def split_frame_ranges_into_chunks(list_frame_ranges,
+                                   n_chunks):
+    """
+    Split a list of frame ranges (both ends inclusive) into n_chunks contiguous chunks with (approx.) the same number
+    of frames. A chunk may span several ranges (e.g. the end of leg 1 and the start of leg 2).
+
+    E.g.: [[714, 1145], [1922, 2303]] in 2 chunks -> [[[714, 1120]], [[1121, 1145], [1922, 2303]]]
+
+    :param list_frame_ranges: list of [first_frame, last_frame]
+    :param n_chunks: number of chunks (if larger than the number of frames, there is one chunk per frame)
+    :return: list of chunks, each a list of frame ranges
+    """
+    list_frames = [f for f0, f1 in list_frame_ranges for f in range(f0, f1 + 1)]
+    n_chunks = max(min(n_chunks, len(list_frames)), 1)
+
+    list_chunks = []
+    for i in range(n_chunks):
+        list_frames_in_chunk = list_frames[(i * len(list_frames)) // n_chunks:
+                                           ((i + 1) * len(list_frames)) // n_chunks]
+        list_chunks.append(frames_to_frame_ranges(list_frames_in_chunk))
+    return list_chunks
+
+
+def write_input_json_with_fixed_output_dir(json_path,
+                                           output_json_path,
+                                           timestamp,
+                                           flag_resume=False):
+    """
+    Write a copy of an input json file with a fixed render output dir (render_output_parent_dir_str), so that several
+    Blender processes rendering parts of the same trial write to the same dir, and a resumed batch writes to the
+    dir of the interrupted one.
+    (by default, config adds the timestamp at which each process starts to the output dir)
+
+    If the input json already defines render_output_parent_dir_str, it is kept. If flag_resume is True and the copy
+    already exists (from a previous batch with the same logs dir), its render_output_parent_dir_str is kept.
+
+    :param json_path: path to input json file
+    :param output_json_path: path to the copy of the input json file
+    :param timestamp: timestamp str for the output dir
+    :param flag_resume: if True, reuse the output dir of an existing copy
+    :return: input_json_dict (with render_output_parent_dir_str)
+    """
+    with open(json_path) as f:
+        input_json_dict = json.load(f)
+    if flag_resume and os.path.isfile(output_json_path):
+        with open(output_json_path) as f:
+            input_json_dict.setdefault('render_output_parent_dir_str',
+                                       json.load(f)['render_output_parent_dir_str'])
+    input_json_dict.setdefault('render_output_parent_dir_str',
+                               '_'.join([input_json_dict['trial_str'],
+                                         input_json_dict['render_output_suffix'],
+                                         timestamp]))
+    with open(output_json_path, 'w') as f:
+        json.dump(input_json_dict, f, indent=4)
+    return input_json_dict
+
+
+def get_list_of_trials(list_json_paths,
+                       python_script_path,
+                       blender_path,
+                       logs_dir_path,
+                       flag_render_complete_animation,
+                       n_shards_per_trial,
+                       timestamp,
+                       flag_resume=False,
+                       flag_incremental=False,
+                       link_mode='hardlink'):
+    """
+    Get one trial dict per input json file, each with the list of Blender jobs to render it
+
+    All jobs of a trial use a copy of the input json with a fixed render output dir (saved in the logs dir)
+    - If flag_incremental is True: the frames that did not change since the previous render of the trial are linked
+    to the render output dir (see run_render_dependencies), and only the rest are rendered. If the complete animation
+    is rendered, its frames are given explicitly.
+    - If flag_resume is True: only the frames that are missing or corrupt in the render output dir of the previous
+    batch (with the same logs dir) are rendered (see get_frames_to_render)
+    - If n_shards_per_trial is 1 (or the complete animation is rendered): one job per trial
+    - Else: the frames to render are split into n_shards_per_trial contiguous chunks, one job per chunk
+
+    :return: list of trial dicts
+    """
+    os.makedirs(os.path.join(logs_dir_path, 'input_jsons'), exist_ok=True)
+    list_trial_dicts = []
+    for json_path in list_json_paths:
+        trial_id = os.path.splitext(os.path.basename(json_path))[0]
+        json_path_for_jobs = os.path.abspath(os.path.join(logs_dir_path, 'input_jsons', os.path.basename(json_path)))
+        input_json_dict = write_input_json_with_fixed_output_dir(json_path,
+                                                                 json_path_for_jobs,
+                                                                 timestamp,
+                                                                 flag_resume)
+        output_dir_path = get_render_output_dir_path(input_json_dict,
+                                                     python_script_path)
+        list_frame_ranges = None if flag_render_complete_animation else get_frame_ranges_from_input_json(json_path)
+
+        # link unchanged frames from the previous render of the trial
+        # (if it fails for this trial, only this trial is rendered in full)
+        flag_incremental_trial = flag_incremental
+        n_frames_carried_forward = 0
+        if flag_incremental_trial:
+            result_dict = run_render_dependencies(json_path_for_jobs,
+                                                  python_script_path,
+                                                  os.path.join(logs_dir_path, 'input_jsons',
+                                                               trial_id + '_render_dependencies.json'),
+                                                  link_mode)
+            if result_dict is None:
+                print('WARNING: incremental render of {} failed, all frames are rendered'.format(trial_id))
+                flag_incremental_trial = False
+            else:
+                n_frames_carried_forward = len(result_dict['frames_carried_forward'])
+                if list_frame_ranges is None:
+                    list_frame_ranges = frames_to_frame_ranges(result_dict['frames'][::int(input_json_dict.get('render_frame_step', 1))])
+
+        # get frames to render
+        list_frame_ranges_to_render = list_frame_ranges
+        n_corrupt_frames = 0
+        if flag_incremental_trial:
+            list_frames_to_render, n_corrupt_frames = get_frames_to_render(list_frame_ranges,
+                                                                           output_dir_path)
+            list_frame_ranges_to_render = frames_to_frame_ranges(list_frames_to_render)
+        elif flag_resume:
+            if list_frame_ranges is None:
+                print('WARNING: {} cannot be resumed (complete animation), all frames are rendered'.format(trial_id))
+            else:
+                list_frames_to_render, n_corrupt_frames = get_frames_to_render(list_frame_ranges,
+                                                                               output_dir_path)
+                list_frame_ranges_to_render = frames_to_frame_ranges(list_frames_to_render)
+
+        # split in chunks if required
+        if not list_frame_ranges_to_render and list_frame_ranges is not None:
+            list_chunks = []  # all frames already rendered (or no suggested frame range)
+        elif n_shards_per_trial > 1 and list_frame_ranges_to_render:
+            list_chunks = split_frame_ranges_into_chunks(list_frame_ranges_to_render,
+                                                         n_shards_per_trial)
+        else:
+            if n_shards_per_trial > 1:
+                print('WARNING: {} is not split in chunks (complete animation)'.format(trial_id))
+            list_chunks = [list_frame_ranges_to_render]
+
+        list_job_dicts = []
+        for i, list_frame_ranges_in_chunk in enumerate(list_chunks):
+            shard_id = None if len(list_chunks) == 1 else 'shard{:02d}'.format(i)
+            job_id = trial_id if shard_id is None else '{}_{}'.format(trial_id, shard_id)
+            list_job_dicts.append({'job_id': job_id,
+                                   'trial_str': input_json_dict.get('trial_str', ''),
+                                   'json_path': json_path_for_jobs,
+                                   'list_frame_ranges': list_frame_ranges_in_chunk,
+                                   'shard_id': shard_id,
+                                   'cmd': get_blender_command(blender_path,
+                                                              python_script_path,
+                                                              json_path_for_jobs,
+                                                              list_frame_ranges_in_chunk,
+                                                              shard_id),
+                                   'log_path': os.path.join(logs_dir_path, 'LOG_' + job_id + '.txt')})
+
+        list_trial_dicts.append({'trial_id': trial_id,
+                                 'trial_str': input_json_dict.get('trial_str', ''),
+                                 'json_path': os.path.abspath(json_path),
+                                 'render_output_dir_path': output_dir_path,
+                                 'list_frame_ranges': list_frame_ranges,
+                                 'list_frame_ranges_to_render': list_frame_ranges_to_render,
+                                 'n_corrupt_frames': n_corrupt_frames,
+                                 'n_frames_carried_forward': n_frames_carried_forward,
+                                 'jobs': list_job_dicts})
+    return list_trial_dicts
+
+
+def get_frame_from_saved_path(saved_path):
+    """
+    Get frame number from the path of a rendered image (Blender's default naming, e.g. '/path/0900.exr' -> 900)
+
+    :return: frame (int), or None if the file name does not end with a number
+    """
+    match = re.search(r'(\d+)$', os.path.splitext(os.path.basename(saved_path))[0])
+    return int(match.group(1)) if match else None
+
+
+def check_trial_frames(trial_dict,
+                       list_job_results):
+    """
+    Merge the saved images of all the jobs of a trial, and check that every frame to render was produced exactly once
+    (per file extension, e.g. .exr and the .jpg preview are checked separately) and in the trial's render output dir
+
+    If a resumed trial had no frames left to render, it is successful.
+
+    :param trial_dict: trial dict (see get_list_of_trials)
+    :param list_job_results: results of the jobs of this trial (see run_job)
+    :return: trial_result_dict
+    """
+    trial_result_dict = {k: v for k, v in trial_dict.items() if k != 'jobs'}
+    trial_result_dict['job_ids'] = [r['job_id'] for r in list_job_results]
+    list_saved_paths = [p for r in list_job_results for p in r.get('list_saved_paths', [])]
+    list_output_dirs = sorted(set(os.path.normpath(os.path.dirname(p)) for p in list_saved_paths))
+    trial_result_dict['output_dir_path'] = list_output_dirs[0] if len(list_output_dirs) == 1 else list_output_dirs
+
+    if not list_job_results:
+        trial_result_dict['status'] = 'success'
+        return trial_result_dict
+
+    flag_all_jobs_successful = all(r['status'] == 'success' for r in list_job_results)
+    flag_frames_ok = True
+    if trial_dict['list_frame_ranges_to_render'] is not None:
+        set_requested_frames = set(f for f0, f1 in trial_dict['list_frame_ranges_to_render'] for f in range(f0, f1 + 1))
+        dict_extension_to_frames_check = dict()
+        for ext in sorted(set(os.path.splitext(p)[1] for p in list_saved_paths)):
+            list_frames = [get_frame_from_saved_path(p) for p in list_saved_paths if os.path.splitext(p)[1] == ext]
+            dict_n_saved_per_frame = dict()
+            for f in list_frames:
+                dict_n_saved_per_frame[f] = dict_n_saved_per_frame.get(f, 0) + 1
+            dict_extension_to_frames_check[ext] = \
+                {'missing_frames': sorted(set_requested_frames - set(dict_n_saved_per_frame.keys())),
+                 'duplicated_frames': sorted(f for f, n in dict_n_saved_per_frame.items() if n > 1),
+                 'unexpected_frames': sorted((f for f in dict_n_saved_per_frame.keys()
+                                              if f not in set_requested_frames), key=str)}
+            flag_frames_ok = flag_frames_ok and not any(dict_extension_to_frames_check[ext].values())
+        if not dict_extension_to_frames_check:
+            flag_frames_ok = False
+        trial_result_dict['frames_check'] = dict_extension_to_frames_check
+
+    flag_frames_ok = flag_frames_ok and list_output_dirs == [trial_dict['render_output_dir_path']]
+    trial_result_dict['status'] = 'success' if (flag_all_jobs_successful and flag_frames_ok) else 'failed'
+    return trial_result_dict
+
+
+def write_summary(summary_dict,
+                  logs_dir_path):
+    """
+    Write json summary of the batch rendering
+
+    :return: path to summary json file
+    """
+    summary_path = os.path.join(logs_dir_path, 'batch_rendering_summary.json')
+    with open(summary_path, 'w') as f:
+        json.dump(summary_dict, f, indent=4)
+    return summary_path
+
+
+def get_parser():
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Batch rendering of trials with a pool of parallel Blender processes')
+    parser.add_argument('-p', dest='python_script_path',
+                        default=os.path.join(script_directory, '01_analysis', 'main.py'),
+                        help='Path to Blender-Python script')
+    parser.add_argument('-j', dest='input_jsons_dir',
+                        default=os.path.join(script_directory, '00_data', 'config_input_files'),
+                        help='Path to directory with input json files')
+    parser.add_argument('-a', dest='flag_render_complete_animation',
+                        action='store_true',
+                        help='If present, the whole animation is rendered, and the suggested range of frames in the input json is ignored')
+    parser.add_argument('-w', dest='n_workers',
+                        type=int, default=1,
+                        help='Number of Blender processes running at the same time')
+    parser.add_argument('-r', dest='n_retries',
+                        type=int, default=0,
+                        help='Number of times a failed job is retried')
+    parser.add_argument('-k', dest='n_shards_per_trial',
+                        type=int, default=1,
+                        help='Number of contiguous chunks the frame ranges of each trial are split into, '
+                             'each rendered by its own Blender process (into the same output dir)')
+    parser.add_argument('-l', dest='logs_dir_path',
+                        default=None,
+                        help='Path to directory for the logs of each job and the json summary')
+    parser.add_argument('--resume', dest='flag_resume',
+                        action='store_true',
+                        help='If present, resume the batch with the logs dir given in -l: only the frames missing or '
+                             'corrupt in its render output dirs (according to their manifests) are rendered')
+    parser.add_argument('--incremental', dest='flag_incremental',
+                        action='store_true',
+                        help='If present, the frames whose inputs did not change since the previous render of each '
+                             'trial are linked from its output dir, and only the rest are rendered')
+    parser.add_argument('--link_mode', dest='link_mode',
+                        default='hardlink', choices=['hardlink', 'symlink', 'copy'],
+                        help='How unchanged frames are carried forward with --incremental')
+    parser.add_argument('--server', dest='flag_render_server',
+                        action='store_true',
+                        help='If present, the jobs are rendered by -w long-lived Blender processes (render workers) '
+                             'that take them from a queue in the logs dir')
+    parser.add_argument('--blender', dest='blender_path',
+                        default='blender',
+                        help='Path to Blender executable')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    timestamp = datetime.today().strftime('%Y%m%d%H%M')
+    logs_dir_path = args.logs_dir_path or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                       '02_output',
+                                                       'LOG_batch_rendering_' + timestamp)
+    if args.flag_resume and not (args.logs_dir_path and os.path.isdir(os.path.join(args.logs_dir_path, 'input_jsons'))):
+        sys.exit('ERROR: --resume requires the logs dir of a previous batch (-l)')
+    os.makedirs(logs_dir_path, exist_ok=True)
+
+    ### Print batch rendering settings
+    print('------------------------------------------------------')
+    print('Batch rendering settings')
+    print(datetime.now().strftime('%x %X'))
+    print('------------------------------------------------------')
+    print('* Python script path: {}'.format(args.python_script_path))
+    print('* Input jsons directory: {}'.format(args.input_jsons_dir))
+    print('* Render complete animation: {}'.format(args.flag_render_complete_animation))
+    print('* Number of parallel Blender processes: {}'.format(args.n_workers))
+    print('* Number of retries per failed job: {}'.format(args.n_retries))
+    print('* Logs directory: {}'.format(logs_dir_path))
+    print('* Resume previous batch: {}'.format(args.flag_resume))
+    print('* Incremental render: {}'.format(args.flag_incremental))
+    print('* Render server (long-lived Blender processes): {}'.format(args.flag_render_server))
+
+    ### Get trials and jobs
+    list_json_paths, list_skipped_paths = get_list_of_input_json_paths(args.input_jsons_dir)
+    for path in list_skipped_paths:
+        print('WARNING: {} is not a valid input json file, skipped'.format(os.path.basename(path)))
+    list_trial_dicts = get_list_of_trials(list_json_paths,
+                                          args.python_script_path,
+                                          args.blender_path,
+                                          logs_dir_path,
+                                          args.flag_render_complete_animation,
+                                          args.n_shards_per_trial,
+                                          timestamp,
+                                          args.flag_resume,
+                                          args.flag_incremental,
+                                          args.link_mode)
+
+    ### Run jobs
+    print('------------------------------------------------------')
+    print('Start rendering...')
+    print('------------------------------------------------------')
+    start_time = datetime.now()
+    for trial_dict in list_trial_dicts:
+        if trial_dict['list_frame_ranges_to_render'] is None:
+            print('* Rendering full animation for {}'.format(trial_dict['trial_str']))
+        elif not trial_dict['jobs']:
+            print('* All frames already rendered for {}'.format(trial_dict['trial_str']))
+        else:
+            print('* Rendering the following range of frames for {}: {} ({} jobs)'.format(trial_dict['trial_str'],
+                                                                                          frame_ranges_to_cli_str(trial_dict['list_frame_ranges_to_render']),
+                                                                                          len(trial_dict['jobs'])))
+            if trial_dict['n_frames_carried_forward']:
+                print('  ({} unchanged frames linked from the previous render)'.format(trial_dict['n_frames_carried_forward']))
+            if trial_dict['n_corrupt_frames']:
+                print('  ({} frames re-rendered because their files do not match the manifest)'.format(trial_dict['n_corrupt_frames']))
+    if args.flag_render_server:
+        list_job_results = run_jobs_with_render_server([j for t in list_trial_dicts for j in t['jobs']],
+                                                       args.n_workers,
+                                                       args.n_retries,
+                                                       args.blender_path,
+                                                       args.python_script_path,
+                                                       logs_dir_path)
+    else:
+        list_job_results = run_jobs([j for t in list_trial_dicts for j in t['jobs']],
+                                    args.n_workers,
+                                    args.n_retries)
+
+    ### Merge results per trial
+    list_trial_results = []
+    for trial_dict in list_trial_dicts:
+        list_job_ids = [j['job_id'] for j in trial_dict['jobs']]
+        list_trial_results.append(check_trial_frames(trial_dict,
+                                                     [r for r in list_job_results if r['job_id'] in list_job_ids]))
+        if list_trial_results[-1]['status'] != 'success' and all(r['status'] == 'success'
+                                                                 for r in list_job_results if r['job_id'] in list_job_ids):
+            print('** {}: all jobs finished, but the frames check failed (see summary)'.format(trial_dict['trial_id']))
+
+    ### Write summary
+    n_successful = sum(r['status'] == 'success' for r in list_trial_results)
+    summary_dict = {'start_time': start_time.isoformat(timespec='seconds'),
+                    'duration_in_s': (datetime.now() - start_time).total_seconds(),
+                    'settings': vars(args),
+                    'n_trials': len(list_trial_results),
+                    'n_successful_trials': n_successful,
+                    'n_jobs': len(list_job_results),
+                    'n_successful_jobs': sum(r['status'] == 'success' for r in list_job_results),
+                    'skipped_json_paths': list_skipped_paths,
+                    'trials': list_trial_results,
+                    'jobs': list_job_results}
+    summary_path = write_summary(summary_dict,
+                                 logs_dir_path)
+
+    print('')
+    print('Successfully rendered trials (over total input json files): {}/{}'.format(n_successful,
+                                                                                     len(list_trial_results)))
+    print('Summary saved at {}'.format(summary_path))
+
+    return 0 if n_successful == len(list_trial_results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())